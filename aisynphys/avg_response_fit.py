@@ -15,7 +15,7 @@ from aisynphys.qc import spike_qc
 from aisynphys.fitting import fit_avg_pulse_response
 
 
-def get_pair_avg_fits(pair, session, notes_session=None, ui=None):
+def get_pair_avg_fits(pair, session, notes_session=None, ui=None, notes_rec=None):
     """Return PSP fits to averaged responses for this pair.
     
     Operations are:
@@ -23,6 +23,9 @@ def get_pair_avg_fits(pair, session, notes_session=None, ui=None):
     - sort responses by clamp mode and holding potential
     - generate average response for each mode/holding combination
     - fit averages to PSP curve
+
+    The pair_notes record for this pair is loaded from the notes DB unless it is given
+    as *notes_rec* (see data_notes_db.get_pair_notes_records).
     
     Returns
     -------
@@ -50,7 +53,8 @@ def get_pair_avg_fits(pair, session, notes_session=None, ui=None):
     sorted_responses = sort_responses(pulse_responses)
     prof('sort prs')
 
-    notes_rec = notes_db.get_pair_notes_record(pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id, session=notes_session)
+    if notes_rec is None:
+        notes_rec = notes_db.get_pair_notes_record(pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id, session=notes_session)
     prof('get pair notes')
 
     if ui is not None:
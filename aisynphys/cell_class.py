@@ -1,6 +1,7 @@
 
 from __future__ import print_function, division
 
+import numpy as np
 from sqlalchemy.orm import aliased
 from collections import OrderedDict
 from .database import default_db
@@ -170,6 +171,104 @@ class CellClass(object):
             
 
 
+class CellClassIndex(object):
+    """Vectorized evaluation of cell class membership for many cells.
+
+    Cell attributes are read once per cell into a table of integer-coded columns
+    (one column per attribute and per source object: cell, morphology, patch_seq).
+    Each CellClass criterion is then evaluated once per unique attribute value and
+    expanded to a boolean mask over all cells. The matching rules are identical to
+    ``cell in cell_class``.
+
+    Example::
+
+        index = CellClassIndex(cells)
+        pv_mask = index.mask(pv_class)
+        cell_groups = index.classify(cell_classes)
+    """
+    def __init__(self, cells):
+        self.cells = list(cells)
+        self._objs = [(cell, cell.morphology, cell.patch_seq) for cell in self.cells]
+        self._columns = {}
+
+    def _column(self, attr, slot):
+        """Return (has_attr, codes, unique_values) for one attribute of one source object
+        (0=cell, 1=morphology, 2=patch_seq) across all cells.
+        """
+        key = (attr, slot)
+        if key not in self._columns:
+            n = len(self.cells)
+            has_attr = np.zeros(n, dtype=bool)
+            codes = np.zeros(n, dtype=int)
+            uniques = []
+            lookup = {}
+            for i, objs in enumerate(self._objs):
+                obj = objs[slot]
+                if not hasattr(obj, attr):
+                    continue
+                has_attr[i] = True
+                val = getattr(obj, attr)
+                try:
+                    code = lookup.get(val)
+                    if code is None:
+                        code = lookup[val] = len(uniques)
+                        uniques.append(val)
+                except TypeError:
+                    # unhashable value; give it a code of its own
+                    code = len(uniques)
+                    uniques.append(val)
+                codes[i] = code
+            self._columns[key] = (has_attr, codes, uniques)
+        return self._columns[key]
+
+    def _match(self, attr, slot, test):
+        """Return (has_attr, match) boolean arrays for a single attribute test.
+        """
+        has_attr, codes, uniques = self._column(attr, slot)
+        matches = np.array([bool(test(val)) for val in uniques] + [False])
+        # cells lacking the attribute index the trailing False
+        codes = np.where(has_attr, codes, len(uniques))
+        return has_attr, matches[codes]
+
+    def mask(self, cell_class):
+        """Return a boolean array indicating which cells belong to *cell_class*.
+        """
+        n = len(self.cells)
+        mask = np.ones(n, dtype=bool)
+        for k, v in cell_class.criteria.items():
+            if isinstance(v, dict):
+                # any matching attribute on any object satisfies the criterion
+                crit = np.zeros(n, dtype=bool)
+                for k2, v2 in v.items():
+                    for slot in range(3):
+                        has_attr, match = self._match(k2, slot, lambda x: x == v2)
+                        crit |= match
+            else:
+                # only the first object that has the attribute is checked
+                if isinstance(v, tuple):
+                    test = lambda x: x in v
+                else:
+                    test = lambda x: not (x != v)
+                crit = np.zeros(n, dtype=bool)
+                found = np.zeros(n, dtype=bool)
+                for slot in range(3):
+                    has_attr, match = self._match(k, slot, test)
+                    first = has_attr & ~found
+                    crit[first] = match[first]
+                    found |= has_attr
+            mask &= crit
+        return mask
+
+    def classify(self, cell_classes):
+        """Return an OrderedDict mapping {cell_class: set(cells)}, as returned by classify_cells().
+        """
+        cell_groups = OrderedDict()
+        for cell_class in cell_classes:
+            mask = self.mask(cell_class)
+            cell_groups[cell_class] = set([self.cells[i] for i in np.argwhere(mask)[:, 0]])
+        return cell_groups
+
+
 def classify_cells(cell_classes, cells=None, pairs=None):
     """Given cell class definitions and a list of cells, return a dict indicating which cells
     are members of each class.
@@ -207,12 +306,7 @@ def classify_cells(cell_classes, cells=None, pairs=None):
     if pairs is not None:
         assert cells is None, "cells and pairs arguments are mutually exclusive"
         cells = set([p.pre_cell for p in pairs] + [p.post_cell for p in pairs])
-    cell_groups = OrderedDict([(cell_class, set()) for cell_class in cell_classes])
-    for cell in cells:
-        for cell_class in cell_classes:
-            if cell in cell_class:
-                cell_groups[cell_class].add(cell)
-    return cell_groups
+    return CellClassIndex(cells).classify(cell_classes)
 
 
 def classify_pairs(pairs, cell_groups):
@@ -233,10 +327,23 @@ def classify_pairs(pairs, cell_groups):
         Maps {(pre_class, post_class): [list of pairs]}
     """
     results = OrderedDict()
-    for pre_class, pre_group in cell_groups.items():
-        for post_class, post_group in cell_groups.items():
-            post_group = cell_groups[post_class]
-            class_pairs = [p for p in pairs if p.pre_cell in pre_group and p.post_cell in post_group]
-            results[(pre_class, post_class)] = class_pairs
+    for pre_class in cell_groups:
+        for post_class in cell_groups:
+            results[(pre_class, post_class)] = []
+
+    # map each cell to the classes it belongs to, then bucket each pair by hash lookup
+    classes_by_cell = {}
+    for cell_class, group in cell_groups.items():
+        for cell in group:
+            classes = classes_by_cell.setdefault(cell, [])
+            if cell_class not in classes:
+                classes.append(cell_class)
+
+    for pair in pairs:
+        pre_classes = classes_by_cell.get(pair.pre_cell, ())
+        post_classes = classes_by_cell.get(pair.post_cell, ())
+        for pre_class in pre_classes:
+            for post_class in post_classes:
+                results[(pre_class, post_class)].append(pair)
     
     return results
@@ -21,6 +21,21 @@ synphys_db_host = None
 synphys_db = None
 
 
+# Optional directory where the contents of NWB files are cached as memory-mappable
+# arrays (see aisynphys.data.sweep_cache). Set to None to always read NWB files directly.
+sweep_cache_path = None
+
+
+# Parallel pipeline workers are replaced when their resident memory exceeds this limit (MB)
+# after finishing a job. Set to None to keep workers running for the entire update.
+worker_rss_limit = 4000
+
+
+# Jobs claimed from the database job queue are returned to the queue if the worker running
+# them has not sent a heartbeat for this many seconds (see aisynphys.pipeline.job_queue).
+queue_lease_time = 300
+
+
 # utility config, not meant for external use
 synphys_data = None  # location of data repo network storage
 synphys_db_host_rw = None  # rw access to postgres / sqlite DB
@@ -4,5 +4,5 @@ from .cell import Cell
 from .data import (
     MultiPatchDataset, MultiPatchProbe,
     PulseStimAnalyzer, MultiPatchSyncRecAnalyzer, BaselineDistributor, Analyzer, 
-    PulseResponseList, PulseResponse, StimPulse,
+    PulseResponseList, PulseResponse, StimPulse, cut_windows,
 )
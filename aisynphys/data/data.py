@@ -1,5 +1,6 @@
 import sys
 import numpy as np
+import scipy.signal
 
 from neuroanalysis.miesnwb import MiesNwb, MiesSyncRecording, MiesRecording
 from neuroanalysis.stimuli import find_square_pulses
@@ -8,12 +9,35 @@ from neuroanalysis.data import TSeries, TSeriesList
 from neuroanalysis.baseline import float_mode
 
 from .. import qc
+from ..util import apply_filter_rows
+from .sweep_cache import SweepCache
 
 
 class MultiPatchDataset(MiesNwb):
     """Extension of neuroanalysis data abstraction layer to include
     multipatch-specific metadata.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the NWB file
+    sweep_cache : str | None
+        Optional directory in which to cache the contents of the NWB file (see SweepCache).
+        The cache is written the first time the file is opened; afterward, all data
+        are read from the cache rather than from the NWB file.
     """
+    def __init__(self, filename, sweep_cache=None):
+        self.sweep_cache = sweep_cache
+        MiesNwb.__init__(self, filename)
+
+    def open(self):
+        if self._hdf is not None:
+            return
+        if self.sweep_cache is None:
+            MiesNwb.open(self)
+        else:
+            self._hdf = SweepCache(self.sweep_cache, self.filename).open()
+
     def create_sync_recording(self, sweep_id):
         return MultiPatchSyncRecording(self, sweep_id)
 
@@ -218,6 +242,9 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
     def get_spike_responses(self, pre_rec, post_rec, align_to='pulse', pre_pad=10e-3, require_spike=True):
         """Given a pre- and a postsynaptic recording, return a structure
         containing evoked responses.
+
+        See get_spike_response_arrays() for a faster way to extract responses from many
+        postsynaptic recordings.
         
         Returns
         -------
@@ -231,6 +258,75 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
             * pre_rec: time slice of the presynaptic recording
             * baseline
         
+        """
+        result = self._spike_response_windows(pre_rec, align_to=align_to, pre_pad=pre_pad, require_spike=require_spike)
+
+        for pulse in result:
+            # Extract data from postsynaptic recording
+            pulse['response'] = post_rec.time_slice(pulse['rec_start'], pulse['rec_stop'])
+            assert len(pulse['response']['primary']) > 0
+
+            # Extract presynaptic spike and stimulus command
+            pulse['pre_rec'] = pre_rec.time_slice(pulse['rec_start'], pulse['rec_stop'])
+
+            # select baseline region between 8th and 9th pulses
+            if 'baseline_start' in pulse:
+                pulse['baseline'] = post_rec['primary'].time_slice(pulse['baseline_start'], pulse['baseline_stop'])
+
+        # Run QC on all responses at once
+        self._response_qc(post_rec, result)
+        
+        return result
+
+    def get_spike_response_arrays(self, pre_rec, post_recs, align_to='pulse', pre_pad=10e-3, require_spike=True, sample_rate=None):
+        """Extract the responses to all presynaptic stimuli from several postsynaptic recordings at once.
+
+        Response windows are chosen exactly as in get_spike_responses(), but instead of recording
+        views, the primary channel of each postsynaptic recording is cut into a single 2D array
+        (see cut_windows), optionally resampled.
+
+        Parameters
+        ----------
+        pre_rec : Recording
+            The presynaptic recording
+        post_recs : list
+            Postsynaptic recordings
+        sample_rate : float | None
+            If given, responses are resampled to this rate
+
+        Returns
+        -------
+        pulses : list
+            A dict for each presynaptic stimulus, with the same keys as returned by
+            get_spike_responses() except for the 'response', 'pre_rec', 'baseline' and QC keys.
+        responses : list
+            A dict for each item in *post_recs*, with keys:
+            * data: 2D array (n_pulses, max_samples) of response data, padded with NaN
+            * t0: start time of each response
+            * n_samples: number of valid samples in each row of *data*
+            * ex_qc_pass, in_qc_pass: boolean arrays of QC results
+            * qc_failures: list of QC failures for each response
+        """
+        pulses = self._spike_response_windows(pre_rec, align_to=align_to, pre_pad=pre_pad, require_spike=require_spike)
+        windows = [(pulse['rec_start'], pulse['rec_stop']) for pulse in pulses]
+        responses = []
+        for post_rec in post_recs:
+            data, t0, n_samples = cut_windows(post_rec['primary'], windows, sample_rate=sample_rate)
+            assert np.all(n_samples > 0)
+            ex_qc_pass, in_qc_pass, qc_failures = qc.pulse_response_qc_pass_batch(
+                post_rec, windows, [pulse['n_spikes'] for pulse in pulses], [pulse['adjacent_pulses'] for pulse in pulses]
+            )
+            responses.append({
+                'data': data, 't0': t0, 'n_samples': n_samples,
+                'ex_qc_pass': ex_qc_pass, 'in_qc_pass': in_qc_pass, 'qc_failures': qc_failures,
+            })
+        for pulse in pulses:
+            del pulse['n_spikes'], pulse['adjacent_pulses']
+        return pulses, responses
+
+    def _spike_response_windows(self, pre_rec, align_to, pre_pad, require_spike):
+        """Return a list of pulse dicts (as in get_spike_responses) with response window times and
+        QC inputs ('n_spikes' and 'adjacent_pulses'), but no data.
         """
         # detect presynaptic spikes
         pulse_stim = PulseStimAnalyzer.get(pre_rec)
@@ -276,37 +372,40 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
             else:
                 # otherwise, stop 50 ms later
                 pulse['rec_stop'] = max_stop
-            
-            # Extract data from postsynaptic recording
-            pulse['response'] = post_rec.time_slice(pulse['rec_start'], pulse['rec_stop'])
-            assert len(pulse['response']['primary']) > 0
-
-            # Extract presynaptic spike and stimulus command
-            pulse['pre_rec'] = pre_rec.time_slice(pulse['rec_start'], pulse['rec_stop'])
 
             # select baseline region between 8th and 9th pulses
             if len(spikes) > 8:
                 baseline_dur = 100e-3
                 stop = spikes[8]['pulse_start']
                 start = stop - baseline_dur
-                pulse['baseline'] = post_rec['primary'].time_slice(start, stop)
                 pulse['baseline_start'] = start
                 pulse['baseline_stop'] = stop
 
-            # Add minimal QC metrics for excitatory and inhibitory measurements
-            pulse_window = [pulse['rec_start'], pulse['rec_stop']]
-            n_spikes = 0 if spike is None else 1
+            # Collect inputs for minimal QC metrics for excitatory and inhibitory measurements
+            pulse['n_spikes'] = 0 if spike is None else 1
             adj_pulse_times = []
             if prev_pulse is not None:
                 adj_pulse_times.append(prev_pulse - this_pulse)
             if next_pulse is not None:
                 adj_pulse_times.append(next_pulse - this_pulse)
-            pulse['ex_qc_pass'], pulse['in_qc_pass'], pulse['qc_failures'] = qc.pulse_response_qc_pass(post_rec=post_rec, window=pulse_window, n_spikes=n_spikes, adjacent_pulses=adj_pulse_times)
+            pulse['adjacent_pulses'] = adj_pulse_times
 
             result.append(pulse)
-        
+
         return result
 
+    def _response_qc(self, post_rec, pulses):
+        """Add QC results to pulse dicts returned by _spike_response_windows.
+        """
+        windows = [[pulse['rec_start'], pulse['rec_stop']] for pulse in pulses]
+        n_spikes = [pulse.pop('n_spikes') for pulse in pulses]
+        adjacent_pulses = [pulse.pop('adjacent_pulses') for pulse in pulses]
+        ex_qc_pass, in_qc_pass, qc_failures = qc.pulse_response_qc_pass_batch(post_rec, windows, n_spikes, adjacent_pulses)
+        for i, pulse in enumerate(pulses):
+            pulse['ex_qc_pass'] = bool(ex_qc_pass[i])
+            pulse['in_qc_pass'] = bool(in_qc_pass[i])
+            pulse['qc_failures'] = qc_failures[i]
+
     def get_pulse_response(self, pre_rec, post_rec, first_pulse=0, last_pulse=-1):
         pulse_stim = PulseStimAnalyzer.get(pre_rec)
         spikes = pulse_stim.evoked_spikes()
@@ -393,6 +492,58 @@ class BaselineDistributor(Analyzer):
             yield chunk
 
 
+def cut_windows(trace, windows, sample_rate=None):
+    """Cut many time windows out of a regularly sampled TSeries into a single 2D array.
+
+    Row *i* contains the data of ``trace.time_slice(*windows[i])`` (resampled with
+    ``TSeries.resample(sample_rate)`` if *sample_rate* is given). The antialiasing filter used for
+    resampling is applied to all windows of equal length in a single call.
+
+    Parameters
+    ----------
+    trace : TSeries
+        The trace to cut
+    windows : list
+        (start, stop) times of each window
+    sample_rate : float | None
+        Optional sample rate to resample windows to
+
+    Returns
+    -------
+    data : array
+        2D array (n_windows, max_samples), padded with NaN after the end of each window
+    t0 : array
+        Time of the first sample in each window
+    n_samples : array
+        Number of valid samples in each row of *data*
+    """
+    views = [trace.time_slice(start, stop) for start, stop in windows]
+    t0 = np.array([view.t0 for view in views], dtype=float)
+    resample = sample_rate is not None and trace.sample_rate != sample_rate
+
+    rows = [view.data for view in views]
+    if resample:
+        # same antialiasing filter and interpolation as TSeries.resample
+        b, a = scipy.signal.bessel(2, sample_rate * trace.dt, btype='low')
+        lengths = np.array([len(row) for row in rows])
+        filtered = [None] * len(rows)
+        for length in np.unique(lengths):
+            inds = np.argwhere(lengths == length)[:, 0]
+            for i, row in zip(inds, apply_filter_rows(np.stack([rows[i] for i in inds]), b, a)):
+                filtered[i] = row
+        for i, view in enumerate(views):
+            t1 = view.time_values
+            t2 = np.arange(t1[0], t1[-1], 1.0/sample_rate)
+            rows[i] = np.interp(t2, t1, filtered[i])
+
+    n_samples = np.array([len(row) for row in rows], dtype=int)
+    dtype = np.result_type(np.float32, *[row.dtype for row in rows]) if len(rows) > 0 else float
+    data = np.full((len(rows), n_samples.max() if len(rows) > 0 else 0), np.nan, dtype=dtype)
+    for i, row in enumerate(rows):
+        data[i, :len(row)] = row
+    return data, t0, n_samples
+
+
 class PulseResponse(object):
     """Represents a chunk of postsynaptic recording taken during a presynaptic pulse stimulus.
 
@@ -1,10 +1,14 @@
 """
 A database holding results of manual analyses
 """
-
+import os, json, time, datetime, hashlib, logging
+import sqlalchemy
 from aisynphys.database.database import declarative_base, make_table
 from aisynphys.database import Database, NoDatabase
 from aisynphys import config
+from aisynphys.util import replace_file
+
+logger = logging.getLogger(__name__)
 
 DataNotesORMBase = declarative_base()
 
@@ -43,3 +47,171 @@ def get_pair_notes_record(expt_id, pre_cell_id, post_cell_id, session=None):
     elif len(recs) > 1:
         raise Exception("Multiple records found in pair_notes for pair %s %s %s!" % (expt_id, pre_cell_id, post_cell_id))
     return recs[0]
+
+
+def get_pair_notes_records(expt_ids=None, session=None):
+    """Return pair_notes records for many pairs, loaded in a single query.
+
+    Parameters
+    ----------
+    expt_ids : list | None
+        Experiment IDs for which to load records. If None, then records for all experiments are loaded.
+    session : Session | None
+        Session used to query the data_notes database
+
+    Returns
+    -------
+    records : dict
+        Maps (expt_id, pre_cell_id, post_cell_id) to the PairNotes record for each pair that has notes
+    """
+    if session is None:
+        session = db.default_session
+
+    q = session.query(PairNotes)
+    if expt_ids is not None:
+        q = q.filter(PairNotes.expt_id.in_(list(expt_ids)))
+
+    recs = {}
+    for rec in q.all():
+        key = (rec.expt_id, rec.pre_cell_id, rec.post_cell_id)
+        if key in recs:
+            raise Exception("Multiple records found in pair_notes for pair %s %s %s!" % key)
+        recs[key] = rec
+    return recs
+
+
+def pair_notes_content_hash(recs):
+    """Return a hash of the content (cell IDs and notes) of a list of pair_notes records.
+
+    Unlike modification times, the hash does not change when records are re-saved with identical content.
+    """
+    content = sorted([rec.pre_cell_id, rec.post_cell_id, rec.notes] for rec in recs)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+class PairNotesModTimes(object):
+    """Persistent record of the most recent pair_notes modification time for each experiment.
+
+    A hash of the notes content for each experiment (see :func:`pair_notes_content_hash`) is kept
+    in ``content_hashes``; it is recomputed only for experiments whose modification time changed.
+
+    Rather than reading the modification time of every pair_notes record, :func:`refresh` only asks
+    for records modified at or after the latest modification time seen previously (the watermark).
+    Deleted records are not visible this way; a full scan is done whenever the number of records
+    decreases, and once every ``full_refresh_interval`` seconds.
+
+    Parameters
+    ----------
+    database : Database | None
+        The data_notes database (default is the module-level ``db``)
+    cache_file : str | None
+        JSON file in which modification times are stored. By default, a file in
+        ``config.cache_path/pair_notes_mod_times`` derived from the database address is used.
+    """
+    version = 2
+
+    # seconds between full scans of all records
+    full_refresh_interval = 24 * 3600
+
+    def __init__(self, database=None, cache_file=None):
+        self.db = db if database is None else database
+        self.db_key = hashlib.sha1(self.db.ro_address.encode('utf8')).hexdigest()[:16]
+        if cache_file is None:
+            cache_file = os.path.join(config.cache_path, 'pair_notes_mod_times', self.db_key + '.json')
+        self.cache_file = cache_file
+        self.mod_times = {}
+        self.content_hashes = {}
+        self.n_records = 0
+        self.last_full_refresh = 0
+        self.load()
+
+    @property
+    def watermark(self):
+        """The most recent modification time of any record, or None if no records are known.
+        """
+        return max(self.mod_times.values()) if len(self.mod_times) > 0 else None
+
+    def load(self):
+        """Read modification times from disk, if they were saved previously.
+        """
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as fh:
+                data = json.load(fh)
+        except Exception:
+            logger.warning("Could not read pair notes modification times from %s", self.cache_file)
+            return
+        if data.get('version') != self.version or data.get('db') != self.db_key:
+            return
+        self.mod_times = {expt_id: datetime.datetime(*t) for expt_id, t in data['mod_times'].items()}
+        self.content_hashes = data['content_hashes']
+        self.n_records = data['n_records']
+        self.last_full_refresh = data['last_full_refresh']
+
+    def save(self):
+        """Write modification times to disk.
+        """
+        data = {
+            'version': self.version,
+            'db': self.db_key,
+            'n_records': self.n_records,
+            'last_full_refresh': self.last_full_refresh,
+            # store datetimes as exact tuples; these values are used as job fingerprints
+            'mod_times': {expt_id: list(t.timetuple()[:6]) + [t.microsecond] for expt_id, t in self.mod_times.items()},
+            'content_hashes': self.content_hashes,
+        }
+        path = os.path.dirname(self.cache_file)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        tmp = self.cache_file + '.tmp.%d' % os.getpid()
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+        replace_file(tmp, self.cache_file)
+
+    def refresh(self, full=None, session=None):
+        """Update modification times from the database and return a dict {expt_id: modification_time}.
+
+        If *full* is True, all records are scanned. By default, a full scan is done if the last one
+        is older than ``full_refresh_interval`` or if records have been deleted.
+        """
+        if session is None:
+            session = self.db.default_session
+        n_records = session.query(PairNotes).count()
+        now = time.time()
+        if full is None:
+            full = n_records < self.n_records or now - self.last_full_refresh > self.full_refresh_interval
+
+        q = session.query(PairNotes.expt_id, sqlalchemy.func.max(PairNotes.modification_time))
+        watermark = self.watermark
+        if full:
+            mod_times = {}
+            self.last_full_refresh = now
+        else:
+            mod_times = dict(self.mod_times)
+            if watermark is not None:
+                q = q.filter(PairNotes.modification_time >= watermark)
+        for expt_id, mtime in q.group_by(PairNotes.expt_id).all():
+            if mtime is None:
+                continue
+            if expt_id not in mod_times or mtime > mod_times[expt_id]:
+                mod_times[expt_id] = mtime
+
+        # rehash notes for experiments that changed (all of them after a full scan, which may be due to deletions)
+        if full:
+            changed = None
+            self.content_hashes = {}
+        else:
+            changed = [expt_id for expt_id, mtime in mod_times.items() if self.mod_times.get(expt_id) != mtime or expt_id not in self.content_hashes]
+        chunks = [None] if changed is None else [changed[i:i+500] for i in range(0, len(changed), 500)]
+        for chunk in chunks:
+            expt_recs = {}
+            for (expt_id, pre_id, post_id), rec in get_pair_notes_records(chunk, session=session).items():
+                expt_recs.setdefault(expt_id, []).append(rec)
+            for expt_id, recs in expt_recs.items():
+                self.content_hashes[expt_id] = pair_notes_content_hash(recs)
+
+        self.mod_times = mod_times
+        self.n_records = n_records
+        self.save()
+        return dict(self.mod_times)
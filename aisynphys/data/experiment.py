@@ -132,10 +132,10 @@ class Experiment(object):
         return None if dt is None else dt.date()
 
     @property
-    def last_modification_time(self):
-        """The timestamp of the most recently modified file in this experiment.
+    def input_files(self):
+        """A list of the files (some of which may not exist) from which this experiment is loaded.
         """
-        files = [
+        return [
             self.path,  # note: checking for the date on the folder also accounts for deleted files.
             self.pipette_file,
             self.nwb_file,
@@ -145,8 +145,13 @@ class Experiment(object):
             os.path.join(self.expt_path, '.index'),
             os.path.join(self.expt_path, 'ignore.txt'),
         ]
+
+    @property
+    def last_modification_time(self):
+        """The timestamp of the most recently modified file in this experiment.
+        """
         mtime = 0
-        for file in files:
+        for file in self.input_files:
             if file is None or not os.path.exists(file):
                 continue
             mtime = max(mtime, os.stat(file).st_mtime)
@@ -945,10 +950,15 @@ class Experiment(object):
     def data(self):
         """Data object from NWB file. 
         
-        Contains all ephys recordings.
+        Contains all ephys recordings. If config.sweep_cache_path is set, then the file
+        contents are read through a SweepCache stored there.
         """
         if self._data is None:
-            self._data = MultiPatchDataset(self.nwb_file)
+            if config.sweep_cache_path is None:
+                sweep_cache = None
+            else:
+                sweep_cache = os.path.join(config.sweep_cache_path, self.uid)
+            self._data = MultiPatchDataset(self.nwb_file, sweep_cache=sweep_cache)
         return self._data
 
     def close_data(self):
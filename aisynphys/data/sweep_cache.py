@@ -0,0 +1,246 @@
+"""
+On-disk cache of the HDF5 contents of MIES NWB files.
+
+Opening an NWB file with h5py and reading sweeps out of it is slow and tends to leak
+memory in long-running processes. A SweepCache mirrors the groups, attributes and datasets
+of one NWB file into a directory: one .npy file per dataset (so sweep data can be
+memory-mapped and read one channel at a time) plus a small JSON index that records the
+tree structure and all attributes. The cache is written the first time the file is opened,
+and afterward stands in for the h5py file object used by MiesNwb.
+
+Example::
+
+    cache = SweepCache('/path/to/cache/expt_id', '/path/to/data.nwb')
+    hdf = cache.open()   # builds the cache if needed
+    data = hdf['acquisition/timeseries/data_00000_AD0/data']
+"""
+from __future__ import print_function, division
+
+import os, json, shutil, tempfile, logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class SweepCache(object):
+    """Mirror of a single NWB file stored as memory-mappable .npy files.
+
+    Parameters
+    ----------
+    path : str
+        Directory where cached data for this file are stored.
+    source_file : str
+        Path to the NWB file that is being cached.
+    """
+    version = 1
+    index_file = 'index.json'
+
+    def __init__(self, path, source_file):
+        self.path = path
+        self.source_file = source_file
+        self._index = None
+
+    def source_stamp(self):
+        """Size and modification time of the source file, used to detect stale caches.
+        """
+        stat = os.stat(self.source_file)
+        return {'file': os.path.abspath(self.source_file), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @property
+    def index(self):
+        if self._index is None:
+            with open(os.path.join(self.path, self.index_file), 'r') as fh:
+                self._index = json.load(fh)
+        return self._index
+
+    def is_valid(self):
+        """Return True if the cache exists and was generated from the current source file.
+        """
+        index_file = os.path.join(self.path, self.index_file)
+        if not os.path.isfile(index_file):
+            return False
+        try:
+            index = self.index
+        except Exception:
+            self._index = None
+            return False
+        return index.get('version') == self.version and index.get('source') == self.source_stamp()
+
+    def build(self):
+        """Read the entire source file and write its contents to the cache directory.
+
+        The cache is assembled in a temporary directory and moved into place when complete,
+        so concurrent processes never see a partially written cache.
+        """
+        import h5py
+        from h5py.h5t import check_string_dtype
+
+        parent = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_' + os.path.basename(self.path))
+
+        items = {}
+        def add_item(name, obj):
+            entry = {'attrs': encode_attrs(obj.attrs)}
+            if isinstance(obj, h5py.Dataset):
+                entry['type'] = 'dataset'
+                try:
+                    if check_string_dtype(obj.dtype):
+                        data = np.array(obj.asstr()[()], dtype=str)
+                    else:
+                        data = obj[()]
+                    data_file = 'd%06d.npy' % len(items)
+                    np.save(os.path.join(tmp_path, data_file), np.asarray(data), allow_pickle=False)
+                    entry['file'] = data_file
+                except (TypeError, ValueError):
+                    # unusual dtypes (references, compound types, ..) are read from the
+                    # source file on demand
+                    entry['file'] = None
+            else:
+                entry['type'] = 'group'
+            items[name] = entry
+
+        try:
+            with h5py.File(self.source_file, 'r') as hdf:
+                stamp = self.source_stamp()
+                add_item('', hdf)
+                hdf.visititems(add_item)
+
+            index = {'version': self.version, 'source': stamp, 'items': items}
+            with open(os.path.join(tmp_path, self.index_file), 'w') as fh:
+                json.dump(index, fh)
+
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+            os.rename(tmp_path, self.path)
+            logger.info("Wrote sweep cache for %s to %s", self.source_file, self.path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isfile(os.path.join(self.path, self.index_file)):
+                raise
+            # another process finished building the same cache first
+            logger.info("Using sweep cache built by another process: %s", self.path)
+
+        self._index = None
+
+    def open(self):
+        """Return a read-only object that can be used in place of the h5py file object
+        for the source file, building the cache first if necessary.
+        """
+        if not self.is_valid():
+            self.build()
+        return CachedGroup(self, '')
+
+    def _load_dataset(self, name):
+        entry = self.index['items'][name]
+        if entry['file'] is None:
+            import h5py
+            with h5py.File(self.source_file, 'r') as hdf:
+                data = np.asarray(hdf[name][()])
+        else:
+            filename = os.path.join(self.path, entry['file'])
+            try:
+                data = np.load(filename, mmap_mode='r', allow_pickle=False)
+            except ValueError:
+                # empty arrays cannot be memory-mapped
+                data = np.load(filename, allow_pickle=False)
+        dataset = data.view(CachedDataset)
+        dataset.attrs = decode_attrs(entry['attrs'])
+        return dataset
+
+
+class CachedGroup(object):
+    """Group in a SweepCache, providing the subset of the h5py.Group interface used by MiesNwb.
+    """
+    def __init__(self, cache, name):
+        self._cache = cache
+        self.name = name
+        self._attrs = None
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = decode_attrs(self._cache.index['items'][self.name]['attrs'])
+        return self._attrs
+
+    def _child_name(self, key):
+        key = key.strip('/')
+        return key if self.name == '' else self.name + '/' + key
+
+    def __getitem__(self, key):
+        name = self._child_name(key)
+        entry = self._cache.index['items'].get(name)
+        if entry is None:
+            raise KeyError("Unable to open object (object '%s' doesn't exist)" % key)
+        if entry['type'] == 'group':
+            return CachedGroup(self._cache, name)
+        return self._cache._load_dataset(name)
+
+    def __contains__(self, key):
+        return self._child_name(key) in self._cache.index['items']
+
+    def keys(self):
+        prefix = '' if self.name == '' else self.name + '/'
+        keys = []
+        for name in self._cache.index['items']:
+            if name.startswith(prefix) and name != self.name and '/' not in name[len(prefix):]:
+                keys.append(name[len(prefix):])
+        return sorted(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return "<CachedGroup '/%s' in %s>" % (self.name, self._cache.path)
+
+
+class CachedDataset(np.ndarray):
+    """Array (usually memory-mapped) loaded from a SweepCache, with an h5py-like ``attrs`` dict.
+    """
+    def __array_finalize__(self, obj):
+        self.attrs = getattr(obj, 'attrs', {})
+
+
+def encode_attrs(attrs):
+    """Convert HDF5 attributes to a JSON-compatible dict.
+    """
+    encoded = {}
+    for k, v in attrs.items():
+        if isinstance(v, bytes):
+            v = v.decode()
+        if isinstance(v, np.ndarray):
+            if v.dtype.kind in 'SO':
+                v = np.array([x.decode() if isinstance(x, bytes) else x for x in v.ravel()], dtype=str).reshape(v.shape)
+            encoded[k] = {'array': v.tolist(), 'dtype': v.dtype.str}
+        elif isinstance(v, np.generic):
+            encoded[k] = {'scalar': v.item(), 'dtype': v.dtype.str}
+        else:
+            encoded[k] = v
+    return encoded
+
+
+def decode_attrs(encoded):
+    """Inverse of encode_attrs().
+    """
+    attrs = {}
+    for k, v in encoded.items():
+        if isinstance(v, dict) and 'array' in v:
+            v = np.array(v['array'], dtype=v['dtype'])
+        elif isinstance(v, dict) and 'scalar' in v:
+            v = np.dtype(v['dtype']).type(v['scalar'])
+        attrs[k] = v
+    return attrs
@@ -5,7 +5,7 @@ The actual schemas for database tables are implemented in other files in this su
 """
 from __future__ import division, print_function
 
-import os, sys, io, time, json, threading, gc, re, weakref
+import os, sys, io, time, json, threading, gc, re, weakref, zlib, bz2, logging
 from datetime import datetime
 from collections import OrderedDict
 import numpy as np
@@ -13,6 +13,11 @@ try:
     import queue
 except ImportError:
     import Queue as queue
+try:
+    import lzma
+except ImportError:
+    # not available in python 2
+    lzma = None
 
 import sqlalchemy
 from distutils.version import LooseVersion
@@ -29,24 +34,64 @@ from sqlalchemy.sql.expression import func
 
 
 from .. import config
+from .query_cache import QueryCache
 
 
 class NDArray(TypeDecorator):
     """For marshalling arrays in/out of binary DB fields.
+
+    Parameters
+    ----------
+    codec : str | None
+        Optional compression codec used to store arrays: 'zlib', 'bz2', or 'lzma' (python 3 only).
+    dtype : str | None
+        Optional floating point dtype (e.g. 'float32'). Floating point arrays with a larger
+        item size are downcast to this type before they are stored.
+
+    Compressed values begin with a short header that names the codec, so values are always decoded
+    correctly regardless of the column settings. Uncompressed values are plain ``np.save`` buffers,
+    which is also the format written by earlier versions.
     """
     impl = LargeBinary
     hashable = False
-    
+
+    codecs = {'zlib': zlib, 'bz2': bz2}
+    if lzma is not None:
+        codecs['lzma'] = lzma
+    header = b'\x00ndarray:'
+
+    def __init__(self, *args, **kwds):
+        self.codec = kwds.pop('codec', None)
+        self.dtype = kwds.pop('dtype', None)
+        if self.dtype is not None:
+            self.dtype = np.dtype(self.dtype)
+        if self.codec is not None and self.codec not in self.codecs:
+            raise ValueError("Unsupported array codec %r (options are %s)" % (self.codec, ', '.join(self.codecs)))
+        TypeDecorator.__init__(self, *args, **kwds)
+
+    def __repr__(self):
+        return "NDArray(codec=%r, dtype=%r)" % (self.codec, None if self.dtype is None else self.dtype.name)
+
     def process_bind_param(self, value, dialect):
         if value is None:
             return b'' 
+        if self.dtype is not None:
+            value = np.asarray(value)
+            if value.dtype.kind == 'f' and value.dtype.itemsize > self.dtype.itemsize:
+                value = value.astype(self.dtype)
         buf = io.BytesIO()
         np.save(buf, value, allow_pickle=False)
-        return buf.getvalue()
+        if self.codec is None:
+            return buf.getvalue()
+        return self.header + self.codec.encode() + b'\x00' + self.codecs[self.codec].compress(buf.getvalue())
         
     def process_result_value(self, value, dialect):
         if value == b'':
             return None
+        value = bytes(value)
+        if value.startswith(self.header):
+            codec, _, value = value[len(self.header):].partition(b'\x00')
+            value = self.codecs[codec.decode()].decompress(value)
         buf = io.BytesIO(value)
         return np.load(buf, allow_pickle=False)
 
@@ -114,6 +159,8 @@ def make_table_docstring(table):
             docstr.append("    Reference to %s.%s" % (prop.entity.primary_key[0].table.name, prop.entity.primary_key[0].name))
     for name, col in insp.columns.items():
         typ_str = str(col.type)
+        if isinstance(col.type, NDArray) and (col.type.codec is not None or col.type.dtype is not None):
+            typ_str = "%s (codec: %s, dtype: %s)" % (typ_str, col.type.codec, 'any' if col.type.dtype is None else col.type.dtype.name)
         docstr.append("%s : %s" % (name, typ_str))
         if col.comment is not None:
             docstr.append("    " + col.comment)
@@ -143,6 +190,7 @@ def make_table(ormbase, name, columns, base=None, **table_args):
         *options* is a dict providing extra initialization arguments to the sqlalchemy
         Column (for example: 'index', 'unique'). Optionally, *data_type* may be a 'tablename.id'
         string indicating that this column is a foreign key referencing another table.
+        Array columns also accept 'codec' and 'dtype' options (see :class:`NDArray`).
     """
     class_name = ''.join([part.title() for part in name.split('_')])
 
@@ -171,6 +219,8 @@ def make_table(ormbase, name, columns, base=None, **table_args):
             props[colname] = Column(Integer, ForeignKey(coltype, ondelete=ondelete), **kwds)
         else:
             ctyp = column_data_types[coltype]
+            if ctyp is NDArray:
+                ctyp = NDArray(codec=kwds.pop('codec', None), dtype=kwds.pop('dtype', None))
             props[colname] = Column(ctyp, **kwds)
 
         if defer_col:
@@ -206,6 +256,10 @@ class Database(object):
     * Clone databases across backends
     """
     _all_dbs = weakref.WeakSet()
+
+    # tables used only while building the database (for example, pipeline job queues); these
+    # are not copied into baked sqlite files
+    internal_tables = ()
     default_app_name = (' '.join(sys.argv))[-63:]
 
     def __init__(self, ro_host, rw_host, db_name, ormbase):
@@ -227,6 +281,7 @@ class Database(object):
         self._all_dbs.add(self)
         
         self._default_session = None
+        self.query_cache = None
 
     @property
     def default_session(self):
@@ -394,7 +449,8 @@ class Database(object):
         """
         if readonly:
             if self._ro_sessionmaker is None:
-                self._ro_sessionmaker = sessionmaker(bind=self.ro_engine, query_cls=DBQuery)
+                # read-only sessions can use this database's query cache (see DBQuery.dataframe)
+                self._ro_sessionmaker = sessionmaker(bind=self.ro_engine, query_cls=DBQuery, info={'database': self})
             return self._ro_sessionmaker()
         else:
             if self.rw_engine is None:
@@ -403,6 +459,32 @@ class Database(object):
                 self._rw_sessionmaker = sessionmaker(bind=self.rw_engine, query_cls=DBQuery)
             return self._rw_sessionmaker()
 
+    def enable_query_cache(self, max_entries=32, cache_dir=None):
+        """Cache the results of DBQuery.dataframe() for read-only sessions.
+
+        This is intended for repeated queries against an unchanging sqlite release file; results are
+        discarded automatically when the file changes. Other backends are never cached.
+
+        Parameters
+        ----------
+        max_entries : int
+            Maximum number of results held in memory.
+        cache_dir : str | None | False
+            Directory where results are also stored on disk, so they survive between processes.
+            The default is a `query_cache` folder in config.cache_path. Use False to keep results
+            in memory only.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(config.cache_path, 'query_cache')
+        elif cache_dir is False:
+            cache_dir = None
+        self.query_cache = QueryCache(max_entries=max_entries, cache_dir=cache_dir)
+
+    def disable_query_cache(self):
+        """Stop caching query results (see enable_query_cache).
+        """
+        self.query_cache = None
+
     def reset_db(self):
         """Drop the existing database and initialize a new one.
         """
@@ -543,6 +625,158 @@ class Database(object):
     #         s.execute("alter table %s %s trigger all;" % (table, enable))
     #     s.commit()
 
+    def cascade_ids(self, queries, session):
+        """Return the ids of all rows that would be removed by deleting the records selected by *queries*,
+        including rows reached through ``cascade="delete"`` relationships.
+
+        Parameters
+        ----------
+        queries : list
+            ORM queries, each selecting records from a single table (for example
+            ``session.query(db.SyncRec).filter(...)``). The queries are not executed directly;
+            only their id columns are used as subqueries.
+        session : Session
+            Session used to run the queries.
+
+        Returns
+        -------
+        ids : OrderedDict
+            {table_name: set(ids)}, sorted such that dependent tables come first (the order in
+            which rows must be deleted).
+        """
+        # follow cascades one relationship at a time; each new query is a subquery of the one
+        # that discovered it, so that all selection happens in the database
+        pending = []
+        for q in queries:
+            entity = q.column_descriptions[0]['entity']
+            pending.append((entity, q.with_entities(entity.id).statement))
+
+        ids = {}
+        while len(pending) > 0:
+            cls, id_query = pending.pop(0)
+            table = cls.__table__
+            found = set(row[0] for row in session.execute(id_query))
+            new_ids = found - ids.setdefault(table.name, set())
+            if len(new_ids) == 0:
+                continue
+            ids[table.name] |= new_ids
+
+            for rel in sqlalchemy.inspect(cls).relationships:
+                if not rel.cascade.delete:
+                    continue
+                target = rel.mapper.class_
+                (local_col, remote_col), = rel.local_remote_pairs
+                if rel.direction is sqlalchemy.orm.interfaces.ONETOMANY:
+                    child_query = sqlalchemy.select([target.__table__.c.id]).where(remote_col.in_(id_query))
+                else:
+                    child_query = sqlalchemy.select([local_col]).where(table.c.id.in_(id_query)).where(local_col != None)
+                pending.append((target, child_query))
+
+        return OrderedDict([(name, ids[name]) for name in reversed(self.metadata_tables()) if name in ids])
+
+    def bulk_delete(self, queries, session, dry_run=False, chunk_size=None):
+        """Delete the records selected by *queries*, along with all records that depend on them
+        through ``cascade="delete"`` relationships.
+
+        This has the same effect as calling ``session.delete()`` on each record, but the affected
+        rows are collected with a few queries per table and removed with one ``DELETE .. WHERE id IN (..)``
+        statement per chunk of ids, in dependency order. Other foreign keys that refer to deleted rows
+        are set to NULL, as the ORM would do (foreign keys followed by a one-to-many delete cascade are
+        skipped, since the rows holding them are deleted as well). Nothing is committed; the caller is
+        responsible for committing *session*, or rolling it back if an exception is raised.
+
+        Parameters
+        ----------
+        queries : list
+            ORM queries that select the records to delete (see :func:`cascade_ids`).
+        session : Session
+            Read-write session in which to delete records.
+        dry_run : bool
+            If True, only count the affected rows.
+        chunk_size : int | None
+            Maximum number of ids per statement. The default is 500 for sqlite (which limits the
+            number of parameters per statement) and 10000 otherwise.
+
+        Returns
+        -------
+        counts : OrderedDict
+            {table_name: n_rows} in the order that tables were (or would be) deleted from.
+        """
+        if chunk_size is None:
+            chunk_size = 500 if self.backend == 'sqlite' else 10000
+        logger = logging.getLogger(__name__)
+        delete_ids = self.cascade_ids(queries, session)
+        tables = self.metadata_tables()
+        cascaded = self._cascade_columns()
+
+        counts = OrderedDict()
+        for table_name, ids in delete_ids.items():
+            counts[table_name] = len(ids)
+            if dry_run:
+                continue
+            table = tables[table_name]
+            refs = [
+                (ref_table, fk.parent) for ref_table in tables.values() for fk in ref_table.foreign_keys
+                if fk.column.table is table and (ref_table.name, fk.parent.name) not in cascaded
+            ]
+            ids = sorted(ids)
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i+chunk_size]
+
+                # null out any remaining references to the rows being deleted
+                for ref_table, ref_col in refs:
+                    result = session.execute(ref_table.update().where(ref_col.in_(chunk)).values({ref_col.name: None}))
+                    if result.rowcount > 0:
+                        logger.info("Set %d references in %s.%s to NULL", result.rowcount, ref_table.name, ref_col.name)
+
+                session.execute(table.delete().where(table.c.id.in_(chunk)))
+        return counts
+
+    def _cascade_columns(self):
+        """Return a set of (table_name, column_name) for foreign keys that are followed by one-to-many
+        ``cascade="delete"`` relationships (all rows referring to a deleted parent are deleted with it).
+        """
+        columns = set()
+        for cls in self.ormbase.__subclasses__():
+            for rel in sqlalchemy.inspect(cls).relationships:
+                if rel.cascade.delete and rel.direction is sqlalchemy.orm.interfaces.ONETOMANY:
+                    for local_col, remote_col in rel.local_remote_pairs:
+                        columns.add((remote_col.table.name, remote_col.name))
+        return columns
+
+    def reserve_ids(self, table_name, n, session):
+        """Return a list of *n* primary keys for new rows in a table.
+
+        This allows rows that refer to each other to be built as plain dicts and then written with
+        :func:`bulk_insert`. On postgres, ids are drawn from the table's id sequence. On sqlite, the
+        database write lock is taken first (so no other process can insert rows until *session* is
+        committed), and ids follow the largest id in the table or the last id reserved in *session*.
+        """
+        if n == 0:
+            return []
+        table = self.metadata_tables()[table_name]
+        if self.backend == 'postgresql':
+            q = "select nextval(pg_get_serial_sequence('%s', 'id')) from generate_series(1, %d)" % (table_name, n)
+            return sorted([row[0] for row in session.execute(q)])
+        else:
+            # a no-op update is enough to acquire the write lock
+            session.execute(table.update().where(sqlalchemy.false()).values(id=table.c.id))
+            max_id = session.execute(sqlalchemy.select([func.max(table.c.id)])).scalar() or 0
+            reserved = session.info.setdefault('reserved_ids', {})
+            start = max(max_id, reserved.get(table_name, 0)) + 1
+            reserved[table_name] = start + n - 1
+            return list(range(start, start + n))
+
+    def bulk_insert(self, table_name, rows, session, chunk_size=1000):
+        """Insert a list of dicts into a table with one executemany statement per chunk of rows.
+
+        All rows must have the same keys. Column types are processed as for ORM inserts (for example,
+        arrays are encoded by :class:`NDArray`), but no ORM objects are created. Nothing is committed.
+        """
+        table = self.metadata_tables()[table_name]
+        for i in range(0, len(rows), chunk_size):
+            session.execute(table.insert(), rows[i:i+chunk_size])
+
     def vacuum(self, tables=None):
         """Cleans up database and analyzes table statistics in order to improve query planning.
         Should be run after any significant changes to the database.
@@ -560,9 +794,12 @@ class Database(object):
 
     def bake_sqlite(self, sqlite_file, **kwds):
         """Dump a copy of this database to an sqlite file.
+
+        Tables listed in ``internal_tables`` are neither created nor copied.
         """
         sqlite_db = Database(ro_host="sqlite:///", rw_host="sqlite:///", db_name=sqlite_file, ormbase=self.ormbase)
-        sqlite_db.create_tables()
+        sqlite_db.create_tables([name for name in self.metadata_tables() if name not in self.internal_tables])
+        kwds['skip_tables'] = list(kwds.get('skip_tables', ())) + list(self.internal_tables)
         
         last_size = 0
         for table in self.iter_copy_tables(self, sqlite_db, **kwds):
@@ -592,61 +829,124 @@ class Database(object):
             pass
 
     @staticmethod
-    def iter_copy_tables(source_db, dest_db, tables=None, skip_tables=(), skip_columns={}, skip_errors=False, vacuum=True):
+    def iter_copy_tables(source_db, dest_db, tables=None, skip_tables=(), skip_columns={}, skip_errors=False, vacuum=True, batch_size=1000):
         """Iterator that copies all tables from one database to another.
         
         Yields each table name as it is completed.
         
         This function does not create tables in dest_db; use db.create_tables if needed.
+        Tables that do not exist in source_db are skipped.
+
+        Records are read in chunks of *batch_size* ids and each chunk is written with a
+        single executemany insert. All writes go through a single connection. When the destination
+        is sqlite, synchronous writes are disabled on that connection and the rollback journal is
+        disabled (or kept in memory if *skip_errors* is True, so that a failed insert can be rolled
+        back before retrying its records individually). The indexes on each table are dropped before
+        loading and always rebuilt afterward, even if the copy fails.
         """
         read_session = source_db.session(readonly=True)
-        write_session = dest_db.session(readonly=False)
+        conn = dest_db.rw_engine.connect()
+        bulk_sqlite = dest_db.backend == 'sqlite'
+        if bulk_sqlite:
+            conn.execute('PRAGMA journal_mode=%s' % ('MEMORY' if skip_errors else 'OFF'))
+            conn.execute('PRAGMA synchronous=OFF')
         
-        for table_name, table in source_db.metadata_tables().items():
-            if (table_name in skip_tables) or (tables is not None and table_name not in tables):
-                print("Skipping %s.." % table_name)
-                continue
-            print("Cloning %s.." % table_name)
-            
-            # read from table in background thread, write to table in main thread.
-            skip_cols = skip_columns.get(table_name, [])
-            reader = TableReadThread(source_db, table, skip_columns=skip_cols)
-            i = 0
-            for i,rec in enumerate(reader):
+        try:
+            source_tables = set(source_db.table_names())
+            for table_name, table in source_db.metadata_tables().items():
+                if (table_name in skip_tables) or (tables is not None and table_name not in tables):
+                    print("Skipping %s.." % table_name)
+                    continue
+                if table_name not in source_tables:
+                    print("Skipping %s (not present in source database).." % table_name)
+                    continue
+                print("Cloning %s.." % table_name)
+                start_time = time.time()
+
+                # defer index creation until the table is loaded
+                indexes = list(table.indexes) if bulk_sqlite else []
+                if len(indexes) > 0:
+                    with conn.begin():
+                        for index in indexes:
+                            index.drop(bind=conn)
                 try:
-                    # Note: it is allowed to write `rec` directly back to the db, but
-                    # in some cases (json columns) we run into a sqlalchemy bug. Converting
-                    # to dict first is a workaround.
-                    rec = {k:getattr(rec, k) for k in rec.keys()}
-                    
-                    write_session.execute(table.insert(rec))
-                except Exception:
-                    if skip_errors:
-                        print("Skip record %d:" % i)
-                        sys.excepthook(*sys.exc_info())
-                    else:
-                        raise
-                if i%1000 == 0:
-                    print("%d/%d   %0.2f%%\r" % (i, reader.max_id, (100.0*(i+1.0)/reader.max_id)), end="")
-                    sys.stdout.flush()
+                    n_rows = Database._copy_table_rows(source_db, conn, table, table_name, batch_size, skip_columns, skip_errors, start_time)
+                    read_session.rollback()
+                finally:
+                    if len(indexes) > 0:
+                        print("   building %d indexes.." % len(indexes))
+                        with conn.begin():
+                            for index in indexes:
+                                index.create(bind=conn)
+
+                dt = time.time() - start_time
+                print("   copied %d rows from %s in %0.1f sec (%0.0f rows/s)" % (n_rows, table_name, dt, n_rows / max(dt, 1e-6)))
                 
-            print("   committing %d rows..                    " % i)
-            write_session.commit()
-            read_session.rollback()
-            
-            yield table_name
+                yield table_name
+        finally:
+            conn.close()
 
         if vacuum:
             print("Optimizing database..")
             dest_db.vacuum()
         print("All finished!")
 
+    @staticmethod
+    def _copy_table_rows(source_db, conn, table, table_name, batch_size, skip_columns, skip_errors, start_time):
+        """Copy all rows of *table* from *source_db* using *conn* in a single transaction (see iter_copy_tables).
+        """
+        # read from table in background thread, write to table in main thread.
+        skip_cols = skip_columns.get(table_name, [])
+        reader = TableReadThread(source_db, table, chunksize=batch_size, skip_columns=skip_cols)
+        n_rows = 0
+        with conn.begin():
+            for recs in reader.iter_chunks():
+                if len(recs) == 0:
+                    continue
+                # Note: it is allowed to write `rec` directly back to the db, but
+                # in some cases (json columns) we run into a sqlalchemy bug. Converting
+                # to dict first is a workaround.
+                recs = [{k:getattr(rec, k) for k in rec.keys()} for rec in recs]
+                if skip_errors:
+                    # a failed insert must not leave part of the chunk behind
+                    chunk = conn.begin_nested()
+                try:
+                    conn.execute(table.insert(), recs)
+                    if skip_errors:
+                        chunk.commit()
+                except Exception:
+                    if not skip_errors:
+                        raise
+                    chunk.rollback()
+                    # retry one record at a time to find the bad ones
+                    for i,rec in enumerate(recs):
+                        try:
+                            with conn.begin_nested():
+                                conn.execute(table.insert(), rec)
+                        except Exception:
+                            print("Skip record %d:" % (n_rows + i))
+                            sys.excepthook(*sys.exc_info())
+                n_rows += len(recs)
+                last_id = recs[-1]['id']
+                rate = n_rows / max(time.time() - start_time, 1e-6)
+                print("%d/%d   %0.2f%%   %0.0f rows/s\r" % (last_id, reader.max_id, (100.0*last_id/reader.max_id), rate), end="")
+                sys.stdout.flush()
+                
+            print("   committing %d rows..                    " % n_rows)
+        return n_rows
+
 
 class DBQuery(sqlalchemy.orm.Query):
     def dataframe(self):
         """Return a pandas dataframe constructed from the results of this query.
+
+        If the query cache is enabled for the database that created this session (see
+        Database.enable_query_cache), the result may be read from the cache.
         """
         import pandas
+        db = self.session.info.get('database')
+        if db is not None and db.query_cache is not None:
+            return db.query_cache.read_sql(self.statement, self.session.bind)
         return pandas.read_sql(self.statement, self.session.bind)
         
 
@@ -673,7 +973,7 @@ class TableReadThread(threading.Thread):
             table = self.table
             chunksize = self.chunksize
             all_columns = [col for col in table.columns if col.name not in self.skip_columns]
-            for i in range(0, self.max_id, chunksize):
+            for i in range(0, self.max_id + 1, chunksize):
                 query = session.query(*all_columns).filter((table.columns['id'] >= i) & (table.columns['id'] < i+chunksize))
                 records = query.all()
                 self.queue.put(records)
@@ -685,12 +985,18 @@ class TableReadThread(threading.Thread):
             self.queue.put(exc)
             raise
     
-    def __iter__(self):
+    def iter_chunks(self):
+        """Yield lists of records, one list per chunk of ids.
+        """
         while True:
             recs = self.queue.get()
             if recs is None:
                 break
             if isinstance(recs, Exception):
                 raise recs
+            yield recs
+
+    def __iter__(self):
+        for recs in self.iter_chunks():
             for rec in recs:
                 yield rec
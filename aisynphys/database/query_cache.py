@@ -0,0 +1,212 @@
+"""
+Opt-in cache for dataframes read from unchanging sqlite databases (see Database.enable_query_cache).
+"""
+from __future__ import division, print_function
+
+import os, json, hashlib, shutil, threading
+from collections import OrderedDict
+import numpy as np
+import six
+from ..util import replace_file
+
+
+class QueryCache(object):
+    """Caches the results of read-only queries as pandas dataframes.
+
+    Results are keyed by the compiled SQL, its parameters, and the identity of the database file
+    (absolute path, size, and modification time). Any change to the database file changes its identity,
+    which discards all cached results for that database.
+
+    Results are held in an in-memory LRU cache of *max_entries* dataframes, and optionally
+    written to *cache_dir*. Results whose columns are all numeric, string or datetime are written
+    as parquet files (if pyarrow is available); all others are written as npz files, with object
+    columns (such as JSON fields) stored as JSON text. Object columns that can't be stored as JSON
+    (such as ndarray fields) are pickled, so *cache_dir* must not be writable by untrusted users.
+
+    Only sqlite databases are cached; there is no cheap way to detect changes to a postgres
+    database, so queries against other backends are always executed.
+    """
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._memory = OrderedDict()
+        self._identities = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def db_identity(bind):
+        """Return a dict identifying the current state of the database at *bind*, or None
+        if the database cannot be cached.
+        """
+        url = bind.url
+        if url.get_backend_name() != 'sqlite' or not url.database:
+            return None
+        path = os.path.abspath(url.database)
+        identity = {'path': path}
+        # include the write-ahead log, which holds changes not yet merged into the main file
+        for name, file_path in [('db', path), ('wal', path + '-wal')]:
+            if os.path.exists(file_path):
+                stat = os.stat(file_path)
+                # st_mtime_ns is not available on python 2
+                identity[name] = [stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)]
+        return identity
+
+    @staticmethod
+    def query_key(statement, bind):
+        """Return a key identifying the compiled SQL and parameters of *statement*.
+        """
+        compiled = statement.compile(dialect=bind.dialect)
+        params = sorted((k, _param_key(v)) for k, v in compiled.params.items())
+        return hashlib.sha1(repr((str(compiled), params)).encode()).hexdigest()
+
+    def read_sql(self, statement, bind):
+        """Return the result of *statement* as a dataframe, using a cached copy if possible.
+        """
+        import pandas
+        identity = self.db_identity(bind)
+        if identity is None:
+            return pandas.read_sql(statement, bind)
+
+        db_key = hashlib.sha1(identity['path'].encode()).hexdigest()
+        key = self.query_key(statement, bind)
+        with self._lock:
+            self._check_identity(db_key, identity)
+            df = self._memory.get((db_key, key))
+            if df is not None:
+                # move to the end of the LRU order
+                del self._memory[db_key, key]
+                self._memory[db_key, key] = df
+                return df.copy()
+
+            df = self._read_file(db_key, key)
+            if df is None:
+                df = pandas.read_sql(statement, bind)
+                self._write_file(db_key, key, df)
+            self._memory[db_key, key] = df
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+            return df.copy()
+
+    def clear(self):
+        """Remove all cached results from memory and disk.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._identities.clear()
+            if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+
+    def _check_identity(self, db_key, identity):
+        """Discard cached results for a database whose identity has changed.
+        """
+        if self._identities.get(db_key) == identity:
+            return
+        self._identities[db_key] = identity
+        for k in [k for k in self._memory if k[0] == db_key]:
+            del self._memory[k]
+
+        if self.cache_dir is None:
+            return
+        db_dir = os.path.join(self.cache_dir, db_key)
+        identity_file = os.path.join(db_dir, 'identity.json')
+        if os.path.exists(identity_file):
+            with open(identity_file, 'r') as fh:
+                if json.load(fh) == identity:
+                    return
+            shutil.rmtree(db_dir)
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        with open(identity_file, 'w') as fh:
+            json.dump(identity, fh)
+
+    def _file_path(self, db_key, key, ext):
+        return os.path.join(self.cache_dir, db_key, key + ext)
+
+    def _read_file(self, db_key, key):
+        if self.cache_dir is None:
+            return None
+        import pandas
+        parquet_file = self._file_path(db_key, key, '.parquet')
+        if os.path.exists(parquet_file):
+            return pandas.read_parquet(parquet_file)
+        npz_file = self._file_path(db_key, key, '.npz')
+        if not os.path.exists(npz_file):
+            return None
+        with np.load(npz_file) as data:
+            columns = json.loads(str(data['columns']))
+            formats = list(data['formats'])
+        # only unpickle files that contain pickled columns
+        with np.load(npz_file, allow_pickle='pickle' in formats) as data:
+            cols = OrderedDict()
+            for i, fmt in enumerate(formats):
+                values = data['col%d' % i]
+                if fmt == 'json':
+                    decoded = np.empty(len(values), dtype=object)
+                    decoded[:] = [json.loads(v) for v in values]
+                    values = decoded
+                cols[i] = values
+        df = pandas.DataFrame(cols)
+        # columns are restored by position because query results may have duplicate names
+        df.columns = columns
+        return df
+
+    def _write_file(self, db_key, key, df):
+        if self.cache_dir is None:
+            return
+        if _parquet_compatible(df):
+            parquet_file = self._file_path(db_key, key, '.parquet')
+            try:
+                df.to_parquet(parquet_file + '.tmp', index=False)
+                replace_file(parquet_file + '.tmp', parquet_file)
+                return
+            except Exception:
+                # no parquet engine installed
+                if os.path.exists(parquet_file + '.tmp'):
+                    os.remove(parquet_file + '.tmp')
+        npz_file = self._file_path(db_key, key, '.npz')
+        arrays = {}
+        formats = []
+        for i in range(len(df.columns)):
+            values = np.asarray(df.iloc[:, i])
+            fmt = 'array'
+            if values.dtype.kind == 'O':
+                try:
+                    values = np.array([json.dumps(v) for v in values], dtype=str)
+                    fmt = 'json'
+                except TypeError:
+                    fmt = 'pickle'
+            arrays['col%d' % i] = values
+            formats.append(fmt)
+        arrays['columns'] = np.array(json.dumps(list(df.columns)))
+        arrays['formats'] = np.array(formats, dtype=str)
+        with open(npz_file + '.tmp', 'wb') as fh:
+            np.savez(fh, **arrays)
+        replace_file(npz_file + '.tmp', npz_file)
+
+
+def _param_key(value):
+    """Return a string identifying a query parameter value.
+
+    The repr of large arrays is truncated, so arrays are identified by their dtype, shape and contents.
+    """
+    if isinstance(value, np.ndarray) and value.dtype.kind != 'O':
+        return repr((value.dtype.str, value.shape, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()))
+    return repr(value)
+
+
+def _parquet_compatible(df):
+    """Return True if every column of *df* holds scalar numbers, strings or datetimes, which
+    parquet stores without changing their type.
+    """
+    import pandas
+    for i in range(len(df.columns)):
+        col = df.iloc[:, i]
+        if col.dtype.kind in 'biufM':
+            continue
+        if col.dtype == object:
+            if all(v is None or isinstance(v, six.string_types) for v in col.values):
+                continue
+        elif pandas.api.types.is_string_dtype(col.dtype):
+            continue
+        return False
+    return True
@@ -137,7 +137,7 @@ StimPulse = make_table(
         ('n_spikes', 'int', 'Number of spikes evoked by this pulse'),
         ('first_spike_time', 'float', 'Time of the first spike evoked by this pulse, measured from the beginning of the recording until the max slope of the spike rising phase.'),
         # ('first_spike', 'stim_spike.id', 'The ID of the first spike evoked by this pulse'),
-        ('data', 'array', 'Numpy array of presynaptic recording sampled at '+sample_rate_str, {'deferred': True}),
+        ('data', 'array', 'Numpy array of presynaptic recording sampled at '+sample_rate_str, {'deferred': True, 'codec': 'zlib', 'dtype': 'float32'}),
         ('data_start_time', 'float', "Starting time of the data chunk, relative to the beginning of the recording"),
         ('previous_pulse_dt', 'float', 'Time elapsed since the last stimulus in the same cell', {'index': True}),
     ]
@@ -245,7 +245,7 @@ PulseResponse = make_table(
         ('stim_pulse_id', 'stim_pulse.id', 'The presynaptic pulse', {'index': True}),
         ('pair_id', 'pair.id', 'The pre-post cell pair involved in this pulse response', {'index': True}),
         ('baseline_id', 'baseline.id', 'A random baseline snippet matched from the same recording.', {'index': True}),
-        ('data', 'array', 'numpy array of response data sampled at '+sample_rate_str, {'deferred': True}),
+        ('data', 'array', 'numpy array of response data sampled at '+sample_rate_str, {'deferred': True, 'codec': 'zlib', 'dtype': 'float32'}),
         ('data_start_time', 'float', 'Starting time of this chunk of the recording in seconds, relative to the beginning of the recording'),
         ('ex_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for excitatory synapse probing', {'index': True}),
         ('in_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for inhibitory synapse probing', {'index': True}),
@@ -264,7 +264,7 @@ Baseline = make_table(
     comment="A snippet of baseline data used for comparison to pulse_response records",
     columns=[
         ('recording_id', 'recording.id', 'The recording from which this baseline snippet was extracted.', {'index': True}),
-        ('data', 'array', 'numpy array of baseline data sampled at '+sample_rate_str, {'deferred': True}),
+        ('data', 'array', 'numpy array of baseline data sampled at '+sample_rate_str, {'deferred': True, 'codec': 'zlib', 'dtype': 'float32'}),
         ('data_start_time', 'float', "Starting time of this chunk of the recording in seconds, relative to the beginning of the recording"),
         ('mode', 'float', 'most common value in the baseline snippet'),
         ('ex_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for excitatory synapse probing'),
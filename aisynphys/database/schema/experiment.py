@@ -42,7 +42,11 @@ class ExperimentBase(object):
             if self.nwb_file is None:
                 self._data = None
             else:
-                self._data = MultiPatchDataset(self.nwb_file)
+                if config.sweep_cache_path is None:
+                    sweep_cache = None
+                else:
+                    sweep_cache = os.path.join(config.sweep_cache_path, self.ext_id)
+                self._data = MultiPatchDataset(self.nwb_file, sweep_cache=sweep_cache)
         return self._data
 
     @property
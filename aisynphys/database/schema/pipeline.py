@@ -1,7 +1,7 @@
 from collections import OrderedDict
 from . import make_table
 
-__all__ = ['Pipeline']
+__all__ = ['Pipeline', 'PipelineQueue', 'PipelineQueueDependency']
 
 
 Pipeline = make_table(
@@ -15,3 +15,31 @@ Pipeline = make_table(
         ('error', 'str', 'Error or warning messages generated during job processing'),
     ]
 )
+
+
+PipelineQueue = make_table(
+    name='pipeline_queue',
+    comment="Pipeline jobs waiting to be claimed by queue workers (see aisynphys.pipeline.job_queue).",
+    columns=[
+        ('pipeline_name', 'str', 'The name of the pipeline that this job belongs to', {'index': True}),
+        ('module_name', 'str', 'The name of the pipeline module that runs this job', {'index': True}),
+        ('job_id', 'str', 'Unique value identifying the job to be processed', {'index': True}),
+        ('status', 'str', "One of 'queued', 'running', 'done', 'failed', or 'skipped'", {'index': True}),
+        ('worker', 'str', 'Name (host:pid) of the worker that claimed this job'),
+        ('claim_time', 'datetime', 'The date/time (UTC) when this job was last claimed'),
+        ('heartbeat_time', 'datetime', 'The date/time (UTC) of the last heartbeat from the worker running this job'),
+        ('finish_time', 'datetime', 'The date/time (UTC) when this job finished'),
+        ('attempts', 'int', 'Number of times this job has been claimed'),
+        ('error', 'str', 'Error message if the job failed or was skipped'),
+    ]
+)
+
+
+PipelineQueueDependency = make_table(
+    name='pipeline_queue_dependency',
+    comment="Links queued pipeline jobs to the upstream jobs that must finish before they may start.",
+    columns=[
+        ('queue_id', 'pipeline_queue.id', 'The queued job', {'ondelete': 'CASCADE'}),
+        ('upstream_id', 'pipeline_queue.id', 'The upstream job that must finish first', {'ondelete': 'CASCADE'}),
+    ]
+)
@@ -1,4 +1,6 @@
 import datetime
+import numpy as np
+import sqlalchemy
 from sqlalchemy.orm import aliased, contains_eager, selectinload
 from collections import OrderedDict
 from .database import Database
@@ -12,6 +14,9 @@ class SynphysDatabase(Database):
     default_sample_rate = default_sample_rate
     schema_version = schema_version
 
+    # pipeline job queue tables are not included in baked release files
+    internal_tables = ('pipeline_queue', 'pipeline_queue_dependency')
+
     mouse_projects = ["mouse V1 coarse matrix", "mouse V1 pre-production"]
     human_projects = ["human coarse matrix"]
 
@@ -104,21 +109,56 @@ class SynphysDatabase(Database):
         
         return slices[0]
 
-    def experiment_from_timestamp(self, ts, session=None):
+    def experiment_from_timestamp(self, ts, session=None, tolerance=0.01):
+        """Return the experiment whose acq_timestamp is nearest to *ts*.
+
+        Timestamps may differ by up to *tolerance* seconds (for backward compatibility with
+        timestamps truncated to 2 decimal places). The lookup is a range query on the
+        indexed acq_timestamp column. Raises RuntimeError if two experiments are equally near.
+        """
         session = session or self.default_session
-        expts = session.query(self.Experiment).filter(self.Experiment.acq_timestamp==ts).all()
+        ts = float(ts)
+        acq_ts = self.Experiment.acq_timestamp
+        q = session.query(self.Experiment).filter(acq_ts.between(ts - tolerance, ts + tolerance))
+        q = q.order_by(sqlalchemy.func.abs(acq_ts - ts)).limit(2)
+        expts = q.all()
         if len(expts) == 0:
-            # For backward compatibility, check for timestamp truncated to 2 decimal places
-            for expt in session.query(self.Experiment).all():
-                if abs((expt.acq_timestamp - ts)) < 0.01:
-                    return expt
-            
             raise KeyError("No experiment found for timestamp %0.3f" % ts)
-        elif len(expts) > 1:
+        elif len(expts) > 1 and abs(expts[0].acq_timestamp - ts) == abs(expts[1].acq_timestamp - ts):
             raise RuntimeError("Multiple experiments found for timestamp %0.3f" % ts)
-        
         return expts[0]
 
+    def experiments_from_timestamps(self, timestamps, session=None, tolerance=0.01, chunk_size=200):
+        """Return a list of experiments matching each of *timestamps*, as in :func:`experiment_from_timestamp`.
+
+        All timestamps are resolved with one range query (per *chunk_size* timestamps).
+        Timestamps with no matching experiment are returned as None.
+        """
+        session = session or self.default_session
+        timestamps = np.array([float(ts) for ts in timestamps])
+        acq_ts = self.Experiment.acq_timestamp
+        candidates = []
+        for i in range(0, len(timestamps), chunk_size):
+            ranges = [acq_ts.between(ts - tolerance, ts + tolerance) for ts in timestamps[i:i+chunk_size]]
+            candidates.extend(session.query(self.Experiment).filter(sqlalchemy.or_(*ranges)).all())
+
+        # select the nearest candidate for each timestamp
+        candidates = sorted(set(candidates), key=lambda expt: expt.acq_timestamp)
+        cand_ts = np.array([expt.acq_timestamp for expt in candidates])
+        expts = []
+        for ts in timestamps:
+            start = np.searchsorted(cand_ts, ts - tolerance, side='left')
+            stop = np.searchsorted(cand_ts, ts + tolerance, side='right')
+            if start == stop:
+                expts.append(None)
+                continue
+            dist = np.abs(cand_ts[start:stop] - ts)
+            nearest = np.argwhere(dist == dist.min())[:, 0]
+            if len(nearest) > 1:
+                raise RuntimeError("Multiple experiments found for timestamp %0.3f" % ts)
+            expts.append(candidates[start + nearest[0]])
+        return expts
+
     def experiment_from_ext_id(self, ext_id, session=None):
         session = session or self.default_session
         expts = session.query(self.Experiment).filter(self.Experiment.ext_id==ext_id).all()
@@ -277,13 +317,81 @@ class SynphysDatabase(Database):
         # package the aliased cells
         query.pre_cell = pre_cell
         query.post_cell = post_cell
+        query.pre_morphology = pre_morphology
+        query.post_morphology = post_morphology
 
         return query
 
     def matrix_pair_query(self, pre_classes, post_classes, columns=None, pair_query_args=None):
         """Returns the concatenated result of running pair_query over every combination
         of presynaptic and postsynaptic cell class.
+
+        Rather than issuing one query per class combination, all candidate pairs are
+        queried once along with the cell / morphology attributes used by the cell class
+        criteria. Class membership is then assigned in memory, using the same matching
+        rules as :func:`CellClass.filter_query`.
+        """
+        import pandas
+        if pair_query_args is None:
+            pair_query_args = {}
+
+        pair_query = self.pair_query(**pair_query_args)
+        if columns is not None:
+            pair_query = pair_query.add_columns(*columns)
+
+        # add one column per (pre/post, criterion) needed to classify cells
+        criteria_cols = OrderedDict()
+        for prefix, cell_classes in [('pre', pre_classes), ('post', post_classes)]:
+            cell_table = getattr(pair_query, prefix + '_cell')
+            morpho_table = getattr(pair_query, prefix + '_morphology')
+            for cell_class in cell_classes.values():
+                for k in cell_class.criteria:
+                    label = '_%s_class_%s' % (prefix, k)
+                    if label in criteria_cols:
+                        continue
+                    for table in (cell_table, morpho_table):
+                        if hasattr(table, k):
+                            criteria_cols[label] = getattr(table, k).label(label)
+                            break
+                    else:
+                        raise Exception('Cannot use "%s" for cell typing; attribute not found on cell or cell.morphology' % k)
+        pair_query = pair_query.add_columns(*criteria_cols.values())
+        
+        all_pairs = pair_query.dataframe()
+        
+        def class_mask(prefix, cell_class):
+            mask = np.ones(len(all_pairs), dtype=bool)
+            for k, v in cell_class.criteria.items():
+                col = all_pairs['_%s_class_%s' % (prefix, k)]
+                if isinstance(v, tuple):
+                    mask &= col.isin(v).values & col.notnull().values
+                elif v is None:
+                    mask &= col.isnull().values
+                else:
+                    mask &= (col == v).values & col.notnull().values
+            return mask
+
+        pre_masks = OrderedDict([(name, class_mask('pre', cls)) for name, cls in pre_classes.items()])
+        post_masks = OrderedDict([(name, class_mask('post', cls)) for name, cls in post_classes.items()])
+        all_pairs = all_pairs.drop(columns=list(criteria_cols.keys()))
+
+        dfs = []
+        for pre_name, pre_mask in pre_masks.items():
+            for post_name, post_mask in post_masks.items():
+                df = all_pairs[pre_mask & post_mask].reset_index(drop=True)
+                df['pre_class'] = pre_name
+                df['post_class'] = post_name
+                dfs.append(df)
+        
+        if len(dfs) == 0:
+            return None
+        return pandas.concat(dfs)
+
+    def _matrix_pair_query_per_class(self, pre_classes, post_classes, columns=None, pair_query_args=None):
+        """Reference implementation of matrix_pair_query that runs one pair_query for each
+        combination of pre/post cell class. Used to benchmark and verify the single-query version.
         """
+        import pandas
         if pair_query_args is None:
             pair_query_args = {}
 
@@ -305,7 +413,7 @@ class SynphysDatabase(Database):
                 if pairs is None:
                     pairs = df
                 else:
-                    pairs = pairs.append(df)
+                    pairs = pandas.concat([pairs, df])
         
         return pairs
 
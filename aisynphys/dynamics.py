@@ -70,6 +70,103 @@ def pulse_response_query(pair, qc_pass=False, clamp_mode=None, data=False, spike
     return q
 
 
+# fields loaded for each pulse response by pulse_response_amplitudes()
+pulse_amplitude_dtype = [
+    ('recording_id', 'int64'),
+    ('induction_frequency', 'float64'),
+    ('recovery_delay', 'float64'),
+    ('pulse_number', 'int64'),
+    ('previous_pulse_dt', 'float64'),
+    ('amplitude', 'float64'),
+    ('baseline_amplitude', 'float64'),
+    ('ex_qc_pass', 'bool'),
+    ('in_qc_pass', 'bool'),
+]
+
+
+def pulse_response_amplitudes(pair, amp_field='dec_fit_reconv_amp', clamp_mode='ic', session=None):
+    """Return a structured array (see pulse_amplitude_dtype) describing the fit amplitude of every
+    pulse response in *pair*, in the same order as pulse_response_query().
+
+    Only plain column values are loaded (no ORM objects). Missing float values are NaN, missing
+    pulse numbers are -1, and missing QC values are False.
+    """
+    q = pulse_response_query(pair, clamp_mode=clamp_mode, session=session)
+    q = q.with_entities(
+        db.Recording.id,
+        db.MultiPatchProbe.induction_frequency,
+        db.MultiPatchProbe.recovery_delay,
+        db.StimPulse.pulse_number,
+        db.StimPulse.previous_pulse_dt,
+        getattr(db.PulseResponseFit, amp_field),
+        getattr(db.PulseResponseFit, 'baseline_' + amp_field),
+        db.PulseResponse.ex_qc_pass,
+        db.PulseResponse.in_qc_pass,
+    )
+    rows = q.all()
+
+    amps = np.empty(len(rows), dtype=pulse_amplitude_dtype)
+    if len(rows) == 0:
+        return amps
+    for (name, dtype), col in zip(pulse_amplitude_dtype, zip(*rows)):
+        if dtype == 'float64':
+            # None becomes NaN
+            amps[name] = np.array(col, dtype=float)
+        elif dtype == 'int64':
+            amps[name] = [-1 if v is None else v for v in col]
+        else:
+            amps[name] = [bool(v) for v in col]
+    return amps
+
+
+def pulse_train_amplitudes(amps):
+    """Arrange pulse amplitudes into one row per recording.
+
+    Recordings are ordered the same way as sorted_pulse_responses(): grouped by stimulus
+    (induction frequency, recovery delay) in order of first appearance, then by first appearance
+    of each recording. If a pulse number appears more than once in a recording, the last one is used.
+
+    Parameters
+    ----------
+    amps : structured array
+        Pulse amplitudes as returned by pulse_response_amplitudes()
+
+    Returns
+    -------
+    ind_freq : array
+        Induction frequency of each recording (NaN if unknown)
+    rec_delay : array
+        Recovery delay of each recording (NaN if unknown)
+    train_amps : 2D array
+        Amplitudes indexed by [recording, pulse_number]; NaN where a pulse is missing.
+    """
+    rec_ids, first_index, rec_index = np.unique(amps['recording_id'], return_index=True, return_inverse=True)
+    ind_freq = amps['induction_frequency'][first_index]
+    rec_delay = amps['recovery_delay'][first_index]
+
+    # order recordings by first appearance of their stimulus, then of the recording itself
+    stim_keys = [tuple(None if np.isnan(v) else v for v in key) for key in zip(ind_freq, rec_delay)]
+    stim_rank = {}
+    for i in np.argsort(first_index):
+        stim_rank.setdefault(stim_keys[i], len(stim_rank))
+    order = np.lexsort((first_index, [stim_rank[key] for key in stim_keys]))
+    row = np.empty(len(order), dtype=int)
+    row[order] = np.arange(len(order))
+
+    valid = amps['pulse_number'] >= 0
+    pulse_number = amps['pulse_number'][valid]
+    n_pulses = max(13, pulse_number.max() + 1) if len(pulse_number) > 0 else 13
+    flat_index = row[rec_index[valid]] * n_pulses + pulse_number
+    # keep only the last response for each (recording, pulse_number)
+    _, last = np.unique(flat_index[::-1], return_index=True)
+    last = len(flat_index) - 1 - last
+    train_amps = np.full(len(order) * n_pulses, np.nan)
+    train_amps[flat_index[last]] = amps['amplitude'][valid][last]
+    train_amps = train_amps.reshape(len(order), n_pulses)
+
+    return ind_freq[order], rec_delay[order], train_amps
+
+
 def generate_pair_dynamics(pair, db, session):
     """Generate a Dynamics table entry for the given pair.
     """
@@ -77,23 +174,18 @@ def generate_pair_dynamics(pair, db, session):
     logger.info('generate dynamics for %s', pair)
     syn_type = pair.synapse.synapse_type
     
-    amp_field = 'dec_fit_reconv_amp'
-    baseline_amp_field = 'baseline_' + amp_field
-    
     # load all IC pulse response amplitudes to determine the maximum that will be used for normalization
-    pr_query = pulse_response_query(pair, qc_pass=False, clamp_mode='ic', session=session)
-    pr_recs = pr_query.all()
+    all_amps = pulse_response_amplitudes(pair, amp_field='dec_fit_reconv_amp', clamp_mode='ic', session=session)
     # cull out all PRs that didn't get a fit or failed qc
-    qc_field = syn_type + '_qc_pass'
-    passed_pr_recs = [pr_rec for pr_rec in pr_recs if getattr(pr_rec.PulseResponse, qc_field) and getattr(pr_rec.PulseResponseFit, amp_field) is not None]
+    qc_pass = all_amps[syn_type + '_qc_pass']
+    passed = all_amps[qc_pass & np.isfinite(all_amps['amplitude'])]
     
     percentile = 90 if syn_type == 'ex' else 10
     # dec_fit_reconv_amp generally has much lower noise than fit_amp:
-    amps = [getattr(rec.PulseResponseFit, amp_field) for rec in passed_pr_recs]
-    amp_90p = scipy.stats.scoreatpercentile(amps, percentile)
+    amp_90p = scipy.stats.scoreatpercentile(passed['amplitude'], percentile)
 
     # load all baseline amplitudes to determine the noise level
-    noise_amps = np.array([getattr(rec.PulseResponseFit, baseline_amp_field) for rec in passed_pr_recs if getattr(rec.PulseResponseFit, baseline_amp_field) is not None])
+    noise_amps = passed['baseline_amplitude'][np.isfinite(passed['baseline_amplitude'])]
     noise_std = noise_amps.std()
     noise_90p = scipy.stats.scoreatpercentile(noise_amps, percentile)
 
@@ -105,47 +197,31 @@ def generate_pair_dynamics(pair, db, session):
         noise_std=noise_std,
     )
 
-    # sort all PRs by recording and stimulus parameters
-    #   [(clamp_mode, ind_freq, recovery_delay)][recording][pulse_number]
-    sorted_prs = sorted_pulse_responses(passed_pr_recs)
+    # arrange amplitudes as [recording, pulse_number]; missing pulses are NaN
+    ind_freq, rec_delay, amps = pulse_train_amplitudes(passed)
+    has_pulse = np.isfinite(amps)
+    is_50hz = ind_freq == 50
+    # has_train[:, n] is True for recordings with every pulse from 1 to n
+    has_train = np.cumprod(has_pulse[:, 1:], axis=1).astype(bool)
+    has_train = np.hstack([np.ones((len(amps), 1), dtype=bool), has_train])
 
     # calculate 50Hz paired pulse and induction metrics
-    metrics = {'stp_initial_50hz': [], 'stp_induction_50hz': [], 'stp_recovery_250ms': []}
-    paired_pulse_ratio = []
-    
-    for key,recs in sorted_prs.items():
-        clamp_mode, ind_freq, rec_delay = key
-        if ind_freq != 50:
-            continue
-        for recording, pulses in recs.items():
-            if 1 not in pulses or 2 not in pulses:
-                continue
-            amps = {k:getattr(r.PulseResponseFit, amp_field) for k,r in pulses.items()}
-            metrics['stp_initial_50hz'].append((amps[2] - amps[1]) / amp_90p)
-            if amps[1] != 0:
-                paired_pulse_ratio.append(amps[2] / amps[1])
-
-            if any([k not in pulses for k in [1,6,7,8]]):
-                continue
-            metrics['stp_induction_50hz'].append((np.mean([amps[6], amps[7], amps[8]]) - amps[1]) / amp_90p)
+    metrics = {}
+    mask = is_50hz & has_pulse[:, 1] & has_pulse[:, 2]
+    metrics['stp_initial_50hz'] = (amps[mask, 2] - amps[mask, 1]) / amp_90p
+    ppr_mask = mask & (amps[:, 1] != 0)
+    paired_pulse_ratio = amps[ppr_mask, 2] / amps[ppr_mask, 1]
+
+    mask = mask & has_pulse[:, 6:9].all(axis=1)
+    metrics['stp_induction_50hz'] = (amps[mask, 6:9].mean(axis=1) - amps[mask, 1]) / amp_90p
             
     # PPR is a bit out of place here, but we're including it since it's a popular metric used
     # in the literature.
     dynamics.paired_pulse_ratio_50hz = scipy.stats.gmean(paired_pulse_ratio)
     
     # calculate recovery at 250 ms
-    for key,recs in sorted_prs.items():
-        clamp_mode, ind_freq, rec_delay = key
-        if rec_delay is None:
-            continue
-        if abs(rec_delay - 250e-3) > 5e-3:
-            continue
-        for recording, pulses in recs.items():
-            if any([k not in pulses for k in range(1,13)]):
-                continue
-            amps = {k:getattr(r.PulseResponseFit, amp_field) for k,r in pulses.items()}
-            r = [amps[i+8] - amps[i] for i in range(1,5)]
-            metrics['stp_recovery_250ms'].append(np.mean(r) / amp_90p)
+    mask = np.isfinite(rec_delay) & (abs(rec_delay - 250e-3) <= 5e-3) & has_train[:, 12]
+    metrics['stp_recovery_250ms'] = (amps[mask, 9:13] - amps[mask, 1:5]).mean(axis=1) / amp_90p
 
     for k,v in metrics.items():
         setattr(dynamics, k, np.mean(v))
@@ -158,10 +234,7 @@ def generate_pair_dynamics(pair, db, session):
     #     sqrt(amp_stdev^2 - noise_stdev^2) / abs(amp_90th_percentile)
         
     # Variability at resting state:
-    resting_amps = []
-    for pr_rec in pr_recs:
-        if pr_rec.StimPulse.previous_pulse_dt > 8.0 and getattr(pr_rec.PulseResponse, qc_field):
-            resting_amps.append(getattr(pr_rec.PulseResponseFit, amp_field))
+    resting_amps = passed['amplitude'][passed['previous_pulse_dt'] > 8.0]
     
     if len(resting_amps) == 0:
         logger.info("%s: no resting amps; bail out", pair)
@@ -172,22 +245,11 @@ def generate_pair_dynamics(pair, db, session):
 
     dynamics.variability_resting_state = variability(resting_amps)
 
-    # Variability in STP-induced state (5th-8th pulses)
+    # Variability in 2nd pulse and STP-induced state (5th-8th pulses)
     pulse_amps = {
-        (2,3): [],
-        (5,9): [],
+        (2,3): amps[is_50hz & has_train[:, 2], 2:3].ravel(),
+        (5,9): amps[is_50hz & has_train[:, 8], 5:9].ravel(),
     }
-    # collect pulse amplitudes in each category
-    for key,recs in sorted_prs.items():
-        clamp_mode, ind_freq, rec_delay = key
-        if ind_freq != 50:
-            continue
-        for recording, pulses in recs.items():
-            for pulse_n, amps in pulse_amps.items():
-                if any([k not in pulses for k in range(1,pulse_n[-1])]):
-                    continue
-                for n in range(*pulse_n):
-                    amps.append(getattr(pulses[n].PulseResponseFit, amp_field))
     
     # normalize
     pulse_var = {n:(variability(a) if len(a) > 0 else np.nan) for n,a in pulse_amps.items()}
@@ -199,24 +261,10 @@ def generate_pair_dynamics(pair, db, session):
     dynamics.variability_change_induction_50hz = pulse_var[5,9] - dynamics.variability_resting_state
     
     # Look for evidence of vesicle depletion -- correlations between adjacent events in 50Hz pulses 5-8.
-    ev1_amp = []
-    ev2_amp = []
-    pulse_amps = [[] for i in range(9)]
-    for key,recs in sorted_prs.items():
-        clamp_mode, ind_freq, rec_delay = key
-        if ind_freq != 50:
-            continue
-        for recording, pulses in recs.items():
-            for i in range(1,9):
-                if i not in pulses:
-                    break
-                if i < 6:
-                    continue
-                ev1_amp.append(getattr(pulses[i-1].PulseResponseFit, amp_field))
-                ev2_amp.append(getattr(pulses[i].PulseResponseFit, amp_field))
-
-    ev1_amp = np.array(ev1_amp)
-    ev2_amp = np.array(ev2_amp)
+    # (pulse pairs 5-6, 6-7, 7-8, taken from recordings with every pulse up to the second of each pair)
+    pair_mask = has_train[:, 6:9] & is_50hz[:, None]
+    ev1_amp = amps[:, 5:8][pair_mask]
+    ev2_amp = amps[:, 6:9][pair_mask]
     ev1_amp -= np.median(ev1_amp)
     ev2_amp -= np.median(ev2_amp)
     
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.special
 import warnings, sys
 
 from pyqtgraph.debug import Profiler
@@ -61,3 +62,227 @@ def fit_avg_pulse_response(pulse_response_list, latency_window, sign, init_param
     prof('fit')
     
     return fit, average
+
+
+class BatchPspFit(object):
+    """Result of a single PSP fit generated by fit_psp_batch().
+
+    Provides the subset of the lmfit ModelResult interface that is used by the
+    pipeline: ``best_values`` and ``nrmse()``.
+    """
+    def __init__(self, best_values, nrmse):
+        self.best_values = best_values
+        self._nrmse = nrmse
+
+    def nrmse(self):
+        return self._nrmse
+
+    def __repr__(self):
+        return "<BatchPspFit %r>" % self.best_values
+
+
+def _psp_shape(x, rise_time, decay_tau, rise_power=2):
+    """Vectorized equivalent of Psp.psp_func with amp=1 and xoffset=yoffset=0.
+
+    *x* has shape (N, T); kinetic parameters have shape (N,).
+    """
+    rise_time = rise_time[:, None]
+    decay_tau = decay_tau[:, None]
+    rt_over_td = np.minimum(rise_time / (rise_power * decay_tau), 0.99999)
+    denom = np.real(scipy.special.lambertw(-rt_over_td * np.exp(-rt_over_td), k=-1) + rt_over_td)
+    rise_tau = -rise_time / denom
+    max_val = Psp._psp_inner(rise_time, rise_tau, rise_power, decay_tau)
+    xpos = np.maximum(x, 0)
+    return np.where(x >= 0, Psp._psp_inner(xpos, rise_tau, rise_power, decay_tau) / max_val, 0)
+
+
+def _fit_linear_psp(t, data, xoffset, rise_time, decay_tau, amp_bounds, exp_amp_bounds):
+    """Solve for the best yoffset, amp and exp_amp of a StackedPsp (with exp_tau=decay_tau)
+    given fixed xoffset and kinetics, for many traces at once.
+
+    With the nonlinear parameters held fixed the model is linear in the remaining three,
+    so each trace is solved exactly by least squares. Bounds on amp and exp_amp are enforced
+    by trying every combination of free / clamped-to-bound and keeping the best feasible
+    solution.
+
+    Returns (sse, yoffset, amp, exp_amp), each with shape (N,).
+    """
+    x = t - xoffset[:, None]
+    basis = np.empty(data.shape + (3,))
+    basis[..., 0] = 1
+    basis[..., 1] = _psp_shape(x, rise_time, decay_tau)
+    with np.errstate(over='ignore'):
+        basis[..., 2] = np.exp(-x / decay_tau[:, None])
+
+    n = data.shape[0]
+    bounds = [None, amp_bounds, exp_amp_bounds]
+
+    # everything below only needs the normal-equation terms, so the (N, T) arrays are reduced once
+    basis_t = basis.transpose(0, 2, 1)
+    gram = np.matmul(basis_t, basis)
+    bty = np.matmul(basis_t, data[:, :, None])[:, :, 0]
+    yty = (data**2).sum(axis=1)
+
+    def solve(rows, states):
+        # least-squares solution for traces *rows*, with amp / exp_amp either free (None)
+        # or clamped to their lower (0) or upper (1) bound
+        free = [i for i in range(3) if states[i] is None]
+        fixed = [i for i in range(3) if states[i] is not None]
+        params = np.zeros((len(rows), 3))
+        for i in fixed:
+            params[:, i] = bounds[i][rows, states[i]]
+        G = gram[rows]
+        rhs = bty[rows][:, free] - np.einsum('njk,nk->nj', G[:, free][:, :, fixed], params[:, fixed])
+        params[:, free] = np.einsum('njk,nk->nj', np.linalg.pinv(G[:, free][:, :, free]), rhs)
+        sse = yty[rows] - 2 * (params * bty[rows]).sum(axis=1) + np.einsum('nj,njk,nk->n', params, G, params)
+
+        feasible = np.ones(len(rows), dtype=bool)
+        for i in free[1:]:
+            lo, hi = bounds[i][rows, 0], bounds[i][rows, 1]
+            tol = 1e-9 * np.maximum(np.abs(lo), np.abs(hi))
+            feasible &= (params[:, i] >= lo - tol) & (params[:, i] <= hi + tol)
+        return sse, params, feasible
+
+    # most traces are solved without touching any bounds
+    all_rows = np.arange(n)
+    best_sse, best, feasible = solve(all_rows, [None, None, None])
+    best_sse[~feasible] = np.inf
+
+    # for the remainder, try every combination of clamped bounds and keep the best feasible result
+    rows = all_rows[~feasible]
+    if len(rows) > 0:
+        for amp_state in (None, 0, 1):
+            for exp_state in (None, 0, 1):
+                if amp_state is None and exp_state is None:
+                    continue
+                sse, params, ok = solve(rows, [None, amp_state, exp_state])
+                better = ok & (sse < best_sse[rows])
+                best_sse[rows[better]] = sse[better]
+                best[rows[better]] = params[better]
+    return best_sse, best[:, 0], best[:, 1], best[:, 2]
+
+
+def _golden_search(fn, lo, hi, n_iter):
+    """Vectorized golden-section minimization of fn(x) -> array, for x bounded in [lo, hi].
+    """
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = lo.copy(), hi.copy()
+    c = b - ratio * (b - a)
+    d = a + ratio * (b - a)
+    fc, fd = fn(c), fn(d)
+    for i in range(n_iter):
+        left = fc < fd
+        # keep [a, d] where f(c) < f(d), else [c, b]
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        # only one new point needs to be evaluated per trace
+        x = np.where(left, b - ratio * (b - a), a + ratio * (b - a))
+        fx = fn(x)
+        c, d = np.where(left, x, d), np.where(left, c, x)
+        fc, fd = np.where(left, fx, fd), np.where(left, fc, fx)
+    return (a + b) / 2
+
+
+def fit_psp_batch(t, data, search_window, clamp_mode, sign, rise_time, decay_tau, fit_kinetics=False, n_xoffset=11, n_iter=15):
+    """Fit many equal-length traces to a StackedPsp model at once.
+
+    This is a vectorized counterpart to ``neuroanalysis.fitting.fit_psp(..., baseline_like_psp=True, refine=False)``
+    as it is used by measure_response(). The model and parameter bounds are the same, but rather than
+    running one lmfit minimization per trace, the parameters that enter the model linearly
+    (yoffset, amp, exp_amp) are solved exactly for all traces in a single least-squares step,
+    and the remaining parameters (xoffset, and optionally rise_time / decay_tau) are found by a
+    grid search followed by golden-section refinement that is evaluated for all traces together.
+
+    Parameters
+    ----------
+    t : array
+        (N, T) array of time values for each trace
+    data : array
+        (N, T) array of trace values
+    search_window : array
+        (N, 2) array giving the range of allowed xoffset values for each trace
+    clamp_mode : str
+        'ic' or 'vc'; shared by all traces
+    sign : array
+        (N,) array of +1, -1, or 0 giving the expected sign of each response
+    rise_time : array
+        (N,) array of rise times (or initial rise times if *fit_kinetics* is True)
+    decay_tau : array
+        (N,) array of decay time constants (or initial values if *fit_kinetics* is True)
+    fit_kinetics : bool
+        If False, rise_time and decay_tau are held fixed. If True, they are fit within the same
+        bounds used by fit_psp (0.1x to 10x of the initial value).
+    n_xoffset : int
+        Number of grid points used for the initial xoffset search
+    n_iter : int
+        Number of golden-section iterations used to refine each nonlinear parameter
+
+    Returns
+    -------
+    fits : list
+        A BatchPspFit for each trace. Flat traces are fit with amp=0 and nrmse=0.
+    """
+    t = np.asarray(t, dtype=float)
+    data = np.asarray(data, dtype=float)
+    n = data.shape[0]
+    search_window = np.asarray(search_window, dtype=float).reshape(n, 2)
+    sign = np.asarray(sign).reshape(n)
+    rise_time = np.asarray(rise_time, dtype=float).reshape(n)
+    decay_tau = np.asarray(decay_tau, dtype=float).reshape(n)
+
+    # parameter bounds, as set up by fit_psp
+    data_range = data.max(axis=1) - data.min(axis=1)
+    if clamp_mode == 'ic':
+        amp_max = np.minimum(100e-3, 3 * data_range)
+        exp_amp_max = 100e-3
+    elif clamp_mode == 'vc':
+        amp_max = np.minimum(500e-12, 3 * data_range)
+        exp_amp_max = 10e-9
+    else:
+        raise ValueError('clamp_mode must be "ic" or "vc"')
+    amp_bounds = np.stack([np.where(sign == 1, 0, -amp_max), np.where(sign == -1, 0, amp_max)], axis=1)
+    exp_amp_bounds = np.stack([np.where(sign == 1, 0, -exp_amp_max), np.where(sign == -1, 0, exp_amp_max)], axis=1)
+
+    params = {'xoffset': None, 'rise_time': rise_time, 'decay_tau': decay_tau}
+
+    def sse(**kwds):
+        p = params.copy()
+        p.update(kwds)
+        return _fit_linear_psp(t, data, p['xoffset'], p['rise_time'], p['decay_tau'], amp_bounds, exp_amp_bounds)[0]
+
+    # coarse grid search over xoffset
+    lo, hi = search_window[:, 0], search_window[:, 1]
+    grid = np.linspace(0, 1, n_xoffset)
+    grid_sse = np.array([sse(xoffset=lo + (hi - lo) * g) for g in grid])
+    best_i = np.argmin(grid_sse, axis=0)
+    step = (hi - lo) / max(n_xoffset - 1, 1)
+    xoff = lo + (hi - lo) * grid[best_i]
+    params['xoffset'] = _golden_search(lambda x: sse(xoffset=x), np.maximum(lo, xoff - step), np.minimum(hi, xoff + step), n_iter)
+
+    if fit_kinetics:
+        # refine kinetics in log space, one parameter at a time
+        for i in range(2):
+            for name, init in (('rise_time', rise_time), ('decay_tau', decay_tau)):
+                log_fn = lambda x, name=name: sse(**{name: np.exp(x)})
+                params[name] = np.exp(_golden_search(log_fn, np.log(init / 10.), np.log(init * 10.), n_iter))
+            params['xoffset'] = _golden_search(lambda x: sse(xoffset=x), lo, hi, n_iter)
+
+    err, yoffset, amp, exp_amp = _fit_linear_psp(t, data, params['xoffset'], params['rise_time'], params['decay_tau'], amp_bounds, exp_amp_bounds)
+    # flat traces are fit exactly by yoffset alone; define their nrmse as 0 rather than 0/0
+    flat = data_range == 0
+    rmse = (err / data.shape[1])**0.5
+    nrmse = np.where(flat, 0, rmse / np.where(flat, 1, data.std(axis=1)))
+
+    fits = []
+    for i in range(n):
+        fits.append(BatchPspFit({
+            'xoffset': params['xoffset'][i],
+            'yoffset': yoffset[i],
+            'rise_time': params['rise_time'][i],
+            'decay_tau': params['decay_tau'][i],
+            'amp': amp[i],
+            'rise_power': 2.0,
+            'exp_amp': exp_amp[i],
+            'exp_tau': params['decay_tau'][i],
+        }, nrmse[i]))
+    return fits
@@ -0,0 +1,163 @@
+"""
+Content fingerprints used to decide whether pipeline jobs need to be rerun.
+
+A job's fingerprint combines the module name and version, hashes of the contents of its
+input files, any extra input data supplied by the module, and the result hashes of the
+upstream jobs it depends on. Touching or re-syncing a file without changing its contents
+therefore does not invalidate any results.
+
+File hashes are cached on disk, keyed by (path, size, mtime), so that each file is only
+read again after it has been modified.
+"""
+from __future__ import print_function, division
+
+import os, json, hashlib, threading, logging
+from .. import config
+from ..util import replace_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileHashCache(object):
+    """Persistent cache of file content hashes.
+
+    Parameters
+    ----------
+    cache_file : str | None
+        JSON file in which hashes are stored. By default, ``config.cache_path/pipeline_file_hashes.json``
+        is used.
+    """
+    version = 1
+    chunk_size = 2**20
+
+    def __init__(self, cache_file=None):
+        if cache_file is None:
+            cache_file = os.path.join(config.cache_path, 'pipeline_file_hashes.json')
+        self.cache_file = cache_file
+        self.lock = threading.RLock()
+        self.hashes = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        """Read cached hashes from disk, if the cache file exists.
+        """
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as fh:
+                data = json.load(fh)
+        except Exception:
+            logger.warning("Could not read file hash cache %s; starting a new one", self.cache_file)
+            return
+        if data.get('version') != self.version:
+            return
+        with self.lock:
+            self.hashes = data['hashes']
+
+    def save(self):
+        """Write cached hashes to disk (only if any were added since the last save).
+        """
+        with self.lock:
+            if not self._dirty:
+                return
+            path = os.path.dirname(self.cache_file)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            tmp = self.cache_file + '.tmp.%d' % os.getpid()
+            with open(tmp, 'w') as fh:
+                json.dump({'version': self.version, 'hashes': self.hashes}, fh)
+            replace_file(tmp, self.cache_file)
+            self._dirty = False
+
+    def file_hash(self, path, stat=None):
+        """Return the sha1 hex digest of the contents of a file, or None if the file does not exist.
+
+        For directories, the hash covers the sorted list of entry names (so that added or removed
+        files are detected).
+
+        If the (mtime, size) of the file is already known (for example from RawDataIndex.stat),
+        it may be given as *stat* to avoid calling os.stat; the file is then only read if its
+        hash is not cached for that mtime and size.
+        """
+        path = os.path.abspath(path)
+        if stat is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            stat = (st.st_mtime, None if os.path.isdir(path) else st.st_size)
+        key = [stat[1], stat[0]]
+        with self.lock:
+            cached = self.hashes.get(path)
+            if cached is not None and cached[:2] == key:
+                return cached[2]
+
+        sha = hashlib.sha1()
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                sha.update(name.encode('utf8') + b'\n')
+        else:
+            with open(path, 'rb') as fh:
+                while True:
+                    chunk = fh.read(self.chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self.lock:
+            self.hashes[path] = key + [digest]
+            self._dirty = True
+        return digest
+
+
+_default_cache = None
+def default_hash_cache():
+    """Return a FileHashCache shared by all pipeline modules in this process.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FileHashCache()
+    return _default_cache
+
+
+def job_fingerprint(module_name, module_version, input_files=(), input_data=None, upstream=(), hash_cache=None, input_file_stats=None):
+    """Return a fingerprint describing all inputs to a single job.
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the pipeline module that runs the job.
+    module_version : object
+        Version of the module's analysis (see PipelineModule.version).
+    input_files : list
+        Paths of raw data files (or directories) read by the job. Missing files are allowed.
+    input_data : object
+        Any other JSON-serializable data that affects the job result.
+    upstream : list
+        Result hashes of upstream jobs that this job depends on.
+    hash_cache : FileHashCache | None
+        Cache used to hash input files (default is :func:`default_hash_cache`).
+    input_file_stats : dict | None
+        Optional {path: (mtime, size)} for input files whose stats are already known (None for
+        missing files). Files listed here are not stat'ed again.
+    """
+    if hash_cache is None:
+        hash_cache = default_hash_cache()
+    stats = input_file_stats or {}
+    file_hashes = []
+    for f in input_files:
+        if f in stats and stats[f] is None:
+            file_hashes.append(None)
+        else:
+            file_hashes.append(hash_cache.file_hash(f, stats.get(f)))
+    state = {
+        'module': module_name,
+        'version': module_version,
+        'files': sorted(file_hashes, key=str),
+        'data': input_data,
+        'upstream': sorted(upstream, key=str),
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode('utf8')).hexdigest()
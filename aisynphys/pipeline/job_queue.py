@@ -0,0 +1,446 @@
+"""
+Job queue stored in the pipeline database, so that pipeline updates can be processed by
+worker processes running on several hosts.
+
+Jobs are added to the ``pipeline_queue`` table along with the upstream jobs that must finish
+before they may start (``pipeline_queue_dependency``). Each worker repeatedly claims one ready
+job, runs it, and records the outcome. Claims are made atomically: on postgres, rows are
+selected with ``FOR UPDATE SKIP LOCKED``; on sqlite, the claim is made inside a
+``BEGIN IMMEDIATE`` transaction, which holds the database write lock.
+
+While a job runs, its worker updates the job's heartbeat time. Jobs whose heartbeat is older
+than ``config.queue_lease_time`` (for example, because the worker host crashed) are returned
+to the queue, or marked as failed once they have been claimed ``max_attempts`` times. If a job
+fails, all queued jobs downstream of it are skipped.
+
+Heartbeat times are compared across hosts, so all hosts are expected to have synchronized
+clocks (all times are UTC).
+"""
+from __future__ import print_function, division
+
+import os, time, socket, threading, logging, multiprocessing
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import OperationalError
+from .. import config, database
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+    """Database-backed queue of jobs for a single pipeline.
+
+    Parameters
+    ----------
+    database : Database
+        The pipeline database in which the queue tables are stored.
+    pipeline_name : str
+        Name of the pipeline whose jobs are queued.
+    lease_time : float | None
+        Seconds after the last heartbeat at which a claimed job is considered abandoned.
+        Default is ``config.queue_lease_time``.
+    max_attempts : int
+        Number of times a job may be claimed before it is marked as failed.
+    worker_name : str | None
+        Name recorded with claimed jobs. Default is "hostname:pid".
+    busy_timeout : float
+        Seconds that sqlite connections wait for another worker's write lock before raising
+        OperationalError ("database is locked").
+    """
+    # number of times claim(), heartbeat() and finish() are attempted if the database is busy
+    # or the connection fails
+    max_retries = 3
+
+    def __init__(self, database, pipeline_name, lease_time=None, max_attempts=3, worker_name=None, busy_timeout=60):
+        self.database = database
+        self.pipeline_name = pipeline_name
+        self.lease_time = config.queue_lease_time if lease_time is None else lease_time
+        self.max_attempts = max_attempts
+        self.busy_timeout = busy_timeout
+        self.worker_name = worker_name or '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def initialize(self):
+        """Create the queue tables if they do not exist yet.
+        """
+        db = self.database
+        tables = ['pipeline_queue', 'pipeline_queue_dependency']
+        if any(t not in db.table_names() for t in tables):
+            db.create_tables(tables)
+
+    def _session(self):
+        """Return a read-write session; on sqlite, its connection waits up to busy_timeout for locks
+        held by other workers.
+        """
+        session = self.database.session(readonly=False)
+        if self.database.backend == 'sqlite':
+            session.execute('PRAGMA busy_timeout = %d' % int(self.busy_timeout * 1000))
+        return session
+
+    def _locked_session(self):
+        """Return a read-write session in which claims can be made without racing other workers.
+        """
+        session = self._session()
+        if self.database.backend == 'sqlite':
+            # take the write lock now rather than at the first UPDATE, so that two workers
+            # cannot both select the same job
+            session.execute('BEGIN IMMEDIATE')
+        return session
+
+    def _retry(self, fn, *args):
+        """Call ``fn(*args)``, retrying up to max_retries times if it raises OperationalError.
+        """
+        for i in range(self.max_retries):
+            try:
+                return fn(*args)
+            except OperationalError:
+                if i == self.max_retries - 1:
+                    raise
+                logger.warning("Job queue operation failed (attempt %d/%d); retrying", i + 1, self.max_retries, exc_info=True)
+                time.sleep(2**i)
+
+    def enqueue(self, graph):
+        """Add all jobs in a :class:`JobGraph` to the queue, along with their dependencies.
+
+        Jobs that are already queued or running are not added again. Finished entries for
+        this pipeline (done, failed, or skipped) are removed from the queue first.
+
+        Returns the number of jobs added.
+        """
+        self.initialize()
+        db = self.database
+        Q = db.PipelineQueue
+        session = self._locked_session()
+        try:
+            self._clear_finished(session)
+            active = {(rec.module_name, rec.job_id): rec.id for rec in session.query(Q.module_name, Q.job_id, Q.id).filter(Q.pipeline_name==self.pipeline_name)}
+
+            new_recs = OrderedDict()
+            for key, job in graph.jobs.items():
+                key = (key[0], str(key[1]))
+                if key in active:
+                    continue
+                rec = Q(
+                    pipeline_name=self.pipeline_name,
+                    module_name=key[0],
+                    job_id=key[1],
+                    status='queued',
+                    attempts=0,
+                    meta={'job_meta': job.get('meta'), 'debug': job.get('debug', False)},
+                )
+                session.add(rec)
+                new_recs[key] = rec
+            session.flush()
+
+            ids = dict(active)
+            ids.update({key: rec.id for key, rec in new_recs.items()})
+            for key, up_keys in graph.upstream.items():
+                key = (key[0], str(key[1]))
+                if key not in new_recs:
+                    continue
+                for up_key in up_keys:
+                    up_key = (up_key[0], str(up_key[1]))
+                    if up_key in ids:
+                        session.add(db.PipelineQueueDependency(queue_id=ids[key], upstream_id=ids[up_key]))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return len(new_recs)
+
+    def _clear_finished(self, session):
+        db = self.database
+        Q = db.PipelineQueue
+        D = db.PipelineQueueDependency
+        finished = session.query(Q.id).filter(Q.pipeline_name==self.pipeline_name).filter(Q.status.in_(['done', 'failed', 'skipped']))
+        session.query(D).filter(D.queue_id.in_(finished.subquery())).delete(synchronize_session=False)
+        session.query(D).filter(D.upstream_id.in_(finished.subquery())).delete(synchronize_session=False)
+        finished.delete(synchronize_session=False)
+
+    def clear(self):
+        """Remove all jobs for this pipeline from the queue (including jobs that are running).
+        """
+        self.initialize()
+        db = self.database
+        Q = db.PipelineQueue
+        D = db.PipelineQueueDependency
+        session = self._locked_session()
+        try:
+            ids = session.query(Q.id).filter(Q.pipeline_name==self.pipeline_name)
+            session.query(D).filter(D.queue_id.in_(ids.subquery())).delete(synchronize_session=False)
+            ids.delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def claim(self):
+        """Claim the next job that is ready to run (all of its upstream jobs are done).
+
+        Returns a dict with keys 'id', 'module_name', 'job_id', 'attempts', 'job_meta', and 'debug',
+        or None if no job is ready.
+        """
+        return self._retry(self._claim)
+
+    def _claim(self):
+        db = self.database
+        Q = db.PipelineQueue
+        D = db.PipelineQueueDependency
+        Up = aliased(Q)
+        session = self._locked_session()
+        try:
+            self._reclaim_expired(session)
+
+            blocked = session.query(D.id).join(Up, Up.id==D.upstream_id).filter(D.queue_id==Q.id).filter(Up.status != 'done')
+            q = session.query(Q).filter(Q.pipeline_name==self.pipeline_name).filter(Q.status=='queued').filter(~blocked.exists())
+            rec = self._for_update(q.order_by(Q.id).limit(1)).first()
+            if rec is None:
+                session.commit()
+                return None
+
+            now = datetime.utcnow()
+            rec.status = 'running'
+            rec.worker = self.worker_name
+            rec.claim_time = now
+            rec.heartbeat_time = now
+            rec.attempts = (rec.attempts or 0) + 1
+            meta = rec.meta or {}
+            job = {
+                'id': rec.id,
+                'module_name': rec.module_name,
+                'job_id': rec.job_id,
+                'attempts': rec.attempts,
+                'job_meta': meta.get('job_meta'),
+                'debug': meta.get('debug', False),
+            }
+            session.commit()
+            return job
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _for_update(self, query):
+        """Lock the rows selected by *query* (on sqlite, the whole database is already locked).
+        """
+        if self.database.backend == 'postgresql':
+            query = query.with_for_update(skip_locked=True, of=self.database.PipelineQueue)
+        return query
+
+    def _reclaim_expired(self, session):
+        """Return jobs whose worker stopped sending heartbeats to the queue (or mark them failed
+        after too many attempts).
+        """
+        Q = self.database.PipelineQueue
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_time)
+        expired = session.query(Q).filter(Q.pipeline_name==self.pipeline_name).filter(Q.status=='running').filter(Q.heartbeat_time < cutoff)
+        for rec in self._for_update(expired).all():
+            msg = "claim by worker %s expired (no heartbeat since %s)" % (rec.worker, rec.heartbeat_time)
+            if rec.attempts >= self.max_attempts:
+                logger.warning("Job %s %s failed: %s", rec.module_name, rec.job_id, msg)
+                rec.status = 'failed'
+                rec.error = msg
+                rec.finish_time = datetime.utcnow()
+                session.flush()
+                self._skip_downstream(session, rec)
+            else:
+                logger.warning("Returning job %s %s to queue: %s", rec.module_name, rec.job_id, msg)
+                rec.status = 'queued'
+                rec.worker = None
+        session.flush()
+
+    def heartbeat(self, job):
+        """Update the heartbeat time of a claimed job.
+
+        Returns False if the job is no longer claimed by this worker.
+        """
+        return self._retry(self._heartbeat, job)
+
+    def _heartbeat(self, job):
+        Q = self.database.PipelineQueue
+        session = self._session()
+        try:
+            n = session.query(Q).filter(Q.id==job['id']).filter(Q.worker==self.worker_name).filter(Q.status=='running').update(
+                {'heartbeat_time': datetime.utcnow()}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+        return n > 0
+
+    def keep_alive(self, job, interval=None):
+        """Return a context manager that sends heartbeats for *job* from a background thread.
+        """
+        if interval is None:
+            interval = max(self.lease_time / 5., 1)
+        return _HeartbeatThread(self, job, interval)
+
+    def finish(self, job, error=None):
+        """Record the outcome of a claimed job.
+
+        If *error* is not None, the job is marked as failed and all queued jobs downstream of it are
+        skipped. Returns False (and records nothing) if the job's claim expired and it was returned
+        to the queue in the meantime.
+        """
+        return self._retry(self._finish, job, error)
+
+    def _finish(self, job, error):
+        Q = self.database.PipelineQueue
+        session = self._locked_session()
+        try:
+            rec = session.query(Q).filter(Q.id==job['id']).first()
+            if rec is None or rec.status != 'running' or rec.worker != self.worker_name:
+                session.commit()
+                return False
+            rec.status = 'done' if error is None else 'failed'
+            rec.error = error
+            rec.finish_time = datetime.utcnow()
+            session.flush()
+            if error is not None:
+                self._skip_downstream(session, rec)
+            session.commit()
+            return True
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _skip_downstream(self, session, rec):
+        Q = self.database.PipelineQueue
+        D = self.database.PipelineQueueDependency
+        reason = "upstream job %s %s failed" % (rec.module_name, rec.job_id)
+        frontier = [rec.id]
+        while len(frontier) > 0:
+            down = session.query(Q).join(D, D.queue_id==Q.id).filter(D.upstream_id.in_(frontier)).filter(Q.status=='queued').all()
+            for drec in down:
+                drec.status = 'skipped'
+                drec.error = reason
+            session.flush()
+            frontier = [drec.id for drec in down]
+
+    def status(self):
+        """Return an OrderedDict {module_name: {status: count}} describing the jobs in the queue.
+        """
+        self.initialize()
+        Q = self.database.PipelineQueue
+        session = self.database.session()
+        counts = OrderedDict()
+        for mod_name, status in session.query(Q.module_name, Q.status).filter(Q.pipeline_name==self.pipeline_name).order_by(Q.id):
+            mod_counts = counts.setdefault(mod_name, OrderedDict())
+            mod_counts[status] = mod_counts.get(status, 0) + 1
+        session.rollback()
+        return counts
+
+    def n_pending(self):
+        """Return the number of jobs that are queued or running.
+        """
+        Q = self.database.PipelineQueue
+        session = self.database.session()
+        n = session.query(Q).filter(Q.pipeline_name==self.pipeline_name).filter(Q.status.in_(['queued', 'running'])).count()
+        session.rollback()
+        return n
+
+
+class _HeartbeatThread(object):
+    def __init__(self, queue, job, interval):
+        self.queue = queue
+        self.job = job
+        self.interval = interval
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='queue-heartbeat')
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job):
+                    logger.warning("Lost claim on job %s %s", self.job['module_name'], self.job['job_id'])
+                    return
+            except Exception:
+                logger.exception("Error sending heartbeat for job %s %s", self.job['module_name'], self.job['job_id'])
+
+
+def run_queue_worker(pipeline, poll_interval=10, max_jobs=None, **queue_kwds):
+    """Claim and run jobs from the pipeline's job queue until no queued or running jobs remain.
+
+    Jobs are run in this process, one at a time. Results are stored exactly as they would be by
+    :func:`Pipeline.update`.
+
+    Parameters
+    ----------
+    pipeline : Pipeline
+        The pipeline whose queued jobs should be run.
+    poll_interval : float
+        Seconds to wait before checking again when jobs are queued but none are ready (their
+        upstream jobs are still running elsewhere).
+    max_jobs : int | None
+        Maximum number of jobs to run before returning.
+    queue_kwds :
+        Extra keyword arguments used to create the :class:`JobQueue`.
+
+    Returns
+    -------
+    results : OrderedDict
+        {(module_name, job_id): error} for every job run by this worker.
+    """
+    queue = JobQueue(pipeline.database, pipeline.name, **queue_kwds)
+    queue.initialize()
+    results = OrderedDict()
+    while max_jobs is None or len(results) < max_jobs:
+        job = queue.claim()
+        if job is None:
+            if queue.n_pending() == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        module = pipeline.get_module(job['module_name'])
+        if job['attempts'] > 1:
+            # an earlier claim on this job expired; remove anything it may have stored
+            module.drop_jobs([job['job_id']])
+        spec = module.make_job_specs([job['job_id']], {job['job_id']: job['job_meta']}, debug=job['debug'])[0]
+        with queue.keep_alive(job):
+            try:
+                error = module._run_job(spec)['error']
+            except Exception as exc:
+                queue.finish(job, str(exc))
+                raise
+        queue.finish(job, error)
+        results[(job['module_name'], job['job_id'])] = error
+    return results
+
+
+def _queue_worker_main(pipeline_name, db, kwds):
+    from .pipeline import Pipeline
+    pipeline = Pipeline.all_pipelines()[pipeline_name](database=db, config=config)
+    results = run_queue_worker(pipeline, **kwds)
+    errors = len([e for e in results.values() if e is not None])
+    print("Queue worker %d finished %d jobs (%d errors)" % (os.getpid(), len(results), errors))
+
+
+def run_local_queue_workers(pipeline, workers=None, **kwds):
+    """Start *workers* processes on this host that run jobs from the pipeline's job queue
+    (see :func:`run_queue_worker`), and wait for all of them to exit.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    # kill DB connections before forking
+    database.dispose_all_engines()
+    procs = []
+    for i in range(workers):
+        proc = multiprocessing.Process(target=_queue_worker_main, args=(pipeline.name, pipeline.database, kwds), name='queue-worker')
+        proc.start()
+        procs.append(proc)
+    for proc in procs:
+        proc.join()
+    return [proc.exitcode for proc in procs]
@@ -8,9 +8,10 @@ from ...util import timestamp_to_datetime, datetime_to_timestamp
 from ...data import Experiment
 from .pipeline_module import MultipatchPipelineModule
 from .experiment import ExperimentPipelineModule
+from .raw_data_index import raw_data_index
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.data import PatchClampRecording
-from ...data import Experiment, MultiPatchDataset, MultiPatchProbe, PulseStimAnalyzer, MultiPatchSyncRecAnalyzer, BaselineDistributor
+from ...data import Experiment, MultiPatchDataset, MultiPatchProbe, PulseStimAnalyzer, MultiPatchSyncRecAnalyzer, BaselineDistributor, cut_windows
 
 
 class DatasetPipelineModule(MultipatchPipelineModule):
@@ -19,10 +20,6 @@ class DatasetPipelineModule(MultipatchPipelineModule):
     name = 'dataset'
     dependencies = [ExperimentPipelineModule]
     table_group = ['sync_rec', 'recording', 'patch_clamp_recording', 'multi_patch_probe', 'test_pulse', 'stim_pulse', 'stim_spike', 'pulse_response', 'baseline']
-
-    # datasets are large and NWB access leaks memory
-    # when running parallel, each child process may run only one job before being killed
-    maxtasksperchild = 1  
     
     @classmethod
     def create_db_entries(cls, job, session):
@@ -31,6 +28,25 @@ class DatasetPipelineModule(MultipatchPipelineModule):
 
         # Load experiment from DB
         expt_entry = db.experiment_from_ext_id(job_id, session=session)
+
+        # load NWB file
+        path = os.path.join(config.synphys_data, expt_entry.storage_path)
+        expt = Experiment(path)
+        nwb = expt.data
+
+        cls.import_nwb(db, expt_entry, nwb, session)
+
+    @classmethod
+    def import_nwb(cls, db, expt_entry, nwb, session):
+        """Load all recordings, stimulus pulses and pulse responses from *nwb* into the DB
+        as children of *expt_entry*.
+
+        Rather than creating ORM objects, new records are collected as plain dicts. Records refer
+        to each other by holding the referenced dict in place of a foreign key; once everything
+        is collected, primary keys are reserved for each table and all records are written with
+        one executemany per table (see Database.bulk_insert).
+        """
+        job_id = expt_entry.ext_id
         elecs_by_ad_channel = {elec.device_id:elec for elec in expt_entry.electrodes}
         pairs_by_device_id = {}
         for pair in expt_entry.pairs.values():
@@ -38,18 +54,19 @@ class DatasetPipelineModule(MultipatchPipelineModule):
             post_dev_id = pair.post_cell.electrode.device_id
             pairs_by_device_id[(pre_dev_id, post_dev_id)] = pair
         
-        # load NWB file
-        path = os.path.join(config.synphys_data, expt_entry.storage_path)
-        expt = Experiment(path)
-        nwb = expt.data
-        
+        # new rows to insert, in foreign key order
+        rows = OrderedDict([(table, []) for table in [
+            'sync_rec', 'recording', 'test_pulse', 'patch_clamp_recording', 'multi_patch_probe',
+            'stim_pulse', 'stim_spike', 'baseline', 'pulse_response',
+        ]])
+
         last_stim_pulse_time = {}
         
         # Load all data from NWB into DB
         for srec in nwb.contents:
             temp = srec.meta.get('temperature', None)
-            srec_entry = db.SyncRec(ext_id=srec.key, experiment=expt_entry, temperature=temp)
-            session.add(srec_entry)
+            srec_entry = {'ext_id': srec.key, 'experiment_id': expt_entry.id, 'temperature': temp, 'meta': None}
+            rows['sync_rec'].append(srec_entry)
             
             srec_has_mp_probes = False
             
@@ -62,49 +79,52 @@ class DatasetPipelineModule(MultipatchPipelineModule):
                 
                 # import all recordings
                 electrode_entry = elecs_by_ad_channel[rec.device_id]  # should probably just skip if this causes KeyError?
-                rec_entry = db.Recording(
-                    sync_rec=srec_entry,
-                    electrode=electrode_entry,
-                    start_time=rec.start_time,
-                )
-                session.add(rec_entry)
+                rec_entry = {
+                    'sync_rec_id': srec_entry,
+                    'electrode_id': electrode_entry.id,
+                    'start_time': rec.start_time,
+                    'meta': None,
+                }
+                rows['recording'].append(rec_entry)
                 rec_entries[rec.device_id] = rec_entry
                 
                 # import patch clamp recording information
                 if not isinstance(rec, PatchClampRecording):
                     continue
-                qc_pass, qc_failures = qc.recording_qc_pass(rec)
-                pcrec_entry = db.PatchClampRecording(
-                    recording=rec_entry,
-                    clamp_mode=rec.clamp_mode,
-                    patch_mode=rec.patch_mode,
-                    stim_name=rec.stimulus.description,
-                    baseline_potential=rec.baseline_potential,
-                    baseline_current=rec.baseline_current,
-                    baseline_rms_noise=rec.baseline_rms_noise,
-                    qc_pass=qc_pass,
-                    meta=None if len(qc_failures) == 0 else {'qc_failures': qc_failures},
-                )
-                session.add(pcrec_entry)
+                qc_pass, qc_failures = qc.cached_recording_qc_pass(rec)
+                pcrec_entry = {
+                    'recording_id': rec_entry,
+                    'clamp_mode': rec.clamp_mode,
+                    'patch_mode': rec.patch_mode,
+                    'stim_name': rec.stimulus.description,
+                    'baseline_potential': rec.baseline_potential,
+                    'baseline_current': rec.baseline_current,
+                    'baseline_rms_noise': rec.baseline_rms_noise,
+                    'nearest_test_pulse_id': None,
+                    'qc_pass': qc_pass,
+                    'meta': None if len(qc_failures) == 0 else {'qc_failures': qc_failures},
+                }
+                rows['patch_clamp_recording'].append(pcrec_entry)
 
                 # import test pulse information
                 tp = rec.nearest_test_pulse
                 if tp is not None:
                     indices = tp.indices or [None, None]
-                    tp_entry = db.TestPulse(
-                        electrode=electrode_entry,
-                        recording=rec_entry,
-                        start_index=indices[0],
-                        stop_index=indices[1],
-                        baseline_current=tp.baseline_current,
-                        baseline_potential=tp.baseline_potential,
-                        access_resistance=tp.access_resistance,
-                        input_resistance=tp.input_resistance,
-                        capacitance=tp.capacitance,
-                        time_constant=tp.time_constant,
-                    )
-                    session.add(tp_entry)
-                    pcrec_entry.nearest_test_pulse = tp_entry
+                    tp_entry = {
+                        'electrode_id': electrode_entry.id,
+                        'recording_id': rec_entry,
+                        'start_index': indices[0],
+                        'stop_index': indices[1],
+                        'baseline_current': tp.baseline_current,
+                        'baseline_potential': tp.baseline_potential,
+                        'access_resistance': tp.access_resistance,
+                        'input_resistance': tp.input_resistance,
+                        'capacitance': tp.capacitance,
+                        'time_constant': tp.time_constant,
+                        'meta': None,
+                    }
+                    rows['test_pulse'].append(tp_entry)
+                    pcrec_entry['nearest_test_pulse_id'] = tp_entry
                     
                 # import information about STP protocol
                 if not isinstance(rec, MultiPatchProbe):
@@ -112,12 +132,13 @@ class DatasetPipelineModule(MultipatchPipelineModule):
                 srec_has_mp_probes = True
                 psa = PulseStimAnalyzer.get(rec)
                 ind_freq, rec_delay = psa.stim_params()
-                mprec_entry = db.MultiPatchProbe(
-                    patch_clamp_recording=pcrec_entry,
-                    induction_frequency=ind_freq,
-                    recovery_delay=rec_delay,
-                )
-                session.add(mprec_entry)
+                mprec_entry = {
+                    'patch_clamp_recording_id': pcrec_entry,
+                    'induction_frequency': ind_freq,
+                    'recovery_delay': rec_delay,
+                    'meta': None,
+                }
+                rows['multi_patch_probe'].append(mprec_entry)
             
                 # import presynaptic stim pulses
                 pulses = psa.pulse_chunks()
@@ -129,20 +150,23 @@ class DatasetPipelineModule(MultipatchPipelineModule):
                     # Record information about all pulses, including test pulse.
                     t0, t1 = pulse.meta['pulse_edges']
                     resampled = pulse['primary'].resample(sample_rate=db.default_sample_rate)
-                    clock_time = t0 + datetime_to_timestamp(rec_entry.start_time)
+                    clock_time = t0 + datetime_to_timestamp(rec_entry['start_time'])
                     prev_pulse_dt = clock_time - last_stim_pulse_time.get(rec.device_id, -np.inf)
                     last_stim_pulse_time[rec.device_id] = clock_time
-                    pulse_entry = db.StimPulse(
-                        recording=rec_entry,
-                        pulse_number=pulse.meta['pulse_n'],
-                        onset_time=t0,
-                        amplitude=pulse.meta['pulse_amplitude'],
-                        duration=t1-t0,
-                        data=resampled.data,
-                        data_start_time=resampled.t0,
-                        previous_pulse_dt=prev_pulse_dt,
-                    )
-                    session.add(pulse_entry)
+                    pulse_entry = {
+                        'recording_id': rec_entry,
+                        'pulse_number': pulse.meta['pulse_n'],
+                        'onset_time': t0,
+                        'amplitude': pulse.meta['pulse_amplitude'],
+                        'duration': t1-t0,
+                        'n_spikes': None,
+                        'first_spike_time': None,
+                        'data': resampled.data,
+                        'data_start_time': resampled.t0,
+                        'previous_pulse_dt': prev_pulse_dt,
+                        'meta': None,
+                    }
+                    rows['stim_pulse'].append(pulse_entry)
                     pulse_entries[pulse.meta['pulse_n']] = pulse_entry
                     
 
@@ -152,31 +176,33 @@ class DatasetPipelineModule(MultipatchPipelineModule):
                 spikes = psa.evoked_spikes()
                 for i,sp in enumerate(spikes):
                     pulse = pulse_entries[sp['pulse_n']]
-                    pulse.n_spikes = len(sp['spikes'])
+                    pulse['n_spikes'] = len(sp['spikes'])
                     for i,spike in enumerate(sp['spikes']):
-                        spike_entry = db.StimSpike(
-                            stim_pulse=pulse,
-                            onset_time=spike['onset_time'],
-                            peak_time=spike['peak_time'],
-                            max_slope_time=spike['max_slope_time'],
-                            max_slope=spike['max_slope'],
-                            peak_diff=spike.get('peak_diff'),
-                            peak_value=spike['peak_value'],
-                        )
-                        session.add(spike_entry)
+                        spike_entry = {
+                            'stim_pulse_id': pulse,
+                            'onset_time': spike['onset_time'],
+                            'peak_time': spike['peak_time'],
+                            'max_slope_time': spike['max_slope_time'],
+                            'max_slope': spike['max_slope'],
+                            'peak_diff': spike.get('peak_diff'),
+                            'peak_value': spike['peak_value'],
+                            'meta': None,
+                        }
+                        rows['stim_spike'].append(spike_entry)
                         if i == 0:
-                            # pulse.first_spike = spike_entry
-                            pulse.first_spike_time = spike_entry.max_slope_time
+                            pulse['first_spike_time'] = spike_entry['max_slope_time']
             
             if not srec_has_mp_probes:
                 continue
 
             # collect and shuffle baseline chunks for each recording
             baseline_chunks = {}
+            baseline_windows = {}
             for post_dev in srec.devices:
 
                 base_dist = BaselineDistributor.get(srec[post_dev])
                 chunks = list(base_dist.baseline_chunks())
+                baseline_windows[post_dev] = chunks[:]
                 
                 # generate a different random shuffle for each combination pre,post device
                 # (we are not allowed to reuse the same baseline chunks for a particular pre-post pair,
@@ -198,51 +224,59 @@ class DatasetPipelineModule(MultipatchPipelineModule):
             unmatched = 0
             mpa = MultiPatchSyncRecAnalyzer(srec)
             for pre_dev in srec.devices:
-                for post_dev in srec.devices:
-                    if pre_dev == post_dev:
-                        continue
+                # only pairs with a DB record are imported
+                post_devs = [post_dev for post_dev in srec.devices if post_dev != pre_dev and (pre_dev, post_dev) in pairs_by_device_id]
+                if len(post_devs) == 0:
+                    continue  # no data for one or both channels
 
-                    # get all responses, regardless of the presence of a spike
-                    responses = mpa.get_spike_responses(srec[pre_dev], srec[post_dev], align_to='pulse', require_spike=False)
-                    
-                    for resp in responses:
-                        pair_entry = pairs_by_device_id.get((pre_dev, post_dev), None)
-                        if pair_entry is None:
-                            continue  # no data for one or both channels
-                        if resp['ex_qc_pass']:
+                # get all responses, regardless of the presence of a spike, for all postsynaptic recordings at once
+                pulses, post_responses = mpa.get_spike_response_arrays(
+                    srec[pre_dev], [srec[post_dev] for post_dev in post_devs], 
+                    align_to='pulse', require_spike=False, sample_rate=db.default_sample_rate,
+                )
+
+                for post_dev, responses in zip(post_devs, post_responses):
+                    pair_entry = pairs_by_device_id[pre_dev, post_dev]
+                    for j, pulse in enumerate(pulses):
+                        ex_qc_pass = bool(responses['ex_qc_pass'][j])
+                        in_qc_pass = bool(responses['in_qc_pass'][j])
+                        if ex_qc_pass:
                             pair_entry.n_ex_test_spikes += 1
-                        if resp['in_qc_pass']:
+                        if in_qc_pass:
                             pair_entry.n_in_test_spikes += 1
                         
-                        resampled = resp['response']['primary'].resample(sample_rate=db.default_sample_rate)
-                        resp_entry = db.PulseResponse(
-                            recording=rec_entries[post_dev],
-                            stim_pulse=all_pulse_entries[pre_dev][resp['pulse_n']],
-                            pair=pair_entry,
-                            data=resampled.data,
-                            data_start_time=resampled.t0,
-                            ex_qc_pass=resp['ex_qc_pass'],
-                            in_qc_pass=resp['in_qc_pass'],
-                            meta=None if resp['ex_qc_pass'] and resp['in_qc_pass'] else {'qc_failures': resp['qc_failures']},
-                        )
-                        session.add(resp_entry)
+                        resp_entry = {
+                            'recording_id': rec_entries[post_dev],
+                            'stim_pulse_id': all_pulse_entries[pre_dev][pulse['pulse_n']],
+                            'pair_id': pair_entry.id,
+                            'baseline_id': None,
+                            'data': responses['data'][j, :responses['n_samples'][j]],
+                            'data_start_time': responses['t0'][j],
+                            'ex_qc_pass': ex_qc_pass,
+                            'in_qc_pass': in_qc_pass,
+                            'meta': None if ex_qc_pass and in_qc_pass else {'qc_failures': responses['qc_failures'][j]},
+                        }
+                        rows['pulse_response'].append(resp_entry)
 
                         # find a baseline chunk from this recording with compatible qc metrics
                         got_baseline = False
                         for i, (start, stop) in enumerate(baseline_chunks[pre_dev, post_dev]):
                             key = (post_dev, start, stop)
 
-                            # pull data and run qc if needed
-                            if key not in baseline_qc_cache:
-                                data = srec[post_dev]['primary'].time_slice(start, stop).resample(sample_rate=db.default_sample_rate).data
-                                ex_qc_pass, in_qc_pass, qc_failures = qc.pulse_response_qc_pass(srec[post_dev], [start, stop], None, [])
-                                baseline_qc_cache[key] = (data, ex_qc_pass, in_qc_pass)
-                            else:
-                                (data, ex_qc_pass, in_qc_pass) = baseline_qc_cache[key]
+                            # cut, resample and run qc on all baseline chunks from this recording if needed
+                            if post_dev not in baseline_qc_cache:
+                                windows = baseline_windows[post_dev]
+                                base_data, _, base_n_samples = cut_windows(srec[post_dev]['primary'], windows, sample_rate=db.default_sample_rate)
+                                ex_pass, in_pass, failures = qc.pulse_response_qc_pass_batch(srec[post_dev], windows, [None] * len(windows), [[]] * len(windows))
+                                baseline_qc_cache[post_dev] = {
+                                    (post_dev, w[0], w[1]): (base_data[k, :base_n_samples[k]], bool(ex_pass[k]), bool(in_pass[k]), failures[k])
+                                    for k, w in enumerate(windows)
+                                }
+                            (data, ex_qc_pass, in_qc_pass, qc_failures) = baseline_qc_cache[post_dev][key]
 
-                            if resp_entry.ex_qc_pass is True and ex_qc_pass is not True:
+                            if resp_entry['ex_qc_pass'] is True and ex_qc_pass is not True:
                                 continue
-                            elif resp_entry.in_qc_pass is True and in_qc_pass is not True:
+                            elif resp_entry['in_qc_pass'] is True and in_qc_pass is not True:
                                 continue
                             else:
                                 got_baseline = True
@@ -256,31 +290,42 @@ class DatasetPipelineModule(MultipatchPipelineModule):
 
                         if key not in baseline_entry_cache:
                             # create a db record for this baseline chunk if it has not already appeared elsewhere
-                            base_entry = db.Baseline(
-                                recording=rec_entries[post_dev],
-                                data=data,
-                                data_start_time=start,
-                                mode=float_mode(data),
-                                ex_qc_pass=ex_qc_pass,
-                                in_qc_pass=in_qc_pass,
-                                meta=None if ex_qc_pass is True and in_qc_pass is True else {'qc_failures': qc_failures},
-                            )
-                            session.add(base_entry)
+                            base_entry = {
+                                'recording_id': rec_entries[post_dev],
+                                'data': data,
+                                'data_start_time': start,
+                                'mode': float_mode(data),
+                                'ex_qc_pass': ex_qc_pass,
+                                'in_qc_pass': in_qc_pass,
+                                'meta': None if ex_qc_pass is True and in_qc_pass is True else {'qc_failures': qc_failures},
+                            }
+                            rows['baseline'].append(base_entry)
                             baseline_entry_cache[key] = base_entry
                         
-                        resp_entry.baseline = baseline_entry_cache[key]
+                        resp_entry['baseline_id'] = baseline_entry_cache[key]
 
             if unmatched > 0:
                 print("%s %s: %d pulse responses without matched baselines" % (job_id, srec, unmatched))
+
+        # assign primary keys, resolve references between new records, and write each table
+        for table, table_rows in rows.items():
+            for row, row_id in zip(table_rows, db.reserve_ids(table, len(table_rows), session)):
+                row['id'] = row_id
+        for table, table_rows in rows.items():
+            for row in table_rows:
+                for k, v in row.items():
+                    if k.endswith('_id') and isinstance(v, dict):
+                        row[k] = v['id']
+            db.bulk_insert(table, table_rows, session)
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         # only need to return from syncrec table; other tables will be dropped automatically.
         db = self.database
-        return session.query(db.SyncRec).filter(db.SyncRec.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids)).all()
+        return [session.query(db.SyncRec).filter(db.SyncRec.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids))]
 
     def ready_jobs(self):
         """Return an ordered dict of all jobs that are ready to be processed (all dependencies are present)
@@ -299,6 +344,7 @@ class DatasetPipelineModule(MultipatchPipelineModule):
         session.rollback()
         
         # Return the greater of NWB mod time and experiment DB record mtime
+        index = raw_data_index()
         ready = OrderedDict()
         for expt_id, (expt_mtime, expt_success) in expts.items():
             if expt_id not in expt_paths or expt_success is False:
@@ -306,6 +352,9 @@ class DatasetPipelineModule(MultipatchPipelineModule):
                 continue
             rec = expt_paths[expt_id]
             ephys_file = os.path.join(config.synphys_data, rec.storage_path, rec.ephys_file)
-            nwb_mtime = timestamp_to_datetime(os.stat(ephys_file).st_mtime)
-            ready[rec.ext_id] = {'dep_time': max(expt_mtime, nwb_mtime)}
+            stat = index.stat(ephys_file)
+            if stat is None:
+                raise OSError("NWB file %s does not exist" % ephys_file)
+            nwb_mtime = timestamp_to_datetime(stat[0])
+            ready[rec.ext_id] = {'dep_time': max(expt_mtime, nwb_mtime), 'input_files': [ephys_file], 'input_file_stats': {ephys_file: stat}}
         return ready
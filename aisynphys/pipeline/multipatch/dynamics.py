@@ -39,10 +39,10 @@ class DynamicsPipelineModule(MultipatchPipelineModule):
             logger.debug("Finished dynamics for pair %s", pair)
         session.commit()
                     
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         db = self.database
-        return session.query(db.Dynamics).filter(db.Dynamics.pair_id==db.Pair.id).filter(db.Pair.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids)).all()
+        return [session.query(db.Dynamics).filter(db.Dynamics.pair_id==db.Pair.id).filter(db.Pair.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids))]
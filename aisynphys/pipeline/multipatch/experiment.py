@@ -1,12 +1,13 @@
 from __future__ import division, print_function
-import os, sys, glob, re, time
+import os, sys, re, time
 import numpy as np
 from datetime import datetime
 from collections import OrderedDict
 from acq4.util.DataManager import getDirHandle
 from .pipeline_module import MultipatchPipelineModule
+from .raw_data_index import RawDataIndex, raw_data_index
 from ... import config, lims
-from ...util import datetime_to_timestamp, dir_timestamp
+from ...util import datetime_to_timestamp
 from ...data import Experiment
 from .slice import SlicePipelineModule
 
@@ -152,14 +153,14 @@ class ExperimentPipelineModule(MultipatchPipelineModule):
         for (pre_cell, post_cell), pair_entry in pair_entries.items():
             pair_entry.reciprocal = pair_entries[post_cell, pre_cell]
 
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         # only need to return from experiment table; other tables will be dropped automatically.
         db = self.database
-        return session.query(db.Experiment).filter(db.Experiment.ext_id.in_(job_ids)).all()
+        return [session.query(db.Experiment).filter(db.Experiment.ext_id.in_(job_ids))]
 
     def dependent_job_ids(self, module, job_ids):
         """Return a list of all finished job IDs in this module that depend on 
@@ -184,31 +185,46 @@ class ExperimentPipelineModule(MultipatchPipelineModule):
         db = self.database
         session = db.session()
         slices = session.query(db.Slice.storage_path).all()
+        session.rollback()
         
-        ymls = []
+        index = raw_data_index()
+        sites = []
         for rec in slices:
-            path = rec[0]
-            ymls.extend(glob.glob(os.path.join(config.synphys_data, path, 'site_*', 'pipettes.yml')))
+            slice_path = os.path.join(index.root, rec[0])
+            sites.extend([site for site in index.site_dirs(slice_path) if 'pipettes.yml' in index.files(site)])
         
         n_errors = 0
         ready = OrderedDict()
-        for i,yml_path in enumerate(ymls):
-            print("  checking experiment %d/%d          \r" % (i, len(ymls)), end='')
+        for i,site_path in enumerate(sites):
+            print("  checking experiment %d/%d          \r" % (i, len(sites)), end='')
             sys.stdout.flush()
-            site_path = os.path.dirname(yml_path)
             try:
-                expt = Experiment(site_path=site_path, verify=False)
-                raw_data_mtime = expt.last_modification_time
-                slice_ts = expt.slice_id
+                expt_id = index.timestamp(site_path)
+                slice_ts = index.timestamp(os.path.dirname(site_path))
+                input_files = index.experiment_files(site_path)
+                if input_files is None:
+                    # NWB file can only be resolved by the experiment itself
+                    expt = Experiment(site_path=site_path, verify=False)
+                    input_files = [f for f in expt.input_files if f is not None]
+                if expt_id is None or slice_ts is None:
+                    raise ValueError("Missing timestamp for %s" % site_path)
+                raw_data_mtime = index.last_modification_time(input_files)
                 slice_mtime, slice_success = finished_slices.get(slice_ts, None)
             except Exception:
                 n_errors += 1
                 continue
             if slice_mtime is None or slice_success is False:
                 continue
-            ready[expt.uid] = {'dep_time': max(raw_data_mtime, slice_mtime), 'meta': {'source': site_path}}
+            ready[expt_id] = {
+                'dep_time': max(raw_data_mtime, slice_mtime), 
+                'meta': {'source': site_path},
+                'input_files': input_files,
+                'input_file_stats': index.file_stats(input_files),
+                'upstream': [('slice', slice_ts)],
+            }
+        index.save()
         
-        print("Found %d experiments; %d are able to be processed, %d were skipped due to errors." % (len(ymls), len(ready), n_errors))
+        print("Found %d experiments; %d are able to be processed, %d were skipped due to errors." % (len(sites), len(ready), n_errors))
         return ready
 
 
@@ -223,24 +239,19 @@ def get_cache():
 
 class DataRepo(object):
     def __init__(self, remote_path=config.synphys_data):
-        self._pip_yamls = None
-        self._nwbs = None
         self._expts = None
         self.remote_path = os.path.abspath(remote_path)
         
     def list_experiments(self):
         if self._expts is None:
-            yamls = self.list_pip_yamls()
-            site_dirs = sorted([os.path.dirname(yml) for yml in yamls], reverse=True)
-            self._expts = OrderedDict([('%0.3f'%dir_timestamp(site_dir), site_dir) for site_dir in site_dirs])
+            # use the index saved by ready_jobs rather than rescanning in every worker
+            if self.remote_path == os.path.abspath(config.synphys_data):
+                index = raw_data_index(max_age=None)
+            else:
+                index = RawDataIndex(self.remote_path)
+                index.refresh()
+            site_dirs = sorted([site for site in index.site_dirs() if 'pipettes.yml' in index.files(site)], reverse=True)
+            self._expts = OrderedDict([(index.timestamp(site_dir), site_dir) for site_dir in site_dirs])
+            self._expts.pop(None, None)
+            index.save()
         return self._expts
-
-    def list_nwbs(self):
-        if self._nwbs is None:
-            self._nwbs = glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', '*.nwb'))
-        return self._nwbs
-    
-    def list_pip_yamls(self):
-        if self._pip_yamls is None:
-            self._pip_yamls = glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', 'pipettes.yml'))
-        return self._pip_yamls
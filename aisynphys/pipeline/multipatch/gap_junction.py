@@ -120,8 +120,8 @@ class GapJunctionPipelineModule(MultipatchPipelineModule):
 
         return errors
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -130,7 +130,7 @@ class GapJunctionPipelineModule(MultipatchPipelineModule):
         q = q.filter(db.GapJunction.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        return q.all()
+        return [q]
 
 
     
@@ -112,8 +112,8 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
 
         return errors
 
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -122,7 +122,7 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
         q = q.filter(db.Intrinsic.cell_id==db.Cell.id)
         q = q.filter(db.Cell.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        return q.all()
+        return [q]
 
 class MPSweep(Sweep):
     """Adapter for neuroanalysis.Recording => ipfx.Sweep
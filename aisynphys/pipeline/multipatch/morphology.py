@@ -104,13 +104,13 @@ class MorphologyPipelineModule(MultipatchPipelineModule):
                 
             session.add(morphology)
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         db = self.database
-        return session.query(db.Morphology).filter(db.Morphology.cell_id==db.Cell.id).filter(db.Cell.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids)).all()
+        return [session.query(db.Morphology).filter(db.Morphology.cell_id==db.Cell.id).filter(db.Cell.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids))]
 
     def ready_jobs(self):
         """Return an ordered dict of all jobs that are ready to be processed (all dependencies are present)
@@ -147,21 +147,23 @@ class MorphologyPipelineModule(MultipatchPipelineModule):
 
             ready[expt_id] = {'dep_time': expt_mtime}
             needs_update = False
+            morpho_db_hashes = []
             for cell_ext_id, cell in expt.cells.items():
-                if cell.morphology is None:
-                    needs_update = True
-                    break
                 cell_specimen_id = cell.meta.get('lims_specimen_id')
                 morpho_rec = morpho_results.get(cell_specimen_id, None)
                 cortical_layer = lims_layers.get(cell_specimen_id, None)
                 morpho_db_hash = hash_record([morpho_rec, cortical_layer])
+                morpho_db_hashes.append(morpho_db_hash)
+                if cell.morphology is None:
+                    needs_update = True
+                    continue
                 prev_hash = None if cell.morphology.meta is None else cell.morphology.meta['morpho_db_hash']
                 if morpho_db_hash != prev_hash:
                     needs_update = True
-                    break
+            ready[expt_id]['input_data'] = morpho_db_hashes
 
             if needs_update:        
-                ready[expt_id] = {'dep_time': datetime.datetime.now()}
+                ready[expt_id]['dep_time'] = datetime.datetime.now()
         
         return ready
 
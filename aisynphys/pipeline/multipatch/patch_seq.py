@@ -13,6 +13,7 @@ from acq4.util.DataManager import getHandle
 from ... import config
 from .pipeline_module import MultipatchPipelineModule
 from .experiment import ExperimentPipelineModule
+from .raw_data_index import raw_data_index
 pyodbc = optional_import('pyodbc')
 
 amp_cols = {
@@ -119,13 +120,13 @@ class PatchSeqPipelineModule(MultipatchPipelineModule):
                     patch_seq = db.PatchSeq(cell_id=cell.id, **results)
                     session.add(patch_seq)
 
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
             
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         db = self.database
-        return session.query(db.PatchSeq).filter(db.PatchSeq.cell_id==db.Cell.id).filter(db.Cell.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids)).all()
+        return [session.query(db.PatchSeq).filter(db.PatchSeq.cell_id==db.Cell.id).filter(db.Cell.experiment_id==db.Experiment.id).filter(db.Experiment.ext_id.in_(job_ids))]
 
     def ready_jobs(self):
         """Return an ordered dict of all jobs that are ready to be processed (all dependencies are present)
@@ -153,6 +154,8 @@ class PatchSeqPipelineModule(MultipatchPipelineModule):
         patchseq_results = amp_results.copy()
         patchseq_results.update(mapping_results)
 
+        index = raw_data_index()
+
         for expt_id, (expt_mtime, success) in expts.items():
             if success is not True:
                 continue
@@ -160,13 +163,9 @@ class PatchSeqPipelineModule(MultipatchPipelineModule):
             expt = session.query(db.Experiment).filter(db.Experiment.ext_id==expt_id).all()[0]
             ready[expt_id] = {'dep_time': expt_mtime}
 
+            # tube IDs are cached in the raw data index until the site's .index file changes
             path = os.path.join(config.synphys_data, expt.storage_path)
-            site_info = getHandle(path).info()
-            headstages = site_info.get('headstages')
-            if headstages is None:
-                continue
-
-            patchseq_tubes = {hs_name.split('HS')[1]: hs['Tube ID'] for hs_name, hs in headstages.items()}
+            patchseq_tubes = index.derived(path, 'patchseq_tubes', site_patchseq_tubes)
             if patchseq_tubes is None:
                 continue
 
@@ -177,6 +176,7 @@ class PatchSeqPipelineModule(MultipatchPipelineModule):
                     continue
                 patchseq_data = patchseq_results[tube_id]
                 patchseq_data_hash = hashlib.md5(str(tuple(patchseq_data.values())).encode()).hexdigest()
+                ready[expt_id].setdefault('input_data', []).append(patchseq_data_hash)
                 patchseq_rec = session.query(db.PatchSeq).join(db.Cell).filter(db.Cell.id == cell.id).all()
                 if len(patchseq_rec) == 1:
                     patchseq_rec_hash = patchseq_rec[0].patchseq_hash
@@ -184,10 +184,21 @@ class PatchSeqPipelineModule(MultipatchPipelineModule):
                 else:
                     patchseq_hash_compare.append(False)
             if all(patchseq_hash_compare) is False:
-                ready[expt_id] = {'dep_time': datetime.datetime.now()}
+                ready[expt_id]['dep_time'] = datetime.datetime.now()
 
+        index.save()
         return ready
 
+
+def site_patchseq_tubes(site_path):
+    """Return a dict mapping {headstage_id: tube_id} read from a site's .index file,
+    or None if no headstage information was recorded.
+    """
+    headstages = getHandle(site_path).info().get('headstages')
+    if headstages is None:
+        return None
+    return {hs_name.split('HS')[1]: hs['Tube ID'] for hs_name, hs in headstages.items()}
+
 amp_cache = None
 def get_amp_results(): 
     global amp_cache
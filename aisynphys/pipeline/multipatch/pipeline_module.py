@@ -14,10 +14,10 @@ class MultipatchPipelineModule(DatabasePipelineModule):
         for jid, (status, error, meta) in jobs.items():
             if status is True:
                 continue
-            if meta is None:
+            if meta is None or 'source' not in meta:
                 if jid not in expts:
                     continue
-                meta = {'source': expts[jid].original_path}
+                meta = dict(meta or {}, source=expts[jid].original_path)
             else:
                 # a path should already be present in meta; translate backward to original source
                 meta['storage_path'] = meta['source']
@@ -7,7 +7,7 @@ from ... import config
 from .pipeline_module import MultipatchPipelineModule
 from .dataset import DatasetPipelineModule
 from .synapse import SynapsePipelineModule
-from ...pulse_response_strength import measure_response, measure_deconvolved_response, analyze_response_strength
+from ...pulse_response_strength import measure_responses, measure_deconvolved_responses, analyze_response_strengths
 
 
 class PulseResponsePipelineModule(MultipatchPipelineModule):
@@ -33,13 +33,12 @@ class PulseResponsePipelineModule(MultipatchPipelineModule):
         print("%s: got %d pulse responses" % (expt_id, len(prs)))
         
         # best estimate of response amplitude using known latency for this synapse
+        # (PSP fits for all responses in the experiment are computed together)
+        syn_prs = [pr for pr in prs if pr.pair.has_synapse]
+        psp_fits = measure_responses(syn_prs)
+        dec_fits = measure_deconvolved_responses(syn_prs)
         fits = 0
-        for pr in prs:
-            if not pr.pair.has_synapse:
-                continue
-            
-            response_fit, baseline_fit = measure_response(pr)
-            response_dec_fit, baseline_dec_fit = measure_deconvolved_response(pr)
+        for pr, (response_fit, baseline_fit), (response_dec_fit, baseline_dec_fit) in zip(syn_prs, psp_fits, dec_fits):
             if response_fit is None and response_dec_fit is None:
                 # print("no response/dec fits")
                 continue
@@ -76,17 +75,15 @@ class PulseResponsePipelineModule(MultipatchPipelineModule):
         print("  %s: added %d fit records" % (expt_id, fits))
 
         # "unbiased" response analysis used to predict connectivity
-        for pr in prs:
+        # (responses and baselines for the entire experiment are analyzed together)
+        sources = [['pulse_response'] if pr.baseline is None else ['pulse_response', 'baseline'] for pr in prs]
+        strengths = iter(analyze_response_strengths([(pr, source) for pr, pr_sources in zip(prs, sources) for source in pr_sources]))
+        for pr, pr_sources in zip(prs, sources):
             bl = pr.baseline
-            if bl is None:
-                blid = None
-                sources = ['pulse_response']
-            else:
-                blid = bl.id
-                sources = ['pulse_response', 'baseline']
+            blid = None if bl is None else bl.id
             rec = db.PulseResponseStrength(pulse_response_id=pr.id, baseline_id=blid)
-            for source in sources:
-                result = analyze_response_strength(pr, source)
+            for source in pr_sources:
+                result = next(strengths)
                 if result is None:
                     continue
                 # copy a subset of results over to new record
@@ -98,8 +95,8 @@ class PulseResponsePipelineModule(MultipatchPipelineModule):
         # just to collect error messages here in case we have made a mistake:
         session.flush()
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -110,14 +107,14 @@ class PulseResponsePipelineModule(MultipatchPipelineModule):
         q = q.filter(db.PulseResponse.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        fits = q.all()
+        fits = q
         
         q = session.query(db.PulseResponseStrength)
         q = q.filter(db.PulseResponseStrength.pulse_response_id==db.PulseResponse.id)
         q = q.filter(db.PulseResponse.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        prs = q.all()
+        prs = q
         
-        return fits + prs
+        return [fits, prs]
 
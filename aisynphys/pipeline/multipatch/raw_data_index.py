@@ -0,0 +1,349 @@
+"""
+Persistent index of the raw multipatch data tree, used by pipeline modules to decide which
+jobs are ready without walking every experiment directory.
+
+Raw data is expected at ``root/<day>/slice_*/site_*``. For every directory in that tree, the
+index records the directory mtime, the names of its relevant subdirectories, and the
+mtime / size of the files that pipeline modules read (.index, pipettes.yml, NWB files, etc.).
+On refresh, only directories whose mtime changed (meaning entries were added, removed or
+replaced) are listed again. The ``.index`` file in each directory is always re-stat'ed because
+acq4 rewrites it in place when metadata changes. Other files that are modified in place are
+picked up by a full rescan, which runs once every ``full_refresh_interval`` seconds.
+
+Values derived from a directory (such as the slice / site timestamps used as job IDs) are
+cached alongside each directory and discarded whenever its ``.index`` file changes.
+"""
+from __future__ import print_function, division
+
+import os, json, fnmatch, hashlib, threading, time, logging
+from ... import config
+from ...util import dir_timestamp, timestamp_to_datetime, replace_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class RawDataIndex(object):
+    """Persistent, incrementally updated index of directories and files below *root*.
+
+    Parameters
+    ----------
+    root : str
+        Path containing day directories (default is ``config.synphys_data``)
+    index_file : str | None
+        JSON file in which the index is stored. By default, a file in
+        ``config.cache_path/pipeline_raw_data_index`` derived from *root* is used.
+    """
+    version = 1
+
+    # seconds between full rescans that re-stat every tracked file
+    full_refresh_interval = 24 * 3600
+
+    # subdirectory name patterns followed at each level (root, day, slice)
+    dir_patterns = ['*', 'slice_*', 'site_*']
+
+    # names of files tracked in each directory
+    file_patterns = ['.index', 'ignore.txt', 'pipettes.yml', 'file_manifest.yml', '*.nwb', '*.NWB', '*.mosaic']
+
+    def __init__(self, root=None, index_file=None):
+        self.root = os.path.abspath(config.synphys_data if root is None else root)
+        if index_file is None:
+            key = hashlib.sha1(self.root.encode('utf8')).hexdigest()[:16]
+            index_file = os.path.join(config.cache_path, 'pipeline_raw_data_index', key + '.json')
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        self.dirs = {}
+        self.last_refresh = None
+        self.last_full_refresh = 0
+        self._dirty = False
+        self._loaded_mtime = None
+        self.load()
+
+    def load(self):
+        """Read the index from disk, if it exists.
+        """
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            self._loaded_mtime = os.stat(self.index_file).st_mtime
+            with open(self.index_file, 'r') as fh:
+                data = json.load(fh)
+        except Exception:
+            logger.warning("Could not read raw data index %s; starting a new one", self.index_file)
+            return
+        if data.get('version') != self.version or data.get('root') != self.root:
+            return
+        with self.lock:
+            self.dirs = data['dirs']
+            self.last_full_refresh = data.get('last_full_refresh', 0)
+
+    def save(self):
+        """Write the index to disk (only if it changed since the last save).
+        """
+        with self.lock:
+            if not self._dirty:
+                return
+            data = {'version': self.version, 'root': self.root, 'last_full_refresh': self.last_full_refresh, 'dirs': self.dirs}
+            path = os.path.dirname(self.index_file)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            tmp = self.index_file + '.tmp.%d' % os.getpid()
+            with open(tmp, 'w') as fh:
+                json.dump(data, fh)
+            replace_file(tmp, self.index_file)
+            self._loaded_mtime = os.stat(self.index_file).st_mtime
+            self._dirty = False
+
+    def reload_if_changed(self):
+        """Reload the index if it was saved by another process since it was last loaded or saved.
+        """
+        try:
+            mtime = os.stat(self.index_file).st_mtime
+        except OSError:
+            return
+        if mtime != self._loaded_mtime:
+            self.load()
+
+    def refresh(self, full=None):
+        """Update the index from the filesystem.
+
+        Directories whose mtime is unchanged are not listed again, and only their ``.index`` file
+        is checked. If *full* is True, every directory is listed and every tracked file is
+        re-stat'ed. By default, a full rescan is done if the last one is older than
+        ``full_refresh_interval``.
+        """
+        now = time.time()
+        if full is None:
+            full = now - self.last_full_refresh > self.full_refresh_interval
+        with self.lock:
+            self._scan_dir(self.root, 0, full)
+            self.last_refresh = now
+            if full:
+                self.last_full_refresh = now
+                self._dirty = True
+        self.save()
+
+    def _scan_dir(self, path, level, full):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._forget_dir(path)
+            return
+
+        entry = self.dirs.get(path)
+        if full or entry is None or entry['mtime'] != mtime:
+            names = os.listdir(path)
+            files = {}
+            for name in names:
+                if any(fnmatch.fnmatchcase(name, pat) for pat in self.file_patterns):
+                    stat = _stat_file(os.path.join(path, name))
+                    if stat is not None:
+                        files[name] = stat
+            subdirs = []
+            if level < len(self.dir_patterns):
+                pattern = self.dir_patterns[level]
+                subdirs = sorted([n for n in names if fnmatch.fnmatchcase(n, pattern) and os.path.isdir(os.path.join(path, n))])
+            old_derived = {} if entry is None else entry['derived']
+            old_index = None if entry is None else entry['files'].get('.index')
+            entry = {'mtime': mtime, 'subdirs': subdirs, 'files': files, 'derived': {}}
+            if files.get('.index') == old_index:
+                entry['derived'] = old_derived
+
+            # forget subdirectories that have disappeared
+            prefix = path + os.sep
+            for p in [p for p in self.dirs if p.startswith(prefix) and os.sep not in p[len(prefix):]]:
+                if os.path.basename(p) not in subdirs:
+                    self._forget_dir(p)
+
+            self.dirs[path] = entry
+            self._dirty = True
+        else:
+            stat = _stat_file(os.path.join(path, '.index'))
+            if stat != entry['files'].get('.index'):
+                if stat is None:
+                    entry['files'].pop('.index', None)
+                else:
+                    entry['files']['.index'] = stat
+                entry['derived'] = {}
+                self._dirty = True
+
+        for name in entry['subdirs']:
+            self._scan_dir(os.path.join(path, name), level + 1, full)
+
+    def _forget_dir(self, path):
+        prefix = path + os.sep
+        for p in list(self.dirs.keys()):
+            if p == path or p.startswith(prefix):
+                del self.dirs[p]
+                self._dirty = True
+
+    def subdirs(self, path=None):
+        """Return a list of the indexed subdirectories of *path* (default is the root).
+        """
+        path = self.root if path is None else os.path.abspath(path)
+        with self.lock:
+            entry = self.dirs.get(path)
+            if entry is None:
+                return []
+            return [os.path.join(path, name) for name in entry['subdirs']]
+
+    def slice_dirs(self):
+        """Return a sorted list of all indexed slice directories.
+        """
+        return sorted([s for day in self.subdirs() for s in self.subdirs(day)])
+
+    def site_dirs(self, slice_path=None):
+        """Return a list of indexed site directories, either for a single slice or for all slices.
+        """
+        slices = self.slice_dirs() if slice_path is None else [slice_path]
+        return [site for sl in slices for site in self.subdirs(sl)]
+
+    def files(self, path):
+        """Return a dict of {file_name: (mtime, size)} for the tracked files in an indexed directory.
+        """
+        with self.lock:
+            entry = self.dirs.get(os.path.abspath(path))
+            if entry is None:
+                return {}
+            return {name: tuple(stat) for name, stat in entry['files'].items()}
+
+    def stat(self, path):
+        """Return (mtime, size) for a file, (mtime, None) for a directory, or None if the path does not exist.
+
+        Indexed directories and files are looked up in the index; all other paths are stat'ed.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.dirs.get(path)
+            if entry is not None:
+                return (entry['mtime'], None)
+            entry = self.dirs.get(os.path.dirname(path))
+            name = os.path.basename(path)
+            if entry is not None and any(fnmatch.fnmatchcase(name, pat) for pat in self.file_patterns):
+                stat = entry['files'].get(name)
+                return None if stat is None else tuple(stat)
+        stat = _stat_file(path)
+        return None if stat is None else tuple(stat)
+
+    def mtime(self, path):
+        """Return the mtime of a file or directory, or None if it does not exist (see stat).
+        """
+        stat = self.stat(path)
+        return None if stat is None else stat[0]
+
+    def file_stats(self, paths):
+        """Return a dict {path: stat} for a list of paths (see stat), for use as the 'input_file_stats'
+        of a ready job.
+        """
+        return {p: self.stat(p) for p in paths}
+
+    def last_modification_time(self, paths):
+        """Return the datetime of the most recently modified path in a list (missing paths are ignored).
+        """
+        mtimes = [self.mtime(p) for p in paths if p is not None]
+        return timestamp_to_datetime(max([0] + [m for m in mtimes if m is not None]))
+
+    def derived(self, path, key, func):
+        """Return a value derived from an indexed directory, calling ``func(path)`` only if the value
+        is not cached or the directory's .index file has changed since it was computed.
+
+        Values must be JSON-serializable.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.dirs.get(path)
+            if entry is not None and key in entry['derived']:
+                return entry['derived'][key]
+        value = func(path)
+        with self.lock:
+            entry = self.dirs.get(path)
+            if entry is not None:
+                entry['derived'][key] = value
+                self._dirty = True
+        return value
+
+    def timestamp(self, path):
+        """Return the acq4 timestamp of an indexed directory formatted as a job ID ('%0.3f'),
+        or None if the directory has no readable .index file.
+        """
+        return self.derived(path, 'timestamp', _dir_timestamp_id)
+
+    def experiment_files(self, site_path):
+        """Return the list of input files for the experiment at *site_path*, matching
+        Experiment.input_files (excluding files that were not found).
+
+        Returns None if the NWB file cannot be determined from the index alone (multiple NWB files).
+        """
+        site_path = os.path.abspath(site_path)
+        slice_path = os.path.dirname(site_path)
+        expt_path = os.path.dirname(slice_path)
+        site_files = self.files(site_path)
+
+        nwbs = sorted([f for f in site_files if f.endswith('.nwb')])
+        if len(nwbs) == 0:
+            nwbs = sorted([f for f in site_files if f.endswith('.NWB')])
+        if len(nwbs) > 1:
+            return None
+        nwb_file = os.path.join(site_path, nwbs[0]) if len(nwbs) == 1 else None
+
+        if 'site.mosaic' in site_files:
+            mosaic_file = os.path.join(site_path, 'site.mosaic')
+        elif 'site.mosaic' in self.files(slice_path):
+            mosaic_file = os.path.join(slice_path, 'site.mosaic')
+        else:
+            mosaics = [f for f in site_files if f.endswith('.mosaic')]
+            mosaic_file = os.path.join(site_path, mosaics[0]) if len(mosaics) == 1 else None
+
+        pipette_file = os.path.join(site_path, 'pipettes.yml') if 'pipettes.yml' in site_files else None
+
+        files = [
+            site_path,
+            pipette_file,
+            nwb_file,
+            mosaic_file,
+            os.path.join(site_path, '.index'),
+            os.path.join(slice_path, '.index'),
+            os.path.join(expt_path, '.index'),
+            os.path.join(expt_path, 'ignore.txt'),
+        ]
+        return [f for f in files if f is not None]
+
+
+def _stat_file(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def _dir_timestamp_id(path):
+    try:
+        ts = dir_timestamp(path)
+    except Exception:
+        return None
+    return None if ts is None else '%0.3f' % ts
+
+
+_index = None
+_index_lock = threading.Lock()
+def raw_data_index(max_age=60):
+    """Return a RawDataIndex of ``config.synphys_data`` shared by all pipeline modules in this process.
+
+    The index is refreshed if it has not been refreshed within the last *max_age* seconds, so that
+    several modules checking for ready jobs in the same run share a single scan. If *max_age* is
+    None, the most recent index saved on disk is used as-is and only scanned if it is empty
+    (this is used by workers, which read the index saved by ready_jobs).
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RawDataIndex()
+        index = _index
+    if max_age is None:
+        index.reload_if_changed()
+        if len(index.dirs) == 0:
+            index.refresh()
+    elif index.last_refresh is None or time.time() - index.last_refresh > max_age:
+        index.refresh()
+    return index
@@ -70,8 +70,8 @@ class RestingStatePipelineModule(MultipatchPipelineModule):
             if result['vc']['fit'] is not None and pair.synapse.psc_rise_time is not None:
                 pair.synapse.psc_amplitude = result['vc']['fit'].best_values['amp']
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -80,4 +80,4 @@ class RestingStatePipelineModule(MultipatchPipelineModule):
         q = q.filter(db.RestingStateFit.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        return q.all()
+        return [q]
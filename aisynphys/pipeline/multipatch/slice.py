@@ -1,10 +1,10 @@
-import os, glob, re, pickle, time
+import os, re
 from datetime import datetime
 from collections import OrderedDict
-from acq4.util.DataManager import getDirHandle
 from .pipeline_module import MultipatchPipelineModule
-from ... import config, lims, constants
-from ...util import datetime_to_timestamp, timestamp_to_datetime
+from .raw_data_index import raw_data_index
+from ... import lims, constants
+from ...util import datetime_to_timestamp
 from ...data.slice import Slice
 
 
@@ -20,7 +20,8 @@ class SlicePipelineModule(MultipatchPipelineModule):
         job_id = job['job_id']
         db = job['database']
 
-        slices = all_slices()
+        # use the index saved by ready_jobs rather than rescanning in every worker
+        slices = all_slices(raw_data_index(max_age=None))
         path = slices[job_id]
         
         ignore_file = os.path.join(path, 'ignore.txt')
@@ -52,17 +53,18 @@ class SlicePipelineModule(MultipatchPipelineModule):
         session.add(orm_sl)
         session.flush()  # force error messages to appear here, if any.
 
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         """
         db = self.database
-        return session.query(db.Slice).filter(db.Slice.acq_timestamp.in_(job_ids)).all()
+        return [session.query(db.Slice).filter(db.Slice.acq_timestamp.in_(job_ids))]
 
     def ready_jobs(self):
         """Return an ordered dict of all jobs that are ready to be processed (all dependencies are present)
         and the dates that dependencies were created.
         """
-        slices = all_slices()
+        index = raw_data_index()
+        slices = all_slices(index)
         ready = OrderedDict()
         for ts, path in slices.items():
             files = [
@@ -70,57 +72,30 @@ class SlicePipelineModule(MultipatchPipelineModule):
                 os.path.join(path, '.index'),
                 os.path.join(path, 'ignore.txt'),
             ]
-            mtimes = [0]
-            for file in files:
-                if not os.path.exists(file):
-                    continue
-                mtimes.append(os.stat(file).st_mtime)
-            mtime = max(mtimes)
+            mtime = index.last_modification_time(files)
 
             # test file updates:
             # import random
             # if random.random() > 0.8:
             #     mtime *= 2
-            ready[ts] = {'dep_time': timestamp_to_datetime(mtime), 'meta': {'source': path}}
+            ready[ts] = {'dep_time': mtime, 'meta': {'source': path}, 'input_files': files, 'input_file_stats': index.file_stats(files)}
         return ready
 
 
-_all_slices = None
-def all_slices():
+def all_slices(index=None):
     """Return a dict mapping {slice_timestamp: path} for all known slices.
     
-    This is only generated once per running process; set _all_slices = None
-    to force the list to be regenerated.
+    Slices are read from the shared raw data index (see raw_data_index.py), which is
+    refreshed incrementally from directory mtimes.
     """
-    global _all_slices
-    if _all_slices is not None:
-        return _all_slices
-        
-    # Speed things up by caching this list with a 4 hour timeout
-    cachefile = os.path.join(config.cache_path, 'all_slices.pkl')
-    if os.path.exists(cachefile):
-        age = time.time() - os.stat(cachefile).st_mtime
-        if age < 4 * 3600:
-            print("Loaded slice timestamps from cache (%0.1f hours old)" % (age/3600.))
-            return pickle.load(open(cachefile, 'rb'))
-    
-    slice_dirs = sorted(glob.glob(os.path.join(config.synphys_data, '*', 'slice_*')))
-
-    _all_slices = OrderedDict()
-    for path in slice_dirs:
-        dh = getDirHandle(path)
-        ts = dh.info().get('__timestamp__')
+    if index is None:
+        index = raw_data_index()
+    slices = OrderedDict()
+    for path in index.slice_dirs():
+        ts = index.timestamp(path)
         if ts is None:
             print("MISSING TIMESTAMP: %s" % path)
             continue
-        _all_slices["%0.3f"%ts] = path
-        
-    try:
-        tmpfile = cachefile+'.tmp'
-        pickle.dump(_all_slices, open(tmpfile, 'wb'))
-        os.rename(tmpfile, cachefile)
-    except:
-        if os.path.exists(tmpfile):
-            os.remove(tmpfile)
-    
-    return _all_slices
+        slices[ts] = path
+    index.save()
+    return slices
@@ -44,9 +44,12 @@ class SynapsePipelineModule(MultipatchPipelineModule):
         # keep track of whether cells look like they should be inhibitory or excitatory based on synaptic projections
         synaptic_cell_class = {}
 
+        # load notes for all pairs in this experiment at once
+        notes_recs = notes_db.get_pair_notes_records([expt_id])
+
         for pair in expt.pair_list:
             # look up synapse type from notes db
-            notes_rec = notes_db.get_pair_notes_record(pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id)
+            notes_rec = notes_recs.get((pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id))
             if notes_rec is None:
                 continue
             
@@ -62,7 +65,7 @@ class SynapsePipelineModule(MultipatchPipelineModule):
             #   - selected from <= 50Hz trains
             #   - must pass ex_qc_pass or in_qc_pass
             #   - must have exactly 1 pre spike with onset time
-            fits = get_pair_avg_fits(pair, session)
+            fits = get_pair_avg_fits(pair, session, notes_rec=notes_rec)
             
             # collect values with which to decide on the "correct" kinetic values to report
             latency_vals = []
@@ -167,8 +170,8 @@ class SynapsePipelineModule(MultipatchPipelineModule):
 
         return errors
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -178,15 +181,15 @@ class SynapsePipelineModule(MultipatchPipelineModule):
         q = q.filter(db.Synapse.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        recs = q.all()
+        queries = [q]
         
         q = session.query(db.AvgResponseFit)
         q = q.filter(db.AvgResponseFit.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        recs.extend(q.all())
+        queries.append(q)
 
-        return recs
+        return queries
 
     def ready_jobs(self):
         """Return an ordered dict of all jobs that are ready to be processed (all dependencies are present)
@@ -195,17 +198,19 @@ class SynapsePipelineModule(MultipatchPipelineModule):
         dataset_module = self.pipeline.get_module('dataset')
         finished_datasets = dataset_module.finished_jobs()
 
-        # find most recent modification time listed for each experiment
-        notes_recs = notes_db.db.query(notes_db.PairNotes.expt_id, notes_db.PairNotes.modification_time)
-        mod_times = {}
-        for rec in notes_recs:
-            mod_times[rec.expt_id] = max(rec.modification_time, mod_times.get(rec.expt_id, rec.modification_time))
+        # find most recent modification time and a hash of the notes content for each experiment
+        # (only records modified since the last check are read from the notes DB)
+        notes_tracker = notes_db.PairNotesModTimes()
+        mod_times = notes_tracker.refresh()
+        notes_hashes = notes_tracker.content_hashes
 
         # combine update times from pair_notes and finished_datasets
         ready = OrderedDict()
         for job, (mtime, success) in finished_datasets.items():
             if job in mod_times:
                 mtime = max(mtime, mod_times[job])
-            ready[job] = {'dep_time': mtime}
+            # pair notes content is part of the input data (re-saving identical notes does not
+            # change the fingerprint); morphology results are not used here
+            ready[job] = {'dep_time': mtime, 'input_data': notes_hashes.get(job), 'upstream': [('dataset', job)]}
             
         return ready
@@ -8,7 +8,7 @@ from .pipeline_module import MultipatchPipelineModule
 from .experiment import ExperimentPipelineModule
 from .dataset import DatasetPipelineModule
 from .pulse_response import PulseResponsePipelineModule
-from ...synapse_prediction import get_amps, analyze_pair_connectivity
+from ...synapse_prediction import analyze_expt_connectivity
 
 
 class SynapsePredictionPipelineModule(MultipatchPipelineModule):
@@ -25,26 +25,16 @@ class SynapsePredictionPipelineModule(MultipatchPipelineModule):
         
         expt = db.experiment_from_timestamp(expt_id, session=session)
 
-        for pair in expt.pair_list:
-            # Query all pulse amplitude records for each clamp mode
-            amps = {}
-            for clamp_mode in ('ic', 'vc'):
-                clamp_mode_fg = get_amps(session, pair, clamp_mode=clamp_mode, get_data=True)
-                amps[clamp_mode] = clamp_mode_fg
-            
-            # Generate summary results for this pair
-            results = analyze_pair_connectivity(amps)
-            
-            if results is None:
-                # no data to analyze
-                continue
+        # Generate summary results for all pairs; pairs with no data to analyze are omitted
+        results = analyze_expt_connectivity(session, expt)
 
+        for pair, fields in results.items():
             # Write new record to DB
-            conn = db.SynapsePrediction(pair_id=pair.id, **results)
+            conn = db.SynapsePrediction(pair_id=pair.id, **fields)
             session.add(conn)
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
         
         This method is used by drop_jobs to delete records for specific job IDs.
         """
@@ -53,4 +43,4 @@ class SynapsePredictionPipelineModule(MultipatchPipelineModule):
         q = q.filter(db.SynapsePrediction.pair_id==db.Pair.id)
         q = q.filter(db.Pair.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
-        return q.all()
+        return [q]
@@ -2,6 +2,10 @@ import re
 from collections import OrderedDict
 from pyqtgraph import toposort
 from .pipeline_module import PipelineModule, DatabasePipelineModule
+from .scheduler import JobGraph, run_job_graph
+from .worker_pool import WorkerPool
+from .job_queue import JobQueue, run_queue_worker, run_local_queue_workers
+from . import telemetry
 
 
 class Pipeline(object):
@@ -22,6 +26,7 @@ class Pipeline(object):
     def __init__(self, **kwds):
         self.kwds = kwds
         self.modules = [mcls(self) for mcls in self.module_classes]
+        self._worker_pool = None
 
         excluded = [PipelineModule, DatabasePipelineModule]
         deps = {c:c.upstream_modules() for c in self.modules if type(c) not in excluded}
@@ -35,14 +40,217 @@ class Pipeline(object):
     
     def get_module(self, module_name):
         return self.sorted_modules()[module_name]
+
+    def worker_pool(self, workers=None):
+        """Return the pool of worker processes used to run parallel jobs.
+
+        The pool is created on first use and kept for the lifetime of the pipeline (or until close()
+        is called), so that workers are only initialized once across all modules and updates.
+        """
+        if self._worker_pool is not None and workers is not None and self._worker_pool.n_workers != workers:
+            self.close()
+        if self._worker_pool is None:
+            self._worker_pool = WorkerPool(workers=workers)
+        return self._worker_pool
+
+    def close(self):
+        """Shut down any worker processes started by this pipeline.
+        """
+        if self._worker_pool is not None:
+            self._worker_pool.close()
+            self._worker_pool = None
         
-    def update(self, modules=None, job_ids=None):
-        if modules is None:
-            modules = self.modules
+    def update(self, modules=None, job_ids=None, retry_errors=False, limit=None, parallel=False, workers=None, debug=False):
+        """Update analysis results for multiple modules at once.
+
+        Rather than running each module's update to completion before starting the next,
+        this builds a single per-job dependency graph across all selected modules and
+        processes it with the pipeline's persistent worker pool (see worker_pool()). Each job starts as soon as the jobs
+        it depends on in upstream modules have finished, and is skipped if any of
+        them failed.
+
+        Some jobs only become ready once upstream results exist (for example, experiments in a
+        newly imported slice). After the graph has been processed, the modules downstream of
+        any successful jobs are planned again, and the new jobs are run in the same way, until
+        no more jobs are found.
+
+        Parameters are the same as for :func:`PipelineModule.update`. If *limit* is given, it applies to the
+        total number of jobs run in each module.
+
+        Returns
+        -------
+        results : OrderedDict
+            {module: result} where each *result* is a dict with the same structure as
+            returned by PipelineModule.update(), plus 'n_skipped' and 'skipped' keys
+            describing jobs that were not run because an upstream job failed.
+        """
+        results = OrderedDict()
+        attempted = set()
+        plan_modules = modules
+        while True:
+            plans, graph = self._plan_update(plan_modules, job_ids=job_ids, retry_errors=retry_errors, limit=limit, debug=debug, attempted=attempted)
+
+            pool = self.worker_pool(workers) if parallel and len(graph) > 0 else None
+            job_results = run_job_graph(graph, parallel=parallel, pool=pool)
+            attempted.update(graph.jobs.keys())
+
+            # record fingerprints for valid results that were stored without one
+            for module, plan in plans.items():
+                if len(plan['backfill']) > 0:
+                    module.store_fingerprints(plan['backfill'])
+
+            for module, plan in plans.items():
+                errors = {job_id:err for (mod_name, job_id), err in job_results.items() if mod_name == module.name and err is not None}
+                skipped = {job_id:reason for (mod_name, job_id), reason in graph.skipped.items() if mod_name == module.name}
+                result = results.setdefault(module, {
+                    'n_dropped': 0, 'n_updated': 0, 'n_errors': 0, 'errors': {}, 
+                    'n_retry': 0, 'n_skipped': 0, 'skipped': {},
+                })
+                result['n_dropped'] += len(plan['drop_job_ids'])
+                result['n_updated'] += len(plan['run_job_ids']) - len(skipped)
+                result['n_errors'] += len(errors)
+                result['errors'].update(errors)
+                result['n_retry'] += plan['n_retry']
+                result['n_skipped'] += len(skipped)
+                result['skipped'].update(skipped)
+
+            # plan again for modules downstream of any jobs that succeeded
+            downstream = set()
+            for mod_name in set(mod_name for (mod_name, job_id), err in job_results.items() if err is None):
+                downstream.update(self.get_module(mod_name).all_downstream_modules())
+            plan_modules = [m for m in results if m in downstream]
+            if len(plan_modules) == 0:
+                break
+
+        return results
         
-    def drop(self, modules=None, job_ids=None):
+    def _plan_update(self, modules=None, job_ids=None, retry_errors=False, limit=None, debug=False, attempted=()):
+        """Decide which jobs to run in each module, drop their invalid results, and return
+        ``(plans, graph)`` where *graph* is a :class:`JobGraph` of all jobs to run.
+
+        Jobs in *attempted* (a set of (module_name, job_id) keys) are not selected again,
+        and are counted against *limit*.
+
+        Nothing is written to the database except for dropping the invalid results. Fingerprints of
+        valid results that were stored without one are collected in each plan's 'backfill' dict.
+        """
+        if modules is None:
+            modules = list(self.sorted_modules().values())
+        else:
+            modules = [m for m in self.sorted_modules().values() if m in modules]
+
+        # decide which jobs to run in each module
+        plans = OrderedDict()
+        for module in modules:
+            # fingerprints are computed from the hashes that upstream results will have after this update
+            upstream_hashes = {m.name: plans[m]['result_hashes'] for m in module.upstream_modules() if m in plans}
+            backfill = {}
+            drop_job_ids, run_job_ids, run_jobs_meta, n_retry, run_jobs_upstream = module.select_jobs(
+                job_ids=job_ids, retry_errors=retry_errors, upstream_hashes=upstream_hashes, backfill=backfill)
+            run_job_ids = [job_id for job_id in run_job_ids if (module.name, job_id) not in attempted]
+
+            # Jobs that depend on upstream jobs scheduled in this update must be rerun as well,
+            # and may not start until those upstream jobs have finished.
+            job_deps = {}
+            scheduled = {(m.name, job_id) for m in plans for job_id in plans[m]['run_job_ids']}
+            for job_id in run_job_ids:
+                for up_key in run_jobs_upstream.get(job_id, []):
+                    if up_key in scheduled:
+                        job_deps.setdefault(job_id, []).append(up_key)
+            for up_module in module.upstream_modules():
+                if up_module not in plans:
+                    continue
+                for up_job_id in plans[up_module]['run_job_ids']:
+                    for dep_job_id in module.dependent_job_ids(up_module, [up_job_id]):
+                        if (module.name, dep_job_id) in attempted:
+                            continue
+                        if dep_job_id not in run_job_ids:
+                            run_job_ids.append(dep_job_id)
+                        job_deps.setdefault(dep_job_id, []).append((up_module.name, up_job_id))
+
+            if limit is not None:
+                n_attempted = len([key for key in attempted if key[0] == module.name])
+                run_job_ids = module.limit_jobs(run_job_ids, limit - n_attempted)
+                drop_job_ids = [jid for jid in drop_job_ids if jid in run_job_ids]
+
+            backfill = {job_id: fp for job_id, fp in backfill.items() if job_id not in run_job_ids}
+            result_hashes = dict(backfill)
+            for job_id in run_job_ids:
+                result_hashes[job_id] = (run_jobs_meta.get(job_id) or {}).get('fingerprint')
+
+            plans[module] = {
+                'drop_job_ids': drop_job_ids,
+                'run_job_ids': run_job_ids,
+                'run_jobs_meta': run_jobs_meta,
+                'backfill': backfill,
+                'result_hashes': result_hashes,
+                # failed jobs are only retried the first time each module is planned
+                'n_retry': n_retry if len(attempted) == 0 else 0,
+                'job_deps': job_deps,
+            }
+            print("%s: %d job(s) to update" % (module.name, len(run_job_ids)))
+
+        # drop invalid records before starting any jobs
+        for module, plan in plans.items():
+            module.drop_invalid_jobs(plan['drop_job_ids'], plan['run_job_ids'])
+
+        # build the complete job dependency graph
+        graph = JobGraph()
+        for module, plan in plans.items():
+            for job in module.make_job_specs(plan['run_job_ids'], plan['run_jobs_meta'], debug=debug):
+                graph.add_job(module.name, job)
+        for module, plan in plans.items():
+            for job_id, up_keys in plan['job_deps'].items():
+                for up_key in up_keys:
+                    graph.add_dependency((module.name, job_id), up_key)
+
+        return plans, graph
+
+    def enqueue(self, modules=None, job_ids=None, retry_errors=False, limit=None, debug=False):
+        """Add jobs to the database job queue instead of running them.
+
+        Jobs are selected exactly as for :func:`update`; they are then processed by any number of
+        queue workers, possibly on other hosts (see :func:`run_queue_workers`). Jobs that only become
+        ready once queued upstream jobs have finished are added by a later call to enqueue().
+
+        Returns the number of jobs added to the queue.
+        """
+        plans, graph = self._plan_update(modules, job_ids=job_ids, retry_errors=retry_errors, limit=limit, debug=debug)
+        return self.job_queue().enqueue(graph)
+
+    def job_queue(self, **kwds):
+        """Return a :class:`JobQueue` for this pipeline's jobs in its database.
+        """
+        return JobQueue(self.database, self.name, **kwds)
+
+    def run_queue_workers(self, workers=None, local=False, **kwds):
+        """Run jobs from the database job queue until no queued or running jobs remain.
+
+        Several hosts may run queue workers against the same database at once; each job is
+        claimed by only one worker.
+
+        Parameters
+        ----------
+        workers : int | None
+            Number of worker processes to start on this host. If None, then use one worker per CPU core.
+        local : bool
+            If True, run a single worker in this process (useful for debugging).
+        kwds :
+            Extra keyword arguments passed to :func:`job_queue.run_queue_worker`.
+        """
+        if local:
+            return run_queue_worker(self, **kwds)
+        return run_local_queue_workers(self, workers=workers, **kwds)
+
+    def drop(self, modules=None, job_ids=None, dry_run=False):
+        """Drop results from a list of modules and all modules that depend on them.
+
+        If *job_ids* is None, then all tables are dropped and reinitialized. Otherwise, only the
+        results for the given job IDs are removed (see :func:`DatabasePipelineModule.drop_jobs`); in that case,
+        *dry_run* may be used to report the number of rows that would be removed without deleting anything.
+        """
         if modules is None:
-            modules = self.sorted_modules().keys()
+            modules = list(self.sorted_modules().values())
         else:
             # if modules were specified, then generate the complete sorted list of dependent modules 
             # that need to be dropped as well
@@ -60,9 +268,15 @@ class Pipeline(object):
                 print("Reinitializing module %s" % module.name)
                 module.initialize()
         else:
-            for module in reversed(modules):
+            # each module drops results from its downstream modules as well
+            counts = OrderedDict()
+            for module in modules:
+                if any(up in modules for up in module.upstream_modules()):
+                    continue
                 print("Dropping %d jobs in module %s" % (len(job_ids), module.name))
-                module.drop_jobs(job_ids=job_ids)
+                for table, n_rows in module.drop_jobs(job_ids=job_ids, dry_run=dry_run).items():
+                    counts[table] = counts.get(table, 0) + n_rows
+            return counts
         
     def rebuild(self, modules=None, job_ids=None):
         if modules is None:
@@ -104,6 +318,11 @@ class Pipeline(object):
             # decide exactly how to describe each error
             err_strs = []
             for job_id, job_error, meta in module_errors:
+                if meta is not None and meta.get('error_summary') is not None:
+                    # summary recorded when the job failed
+                    err_strs.append((str(job_id), meta.get('source', ''), meta['error_summary']))
+                    continue
+
                 # Attempt to summarize the job error string into a single line
                 err_lines = job_error.strip().split('\n')
                 
@@ -165,3 +384,19 @@ class Pipeline(object):
                 report.append(report_entry)
         
         return ''.join(report)
+
+    def telemetry_report(self, modules=None, limit=10):
+        """Return a printable report summarizing the time and memory used by the most recent run
+        of each job: the slowest modules and experiments, and jobs with unusually high memory use.
+
+        See :func:`telemetry.telemetry_report`.
+        """
+        if modules is None:
+            modules = list(self.sorted_modules().values())
+        job_telemetry = OrderedDict()
+        for module in modules:
+            job_telemetry[module.name] = OrderedDict([
+                (job_id, meta['telemetry']) for job_id, (success, error, meta) in module.job_status().items()
+                if meta is not None and meta.get('telemetry') is not None
+            ])
+        return telemetry.telemetry_report(job_telemetry, limit=limit)
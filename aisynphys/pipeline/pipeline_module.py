@@ -1,9 +1,9 @@
 from __future__ import division, print_function
-import sys, time, multiprocessing, traceback, logging
+import sys, time, traceback, logging
 from datetime import datetime
 import numpy as np
 from collections import OrderedDict
-from .. import database
+from . import fingerprint, telemetry
 
 
 class PipelineModule(object):
@@ -37,7 +37,9 @@ class PipelineModule(object):
     
     name = None
     dependencies = []
-    maxtasksperchild = None
+
+    # Increment when a change to the analysis code should invalidate all previous results
+    version = 1
 
     def __init__(self, pipeline):
         self.pipeline = pipeline
@@ -60,6 +62,17 @@ class PipelineModule(object):
             deps.extend(dep.downstream_modules())
         return [mod for mod in self.pipeline.modules if mod in deps]
     
+    def dependent_job_ids(self, module, job_ids):
+        """Return a list of all finished job IDs in this module that depend on 
+        specific jobs from another module.
+        """
+        if module not in self.upstream_modules():
+            raise ValueError("%s does not depend on module %s" % (self, module))
+        
+        # In most cases, modules use the same IDs as the modules that they depend on.
+        # (usually this is the experiment ID)
+        return job_ids
+
     def update(self, job_ids=None, retry_errors=False, limit=None, parallel=False, workers=None, debug=False):
         """Update analysis results for this module.
         
@@ -83,32 +96,102 @@ class PipelineModule(object):
         """
         logger = logging.getLogger(__name__)
         logger.info("Updating pipeline stage: %s", self.name)
+        backfill = {}
+        drop_job_ids, run_job_ids, run_jobs_meta, n_retry, run_jobs_upstream = self.select_jobs(job_ids=job_ids, retry_errors=retry_errors, limit=limit, backfill=backfill)
+        logger.info("Found %d job(s) to update.", len(run_job_ids))
+
+        # drop invalid records first
+        self.drop_invalid_jobs(drop_job_ids, run_job_ids)
+
+        # Make a list of specifications for jobs to be run.
+        run_jobs = self.make_job_specs(run_job_ids, run_jobs_meta, debug=debug)
+            
+        if parallel:
+            logger.info("Processing %d jobs (parallel)..", len(run_jobs))
+            # workers are kept by the pipeline and reused across modules
+            pool = self.pipeline.worker_pool(workers)
+            
+            # would like to just call self._run_job, but we can't pass a method to the pool;
+            # instead we wrap this with the run_job_parallel function defined below.
+            job_results = {}
+            for job, result, error in pool.imap_unordered(run_job_parallel, run_jobs):
+                job_results[job['job_id']] = result['error'] if error is None else error
+                print("Finished %d/%d  (%0.1f%%)" % (len(job_results), len(run_jobs), 100*len(job_results)/len(run_jobs)))
+                
+        else:
+            logger.info("Processing %d jobs (serial)..", len(run_jobs))
+            job_results = {}
+            for job in run_jobs:
+                result = self._run_job(job)
+                job_results[result['job_id']] = result['error']
+                
+        # record fingerprints for valid results that were stored without one
+        backfill = {job_id: fp for job_id, fp in backfill.items() if job_id not in run_job_ids}
+        if len(backfill) > 0:
+            self.store_fingerprints(backfill)
+
+        errors = {job:result for job,result in job_results.items() if result is not None}
+        return {'n_dropped': len(drop_job_ids), 'n_updated': len(run_job_ids), 'n_errors': len(errors), 'errors': errors, 'n_retry': n_retry, 'n_skipped': 0, 'skipped': {}}
+
+    def select_jobs(self, job_ids=None, retry_errors=False, limit=None, upstream_hashes=None, backfill=None):
+        """Decide which jobs should be dropped and which should be run during an update.
+
+        Parameters are the same as for update(); *upstream_hashes* and *backfill* are passed
+        to updatable_jobs().
+
+        Returns
+        -------
+        drop_job_ids : list
+            Job IDs whose results are invalid and should be dropped
+        run_job_ids : list
+            Job IDs that should be (re)processed
+        run_jobs_meta : dict
+            {job_id: meta} for jobs that should be processed
+        n_retry : int
+            Number of previously failed jobs that are being retried
+        run_jobs_upstream : dict
+            {job_id: [(module_name, job_id), ...]} listing the upstream jobs that each job to be processed
+            depends on (see job_upstream)
+        """
+        logger = logging.getLogger(__name__)
         n_retry = 0
         if job_ids is None:
             logger.info("Searching for jobs to update..")
-            drop_job_ids, run_jobs_meta, error_jobs = self.updatable_jobs()
+            ready = self.ready_jobs()
+            drop_job_ids, run_jobs_meta, error_jobs = self.updatable_jobs(ready=ready, upstream_hashes=upstream_hashes, backfill=backfill)
             
             if retry_errors:
                 run_jobs_meta.update(error_jobs)
                 n_retry = len(error_jobs)
 
             run_job_ids = list(run_jobs_meta.keys())
+            run_jobs_upstream = {job_id: self.job_upstream(job_id, ready[job_id]) for job_id in run_job_ids}
             
             if limit is not None:
-                # pick a random subset to import; this is just meant to ensure we get a variety
-                # of data when testing the import system.
-                rng = np.random.RandomState(0)
-                rng.shuffle(run_job_ids)
-                run_job_ids = run_job_ids[:limit]
+                run_job_ids = self.limit_jobs(run_job_ids, limit)
                 drop_job_ids = [jid for jid in drop_job_ids if jid in run_jobs_meta]
         else:
             run_job_ids = job_ids
             run_jobs_meta = {}  # no extra metadata provided for these jobs
             drop_job_ids = job_ids
-            
-        logger.info("Found %d job(s) to update.", len(run_job_ids))
+            run_jobs_upstream = {job_id: self.job_upstream(job_id, {}) for job_id in run_job_ids}
 
-        # drop invalid records first
+        return drop_job_ids, run_job_ids, run_jobs_meta, n_retry, run_jobs_upstream
+
+    def limit_jobs(self, run_job_ids, limit):
+        """Return a random subset of at most *limit* job IDs from *run_job_ids*.
+
+        This is just meant to ensure we get a variety of data when testing the import system.
+        """
+        run_job_ids = list(run_job_ids)
+        rng = np.random.RandomState(0)
+        rng.shuffle(run_job_ids)
+        return run_job_ids[:max(limit, 0)]
+
+    def drop_invalid_jobs(self, drop_job_ids, run_job_ids):
+        """Drop results for jobs that are invalid and for jobs that are about to be reprocessed.
+        """
+        logger = logging.getLogger(__name__)
         if len(drop_job_ids) > 0:
             logger.info("Dropping %d invalid results (will not update)..", len(drop_job_ids))
             logger.debug("%s", drop_job_ids)
@@ -118,7 +201,10 @@ class PipelineModule(object):
             logger.debug("%s", run_job_ids)
             self.drop_jobs(run_job_ids)
 
-        # Make a list of specifications for jobs to be run.
+    def make_job_specs(self, run_job_ids, run_jobs_meta=None, debug=False):
+        """Return a list of job specifications (see make_job_spec) for each job ID in *run_job_ids*.
+        """
+        run_jobs_meta = run_jobs_meta or {}
         run_jobs = []
         for i, job_id in enumerate(run_job_ids):
             job = {
@@ -134,33 +220,7 @@ class PipelineModule(object):
             job = self.make_job_spec(job)
             
             run_jobs.append(job)
-            
-        if parallel:
-            # kill DB connections before forking multiple processes
-            database.dispose_all_engines()
-            
-            logger.info("Processing %d jobs (parallel)..", len(run_jobs))
-            pool = multiprocessing.Pool(processes=workers, maxtasksperchild=self.maxtasksperchild)
-            try:
-                # would like to just call self._run_job, but we can't pass a method to Pool.map()
-                # instead we wrap this with the run_job_parallel function defined below.
-                job_results = {}
-                chunksize = self.maxtasksperchild or 1
-                for result in pool.imap(run_job_parallel, run_jobs, chunksize=chunksize):  # note: maxtasksperchild is broken unless we also force chunksize
-                    job_results[result['job_id']] = result['error']
-                    print("Finished %d/%d  (%0.1f%%)" % (len(job_results), len(run_jobs), 100*len(job_results)/len(run_jobs)))
-            finally:
-                pool.close()
-                
-        else:
-            logger.info("Processing %d jobs (serial)..", len(run_jobs))
-            job_results = {}
-            for job in run_jobs:
-                result = self._run_job(job)
-                job_results[result['job_id']] = result['error']
-                
-        errors = {job:result for job,result in job_results.items() if result is not None}
-        return {'n_dropped': len(drop_job_ids), 'n_updated': len(run_job_ids), 'n_errors': len(errors), 'errors': errors, 'n_retry': n_retry}
+        return run_jobs
 
     def make_job_spec(self, spec):
         """Return a dictionary modified from *spec* that contains all
@@ -238,11 +298,18 @@ class PipelineModule(object):
         Returns
         -------
         ready : OrderedDict
-            Contains {job_id: {'dep_time': datetime, 'meta': object}, ...}
+            Contains {job_id: {'dep_time': datetime, 'meta': dict}, ...}
             where *job_id* is a string that uniquely identifies the job to be processed,
             *dep_time* gives the date that its dependencies were last updated, and
-            *meta* is an optional arbitrary object to be stored in the pipeline
+            *meta* is an optional dict to be stored in the pipeline
             table along with this job.
+            
+            Each entry may also contain keys that are used to compute the job fingerprint
+            (see job_fingerprint): 'input_files' (list of raw data files read by the job),
+            'input_file_stats' ({path: (mtime, size)} for input files whose stats are already
+            known, so that they are not stat'ed again), 'input_data' (other JSON-serializable
+            inputs), and 'upstream' (list of (module_name, job_id) pairs; by default, the same
+            job ID in each upstream module).
         """
         # default implpementation collects IDs of finished jobs from upstream modules.
         job_times = OrderedDict()
@@ -263,8 +330,21 @@ class PipelineModule(object):
             
         return ready
 
-    def updatable_jobs(self):
+    def updatable_jobs(self, ready=None, upstream_hashes=None, backfill=None):
         """Return lists of jobs that should be updated and/or should have their results dropped.
+
+        Parameters
+        ----------
+        ready : OrderedDict | None
+            If given, this is used in place of calling ready_jobs().
+        upstream_hashes : dict | None
+            {module_name: {job_id: hash}} giving the hashes that upstream jobs will have once
+            they are rerun in the same update. These replace the stored result hashes when
+            computing job fingerprints.
+        backfill : dict | None
+            Finished jobs that are still valid but were recorded without a fingerprint are added to
+            this dict as {job_id: fingerprint}. Nothing is written to the database here; the caller
+            may store these with store_fingerprints() once the update has run.
         
         Returns
         -------
@@ -278,14 +358,34 @@ class PipelineModule(object):
         drop_job_ids = []
         run_jobs = OrderedDict()
         error_jobs = OrderedDict()
-        ready = self.ready_jobs()
+        if ready is None:
+            ready = self.ready_jobs()
         finished = self.finished_jobs()
+        fingerprints = self.job_fingerprints()
+        planned_hashes = upstream_hashes or {}
+        upstream_hashes = {mod.name: mod.result_hashes() for mod in self.upstream_modules()}
+        for mod_name, hashes in planned_hashes.items():
+            if mod_name in upstream_hashes:
+                upstream_hashes[mod_name].update(hashes)
+        if backfill is None:
+            backfill = {}
         for job_id in ready:
             meta = ready[job_id].get('meta', None)
+            job_fingerprint = self.job_fingerprint(job_id, ready[job_id], upstream_hashes)
+            meta = dict(meta or {}, fingerprint=job_fingerprint)
             if job_id in finished:
                 finish_date, success = finished[job_id]
-                dep_date = ready[job_id]['dep_time']
-                if dep_date > finish_date:
+                if fingerprints.get(job_id) is None or job_fingerprint is None:
+                    # no fingerprint stored with this result, or an upstream result hash is unknown;
+                    # fall back to comparing modification times
+                    invalid = ready[job_id]['dep_time'] > finish_date
+                    if not invalid and success is not False and job_fingerprint is not None:
+                        # result is still valid; its fingerprint may be stored so that comparisons
+                        # (here and in downstream modules) can use it from now on
+                        backfill[job_id] = job_fingerprint
+                else:
+                    invalid = fingerprints[job_id] != job_fingerprint
+                if invalid:
                     # result is invalid
                     run_jobs[job_id] = meta
                 else:
@@ -302,10 +402,78 @@ class PipelineModule(object):
         for job in finished:
             if job not in ready and job not in drop_job_ids:
                 drop_job_ids.append(job)
+
+        fingerprint.default_hash_cache().save()
         
         print("%d jobs ready for processing, %d finished, %d need drop, %d need update, %d previous errors" % (len(ready), len(finished), len(drop_job_ids), len(run_jobs), len(error_jobs)))
         return drop_job_ids, run_jobs, error_jobs
 
+    def job_fingerprint(self, job_id, ready_info, upstream_hashes):
+        """Return a hash of all inputs to a job.
+
+        The fingerprint covers this module's name and version, the contents of
+        ready_info['input_files'], ready_info['input_data'], and the result hashes of the upstream jobs
+        listed in ready_info['upstream']. A finished job is rerun only if its fingerprint changes.
+
+        Parameters
+        ----------
+        job_id : str
+            The job ID.
+        ready_info : dict
+            The entry for this job returned by ready_jobs().
+        upstream_hashes : dict
+            {module_name: {job_id: result_hash}} for all upstream modules (see result_hashes).
+
+        Returns None if the result hash of any upstream job is unknown.
+        """
+        upstream = [(mod_name, up_id, upstream_hashes.get(mod_name, {}).get(up_id)) for mod_name, up_id in self.job_upstream(job_id, ready_info)]
+        if any(up_hash is None for mod_name, up_id, up_hash in upstream):
+            # an upstream result has no known hash; the fingerprint can't be compared
+            return None
+        return fingerprint.job_fingerprint(
+            self.name, self.version, 
+            input_files=ready_info.get('input_files', ()), 
+            input_file_stats=ready_info.get('input_file_stats', None),
+            input_data=ready_info.get('input_data', None), 
+            upstream=upstream,
+        )
+
+    def job_upstream(self, job_id, ready_info):
+        """Return a list of (module_name, job_id) pairs for the upstream jobs that a job depends on.
+
+        This is ready_info['upstream'] if it was given by ready_jobs(); otherwise, the same
+        job ID in each upstream module.
+        """
+        upstream = ready_info.get('upstream', None)
+        if upstream is None:
+            upstream = [(mod.name, job_id) for mod in self.upstream_modules()]
+        return [tuple(up) for up in upstream]
+
+    def job_fingerprints(self):
+        """Return a dict {job_id: fingerprint} giving the fingerprint that was stored with each finished job
+        (or None if no fingerprint was stored).
+        """
+        return {}
+
+    def store_fingerprints(self, fingerprints):
+        """Store fingerprints {job_id: fingerprint} for finished jobs that were recorded without one.
+        """
+        pass
+
+    def result_hashes(self):
+        """Return a dict {job_id: hash} identifying the current result of each successfully finished job.
+
+        These are used by downstream modules to compute job fingerprints. The default implementation
+        uses the stored job fingerprint, which is None (unknown) for jobs finished without one.
+        """
+        fingerprints = self.job_fingerprints()
+        hashes = {}
+        for job_id, (finish_time, success) in self.finished_jobs().items():
+            if success is False:
+                continue
+            hashes[job_id] = fingerprints.get(job_id)
+        return hashes
+
     def job_status(self):
         """Return the status and error message for each job in this module.
             
@@ -319,7 +487,7 @@ class PipelineModule(object):
 
 
 def run_job_parallel(job):
-    # multiprocessing Pool.map doesn't work on methods; must be a plain function
+    # worker pools can't run methods; must be a plain function
     cls = job['module_class']
     return cls._run_job(job)
 
@@ -346,23 +514,19 @@ class DatabasePipelineModule(PipelineModule):
         """
         raise NotImplementedError()
         
-    def job_records(self, job_ids, session):
-        """Return a list of records associated with a list of job IDs.
-        
+    def job_queries(self, job_ids, session):
+        """Return a list of queries that select the records associated with a list of job IDs.
+
+        Each query must select records from a single table. Records in other tables that are removed
+        by ``cascade="delete"`` relationships do not need to be included.
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         raise NotImplementedError()
 
-    def dependent_job_ids(self, module, job_ids):
-        """Return a list of all finished job IDs in this module that depend on 
-        specific jobs from another module.
+    def job_records(self, job_ids, session):
+        """Return a list of records associated with a list of job IDs.
         """
-        if module not in self.upstream_modules():
-            raise ValueError("%s does not depend on module %s" % (self, module))
-        
-        # In most cases, modules use the same IDs as the modules that they depend on.
-        # (usually this is the experiment ID)
-        return job_ids
+        return [rec for q in self.job_queries(job_ids, session) for rec in q.all()]
 
     def make_job_spec(self, spec):
         """Return a dictionary modified from *spec* that contains all
@@ -393,11 +557,16 @@ class DatabasePipelineModule(PipelineModule):
         session.query(db.Pipeline).filter(db.Pipeline.job_id==job_id).filter(db.Pipeline.module_name==cls.name).delete()
         session.commit()
         
+        # record resources used by the job (committing the pipeline record is not included)
+        job_telemetry = telemetry.JobTelemetry()
         try:
-            errors = cls.create_db_entries(job, session)
+            with job_telemetry:
+                errors = cls.create_db_entries(job, session)
+                session.flush()
             if errors is None:
                 errors = []
             error = '\n'.join(errors)
+            meta = dict(meta or {}, telemetry=job_telemetry.result())
             job_result = db.Pipeline(module_name=cls.name, job_id=job_id, success=True, error=error, finish_time=datetime.now(), meta=meta)
             session.add(job_result)
 
@@ -408,6 +577,8 @@ class DatabasePipelineModule(PipelineModule):
             session.rollback()
             
             err = ''.join(traceback.format_exception(*sys.exc_info()))
+            exc_type, exc_value = sys.exc_info()[:2]
+            meta = dict(meta or {}, telemetry=job_telemetry.result(), error_summary=traceback.format_exception_only(exc_type, exc_value)[-1].strip())
             job_result = db.Pipeline(module_name=cls.name, job_id=job_id, success=False, error=err, finish_time=datetime.now(), meta=meta)
             session.add(job_result)
             session.commit()
@@ -434,38 +605,71 @@ class DatabasePipelineModule(PipelineModule):
         session.query(db.Pipeline).filter(db.Pipeline.module_name==self.name).delete()
         session.commit()
     
-    def drop_jobs(self, job_ids, session=None, skip=None):
+    def drop_jobs(self, job_ids, session=None, dry_run=False):
         """Remove all results previously stored for a list of job IDs.
         
-        The associated results of dependent modules are also removed.
+        The associated results of dependent modules are also removed. All affected rows
+        are collected per table and deleted in bulk (see :func:`Database.bulk_delete`),
+        along with the pipeline job records, in a single transaction.
+
+        Parameters
+        ----------
+        job_ids : list
+            Job IDs whose results should be removed.
+        session : Session | None
+            Read-write session to use. If None, a new session is created.
+        dry_run : bool
+            If True, nothing is deleted; only the number of affected rows is reported.
+
+        Returns
+        -------
+        counts : OrderedDict
+            {table_name: n_rows} giving the number of rows removed (or that would be removed) from each table.
         """
         db = self.database
         if session is None:
             session = db.session(readonly=False)
         
-        if skip is None:
-            skip = []
-        
-        for dep in reversed(self.downstream_modules()):
-            if dep in skip:
-                continue            
-            dep_jobs = dep.dependent_job_ids(self, job_ids)
-            dep.drop_jobs(dep_jobs, session=session, skip=skip)
-        
-        print("Dropping %d jobs from %s module.." % (len(job_ids), self.name))
-        records = self.job_records(job_ids, session)
-        if len(records) == 0:
-            print("   (no records to remove for these job IDs)")
-        else:
-            for i,rec in enumerate(records):
-                session.delete(rec)
-                print("   record %d/%d\r" % (i, len(records)), end='')
-                sys.stdout.flush()
-            session.query(db.Pipeline).filter(db.Pipeline.module_name==self.name).filter(db.Pipeline.job_id.in_(job_ids)).delete(synchronize_session=False)
-            print("   dropped %d records; committing.." % len(records))
-            session.commit()
-        
-        skip.append(self)  # only process each module once
+        # collect job IDs from this module and all dependent modules
+        drop_jobs = OrderedDict([(self, set(job_ids))])
+        downstream = self.all_downstream_modules()
+        for dep in [m for m in self.pipeline.sorted_modules().values() if m in downstream]:
+            dep_jobs = set()
+            for up_mod in dep.upstream_modules():
+                if up_mod in drop_jobs:
+                    dep_jobs.update(dep.dependent_job_ids(up_mod, list(drop_jobs[up_mod])))
+            drop_jobs[dep] = dep_jobs
+
+        try:
+            queries = []
+            pipeline_counts = 0
+            for module, mod_job_ids in drop_jobs.items():
+                if len(mod_job_ids) == 0:
+                    continue
+                mod_job_ids = list(mod_job_ids)
+                print("Dropping %d jobs from %s module.." % (len(mod_job_ids), module.name))
+                queries.extend(module.job_queries(mod_job_ids, session))
+                for i in range(0, len(mod_job_ids), 500):
+                    q = session.query(db.Pipeline).filter(db.Pipeline.module_name==module.name).filter(db.Pipeline.job_id.in_(mod_job_ids[i:i+500]))
+                    if dry_run:
+                        pipeline_counts += q.count()
+                    else:
+                        pipeline_counts += q.delete(synchronize_session=False)
+
+            counts = db.bulk_delete(queries, session, dry_run=dry_run)
+            counts['pipeline'] = pipeline_counts
+            if dry_run:
+                session.rollback()
+            else:
+                print("   dropped %d records; committing.." % sum(counts.values()))
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        for table_name, n_rows in counts.items():
+            print("   %s %-30s %8d rows" % ("would drop" if dry_run else "dropped", table_name, n_rows))
+        return counts
     
     def finished_jobs(self):
         """Return an ordered dict of job IDs that have been successfully processed by this module,
@@ -479,6 +683,34 @@ class DatabasePipelineModule(PipelineModule):
         session.rollback()
         return OrderedDict([(uid, (date, success)) for uid, date, success in jobs])
 
+    def job_fingerprints(self):
+        """Return a dict {job_id: fingerprint} giving the fingerprint that was stored with each finished job
+        (or None if no fingerprint was stored).
+        """
+        db = self.database
+        session = db.session()
+        jobs = session.query(db.Pipeline.job_id, db.Pipeline.meta).filter(db.Pipeline.module_name==self.name).all()
+        session.rollback()
+        return {uid: (meta or {}).get('fingerprint') for uid, meta in jobs}
+
+    def store_fingerprints(self, fingerprints):
+        """Store fingerprints {job_id: fingerprint} for finished jobs that were recorded without one.
+        """
+        db = self.database
+        session = db.session(readonly=False)
+        try:
+            job_ids = list(fingerprints.keys())
+            for i in range(0, len(job_ids), 500):
+                q = session.query(db.Pipeline).filter(db.Pipeline.module_name==self.name).filter(db.Pipeline.job_id.in_(job_ids[i:i+500]))
+                for rec in q.all():
+                    rec.meta = dict(rec.meta or {}, fingerprint=fingerprints[rec.job_id])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
     def job_status(self):
         """Return the status and error message for each job in this module.
             
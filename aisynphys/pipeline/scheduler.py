@@ -0,0 +1,144 @@
+from __future__ import division, print_function
+import logging
+from collections import OrderedDict
+from .pipeline_module import run_job_parallel
+from .worker_pool import WorkerPool
+
+
+class JobGraph(object):
+    """Dependency graph of individual jobs spanning all modules in a pipeline.
+
+    Each node is keyed by ``(module_name, job_id)`` and holds the job specification
+    generated by :func:`PipelineModule.make_job_specs`. A job becomes ready to run
+    once all of its upstream jobs have finished successfully; if any upstream job
+    fails, then all jobs that depend on it (directly or indirectly) are skipped.
+    """
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.upstream = {}
+        self.downstream = {}
+        self.skipped = OrderedDict()
+        self._pending = {}
+        self._started = set()
+
+    def add_job(self, module_name, job):
+        """Add a job specification to the graph.
+        """
+        key = (module_name, job['job_id'])
+        self.jobs[key] = job
+        self.upstream.setdefault(key, set())
+        self.downstream.setdefault(key, set())
+        self._pending[key] = set()
+        return key
+
+    def add_dependency(self, key, upstream_key):
+        """Declare that job *key* may not start until *upstream_key* has finished.
+
+        Dependencies on jobs that are not part of the graph are ignored.
+        """
+        if upstream_key not in self.jobs or key not in self.jobs:
+            return
+        self.upstream[key].add(upstream_key)
+        self.downstream[upstream_key].add(key)
+        self._pending[key].add(upstream_key)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def pop_ready(self):
+        """Return a list of keys for jobs that have not been started yet and whose
+        upstream jobs have all finished successfully.
+        """
+        ready = [key for key, pending in self._pending.items() if len(pending) == 0 and key not in self._started and key not in self.skipped]
+        self._started.update(ready)
+        return ready
+
+    def finish(self, key, success):
+        """Mark job *key* as finished.
+
+        If the job failed, then all jobs downstream of it are marked as skipped.
+        Returns a list of keys that were skipped as a result.
+        """
+        skipped = []
+        if success:
+            for dkey in self.downstream[key]:
+                self._pending[dkey].discard(key)
+        else:
+            stack = list(self.downstream[key])
+            while len(stack) > 0:
+                dkey = stack.pop()
+                if dkey in self.skipped or dkey in self._started:
+                    continue
+                self.skipped[dkey] = "upstream job %s %s failed" % key
+                skipped.append(dkey)
+                stack.extend(self.downstream[dkey])
+        return skipped
+
+
+def run_job_graph(graph, parallel=False, workers=None, pool=None):
+    """Process all jobs in a JobGraph, starting each job as soon as its upstream jobs
+    have finished.
+
+    Parameters
+    ----------
+    graph : JobGraph
+        The jobs to be processed.
+    parallel : bool
+        If True, run jobs in a single shared pool of subprocesses.
+    workers : int or None
+        Number of parallel workers to spawn if *pool* is not given. If None, then use one worker per CPU core.
+    pool : WorkerPool or None
+        Pool in which to run jobs when *parallel* is True. If None, a new pool is created
+        for this call and closed afterward.
+
+    Returns
+    -------
+    results : OrderedDict
+        {(module_name, job_id): error} for every job that was run, where *error* is None
+        for successful jobs. Jobs that were skipped because an upstream job failed are
+        listed in ``graph.skipped``.
+    """
+    logger = logging.getLogger(__name__)
+    results = OrderedDict()
+    n_jobs = len(graph)
+
+    def job_finished(key, result):
+        results[key] = result['error']
+        skipped = graph.finish(key, success=result['error'] is None)
+        for skey in skipped:
+            logger.info("Skipping %s %s: %s", skey[0], skey[1], graph.skipped[skey])
+        n_done = len(results) + len(graph.skipped)
+        print("Finished %d/%d  (%0.1f%%)" % (n_done, n_jobs, 100*n_done/max(n_jobs, 1)))
+
+    if parallel:
+        logger.info("Processing %d jobs (parallel)..", n_jobs)
+        own_pool = pool is None
+        if own_pool:
+            pool = WorkerPool(workers=workers)
+        try:
+            running = {}
+            while True:
+                for key in graph.pop_ready():
+                    running[pool.submit(run_job_parallel, graph.jobs[key])] = key
+                if len(running) == 0:
+                    break
+                task_id, result, error = pool.get_result()
+                key = running.pop(task_id)
+                if error is not None:
+                    result = {'job_id': key[1], 'error': error}
+                job_finished(key, result)
+        finally:
+            if own_pool:
+                pool.close()
+    else:
+        logger.info("Processing %d jobs (serial)..", n_jobs)
+        while True:
+            ready = graph.pop_ready()
+            if len(ready) == 0:
+                break
+            for key in ready:
+                job = graph.jobs[key]
+                result = job['module_class']._run_job(job)
+                job_finished(key, result)
+
+    return results
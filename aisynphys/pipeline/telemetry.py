@@ -0,0 +1,258 @@
+"""
+Per-job resource telemetry for pipeline jobs.
+
+While a job runs inside a :class:`JobTelemetry` context, we record its wall time, CPU time,
+peak memory use, the time spent executing database statements, and the number of rows
+inserted into each table. The result is a plain dict that is stored in the ``telemetry``
+key of the job's pipeline record (``Pipeline.meta``), from which :func:`telemetry_report`
+summarizes where an update spent its time.
+"""
+from __future__ import print_function, division
+
+import os, sys, logging
+from collections import OrderedDict
+try:
+    from time import perf_counter, process_time
+except ImportError:
+    # python 2; time.clock measures CPU time on posix (but wall time on windows)
+    from time import time as perf_counter, clock as process_time
+import numpy as np
+import sqlalchemy.event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss():
+    """Return the resident set size of the current process in bytes, or None if it cannot be determined.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    """Return the peak resident set size of the current process in bytes, or None if it cannot be determined.
+
+    On linux this is the high-water mark since the last call to :func:`reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        # ru_maxrss is kB on linux and bytes on macos
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except ImportError:
+        return None
+
+
+def reset_peak_rss():
+    """Reset the peak RSS reported by :func:`peak_rss` to the current RSS.
+
+    Worker processes run many jobs, so without a reset the peak would describe the largest job
+    seen so far rather than the current one. Only supported on linux; return True if the reset succeeded.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# Telemetry collectors that are currently recording (innermost last). Statement events from
+# all engines are routed to these, so engines created during a job are covered as well.
+_active = []
+
+
+@sqlalchemy.event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if len(_active) > 0:
+        conn.info.setdefault('telemetry_start', []).append(perf_counter())
+
+
+@sqlalchemy.event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if len(_active) == 0:
+        return
+    starts = conn.info.get('telemetry_start')
+    if not starts:
+        return
+    dt = perf_counter() - starts.pop()
+
+    n_rows = 0
+    table = None
+    if context is not None and context.isinsert:
+        table = getattr(getattr(context.compiled, 'statement', None), 'table', None)
+        n_rows = cursor.rowcount
+        if n_rows is None or n_rows < 0:
+            n_rows = len(parameters) if executemany else 1
+    for collector in _active:
+        collector._record_statement(dt, None if table is None else table.name, n_rows)
+
+
+class JobTelemetry(object):
+    """Context manager that measures the resources used by a single job.
+
+    Usage::
+
+        with JobTelemetry() as tel:
+            run_job()
+        meta['telemetry'] = tel.result()
+    """
+    def __init__(self):
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.db_time = 0.0
+        self.n_statements = 0
+        self.rows = OrderedDict()
+
+    def _record_statement(self, dt, table_name, n_rows):
+        self.db_time += dt
+        self.n_statements += 1
+        if table_name is not None:
+            self.rows[table_name] = self.rows.get(table_name, 0) + n_rows
+
+    def __enter__(self):
+        self._rss_reset = reset_peak_rss()
+        self._start_rss = current_rss()
+        self._start_wall = perf_counter()
+        self._start_cpu = process_time()
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stop(self):
+        """Stop recording. May be called before the context exits (subsequent calls have no effect).
+        """
+        if self not in _active:
+            return
+        _active.remove(self)
+        self.wall_time = perf_counter() - self._start_wall
+        self.cpu_time = process_time() - self._start_cpu
+        self.peak_rss = peak_rss()
+
+    def result(self):
+        """Return a JSON-serializable dict describing the resources used.
+
+        Memory values are in bytes and times in seconds. *peak_rss* is only specific to this
+        job if *peak_rss_reset* is True; otherwise it is the peak for the lifetime of the process.
+        """
+        if self in _active:
+            self.stop()
+        return {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'db_time': self.db_time,
+            'n_statements': self.n_statements,
+            'start_rss': self._start_rss,
+            'peak_rss': self.peak_rss,
+            'peak_rss_reset': self._rss_reset,
+            'rows': dict(self.rows),
+            'pid': os.getpid(),
+        }
+
+
+def _format_table(header, rows):
+    rows = [[str(c) for c in row] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in rows]) for i,h in enumerate(header)]
+    fmt = "  ".join(["{:<%ds}" % widths[0]] + ["{:>%ds}" % w for w in widths[1:]]) + "\n"
+    lines = [fmt.format(*header), fmt.format(*['-'*w for w in widths])]
+    lines.extend([fmt.format(*r) for r in rows])
+    return ''.join(lines)
+
+
+def telemetry_report(job_telemetry, limit=10, rss_outlier_factor=3.0):
+    """Return a printable report summarizing job telemetry.
+
+    Parameters
+    ----------
+    job_telemetry : dict
+        {module_name: {job_id: telemetry}} where each *telemetry* is a dict as returned by
+        JobTelemetry.result(). Jobs with no recorded telemetry should be omitted.
+    limit : int
+        Maximum number of rows to include in each of the per-job tables.
+    rss_outlier_factor : float
+        Jobs whose peak RSS exceeds this multiple of their module's median are listed as memory outliers.
+    """
+    report = []
+    mb = 1e-6
+
+    # per-module totals
+    rows = []
+    for mod_name, jobs in job_telemetry.items():
+        if len(jobs) == 0:
+            continue
+        tel = list(jobs.values())
+        wall = np.array([t.get('wall_time') or 0 for t in tel])
+        cpu = np.array([t.get('cpu_time') or 0 for t in tel])
+        db_time = np.array([t.get('db_time') or 0 for t in tel])
+        rss = [t['peak_rss'] for t in tel if t.get('peak_rss') is not None]
+        n_rows = sum([sum(t.get('rows', {}).values()) for t in tel])
+        rows.append([
+            mod_name, len(tel), "%0.1f" % wall.sum(), "%0.2f" % wall.mean(), "%0.2f" % wall.max(),
+            "%0.1f" % cpu.sum(), "%0.1f" % db_time.sum(), n_rows,
+            "%0.0f" % (max(rss) * mb) if len(rss) > 0 else '-',
+        ])
+    rows.sort(key=lambda r: -float(r[2]))
+    report.append("\n=====  Slowest modules  =====\n")
+    report.append(_format_table(['module', 'jobs', 'wall (s)', 'mean (s)', 'max (s)', 'cpu (s)', 'db (s)', 'rows', 'max rss (MB)'], rows))
+
+    # per-experiment totals across all modules
+    experiments = OrderedDict()
+    for mod_name, jobs in job_telemetry.items():
+        for job_id, tel in jobs.items():
+            experiments.setdefault(job_id, []).append((mod_name, tel))
+    rows = []
+    for job_id, mod_tel in experiments.items():
+        wall = [(t.get('wall_time') or 0, mod_name) for mod_name, t in mod_tel]
+        slowest = max(wall)
+        rows.append([
+            str(job_id), len(mod_tel), sum([w for w,m in wall]), "%s (%0.1f s)" % (slowest[1], slowest[0]),
+            "%0.1f" % sum([t.get('db_time') or 0 for m,t in mod_tel]),
+        ])
+    rows.sort(key=lambda r: -r[2])
+    for r in rows:
+        r[2] = "%0.1f" % r[2]
+    report.append("\n=====  Slowest experiments  =====\n")
+    report.append(_format_table(['job_id', 'modules', 'wall (s)', 'slowest module', 'db (s)'], rows[:limit]))
+
+    # memory outliers
+    rows = []
+    for mod_name, jobs in job_telemetry.items():
+        rss = {job_id: t['peak_rss'] for job_id, t in jobs.items() if t.get('peak_rss') is not None}
+        if len(rss) == 0:
+            continue
+        median = np.median(list(rss.values()))
+        for job_id, job_rss in rss.items():
+            ratio = job_rss / median if median > 0 else 0
+            if ratio >= rss_outlier_factor:
+                rows.append([mod_name, str(job_id), job_rss, "%0.1fx" % ratio])
+    rows.sort(key=lambda r: -r[2])
+    for r in rows:
+        r[2] = "%0.0f" % (r[2] * mb)
+    report.append("\n=====  Memory outliers (peak RSS > %gx module median)  =====\n" % rss_outlier_factor)
+    if len(rows) == 0:
+        report.append("  none\n")
+    else:
+        report.append(_format_table(['module', 'job_id', 'peak rss (MB)', 'vs. median'], rows[:limit]))
+
+    return ''.join(report)
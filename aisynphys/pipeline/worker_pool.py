@@ -0,0 +1,203 @@
+"""
+Long-lived pool of worker processes for running pipeline jobs.
+
+Unlike multiprocessing.Pool with maxtasksperchild, workers in a WorkerPool are started once
+and keep their warm state (imported modules, ORM mappings, DB engines) from one job to the
+next, across all modules in a pipeline update. A worker is only replaced when its memory use
+grows beyond a limit (``config.worker_rss_limit``), which is how leaks in NWB / HDF5 access
+are contained.
+"""
+from __future__ import print_function, division
+
+import traceback, multiprocessing, multiprocessing.connection, logging
+from collections import OrderedDict
+from .. import config, database
+from .telemetry import current_rss
+
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker():
+    """Default worker initializer: import the modules and build the ORM mappings needed by most
+    pipeline jobs, so that this cost is paid once per worker rather than once per job.
+    """
+    import sqlalchemy.orm
+    import lmfit, pyqtgraph, neuroanalysis
+    import aisynphys.pulse_response_strength, aisynphys.avg_response_fit
+    sqlalchemy.orm.configure_mappers()
+
+
+# Databases used by jobs in this worker process, keyed by address. Job specifications carry a
+# pickled copy of the database; replacing it with the first copy seen lets DB engines and
+# connections be reused across jobs.
+_worker_databases = {}
+
+def _shared_database(job):
+    if not isinstance(job, dict) or job.get('database') is None:
+        return job
+    db = job['database']
+    key = (db.ro_address, db.rw_address)
+    job['database'] = _worker_databases.setdefault(key, db)
+    return job
+
+
+def _worker_main(task_queue, conn, current_task, rss_limit, initializer):
+    if initializer is not None:
+        try:
+            initializer()
+        except Exception:
+            logger.warning("Worker initializer failed:\n%s", traceback.format_exc())
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, fn, arg = task
+        # shared memory is written immediately, so the parent can tell which task was lost if we crash
+        current_task.value = task_id
+        try:
+            result = fn(_shared_database(arg))
+            conn.send(('result', task_id, result))
+        except Exception:
+            conn.send(('error', task_id, traceback.format_exc()))
+
+        rss = current_rss()
+        if rss_limit is not None and rss is not None and rss > rss_limit * 1e6:
+            conn.send(('retire', None, rss))
+            break
+
+
+class WorkerPool(object):
+    """Pool of worker processes that persist across many jobs.
+
+    Parameters
+    ----------
+    workers : int | None
+        Number of worker processes. If None, then use one worker per CPU core.
+    rss_limit : float | None
+        Memory limit (MB). A worker whose resident set size exceeds this after finishing a job
+        exits and is replaced. Default is ``config.worker_rss_limit``.
+    initializer : callable | None
+        Function called once in each worker when it starts (default is :func:`init_worker`).
+    """
+    def __init__(self, workers=None, rss_limit=None, initializer=init_worker):
+        self.n_workers = workers or multiprocessing.cpu_count()
+        self.rss_limit = config.worker_rss_limit if rss_limit is None else rss_limit
+        self.initializer = initializer
+        self.task_queue = multiprocessing.Queue()
+        self.workers = []
+        self.pending = OrderedDict()
+        self.n_recycled = 0
+        self._next_task_id = 0
+        self._closed = False
+        for i in range(self.n_workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        # kill DB connections before forking
+        database.dispose_all_engines()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        current_task = multiprocessing.Value('q', -1, lock=False)
+        proc = multiprocessing.Process(
+            target=_worker_main,
+            args=(self.task_queue, writer, current_task, self.rss_limit, self.initializer),
+            name='pipeline-worker',
+        )
+        proc.daemon = True
+        proc.start()
+        writer.close()
+        self.workers.append(_Worker(proc, reader, current_task))
+
+    def _replace_worker(self, worker):
+        worker.proc.join()
+        worker.conn.close()
+        self.workers.remove(worker)
+        self._start_worker()
+
+    def submit(self, fn, arg):
+        """Queue ``fn(arg)`` to be run in a worker and return a task ID.
+
+        *fn* and *arg* must be picklable.
+        """
+        if self._closed:
+            raise RuntimeError("Worker pool is closed")
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        self.pending[task_id] = True
+        self.task_queue.put((task_id, fn, arg))
+        return task_id
+
+    def get_result(self):
+        """Wait for any submitted task to finish and return ``(task_id, result, error)``.
+
+        *error* is None if the task succeeded, or a formatted traceback otherwise. If a worker
+        process dies while running a task, that task is reported with an error and the worker
+        is replaced.
+        """
+        if len(self.pending) == 0:
+            raise RuntimeError("No tasks are pending")
+        while True:
+            conns = {w.conn: w for w in self.workers}
+            for conn in multiprocessing.connection.wait(list(conns.keys())):
+                worker = conns[conn]
+                try:
+                    msg, task_id, value = conn.recv()
+                except EOFError:
+                    # worker exited without retiring; everything it sent has already been read
+                    task_id = worker.current_task.value
+                    self._replace_worker(worker)
+                    if task_id in self.pending:
+                        del self.pending[task_id]
+                        return task_id, None, "Worker process exited with code %s" % worker.proc.exitcode
+                    continue
+                if msg == 'retire':
+                    logger.info("Replacing worker process %d (using %0.0f MB)", worker.proc.pid, value / 1e6)
+                    self.n_recycled += 1
+                    self._replace_worker(worker)
+                    continue
+                self.pending.pop(task_id, None)
+                if msg == 'result':
+                    return task_id, value, None
+                else:
+                    return task_id, None, value
+
+    def imap_unordered(self, fn, args):
+        """Run ``fn(arg)`` for each item in *args* and yield ``(arg, result, error)`` in order of completion.
+        """
+        tasks = {self.submit(fn, arg): arg for arg in args}
+        for i in range(len(tasks)):
+            task_id, result, error = self.get_result()
+            yield tasks[task_id], result, error
+
+    def close(self):
+        """Stop all workers after they finish their current tasks.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for i in range(len(self.workers)):
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.proc.join()
+            self._drain(worker)
+            worker.conn.close()
+        self.workers = []
+
+    def _drain(self, worker):
+        # read messages sent after the last result was collected (workers that retired after
+        # their final task), so that n_recycled is complete once the pool is closed
+        while worker.conn.poll():
+            try:
+                msg, task_id, value = worker.conn.recv()
+            except EOFError:
+                break
+            if msg == 'retire':
+                self.n_recycled += 1
+
+
+class _Worker(object):
+    def __init__(self, proc, conn, current_task):
+        self.proc = proc
+        self.conn = conn
+        self.current_task = current_task
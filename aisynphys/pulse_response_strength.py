@@ -6,28 +6,24 @@ Analyses that measure the strength of synaptic connections.
 from __future__ import print_function, division
 
 import sys, multiprocessing, time, warnings
+from collections import OrderedDict
 
 import numpy as np
+import scipy.signal
 import pyqtgraph as pg
 
-from neuroanalysis.data import TSeries
-from neuroanalysis import filter
-from neuroanalysis.event_detection import exp_deconvolve, exp_reconvolve, exp_deconv_psp_params
+from neuroanalysis.event_detection import exp_reconvolve, exp_deconv_psp_params
 from neuroanalysis.fitting import fit_psp, Psp, SearchFit, fit_scale_offset
 from neuroanalysis.baseline import float_mode
 
 from .database import default_db as db
+from .fitting import fit_psp_batch
+from .util import apply_filter_rows
 
 
-def measure_response(pr):
-    """Curve fit a single pulse response to measure its amplitude / kinetics.
-    
-    Uses the known latency and kinetics of the synapse to seed the fit.
-    Optionally fit a baseline at the same time for noise measurement.
-    
-    Parameters
-    ----------
-    pr : PulseResponse
+def _response_fit_params(pr):
+    """Return (clamp_mode, sign, latency, rise_time, decay_tau) used to seed PSP fits of *pr*,
+    or None if the synapse parameters are not available.
     """
     syn = pr.pair.synapse
     pcr = pr.recording.patch_clamp_recording
@@ -42,10 +38,8 @@ def measure_response(pr):
     for v in [pr.stim_pulse.first_spike_time, syn.latency, rise_time, decay_tau]:
         if v is None or syn.latency is None or not np.isfinite(v):
             # print("bad:", pr.stim_pulse.first_spike_time, syn.latency, rise_time, decay_tau)
-            return None, None
+            return None
     
-    data = pr.get_tseries('post', align_to='spike')
-
     # decide whether/how to constrain the sign of the fit
     if syn.synapse_type == 'ex':
         sign = 1
@@ -59,10 +53,32 @@ def measure_response(pr):
     if pcr.clamp_mode == 'vc':
         sign = -sign
 
+    return pcr.clamp_mode, sign, syn.latency, rise_time, decay_tau
+
+
+def measure_response(pr):
+    """Curve fit a single pulse response to measure its amplitude / kinetics.
+    
+    Uses the known latency and kinetics of the synapse to seed the fit.
+    Optionally fit a baseline at the same time for noise measurement.
+
+    See measure_responses() for a faster version that fits many responses at once.
+    
+    Parameters
+    ----------
+    pr : PulseResponse
+    """
+    fit_params = _response_fit_params(pr)
+    if fit_params is None:
+        return None, None
+    clamp_mode, sign, latency, rise_time, decay_tau = fit_params
+    
+    data = pr.get_tseries('post', align_to='spike')
+
     # fit response region
     response_fit = fit_psp(data,
-        search_window=syn.latency + np.array([-100e-6, 100e-6]), 
-        clamp_mode=pcr.clamp_mode, 
+        search_window=latency + np.array([-100e-6, 100e-6]), 
+        clamp_mode=clamp_mode, 
         sign=sign,
         baseline_like_psp=True, 
         init_params={'rise_time': rise_time, 'decay_tau': decay_tau},
@@ -77,8 +93,8 @@ def measure_response(pr):
         baseline_fit = None
     else:
         baseline_fit = fit_psp(baseline,
-            search_window=syn.latency + np.array([-100e-6, 100e-6]), 
-            clamp_mode=pcr.clamp_mode, 
+            search_window=latency + np.array([-100e-6, 100e-6]), 
+            clamp_mode=clamp_mode, 
             sign=sign, 
             baseline_like_psp=True, 
             init_params={'rise_time': rise_time, 'decay_tau': decay_tau},
@@ -88,116 +104,206 @@ def measure_response(pr):
     return response_fit, baseline_fit
 
 
+def measure_responses(prs):
+    """Curve fit many pulse responses to measure their amplitudes / kinetics.
+
+    This produces the same fits as calling measure_response() on each item in *prs*, 
+    but responses (and baselines) with the same clamp mode, sample rate, and length are
+    stacked together and fit in a single call to fit_psp_batch().
+
+    Parameters
+    ----------
+    prs : list
+        List of PulseResponse instances
+
+    Returns
+    -------
+    fits : list
+        A (response_fit, baseline_fit) tuple for each item in *prs*
+    """
+    results = [[None, None] for pr in prs]
+
+    # collect traces to fit, grouped by everything that must be shared within a batch
+    groups = OrderedDict()
+    for i, pr in enumerate(prs):
+        fit_params = _response_fit_params(pr)
+        if fit_params is None:
+            continue
+        clamp_mode, sign, latency, rise_time, decay_tau = fit_params
+        for j, ts_type in enumerate(('post', 'baseline')):
+            ts = pr.get_tseries(ts_type, align_to='spike')
+            if ts is None:
+                continue
+            # baseline fits are allowed to vary kinetics, as in measure_response
+            key = (clamp_mode, ts_type == 'baseline', len(ts), ts.dt)
+            groups.setdefault(key, []).append((i, j, ts, sign, latency, rise_time, decay_tau))
+
+    for (clamp_mode, fit_kinetics, n_samples, dt), items in groups.items():
+        i, j, tseries, sign, latency, rise_time, decay_tau = zip(*items)
+        latency = np.array(latency)
+        fits = fit_psp_batch(
+            t=np.stack([ts.time_values for ts in tseries]),
+            data=np.stack([ts.data for ts in tseries]),
+            search_window=latency[:, None] + np.array([-100e-6, 100e-6])[None, :],
+            clamp_mode=clamp_mode,
+            sign=sign,
+            rise_time=rise_time,
+            decay_tau=decay_tau,
+            fit_kinetics=fit_kinetics,
+        )
+        for pr_index, fit_index, fit in zip(i, j, fits):
+            results[pr_index][fit_index] = fit
+
+    return [tuple(r) for r in results]
+
+
 def measure_deconvolved_response(pr):
     """Use exponential deconvolution and a curve fit to estimate the amplitude of a synaptic response.
 
     Uses the known latency and kinetics of the synapse to constrain the fit.
     Optionally fit a baseline at the same time for noise measurement.
+
+    See measure_deconvolved_responses() for a faster version that processes many responses at once.
     
     Parameters
     ----------
     pr : PulseResponse
     """
-    syn = pr.pair.synapse
-    pcr = pr.recording.patch_clamp_recording
-    if pcr.clamp_mode == 'ic':
-        rise_time = syn.psp_rise_time
-        decay_tau = syn.psp_decay_tau
-        lowpass = 2000
-    else:
-        rise_time = syn.psc_rise_time
-        decay_tau = syn.psc_decay_tau
-        lowpass = 6000
-    
-    # make sure all parameters are available
-    for v in [pr.stim_pulse.first_spike_time, syn.latency, rise_time, decay_tau]:
-        if v is None or not np.isfinite(v):
-            return None, None
+    return measure_deconvolved_responses([pr])[0]
 
-    response_data = pr.get_tseries('post', align_to='spike')
-    baseline_data = pr.get_tseries('baseline', align_to='spike')
 
-    ret = []
-    for data in (response_data, baseline_data):
-        if data is None:
-            ret.append(None)
-            continue
-            
-        filtered = deconv_filter(data, None, tau=decay_tau, lowpass=lowpass, remove_artifacts=False, bsub=True)
-        
-        # chop down to the minimum we need to fit the deconvolved event.
-        # there's a tradeoff here -- to much data and we risk incorporating nearby spontaneous events; too little
-        # data and we get more noise in the fit to baseline
-        filtered = filtered.time_slice(syn.latency-1e-3, syn.latency + rise_time + 1e-3)
-        
-        # Deconvolving a PSP-like shape yields a narrower PSP-like shape with lower rise power.
-        # Guess the deconvolved time constants:
-        dec_amp, dec_rise_time, dec_rise_power, dec_decay_tau = exp_deconv_psp_params(amp=1, rise_time=rise_time, decay_tau=decay_tau, rise_power=2)
-        amp_ratio = 1 / dec_amp
-        
-        psp = Psp()
-
-        # Need to measure amplitude of exp-deconvolved events; two methods to pick from here:
-        # 1) Direct curve fitting using the expected deconvolved rise/decay time constants. This
-        #    allows some wiggle room in latency, but produces a weird butterfly-shaped background noise distribution.
-        # 2) Analytically calculate the scale/offset of a fixed template. Uses a fixed latency, but produces
-        #    a nice, normal-looking background noise distribution.
-
-        # Measure amplitude of deconvolved event by curve fitting:
-        # with warnings.catch_warnings():
-        #     warnings.simplefilter("ignore")
-        #     max_amp = filtered.data.max() - filtered.data.min()
-        #     fit = psp.fit(filtered.data, x=filtered.time_values, params={
-        #         'xoffset': (response_rec.latency, response_rec.latency-0.2e-3, response_rec.latency+0.5e-3),
-        #         'yoffset': (0, 'fixed'),
-        #         'amp': (0, -max_amp, max_amp),
-        #         'rise_time': (dec_rise_time, 'fixed'),
-        #         'decay_tau': (dec_decay_tau, 'fixed'),
-        #         'rise_power': (dec_rise_power, 'fixed'),
-        #     })
-        # reconvolved_amp = fit.best_values['amp'] * amp_ratio
+def measure_deconvolved_responses(prs):
+    """Measure the deconvolved amplitude of many pulse responses (and their baselines).
+
+    This produces the same results as calling measure_deconvolved_response() on each item in *prs*,
+    but traces with the same filter settings, sample rate, and length are deconvolved and filtered
+    together in a single call to deconv_filter_batch().
+
+    Parameters
+    ----------
+    prs : list
+        List of PulseResponse instances
+
+    Returns
+    -------
+    fits : list
+        A (response_fit, baseline_fit) pair for each item in *prs*
+    """
+    results = [(None, None) for pr in prs]
+
+    groups = OrderedDict()
+    for i, pr in enumerate(prs):
+        syn = pr.pair.synapse
+        pcr = pr.recording.patch_clamp_recording
+        if pcr.clamp_mode == 'ic':
+            rise_time = syn.psp_rise_time
+            decay_tau = syn.psp_decay_tau
+            lowpass = 2000
+        else:
+            rise_time = syn.psc_rise_time
+            decay_tau = syn.psc_decay_tau
+            lowpass = 6000
         
-        # fit = {
-        #     'xoffset': fit.best_values['xoffset'],
-        #     'yoffset': fit.best_values['yoffset'],
-        #     'amp': fit.best_values['amp'],
-        #     'rise_time': dec_rise_time,
-        #     'decay_tau': dec_decay_tau,
-        #     'rise_power': dec_rise_power,
-        #     'reconvolved_amp': reconvolved_amp,
-        # }
-
-        # Measure amplitude of deconvolved events by direct template match
-        template = psp.eval(
-            x=filtered.time_values, 
-            xoffset=syn.latency,
-            yoffset=0,
-            amp=1,
-            rise_time=dec_rise_time,
-            decay_tau=dec_decay_tau,
-            rise_power=dec_rise_power,
+        # make sure all parameters are available
+        if any(v is None or not np.isfinite(v) for v in [pr.stim_pulse.first_spike_time, syn.latency, rise_time, decay_tau]):
+            continue
+
+        results[i] = [None, None]
+        for j, ts_type in enumerate(('post', 'baseline')):
+            ts = pr.get_tseries(ts_type, align_to='spike')
+            if ts is None:
+                continue
+            key = (lowpass, len(ts), ts.dt, ts.data.dtype)
+            groups.setdefault(key, []).append((i, j, ts, syn.latency, rise_time, decay_tau))
+
+    for (lowpass, n_samples, dt, dtype), items in groups.items():
+        i, j, tseries, latency, rise_time, decay_tau = zip(*items)
+        filtered = deconv_filter_batch(
+            np.stack([ts.data for ts in tseries]), dt, t0=[ts.t0 for ts in tseries], 
+            tau=np.array(decay_tau), lowpass=lowpass, remove_artifacts=False, bsub=True,
         )
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            scale, offset = fit_scale_offset(filtered.data, template)
+        for k in range(len(items)):
+            ts = _deconvolved_copy(tseries[k], filtered[k], deconvolved=True)
+            results[i[k]][j[k]] = _fit_deconvolved_response(ts, latency[k], rise_time[k], decay_tau[k])
 
-        # calculate amplitude of reconvolved event -- tis is our best guess as to the
-        # actual event amplitude
-        reconvolved_amp = scale * amp_ratio
-        
-        fit = {
-            'xoffset': syn.latency,
-            'yoffset': offset,
-            'amp': scale,
-            'rise_time': dec_rise_time,
-            'decay_tau': dec_decay_tau,
-            'rise_power': 1,
-            'reconvolved_amp': reconvolved_amp,
-        }
-        
-        ret.append(fit)
-        
-    return ret
+    return results
+
+
+def _fit_deconvolved_response(filtered, latency, rise_time, decay_tau):
+    """Measure the amplitude of a deconvolved, filtered response by matching it to a template
+    with the expected deconvolved kinetics.
+    """
+    # chop down to the minimum we need to fit the deconvolved event.
+    # there's a tradeoff here -- to much data and we risk incorporating nearby spontaneous events; too little
+    # data and we get more noise in the fit to baseline
+    filtered = filtered.time_slice(latency-1e-3, latency + rise_time + 1e-3)
+    
+    # Deconvolving a PSP-like shape yields a narrower PSP-like shape with lower rise power.
+    # Guess the deconvolved time constants:
+    dec_amp, dec_rise_time, dec_rise_power, dec_decay_tau = exp_deconv_psp_params(amp=1, rise_time=rise_time, decay_tau=decay_tau, rise_power=2)
+    amp_ratio = 1 / dec_amp
+    
+    psp = Psp()
+
+    # Need to measure amplitude of exp-deconvolved events; two methods to pick from here:
+    # 1) Direct curve fitting using the expected deconvolved rise/decay time constants. This
+    #    allows some wiggle room in latency, but produces a weird butterfly-shaped background noise distribution.
+    # 2) Analytically calculate the scale/offset of a fixed template. Uses a fixed latency, but produces
+    #    a nice, normal-looking background noise distribution.
+
+    # Measure amplitude of deconvolved event by curve fitting:
+    # with warnings.catch_warnings():
+    #     warnings.simplefilter("ignore")
+    #     max_amp = filtered.data.max() - filtered.data.min()
+    #     fit = psp.fit(filtered.data, x=filtered.time_values, params={
+    #         'xoffset': (response_rec.latency, response_rec.latency-0.2e-3, response_rec.latency+0.5e-3),
+    #         'yoffset': (0, 'fixed'),
+    #         'amp': (0, -max_amp, max_amp),
+    #         'rise_time': (dec_rise_time, 'fixed'),
+    #         'decay_tau': (dec_decay_tau, 'fixed'),
+    #         'rise_power': (dec_rise_power, 'fixed'),
+    #     })
+    # reconvolved_amp = fit.best_values['amp'] * amp_ratio
+    
+    # fit = {
+    #     'xoffset': fit.best_values['xoffset'],
+    #     'yoffset': fit.best_values['yoffset'],
+    #     'amp': fit.best_values['amp'],
+    #     'rise_time': dec_rise_time,
+    #     'decay_tau': dec_decay_tau,
+    #     'rise_power': dec_rise_power,
+    #     'reconvolved_amp': reconvolved_amp,
+    # }
+
+    # Measure amplitude of deconvolved events by direct template match
+    template = psp.eval(
+        x=filtered.time_values, 
+        xoffset=latency,
+        yoffset=0,
+        amp=1,
+        rise_time=dec_rise_time,
+        decay_tau=dec_decay_tau,
+        rise_power=dec_rise_power,
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        scale, offset = fit_scale_offset(filtered.data, template)
+
+    # calculate amplitude of reconvolved event -- tis is our best guess as to the
+    # actual event amplitude
+    reconvolved_amp = scale * amp_ratio
+    
+    fit = {
+        'xoffset': latency,
+        'yoffset': offset,
+        'amp': scale,
+        'rise_time': dec_rise_time,
+        'decay_tau': dec_decay_tau,
+        'rise_power': 1,
+        'reconvolved_amp': reconvolved_amp,
+    }
+    
+    return fit
 
 
 def measure_peak(trace, sign, spike_time, pulse_times, spike_delay=1e-3, response_window=4e-3):
@@ -236,37 +342,143 @@ def measure_sum(trace, sign, baseline=(0e-3, 9e-3), response=(12e-3, 17e-3)):
 
         
 def deconv_filter(trace, pulse_times, tau=15e-3, lowpass=24000., lpf=True, remove_artifacts=False, bsub=True):
+    """Deconvolve, remove stimulus artifacts, baseline-subtract, and lowpass filter a TSeries.
+
+    See deconv_filter_batch() for a description of the arguments.
+    """
+    filtered = deconv_filter_batch(
+        trace.data[np.newaxis, :], trace.dt, t0=trace.t0, 
+        pulse_times=None if pulse_times is None else [pulse_times],
+        tau=tau, lowpass=lowpass, lpf=lpf, remove_artifacts=remove_artifacts, bsub=bsub,
+    )
+    return _deconvolved_copy(trace, filtered[0], deconvolved=tau is not None)
+
+
+def deconv_filter_batch(data, dt, t0=0, pulse_times=None, tau=15e-3, lowpass=24000., lpf=True, remove_artifacts=False, bsub=True):
+    """Deconvolve, remove stimulus artifacts, baseline-subtract, and lowpass filter many traces at once.
+
+    Each step is applied along axis 1 of *data*; row *i* of the result is identical to
+    ``deconv_filter(TSeries(data[i], dt=dt, t0=t0[i]), pulse_times[i], ...).data``.
+
+    Parameters
+    ----------
+    data : array
+        2D array (n_traces, n_samples) of traces with equal sample rate and length
+    dt : float
+        Sample interval shared by all traces
+    t0 : float | array
+        Start time of each trace
+    pulse_times : list | None
+        (pulse_start, pulse_stop) for each trace; required if *remove_artifacts* is True
+    tau : float | array | None
+        Exponential deconvolution time constant, either shared by all traces or one per trace.
+        If None, then no deconvolution is done. Deconvolved traces are one sample shorter than the input.
+    lowpass : float
+        Bessel filter cutoff frequency
+    lpf : bool
+        If True, apply a bidirectional Bessel lowpass filter
+    remove_artifacts : bool
+        If True, remove stimulus crosstalk artifacts after deconvolution (see remove_crosstalk_artifacts_batch)
+    bsub : bool
+        If True, subtract the median of 5-10 ms after the beginning of each trace
+    """
+    data = np.asarray(data)
+    t0 = np.broadcast_to(np.asarray(t0, dtype=float), (len(data),))
+
     if tau is not None:
-        dec = exp_deconvolve(trace, tau)
-    else:
-        dec = trace
+        scale = np.asarray(tau, dtype=float) / dt
+        if scale.ndim > 0:
+            scale = scale[:, np.newaxis]
+        if np.issubdtype(data.dtype, np.floating):
+            # match the precision of deconvolving with a scalar time constant
+            scale = scale.astype(data.dtype)
+        data = data[:, :-1] + scale * np.diff(data, axis=1)
 
     if remove_artifacts:
         # after deconvolution, the pulse causes two sharp artifacts; these
         # must be removed before LPF
-        cleaned = remove_crosstalk_artifacts(dec, pulse_times)
-    else:
-        cleaned = dec
+        data = remove_crosstalk_artifacts_batch(data, dt, t0, pulse_times)
 
     if bsub:
-        baseline = np.median(cleaned.time_slice(cleaned.t0+5e-3, cleaned.t0+10e-3).data)
-        b_subbed = cleaned - baseline
-    else:
-        b_subbed = cleaned
+        baseline = np.empty(len(data), dtype=data.dtype)
+        start = _time_index(t0 + 5e-3, t0, dt, data.shape[1])
+        stop = _time_index(t0 + 10e-3, t0, dt, data.shape[1])
+        for i0, i1 in set(zip(start, stop)):
+            mask = (start == i0) & (stop == i1)
+            baseline[mask] = np.median(data[mask, i0:i1], axis=1)
+        data = data - baseline[:, np.newaxis]
 
     if lpf:
-        return filter.bessel_filter(b_subbed, lowpass)
+        b, a = scipy.signal.bessel(1, lowpass * dt, btype='low')
+        data = apply_filter_rows(data, b, a)
+
+    return data
+
+
+def _time_index(t, t0, dt, n):
+    """Return the sample indices nearest to times *t* in traces starting at *t0*, clipped
+    to the range used by TSeries.time_slice.
+    """
+    return np.clip(np.round((t - t0) * (1.0 / dt)), 0, n - 1).astype(int)
+
+
+def _deconvolved_copy(trace, data, deconvolved):
+    """Return a copy of *trace* with new *data*, which is one sample shorter if it was deconvolved.
+    """
+    if deconvolved and trace.has_time_values:
+        return trace.copy(data=data, time_values=trace.time_values[:-1])
     else:
-        return b_subbed
+        return trace.copy(data=data)
 
 
 def remove_crosstalk_artifacts(data, pulse_times):
-    dt = data.dt
+    cleaned = remove_crosstalk_artifacts_batch(data.data[np.newaxis, :], data.dt, [data.t0], [pulse_times])
+    return data.copy(data=cleaned[0])
+
+
+def remove_crosstalk_artifacts_batch(data, dt, t0, pulse_times):
+    """Remove stimulus crosstalk artifacts from each row of *data*.
+
+    The region from 50 us before to 250 us after each of the (pulse_start, pulse_stop) times
+    given for each row is replaced by a line fit to the 100 us on either side (as in
+    neuroanalysis.filter.remove_artifacts). Rows that have the same artifact regions
+    are fit together. The fits do not depend on the start time *t0* of each row.
+    """
     r = [-50e-6, 250e-6]
-    edges = [(int((t+r[0])/dt), int((t+r[1])/dt)) for t in pulse_times]
     # If window is too shortm then it becomes seneitive to sample noise.
     # If window is too long, then it becomes sensitive to slower signals (like the AP following pulse onset)
-    return filter.remove_artifacts(data, edges, window=100e-6)
+    w = int(100e-6 / dt)
+    cleaned = np.array(data, copy=True)
+    index = np.arange(cleaned.shape[1])
+
+    # group rows by their (merged) artifact regions
+    groups = OrderedDict()
+    for i, times in enumerate(pulse_times):
+        edges = sorted((int((t+r[0])/dt), int((t+r[1])/dt)) for t in times)
+        merged_edges = [edges[0]]
+        for on, off in edges[1:]:
+            on1, off1 = merged_edges[-1]
+            if on < off1:
+                merged_edges[-1] = (min(on, on1), max(off, off1))
+            else:
+                merged_edges.append((on, off))
+        groups.setdefault(tuple(merged_edges), []).append(i)
+
+    for merged_edges, rows in groups.items():
+        rows = np.array(rows)
+        for on, off in merged_edges:
+            # fit a line to the windows on either side of the artifact in all rows at once
+            x = index[on-w:off+w]
+            mask = np.ones(len(x), dtype='bool')
+            mask[w:w+(off-on)] = False
+            x = x[mask].astype(float)
+            y = cleaned[rows][:, x.astype(int)].astype(float)
+            xm = x.mean()
+            ym = y.mean(axis=1)
+            slope = ((x - xm) * (y - ym[:, np.newaxis])).sum(axis=1) / ((x - xm)**2).sum()
+            intercept = ym - slope * xm
+            cleaned[rows, on:off] = slope[:, np.newaxis] * index[on:off] + intercept[:, np.newaxis]
+    return cleaned
 
 
 def analyze_response_strength(pr, source, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000):
@@ -276,54 +488,92 @@ def analyze_response_strength(pr, source, remove_artifacts=False, deconvolve=Tru
     2. Measure peak deflection on raw trace
     3. Apply deconvolution / artifact removal / lpf
     4. Measure peak deflection on deconvolved trace
+
+    See analyze_response_strengths() for a faster version that analyzes many records at once.
     """
-    if source == 'pulse_response':
-        data = pr.get_tseries('post', align_to='pulse')
-    elif source == 'baseline':
-        data = pr.get_tseries('baseline', align_to='pulse')
-    else:
-        raise ValueError("Invalid source %s" % source)
-    
-    if data is None:
-        return None
-            
-    pulse_times = data.meta['pulse_start'], data.meta['pulse_stop']
-    spike_time = data.meta['spike_time']
-    if spike_time is None:
-        # these pulses failed QC, but we analyze them anyway to make all data visible
-        spike_time = 1e-3
-
-    results = {}
-
-    results['raw_trace'] = data
-    results['pulse_times'] = pulse_times
-    results['spike_time'] = spike_time
-
-    # Measure crosstalk from pulse onset
-    p1 = data.time_slice(pulse_times[0]-200e-6, pulse_times[0]).median()
-    p2 = data.time_slice(pulse_times[0], pulse_times[0]+200e-6).median()
-    results['crosstalk'] = p2 - p1
-
-    # crosstalk artifacts in VC are removed before deconvolution
-    pcr = pr.recording.patch_clamp_recording
-    if pcr.clamp_mode == 'vc' and remove_artifacts is True:
-        data = remove_crosstalk_artifacts(data, pulse_times)
-        remove_artifacts = False
+    return analyze_response_strengths([(pr, source)], remove_artifacts=remove_artifacts, deconvolve=deconvolve, lpf=lpf, bsub=bsub, lowpass=lowpass)[0]
 
-    # Measure deflection on raw data
-    results['pos_amp'], _ = measure_peak(data, '+', spike_time, pulse_times)
-    results['neg_amp'], _ = measure_peak(data, '-', spike_time, pulse_times)
-    
-    # Deconvolution / artifact removal / filtering
-    if deconvolve:
-        tau = 15e-3 if pcr.clamp_mode == 'ic' else 5e-3
-    else:
-        tau = None
-    dec_data = deconv_filter(data, pulse_times, tau=tau, lpf=lpf, remove_artifacts=remove_artifacts, bsub=bsub, lowpass=lowpass)
-    results['dec_trace'] = dec_data
 
-    # Measure deflection on deconvolved data
-    results['pos_dec_amp'], results['pos_dec_latency'] = measure_peak(dec_data, '+', spike_time, pulse_times)
-    results['neg_dec_amp'], results['neg_dec_latency'] = measure_peak(dec_data, '-', spike_time, pulse_times)
+def analyze_response_strengths(records, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000):
+    """Perform the analysis described in analyze_response_strength() on many records.
+
+    Traces with the same deconvolution settings, sample rate, and length are deconvolved and
+    filtered together in a single call to deconv_filter_batch().
+
+    Parameters
+    ----------
+    records : list
+        List of (pulse_response, source) tuples, where *source* is 'pulse_response' or 'baseline'
+
+    Returns
+    -------
+    results : list
+        A result dict (or None if no data is available) for each item in *records*
+    """
+    all_results = [None] * len(records)
+    groups = OrderedDict()
+    for i, (pr, source) in enumerate(records):
+        if source == 'pulse_response':
+            data = pr.get_tseries('post', align_to='pulse')
+        elif source == 'baseline':
+            data = pr.get_tseries('baseline', align_to='pulse')
+        else:
+            raise ValueError("Invalid source %s" % source)
+        
+        if data is None:
+            continue
+                
+        pulse_times = data.meta['pulse_start'], data.meta['pulse_stop']
+        spike_time = data.meta['spike_time']
+        if spike_time is None:
+            # these pulses failed QC, but we analyze them anyway to make all data visible
+            spike_time = 1e-3
+
+        results = {}
+
+        results['raw_trace'] = data
+        results['pulse_times'] = pulse_times
+        results['spike_time'] = spike_time
+
+        # Measure crosstalk from pulse onset
+        p1 = data.time_slice(pulse_times[0]-200e-6, pulse_times[0]).median()
+        p2 = data.time_slice(pulse_times[0], pulse_times[0]+200e-6).median()
+        results['crosstalk'] = p2 - p1
+
+        # crosstalk artifacts in VC are removed before deconvolution
+        pcr = pr.recording.patch_clamp_recording
+        dec_remove_artifacts = remove_artifacts
+        if pcr.clamp_mode == 'vc' and remove_artifacts is True:
+            data = remove_crosstalk_artifacts(data, pulse_times)
+            dec_remove_artifacts = False
+
+        # Measure deflection on raw data
+        results['pos_amp'], _ = measure_peak(data, '+', spike_time, pulse_times)
+        results['neg_amp'], _ = measure_peak(data, '-', spike_time, pulse_times)
+        
+        # Deconvolution / artifact removal / filtering are done below for all traces at once
+        if deconvolve:
+            tau = 15e-3 if pcr.clamp_mode == 'ic' else 5e-3
+        else:
+            tau = None
+        all_results[i] = results
+        key = (tau, dec_remove_artifacts, len(data), data.dt, data.data.dtype)
+        groups.setdefault(key, []).append((i, data))
+
+    for (tau, dec_remove_artifacts, n_samples, dt, dtype), items in groups.items():
+        dec = deconv_filter_batch(
+            np.stack([data.data for i, data in items]), dt, t0=[data.t0 for i, data in items],
+            pulse_times=[all_results[i]['pulse_times'] for i, data in items],
+            tau=tau, lpf=lpf, remove_artifacts=dec_remove_artifacts, bsub=bsub, lowpass=lowpass,
+        )
+        for (i, data), dec_row in zip(items, dec):
+            results = all_results[i]
+            dec_data = _deconvolved_copy(data, dec_row, deconvolved=tau is not None)
+            results['dec_trace'] = dec_data
+
+            # Measure deflection on deconvolved data
+            spike_time, pulse_times = results['spike_time'], results['pulse_times']
+            results['pos_dec_amp'], results['pos_dec_latency'] = measure_peak(dec_data, '+', spike_time, pulse_times)
+            results['neg_dec_amp'], results['neg_dec_latency'] = measure_peak(dec_data, '-', spike_time, pulse_times)
     
-    return results
+    return all_results
@@ -64,6 +64,19 @@ def recording_qc_pass(rec):
     return qc_pass, failures
 
 
+def cached_recording_qc_pass(rec):
+    """Return the result of recording_qc_pass(rec), computing it only once per recording.
+
+    The result is stored on the recording object, so this is only appropriate for recordings
+    whose data will not change.
+    """
+    result = getattr(rec, '_recording_qc_pass', None)
+    if result is None:
+        result = recording_qc_pass(rec)
+        rec._recording_qc_pass = result
+    return result
+
+
 def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     """Apply QC criteria for pulse-response recordings:
 
@@ -78,6 +91,8 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     These criteria are intended as minimal quality control when determining _whether_ a synaptic
     connection exists between two cells. 
 
+    To check many pulse responses from the same recording, use pulse_response_qc_pass_batch.
+
     Parameters
     ----------
     post_rec : Recording
@@ -101,71 +116,151 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     failures : dict
         QC failures for ex and in
     """
-    
-    failures = {'ex': [], 'in': []}
+    ex_qc_pass, in_qc_pass, failures = pulse_response_qc_pass_batch(post_rec, [window], [n_spikes], [adjacent_pulses])
+    return bool(ex_qc_pass[0]), bool(in_qc_pass[0]), failures[0]
 
-    # Require the postsynaptic recording to pass basic QC
-    recording_pass_qc, recording_qc_failures = recording_qc_pass(post_rec)
-    if recording_pass_qc is False:
-        [failures[k].append('postsynaptic recording failed QC: %s' % ', and '.join(recording_qc_failures)) for k in failures.keys()]
-
-    # require at least 1 presynaptic spike
-    if n_spikes == 0:
-        [failures[k].append('%d spikes detected in presynaptic recording' % n_spikes) for k in failures.keys()]
-
-    # Check for noise in response window
-    data = post_rec['primary'].time_slice(window[0], window[1])
-    pre_pulse = data.time_slice(window[0], window[0] + 5e-3)
-    base = pre_pulse.median()
-    max_amp = np.abs((data - base).data).max()
+
+def pulse_response_qc_pass_batch(post_rec, windows, n_spikes, adjacent_pulses):
+    """Apply the QC criteria described in pulse_response_qc_pass to many pulse responses
+    from the same postsynaptic recording.
+
+    Recording-level QC is computed only once per recording (see cached_recording_qc_pass), and
+    the per-window measurements (baseline median and noise, response max and amplitude) are
+    computed over all windows of equal length at once.
+
+    Parameters
+    ----------
+    post_rec : Recording
+        The postsynaptic Recording instance
+    windows : list
+        [start, stop] times for each pulse response
+    n_spikes : list
+        Number of presynaptic spikes (or None) for each pulse response
+    adjacent_pulses : list
+        List of adjacent pulse times for each pulse response
+
+    Returns
+    -------
+    ex_qc_pass : array
+        Boolean array indicating which pulse-responses pass QC for detecting excitatory connections
+    in_qc_pass : array
+        Boolean array indicating which pulse-responses pass QC for detecting inhibitory connections
+    failures : list
+        QC failure dicts (as returned by pulse_response_qc_pass) for each pulse response
+    """
+    n = len(windows)
+    failures = [{'ex': [], 'in': []} for i in range(n)]
+    if n == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool), failures
+
+    def fail_both(i, msg):
+        failures[i]['ex'].append(msg)
+        failures[i]['in'].append(msg)
+
+    if post_rec.clamp_mode not in ('ic', 'vc'):
+        raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
+
+    # Locate the sample range of each response window and its first 5 ms
+    primary = post_rec['primary']
+    resp_inds = np.empty((n, 2), dtype=int)
+    pre_inds = np.empty((n, 2), dtype=int)
+    for i, window in enumerate(windows):
+        resp_inds[i] = _slice_indices(primary, window[0], window[1])
+        view = primary.time_slice(window[0], window[1])
+        pre_inds[i] = resp_inds[i, 0] + np.array(_slice_indices(view, window[0], window[0] + 5e-3))
+
+    # Measure all windows
+    data = primary.data
+    base = np.empty(n, dtype=data.dtype)
+    pre_std = np.empty(n, dtype=data.dtype)
+    for mask, chunks in _iter_windows(data, pre_inds):
+        base[mask] = np.median(chunks, axis=1)
+        pre_std[mask] = chunks.std(axis=1)
+    resp_max = np.empty(n, dtype=data.dtype)
+    max_amp = np.empty(n, dtype=data.dtype)
+    for mask, chunks in _iter_windows(data, resp_inds):
+        resp_max[mask] = chunks.max(axis=1)
+        max_amp[mask] = np.abs(chunks - base[mask][:, None]).max(axis=1)
     if post_rec.clamp_mode == 'ic':
         base_potential = base
-        if pre_pulse.std() > 1.5e-3:
-            [failures[k].append('STD of response window, %s, exceeds 1.5mV' % pg.siFormat(pre_pulse.std(), suffix='V')) for k in failures.keys()]
-        if data.data.max() > -40e-3:
-            [failures[k].append('Max in response window, %s, exceeds -40mV' % pg.siFormat(data.data.max(), suffix='V')) for k in failures.keys()]
-        if max_amp > 10e-3:
-            [failures[k].append('Max response amplitude, %s, exceeds 10mV' % pg.siFormat(max_amp, suffix='V')) for k in failures.keys()]
-    elif post_rec.clamp_mode == 'vc':
-        base_potential = post_rec['command'].time_slice(window[0], window[1]).median()
-        if pre_pulse.std() > 15e-12:
-            [failures[k].append('STD of response window, %s, exceeds 15pA' % pg.siFormat(pre_pulse.std(), suffix='A')) for k in failures.keys()]
-        if max_amp > 500e-12:
-            [failures[k].append('Max response amplitude, %s, exceeds 500pA' % pg.siFormat(max_amp, suffix='A')) for k in failures.keys()]
     else:
-        raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
-
-    # Check timing of adjacent spikes
-    if any([abs(t) < 8e-3 for t in adjacent_pulses]):
-        [failures[k].append('Spikes detected within 8ms of the response window') for k in failures.keys()]
+        command = post_rec['command']
+        cmd_inds = np.array([_slice_indices(command, w[0], w[1]) for w in windows])
+        base_potential = np.empty(n, dtype=command.data.dtype)
+        for mask, chunks in _iter_windows(command.data, cmd_inds):
+            base_potential[mask] = np.median(chunks, axis=1)
 
-    # Check holding potential is appropriate for each sign
+    # Require the postsynaptic recording to pass basic QC
+    recording_pass_qc, recording_qc_failures = cached_recording_qc_pass(post_rec)
     ex_limits = [-85e-3, -45e-3]
     in_limits = [-60e-3, -45e-3]
-    # check both baseline_potential (which is measured over all baseline regions in the recording)
-    # and *base_potential*, which is just the median value over the IC pre_pulse window or VC command
-    
-    if not (ex_limits[0] < base_potential < ex_limits[1]): 
-        failures['ex'].append('Response window baseline of %s is outside of bounds [-85mV, -45mV]' % pg.siFormat(base_potential, suffix='V'))
-    if not (in_limits[0] < base_potential < in_limits[1]): 
-        failures['in'].append('Response window baseline of %s is outside of bounds [-60mV, -45mV]' % pg.siFormat(base_potential, suffix='V'))
-    
     base2 = post_rec.baseline_potential
-    if base2 is None:
-        failures['ex'].append('Unknown baseline potential for this recording')
-        failures['in'].append('Unknown baseline potential for this recording')
-    else:
-        if not (ex_limits[0] < base2 < ex_limits[1]):
-            failures['ex'].append('Recording baseline of %s is outside of bounds [-85mV, -45mV]' % pg.siFormat(base2, suffix='V'))
-        if not (in_limits[0] < base2 < in_limits[1]):
-            failures['in'].append('Recording baseline of %s is outside of bounds [-60mV, -45mV]' % pg.siFormat(base2, suffix='V'))
-    
-    
-    ex_qc_pass = len(failures['ex'])==0 
-    in_qc_pass = len(failures['in'])==0
-    
+
+    for i in range(n):
+        if recording_pass_qc is False:
+            fail_both(i, 'postsynaptic recording failed QC: %s' % ', and '.join(recording_qc_failures))
+
+        # require at least 1 presynaptic spike
+        if n_spikes[i] == 0:
+            fail_both(i, '%d spikes detected in presynaptic recording' % n_spikes[i])
+
+        # Check for noise in response window
+        if post_rec.clamp_mode == 'ic':
+            if pre_std[i] > 1.5e-3:
+                fail_both(i, 'STD of response window, %s, exceeds 1.5mV' % pg.siFormat(pre_std[i], suffix='V'))
+            if resp_max[i] > -40e-3:
+                fail_both(i, 'Max in response window, %s, exceeds -40mV' % pg.siFormat(resp_max[i], suffix='V'))
+            if max_amp[i] > 10e-3:
+                fail_both(i, 'Max response amplitude, %s, exceeds 10mV' % pg.siFormat(max_amp[i], suffix='V'))
+        else:
+            if pre_std[i] > 15e-12:
+                fail_both(i, 'STD of response window, %s, exceeds 15pA' % pg.siFormat(pre_std[i], suffix='A'))
+            if max_amp[i] > 500e-12:
+                fail_both(i, 'Max response amplitude, %s, exceeds 500pA' % pg.siFormat(max_amp[i], suffix='A'))
+
+        # Check timing of adjacent spikes
+        if any([abs(t) < 8e-3 for t in adjacent_pulses[i]]):
+            fail_both(i, 'Spikes detected within 8ms of the response window')
+
+        # Check holding potential is appropriate for each sign
+        # check both baseline_potential (which is measured over all baseline regions in the recording)
+        # and *base_potential*, which is just the median value over the IC pre_pulse window or VC command
+        bp = base_potential[i]
+        if not (ex_limits[0] < bp < ex_limits[1]): 
+            failures[i]['ex'].append('Response window baseline of %s is outside of bounds [-85mV, -45mV]' % pg.siFormat(bp, suffix='V'))
+        if not (in_limits[0] < bp < in_limits[1]): 
+            failures[i]['in'].append('Response window baseline of %s is outside of bounds [-60mV, -45mV]' % pg.siFormat(bp, suffix='V'))
+        
+        if base2 is None:
+            failures[i]['ex'].append('Unknown baseline potential for this recording')
+            failures[i]['in'].append('Unknown baseline potential for this recording')
+        else:
+            if not (ex_limits[0] < base2 < ex_limits[1]):
+                failures[i]['ex'].append('Recording baseline of %s is outside of bounds [-85mV, -45mV]' % pg.siFormat(base2, suffix='V'))
+            if not (in_limits[0] < base2 < in_limits[1]):
+                failures[i]['in'].append('Recording baseline of %s is outside of bounds [-60mV, -45mV]' % pg.siFormat(base2, suffix='V'))
+
+    ex_qc_pass = np.array([len(f['ex']) == 0 for f in failures])
+    in_qc_pass = np.array([len(f['in']) == 0 for f in failures])
     return ex_qc_pass, in_qc_pass, failures
 
+
+def _slice_indices(ts, start, stop):
+    """Return the [start, stop) sample indices selected by ts.time_slice(start, stop).
+    """
+    return max(0, ts.index_at(start)), max(0, ts.index_at(stop))
+
+
+def _iter_windows(data, inds):
+    """Yield (mask, chunks) for each group of equal-length windows in *inds*, where *chunks*
+    is a 2D array containing data[start:stop] for each window selected by *mask*.
+    """
+    lengths = np.clip(inds[:, 1] - inds[:, 0], 0, None)
+    for length in np.unique(lengths):
+        mask = lengths == length
+        chunks = data[inds[mask, 0][:, None] + np.arange(length)[None, :]]
+        yield mask, chunks
+
 def spike_qc(n_spikes, post_qc):
     """If there is not exactly 1 presynaptic spike, qc Fail spike and postsynaptic response
     """
@@ -1,6 +1,6 @@
 # coding: utf8
 from __future__ import print_function, division
-import functools, pickle, time, os
+import functools, pickle, time, os, shutil
 from collections import OrderedDict
 import numpy as np
 import numba
@@ -500,8 +500,29 @@ def estimate_mini_amplitude(amplitudes, params):
 
 class ParameterSpace(object):
     """Used to generate and store model results over a multidimentional parameter space.
+
+    Results are stored in a numpy structured array (``self.result``) with one record per
+    point in the parameter space; the fields of each record are given by *result_dtype*.
+    Optionally, a variable-length array of per-event results may also be stored for each point
+    (see *event_dtype* and ``self.events``).
+
+    Parameter spaces can be written to disk with save() and read back with load(). Each result
+    field is stored in its own file and memory-mapped on load (as a :class:`FieldArray`), so that
+    projections and slices of one field only read that field's data.
+
+    Parameters
+    ----------
+    params : dict
+        {name: values} for each parameter. Array values define the axes of the parameter space;
+        scalar values are passed unchanged to every model run.
+    result_dtype : list
+        Structured dtype for the per-point results. Each field is filled from the key of the same
+        name in the dict returned by the model function, or from the returned ``'params'`` dict.
+    event_dtype : list | None
+        Structured dtype for per-event results, which are read from the ``'events'`` key of the
+        dict returned by the model function. If None, then per-event results are not stored.
     """
-    def __init__(self, params):
+    def __init__(self, params, result_dtype=(('likelihood', float),), event_dtype=None):
         self.params = params
         
         static_params = {}
@@ -513,7 +534,9 @@ class ParameterSpace(object):
         self.param_order = list(params.keys())
         shape = tuple([len(params[p]) for p in self.param_order])
         
-        self.result = np.zeros(shape, dtype=object)
+        self.result = np.zeros(shape, dtype=list(result_dtype))
+        self.event_dtype = None if event_dtype is None else np.dtype(list(event_dtype))
+        self.events = None
         
     def axes(self):
         return OrderedDict([(ax, {'values': self.params[ax]}) for ax in self.param_order])
@@ -521,10 +544,33 @@ class ParameterSpace(object):
     def run(self, func, workers=None, **kwds):
         from pyqtgraph.multiprocess import Parallelize
         all_inds = list(np.ndindex(self.result.shape))
-        with Parallelize(enumerate(all_inds), results=self.result, progressDialog='synapticulating...', workers=workers) as tasker:
+        events = {}
+        with Parallelize(enumerate(all_inds), results=self.result, events=events, progressDialog='synapticulating...', workers=workers) as tasker:
             for i, inds in tasker:
                 params = self[inds]
-                tasker.results[inds] = func(params, **kwds)
+                result = func(params, **kwds)
+                tasker.results[inds] = self._result_record(result)
+                if self.event_dtype is not None:
+                    # copy only the requested fields
+                    src = result['events']
+                    events_i = np.empty(len(src), dtype=self.event_dtype)
+                    for name in self.event_dtype.names:
+                        events_i[name] = src[name]
+                    tasker.events[i] = events_i
+
+        if self.event_dtype is not None:
+            self.events = RaggedArray.from_list([events[i] for i in range(len(all_inds))], dtype=self.event_dtype)
+
+    def _result_record(self, result):
+        """Convert a result dict returned by the model function into a record tuple for self.result.
+        """
+        record = []
+        for name in self.result.dtype.names:
+            if name in result:
+                record.append(result[name])
+            else:
+                record.append(result['params'][name])
+        return tuple(record)
         
     def __getitem__(self, inds):
         params = self.static_params.copy()
@@ -532,6 +578,132 @@ class ParameterSpace(object):
             params[param] = self.params[param][inds[i]]
         return params
 
+    def event_result(self, inds):
+        """Return the per-event results stored for the point at *inds*.
+        """
+        if self.events is None:
+            raise ValueError("No per-event results were stored for this parameter space.")
+        return self.events[np.ravel_multi_index(inds, self.result.shape)]
+
+    def save(self, path):
+        """Write this parameter space to a directory at *path*.
+
+        The directory contains one ``result.<field>.npy`` file per result field, ``params.npz``
+        (parameter axes, static parameters, and the result field names), and, if per-event results
+        were stored, ``event_offsets.npy`` and ``event_data.npy``.
+        """
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        arrays = {
+            'param_order': np.array(self.param_order, dtype=str),
+            'result_fields': np.array(self.result.dtype.names, dtype=str),
+        }
+        for k, v in self.params.items():
+            arrays['axis:' + k] = np.asarray(v)
+        for k, v in self.static_params.items():
+            arrays['static:' + k] = np.asarray(v)
+        np.savez(os.path.join(tmp, 'params.npz'), **arrays)
+        for name in self.result.dtype.names:
+            np.save(os.path.join(tmp, 'result.%s.npy' % name), np.ascontiguousarray(self.result[name]), allow_pickle=False)
+        if self.events is not None:
+            np.save(os.path.join(tmp, 'event_offsets.npy'), self.events.offsets, allow_pickle=False)
+            np.save(os.path.join(tmp, 'event_data.npy'), self.events.data, allow_pickle=False)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a parameter space that was written by save().
+
+        By default, result arrays are memory-mapped read-only.
+        """
+        arrays = np.load(os.path.join(path, 'params.npz'), allow_pickle=False)
+        params = OrderedDict()
+        for name in arrays['param_order']:
+            params[str(name)] = arrays['axis:' + name]
+        for k in arrays.files:
+            if k.startswith('static:'):
+                params[k[7:]] = arrays[k].item()
+
+        result_file = os.path.join(path, 'result.npy')
+        if os.path.exists(result_file):
+            # written by an earlier version as a single structured array
+            result = np.load(result_file, mmap_mode=mmap_mode, allow_pickle=False)
+        else:
+            result = FieldArray(OrderedDict([
+                (str(name), np.load(os.path.join(path, 'result.%s.npy' % name), mmap_mode=mmap_mode, allow_pickle=False))
+                for name in arrays['result_fields']
+            ]))
+        param_space = cls(params, result_dtype=result.dtype.descr)
+        param_space.result = result
+
+        offsets_file = os.path.join(path, 'event_offsets.npy')
+        if os.path.exists(offsets_file):
+            data = np.load(os.path.join(path, 'event_data.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+            param_space.events = RaggedArray(np.load(offsets_file, mmap_mode=mmap_mode), data)
+            param_space.event_dtype = data.dtype
+        return param_space
+
+
+class FieldArray(object):
+    """An array of records stored as one array per field (rather than as an interleaved
+    structured array), so that reading one field does not read the others.
+
+    Indexing with a field name returns that field's array; any other index is applied to every
+    field, returning a record (np.void) for a single element or a FieldArray otherwise.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+
+    @property
+    def dtype(self):
+        return np.dtype([(name, arr.dtype) for name, arr in self.fields.items()])
+
+    @property
+    def shape(self):
+        return next(iter(self.fields.values())).shape
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self.fields[index]
+        fields = OrderedDict([(name, arr[index]) for name, arr in self.fields.items()])
+        if next(iter(fields.values())).ndim > 0:
+            return FieldArray(fields)
+        record = np.zeros((), dtype=self.dtype)
+        for name, val in fields.items():
+            record[name] = val
+        return record[()]
+
+
+class RaggedArray(object):
+    """A list of variable-length arrays stored as one flat array plus offsets.
+
+    Item *i* is ``data[offsets[i]:offsets[i+1]]``.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_list(cls, arrays, dtype):
+        offsets = np.zeros(len(arrays) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(a) for a in arrays])
+        data = np.empty(offsets[-1], dtype=dtype)
+        for i, a in enumerate(arrays):
+            data[offsets[i]:offsets[i+1]] = a
+        return cls(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
 
 def event_query(pair, db, session):
     q = session.query(
@@ -573,6 +745,20 @@ def event_query(pair, db, session):
 class StochasticModelRunner:
     """Handles loading data for a synapse and executing the model across a parameter space.
     """
+    # summary results stored for each point in the parameter space
+    result_dtype = [
+        ('likelihood', 'float64'),
+        ('mini_amplitude', 'float64'),
+        ('expected_amplitude_mean', 'float32'),
+        ('expected_amplitude_stdev', 'float32'),
+    ]
+
+    # per-event results stored if store_events is True
+    event_dtype = [
+        ('expected_amplitude', 'float32'),
+        ('likelihood', 'float32'),
+    ]
+
     def __init__(self, db, experiment_id, pre_cell_id, post_cell_id, workers=None):
         self.db = db
         self.experiment_id = experiment_id
@@ -582,6 +768,9 @@ class StochasticModelRunner:
         
         self.workers = workers
         self.max_events = None
+        # if True, per-event expected amplitudes and likelihoods are stored for every
+        # point in the parameter space (this can require a lot of memory / disk space)
+        self.store_events = False
         
         self._synapse_events = None
         self._parameters = None
@@ -598,7 +787,7 @@ class StochasticModelRunner:
     def _generate_param_space(self):
         search_params = self.parameters
         
-        param_space = ParameterSpace(search_params)
+        param_space = ParameterSpace(search_params, result_dtype=self.result_dtype, event_dtype=self.event_dtype if self.store_events else None)
 
         # run once to jit-precompile before measuring preformance
         self.run_model(param_space[(0,)*len(search_params)])
@@ -615,13 +804,30 @@ class StochasticModelRunner:
         
         return param_space
 
-    def store_result(self, cache_file):    
-        tmp = cache_file + '.tmp'
-        pickle.dump(self.param_space, open(tmp, 'wb'))
-        os.rename(tmp, cache_file)
+    def store_result(self, cache_path):
+        """Store the parameter space results in a directory (see ParameterSpace.save).
+        """
+        self.param_space.save(cache_path)
+
+    def load_result(self, cache_path):
+        """Load parameter space results from a directory written by store_result.
 
-    def load_result(self, cache_file):
-        self._param_space = pickle.load(open(cache_file, 'rb'))
+        Results are memory-mapped rather than read into memory. Older results stored
+        as a single pickle file are also accepted.
+        """
+        if os.path.isfile(cache_path):
+            param_space = pickle.load(open(cache_path, 'rb'))
+            if param_space.result.dtype == object:
+                # convert from the old format, where each result was a dict
+                result = np.empty(param_space.result.shape, dtype=[('likelihood', 'float64'), ('mini_amplitude', 'float64')])
+                for ind in np.ndindex(result.shape):
+                    old_result = param_space.result[ind]
+                    result['likelihood'][ind] = old_result['likelihood']
+                    result['mini_amplitude'][ind] = old_result.get('params', {}).get('mini_amplitude', np.nan)
+                param_space.result = result
+            self._param_space = param_space
+        else:
+            self._param_space = ParameterSpace.load(cache_path)
         
     @property
     def synapse_events(self):
@@ -736,7 +942,16 @@ class StochasticModelRunner:
             result['event_meta'] = event_meta
             return result
         else:
-            return {'likelihood': result['likelihood'], 'params': result['params']}
+            expected_amps = result['result']['expected_amplitude']
+            mini_amp = result.get('optimized_params', result['params'])['mini_amplitude']
+            return {
+                'likelihood': result['likelihood'],
+                'params': result['params'],
+                'mini_amplitude': mini_amp,
+                'expected_amplitude_mean': np.nanmean(expected_amps),
+                'expected_amplitude_stdev': np.nanstd(expected_amps),
+                'events': result['result'][['expected_amplitude', 'likelihood']],
+            }
 
 
 class CombinedModelRunner:
@@ -753,8 +968,13 @@ class CombinedModelRunner:
         # ]
         params['synapse'] = np.arange(len(runners))
         params.update(runners[0].param_space.params)
-        param_space = ParameterSpace(params)
-        param_space.result = np.stack([runner.param_space.result for runner in runners])
+        params.update(runners[0].param_space.static_params)
+        dtype = runners[0].param_space.result.dtype
+        param_space = ParameterSpace(params, result_dtype=dtype.descr)
+        param_space.result = FieldArray(OrderedDict([
+            (name, np.stack([runner.param_space.result[name] for runner in runners]))
+            for name in dtype.names
+        ]))
         
         self.param_space = param_space
         
@@ -6,6 +6,7 @@ Analyses that measure the strength of synaptic connections.
 from __future__ import print_function, division
 
 import sys, multiprocessing, time
+from collections import OrderedDict
 import numpy as np
 import pandas
 import scipy.stats
@@ -19,6 +20,93 @@ from .database import default_db as db
 def get_amps(session, pair, clamp_mode='ic', get_data=False):
     """Select records from pulse_response_strength table
     """
+    q, pre_rec, post_rec = amps_query(session, get_data=get_data)
+        
+    filters = [
+        (pre_rec.electrode==pair.pre_cell.electrode,),
+        (post_rec.electrode==pair.post_cell.electrode,),
+        (db.PatchClampRecording.clamp_mode==clamp_mode,),
+        # Return all results, regardless of QC -- we want to see what is being excluded later on.
+        # Also note that the ex_qc_pass and in_qc_pass fields returned above already take p_c_recording.qc_pass into account.
+        # (db.PatchClampRecording.qc_pass==True,),
+    ]
+    for filter_args in filters:
+        q = q.filter(*filter_args)
+    
+    # should result in chronological order
+    q = q.order_by(db.PulseResponse.id)
+
+    df = pandas.read_sql_query(q.statement, q.session.bind)
+    recs = df.to_records()
+    return recs
+
+
+def get_expt_amps(session, expt, get_data=False):
+    """Select records from pulse_response_strength table for all pairs in an experiment
+    using a single query.
+
+    Returns
+    -------
+    amps : dict
+        Structured arrays as returned by get_amps(), keyed by
+        ``(pre_electrode_id, post_electrode_id)`` and then by clamp mode::
+
+            {(pre_electrode_id, post_electrode_id): {'ic': recs, 'vc': recs}, ...}
+
+        Records also include ``pulse_response_id``, ``pre_electrode_id``, and ``post_electrode_id``
+        fields. Pairs with no records are omitted; ``amps[None]`` holds an empty array
+        with the same fields.
+    """
+    q, pre_rec, post_rec = amps_query(session, get_data=get_data)
+    q = q.add_columns(
+        db.PulseResponse.id.label('pulse_response_id'),
+        pre_rec.electrode_id.label('pre_electrode_id'),
+        post_rec.electrode_id.label('post_electrode_id'),
+    )
+    q = q.filter(db.Experiment.id==expt.id)
+    q = q.filter(db.PatchClampRecording.clamp_mode.in_(['ic', 'vc']))
+    
+    # should result in chronological order
+    q = q.order_by(db.PulseResponse.id)
+
+    df = pandas.read_sql_query(q.statement, q.session.bind)
+    recs = df.to_records()
+
+    # split records by pair and clamp mode (lexsort is stable, so chronological order is kept)
+    keys = np.empty(len(recs), dtype=[('pre', 'int64'), ('post', 'int64'), ('clamp_mode', 'U2')])
+    keys['pre'] = recs['pre_electrode_id']
+    keys['post'] = recs['post_electrode_id']
+    keys['clamp_mode'] = recs['clamp_mode']
+    order = np.lexsort((keys['clamp_mode'], keys['post'], keys['pre']))
+    keys = keys[order]
+    recs = recs[order]
+    amps = {None: recs[:0]}
+    if len(recs) == 0:
+        return amps
+    starts = np.concatenate([[0], np.argwhere(keys[1:] != keys[:-1])[:, 0] + 1, [len(recs)]])
+    for start, stop in zip(starts[:-1], starts[1:]):
+        pre, post, clamp_mode = keys[start]
+        pair_amps = amps.setdefault((int(pre), int(post)), {'ic': recs[:0], 'vc': recs[:0]})
+        pair_amps[str(clamp_mode)] = recs[start:stop]
+    return amps
+
+
+def get_pulse_response_data(session, pulse_response_ids, chunk_size=500):
+    """Return a dict of {pulse_response_id: data} for the requested pulse responses.
+    """
+    pulse_response_ids = [int(i) for i in pulse_response_ids]
+    data = {}
+    for i in range(0, len(pulse_response_ids), chunk_size):
+        q = session.query(db.PulseResponse.id, db.PulseResponse.data)
+        q = q.filter(db.PulseResponse.id.in_(pulse_response_ids[i:i+chunk_size]))
+        data.update(q.all())
+    return data
+
+
+def amps_query(session, get_data=False):
+    """Return a query selecting the pulse_response_strength columns used by get_amps(),
+    along with the aliased pre- and postsynaptic Recording tables.
+    """
     cols = [
         db.PulseResponseStrength.id,
         db.PulseResponseStrength.pos_amp,
@@ -54,24 +142,7 @@ def get_amps(session, pair, clamp_mode='ic', get_data=False):
     q, pre_rec, post_rec = join_pulse_response_to_expt(q)
     q = q.join(db.StimSpike)
     q = q.add_columns(post_rec.start_time.label('rec_start_time'))
-        
-    filters = [
-        (pre_rec.electrode==pair.pre_cell.electrode,),
-        (post_rec.electrode==pair.post_cell.electrode,),
-        (db.PatchClampRecording.clamp_mode==clamp_mode,),
-        # Return all results, regardless of QC -- we want to see what is being excluded later on.
-        # Also note that the ex_qc_pass and in_qc_pass fields returned above already take p_c_recording.qc_pass into account.
-        # (db.PatchClampRecording.qc_pass==True,),
-    ]
-    for filter_args in filters:
-        q = q.filter(*filter_args)
-    
-    # should result in chronological order
-    q = q.order_by(db.PulseResponse.id)
-
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
-    return recs
+    return q, pre_rec, post_rec
 
 
 def join_pulse_response_to_expt(query):
@@ -136,6 +207,60 @@ def analyze_pair_connectivity(amps, sign=None):
        and background distributions for amplitude, deconvolved amplitude, and
        deconvolved latency    
     """
+    result = pair_connectivity_stats(amps, sign=sign)
+    if result is None:
+        return None
+    fields, avg_recs = result
+    for clamp_mode, (sign, fg) in avg_recs.items():
+        average_response_fit(fields, clamp_mode, sign, fg, fg['data'])
+    return fields
+
+
+def analyze_expt_connectivity(session, expt, pairs=None):
+    """Run analyze_pair_connectivity() for all pairs in an experiment.
+
+    Amplitudes for every pair are loaded with a single query (see get_expt_amps()), and raw
+    response data is then loaded only for the responses that contribute to an averaged PSP fit.
+
+    Returns
+    -------
+    results : OrderedDict
+        ``{pair: fields}`` for each pair that produced a result.
+    """
+    if pairs is None:
+        pairs = expt.pair_list
+    amps = get_expt_amps(session, expt)
+    empty = amps[None]
+
+    stats = []
+    for pair in pairs:
+        pre_cell, post_cell = pair.pre_cell, pair.post_cell
+        key = (pre_cell.electrode_id if pre_cell is not None else None, post_cell.electrode_id if post_cell is not None else None)
+        pair_amps = dict(amps.get(key, {'ic': empty, 'vc': empty}))
+        result = pair_connectivity_stats(pair_amps)
+        if result is None:
+            continue
+        stats.append((pair, result))
+
+    # load raw data only for responses that will be averaged
+    pr_ids = [pr_id for pair, (fields, avg_recs) in stats for sign, fg in avg_recs.values() for pr_id in fg['pulse_response_id']]
+    data = get_pulse_response_data(session, pr_ids)
+
+    results = OrderedDict()
+    for pair, (fields, avg_recs) in stats:
+        for clamp_mode, (sign, fg) in avg_recs.items():
+            average_response_fit(fields, clamp_mode, sign, fg, [data[pr_id] for pr_id in fg['pulse_response_id']])
+        results[pair] = fields
+    return results
+
+
+def pair_connectivity_stats(amps, sign=None):
+    """Compute the parts of analyze_pair_connectivity() that do not need raw response data.
+
+    Returns None if there is no data to analyze, or a tuple (fields, avg_recs), where *avg_recs*
+    is ``{clamp_mode: (sign, recs)}`` with the records ('pos' or 'neg' deflections) that should be
+    passed to average_response_fit().
+    """
     # Filter by QC
     for k,v in amps.items():
         mask = v['qc_pass'].astype(bool)
@@ -205,6 +330,7 @@ def analyze_pair_connectivity(amps, sign=None):
         signs = {'ic':'neg', 'vc':'pos'}
 
     # compute the rest of statistics for only positive or negative deflections
+    avg_recs = {}
     for clamp_mode in ('ic', 'vc'):
         sign = signs[clamp_mode]
         fg = qc_amps.get((sign, clamp_mode))
@@ -233,50 +359,47 @@ def analyze_pair_connectivity(amps, sign=None):
             fields[clamp_mode + '_' + val + '_ttest'] = norm_pvalue(tt_pval)
             fields[clamp_mode + '_' + val + '_ks2samp'] = norm_pvalue(ks_pval)
 
+        # select records that can be time-aligned to the presynaptic spike for averaging
+        slope_time = fg['max_slope_time'].astype(float)
+        avg_recs[clamp_mode] = (sign, fg[np.isfinite(slope_time)])
 
-        ### generate the average response and psp fit
-        
-        # collect all bg and fg traces
-        fg_traces = TSeriesList()
-        for rec in fg:
-            if not np.isfinite(rec['max_slope_time']) or rec['max_slope_time'] is None:
-                continue
-            t0 = rec['response_start_time'] - rec['max_slope_time']   # time-align to presynaptic spike
-            trace = TSeries(rec['data'], sample_rate=db.default_sample_rate, t0=t0)
-            fg_traces.append(trace)
-        
-        # get averages
-        
-        if len(fg_traces) == 0:
-            continue
-            
-        # bg_avg = bg_traces.mean()
-        fg_avg = fg_traces.mean()
-        base_rgn = fg_avg.time_slice(-6e-3, 0)
-        base = float_mode(base_rgn.data)
-        fields[clamp_mode + '_average_response'] = fg_avg.data
-        fields[clamp_mode + '_average_response_t0'] = fg_avg.t0
-        fields[clamp_mode + '_average_base_stdev'] = base_rgn.std()
-
-        sign = {'pos':1, 'neg':-1}[signs[clamp_mode]]
-        fg_bsub = fg_avg.copy(data=fg_avg.data - base)  # remove base to help fitting
-        try:
-            fit = fit_psp(fg_bsub, clamp_mode=clamp_mode, sign=sign, search_window=[0, 6e-3])
-            for param, val in fit.best_values.items():
-                fields['%s_fit_%s' % (clamp_mode, param)] = val
-            fields[clamp_mode + '_fit_yoffset'] = fit.best_values['yoffset'] + base
-            fields[clamp_mode + '_fit_nrmse'] = fit.nrmse()
-        except:
-            print("Error in PSP fit:")
-            sys.excepthook(*sys.exc_info())
-            continue
+    return fields, avg_recs
+
+
+def average_response_fit(fields, clamp_mode, sign, fg, data):
+    """Average the responses in *fg* (time-aligned to the presynaptic spike) and fit the
+    average with a PSP/PSC, storing the results in *fields*.
+
+    *data* is a sequence of raw response arrays, one for each record in *fg*. *sign* is 'pos' or 'neg'.
+    """
+    # collect all fg traces
+    fg_traces = TSeriesList()
+    for rec, rec_data in zip(fg, data):
+        t0 = rec['response_start_time'] - rec['max_slope_time']   # time-align to presynaptic spike
+        trace = TSeries(rec_data, sample_rate=db.default_sample_rate, t0=t0)
+        fg_traces.append(trace)
+    
+    # get averages
+    
+    if len(fg_traces) == 0:
+        return
         
-        #global fit_plot
-        #if fit_plot is None:
-            #fit_plot = FitExplorer(fit)
-            #fit_plot.show()
-        #else:
-            #fit_plot.set_fit(fit)
-        #raw_input("Waiting to continue..")
+    # bg_avg = bg_traces.mean()
+    fg_avg = fg_traces.mean()
+    base_rgn = fg_avg.time_slice(-6e-3, 0)
+    base = float_mode(base_rgn.data)
+    fields[clamp_mode + '_average_response'] = fg_avg.data
+    fields[clamp_mode + '_average_response_t0'] = fg_avg.t0
+    fields[clamp_mode + '_average_base_stdev'] = base_rgn.std()
 
-    return fields
+    sign = {'pos':1, 'neg':-1}[sign]
+    fg_bsub = fg_avg.copy(data=fg_avg.data - base)  # remove base to help fitting
+    try:
+        fit = fit_psp(fg_bsub, clamp_mode=clamp_mode, sign=sign, search_window=[0, 6e-3])
+        for param, val in fit.best_values.items():
+            fields['%s_fit_%s' % (clamp_mode, param)] = val
+        fields[clamp_mode + '_fit_yoffset'] = fit.best_values['yoffset'] + base
+        fields[clamp_mode + '_fit_nrmse'] = fit.nrmse()
+    except:
+        print("Error in PSP fit:")
+        sys.excepthook(*sys.exc_info())
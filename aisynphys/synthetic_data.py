@@ -0,0 +1,499 @@
+"""
+Synthetic multipatch experiments, used for benchmarking and testing the analysis pipeline
+without access to real data.
+
+A SyntheticExperiment describes a set of cells, the chemical synapses between them, and a
+series of current clamp sweeps. As in the distributed-DAQ protocols used on the rigs, each
+sweep stimulates every cell in turn with a 12-pulse train (8 pulses at the induction frequency,
+a recovery delay, then 4 more pulses) while all cells are recorded. Sweeps alternate between
+holding near -70 mV and -55 mV, and every second sweep uses the next induction frequency.
+From this description it can generate:
+
+* A MIES-like NWB file (lab notebook, acquisition and stimulus timeseries) that can be read
+  with MultiPatchDataset and imported by the dataset pipeline module
+* Matching synphys DB records: slice, experiment, electrodes, cells, pairs and synapses, and
+  (optionally) the sync rec / recording / stim pulse / pulse response records that would
+  normally be generated by importing the NWB file
+* Manual fit records in the data notes DB
+
+Example::
+
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', 'synthetic.sqlite')
+    db.create_tables()
+    session = db.session(readonly=False)
+    expt = SyntheticExperiment(1500000000.0, n_cells=4, n_sweeps=8)
+    expt.write_nwb('synthetic.nwb')
+    expt_entry = expt.add_to_db(db, session)
+    expt.add_recordings_to_db(db, session, expt_entry)
+    session.commit()
+"""
+from __future__ import print_function, division
+
+import datetime
+from collections import OrderedDict
+import numpy as np
+from neuroanalysis.data import TSeries
+from neuroanalysis.fitting import Psp
+from neuroanalysis.baseline import float_mode
+
+
+# seconds between the IgorPro epoch (1904-01-01) and the unix epoch
+_igor_epoch_offset = (datetime.datetime(1970, 1, 1) - datetime.datetime(1904, 1, 1)).total_seconds()
+
+# (cre type, target layer, excitatory)
+_cell_types = [
+    ('tlx3', '5', True),
+    ('sim1', '5', True),
+    ('nr5a1', '4', True),
+    ('unknown', '2/3', True),
+    ('pvalb', '2/3', False),
+    ('sst', '5', False),
+    ('vip', '2/3', False),
+]
+
+_numerical_keys = [
+    'SweepNum', 'TimeStamp', 'TimeStampSinceIgorEpochUTC', 'EntrySourceType',
+    'Clamp Mode', 'V-Clamp Holding Level', 'I-Clamp Holding Level', 'Bridge Bal Enable',
+    'Bridge Bal Value', 'LPF Cutoff', 'Pipette Offset', 'Set Sweep Count', 'Stim Scale Factor',
+    'Delay onset oodDAQ', 'Delay onset user', 'Delay onset auto', 'Delay termination',
+    'Distributed DAQ', 'Delay distributed DAQ', 'TP Insert Checkbox', 'TP Peak Resistance',
+    'TP Pulse Duration', 'Async AD 1: Bath Temperature',
+]
+
+_textual_keys = ['SweepNum', 'TimeStamp', 'TimeStampSinceIgorEpochUTC', 'EntrySourceType', 'Stim Wave Name', 'Stim Wave Note']
+
+
+class SyntheticExperiment(object):
+    """Randomly generated multipatch experiment.
+
+    Parameters
+    ----------
+    timestamp : float
+        Acquisition timestamp of the experiment; also used to derive its ext_id.
+    n_cells : int
+        Number of simultaneously recorded cells (at most 8).
+    n_sweeps : int
+        Number of sweeps. Each sweep stimulates every cell in turn.
+    sample_rate : float
+        Sample rate of the generated recordings.
+    connection_probability : float
+        Probability that any ordered pair of cells is connected by a chemical synapse.
+    seed : int | None
+        Random seed. By default, the seed is derived from *timestamp* so that the same experiment
+        is generated each time.
+    """
+    induction_frequencies = [50, 20, 100, 10]
+    recovery_delay = 250e-3
+    pre_delay = 300e-3
+    post_delay = 300e-3
+    pulse_duration = 1.5e-3
+    pulse_amplitude = 1.5e-9
+    train_padding = 50e-3
+    ddaq_delay = 50e-3
+    holding_potentials = [-70e-3, -55e-3]
+    noise_stdev = 100e-6
+    temperature = 32.0
+
+    def __init__(self, timestamp, n_cells=4, n_sweeps=8, sample_rate=50e3, connection_probability=0.3, seed=None):
+        assert n_cells <= 8, "MIES supports at most 8 headstages"
+        self.timestamp = timestamp
+        self.ext_id = '%0.3f' % timestamp
+        self.n_cells = n_cells
+        self.n_sweeps = n_sweeps
+        self.sample_rate = sample_rate
+        self.dt = 1.0 / sample_rate
+        self.rng = np.random.RandomState(int(timestamp * 1000) % 2**32 if seed is None else seed)
+
+        self.cells = OrderedDict()
+        for i in range(n_cells):
+            cre_type, layer, is_ex = _cell_types[self.rng.randint(len(_cell_types))]
+            self.cells[i] = {
+                'ext_id': str(i + 1),
+                'cre_type': cre_type,
+                'target_layer': layer,
+                'synapse_type': 'ex' if is_ex else 'in',
+                'position': self.rng.uniform(0, 200e-6, size=3),
+            }
+
+        self.synapses = OrderedDict()
+        for pre in self.cells:
+            for post in self.cells:
+                if pre == post or self.rng.uniform() > connection_probability:
+                    continue
+                syn_type = self.cells[pre]['synapse_type']
+                self.synapses[(pre, post)] = {
+                    'synapse_type': syn_type,
+                    'amplitude': (1 if syn_type == 'ex' else -1) * self.rng.uniform(0.2e-3, 1.0e-3),
+                    'latency': self.rng.uniform(1.0e-3, 2.0e-3),
+                    'rise_time': self.rng.uniform(1.0e-3, 3.0e-3),
+                    'decay_tau': self.rng.uniform(10e-3, 30e-3),
+                    'depression': self.rng.uniform(0.6, 1.1),
+                }
+
+        self.sweeps = []
+        for i in range(n_sweeps):
+            freq = self.induction_frequencies[(i // 2) % len(self.induction_frequencies)]
+            self.sweeps.append({
+                'induction_frequency': freq,
+                'recovery_delay': self.recovery_delay,
+                'holding_potential': self.holding_potentials[i % len(self.holding_potentials)],
+            })
+
+        self._sweep_data = {}
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.timestamp)
+
+    def sweep_start_time(self, sweep_id):
+        """Clock time (unix timestamp) at which a sweep began.
+        """
+        return self.timestamp + 60 + 10 * sweep_id
+
+    def train_duration(self, sweep_id):
+        """Duration of the pulse train delivered to each cell in a sweep.
+        """
+        sweep = self.sweeps[sweep_id]
+        interval = 1.0 / sweep['induction_frequency']
+        return 11 * interval + sweep['recovery_delay'] + self.train_padding
+
+    def pulse_times(self, sweep_id, device_id):
+        """Return onset times of the stimulus pulses delivered to one cell in a sweep, relative to
+        the start of the sweep.
+        """
+        sweep = self.sweeps[sweep_id]
+        interval = 1.0 / sweep['induction_frequency']
+        start = self.pre_delay + list(self.cells).index(device_id) * (self.train_duration(sweep_id) + self.ddaq_delay)
+        times = start + np.arange(8) * interval
+        return np.concatenate([times, times[-1] + sweep['recovery_delay'] + np.arange(4) * interval])
+
+    def spike_times(self, sweep_id, device_id):
+        """Return the time of the max rising slope of each spike evoked in one cell during a sweep.
+        """
+        return self.pulse_times(sweep_id, device_id) + 0.7e-3
+
+    def sweep_duration(self, sweep_id):
+        return self.pre_delay + self.n_cells * (self.train_duration(sweep_id) + self.ddaq_delay) + self.post_delay
+
+    def sweep_data(self, sweep_id):
+        """Return recorded membrane potential and command current for each cell in a sweep.
+
+        Returns
+        -------
+        data : OrderedDict
+            {device_id: (primary, command)} where *primary* is in V and *command* in A.
+        """
+        if sweep_id in self._sweep_data:
+            return self._sweep_data[sweep_id]
+
+        sweep = self.sweeps[sweep_id]
+        n_samples = int(self.sweep_duration(sweep_id) * self.sample_rate)
+        t = np.arange(n_samples) * self.dt
+
+        data = OrderedDict()
+        for dev in self.cells:
+            primary = sweep['holding_potential'] + self.rng.normal(scale=self.noise_stdev, size=n_samples)
+            command = np.zeros(n_samples)
+            for pulse_t, spike_t in zip(self.pulse_times(sweep_id, dev), self.spike_times(sweep_id, dev)):
+                i0 = int(np.round(pulse_t * self.sample_rate))
+                i1 = i0 + int(np.round(self.pulse_duration * self.sample_rate))
+                command[i0:i1] = self.pulse_amplitude
+                primary += _spike_shape(t, spike_t)
+            data[dev] = (primary, command)
+
+        for (pre, post), syn in self.synapses.items():
+            primary = data[post][0]
+            for i, spike_t in enumerate(self.spike_times(sweep_id, pre)):
+                # simple depression / facilitation that recovers during the recovery delay
+                amp = syn['amplitude'] * syn['depression'] ** (i % 8) * self.rng.lognormal(sigma=0.2)
+                primary += Psp.psp_func(t, spike_t + syn['latency'], 0, syn['rise_time'], syn['decay_tau'], amp, 2)
+
+        self._sweep_data[sweep_id] = data
+        return data
+
+    def stim_name(self, sweep_id):
+        return 'PulseTrain_%dHz_DA_0' % self.sweeps[sweep_id]['induction_frequency']
+
+    def _stim_wave_note(self, sweep_id, device_id):
+        # pulse times are relative to the start of this channel's epoch; with distributed DAQ,
+        # each channel's epoch begins after the epochs of all previous channels
+        times = (self.pulse_times(sweep_id, device_id) - self.pulse_times(sweep_id, device_id)[0]) * 1e3
+        return "Version = 2;\n" + (
+            "Sweep = 0;Epoch = 0;Type = Pulse Train;Duration = %g;Amplitude = %g;Pulse duration = %g;"
+            "Mixed frequency = True;Poisson distribution = False;Pulse Type = Square;Pulse Train Pulses = %s,;"
+            % (self.train_duration(sweep_id) * 1e3, self.pulse_amplitude * 1e12, self.pulse_duration * 1e3, ','.join('%g' % x for x in times))
+        )
+
+    def write_nwb(self, filename, device='ITC18USB_Dev_0'):
+        """Write all sweeps to a MIES-like NWB file that can be read by MultiPatchDataset.
+        """
+        import h5py
+        str_dtype = h5py.string_dtype()
+        n_sweeps = len(self.sweeps)
+        n_hs = 9  # 8 headstages + 1 column for global values
+
+        num_values = np.full((n_sweeps, len(_numerical_keys), n_hs), np.nan)
+        txt_values = np.full((n_sweeps, len(_textual_keys), n_hs), '', dtype=object)
+        num_index = {k: i for i, k in enumerate(_numerical_keys)}
+        txt_index = {k: i for i, k in enumerate(_textual_keys)}
+
+        with h5py.File(filename, 'w') as hdf:
+            hdf.create_group('general/devices/device_' + device)
+            acq = hdf.create_group('acquisition/timeseries')
+            stim = hdf.create_group('stimulus/presentation')
+
+            for sweep_id in range(n_sweeps):
+                igor_time = self.sweep_start_time(sweep_id) + _igor_epoch_offset
+                row = num_values[sweep_id]
+                for k, v in [('SweepNum', sweep_id), ('TimeStamp', igor_time), ('TimeStampSinceIgorEpochUTC', igor_time), ('EntrySourceType', 0)]:
+                    row[num_index[k], 0] = v
+                row[num_index['Async AD 1: Bath Temperature'], 0] = self.temperature
+                for k, v in [('Set Sweep Count', 0), ('Stim Scale Factor', 1), ('Delay onset oodDAQ', 0),
+                             ('Delay onset user', self.pre_delay * 1e3), ('Delay onset auto', 0),
+                             ('Delay termination', self.post_delay * 1e3), ('Distributed DAQ', 1),
+                             ('Delay distributed DAQ', self.ddaq_delay * 1e3), ('TP Insert Checkbox', 0)]:
+                    row[num_index[k], 8] = v
+
+                txt_row = txt_values[sweep_id]
+                for k, v in [('SweepNum', str(sweep_id)), ('TimeStamp', str(igor_time)), ('EntrySourceType', '0')]:
+                    txt_row[txt_index[k], :] = v
+
+                for hs, (primary, command) in self.sweep_data(sweep_id).items():
+                    for k, v in [('Clamp Mode', 1), ('I-Clamp Holding Level', 0), ('Bridge Bal Enable', 0),
+                                 ('LPF Cutoff', 10e3), ('Pipette Offset', 0)]:
+                        row[num_index[k], hs] = v
+                    txt_row[txt_index['Stim Wave Name'], hs] = self.stim_name(sweep_id)
+                    txt_row[txt_index['Stim Wave Note'], hs] = self._stim_wave_note(sweep_id, hs)
+
+                    # in current clamp, primary is stored in mV and command in pA
+                    scaling = np.array([[np.nan, np.nan], [self.dt * 1e3, 0]])
+                    for group, name, values in [(acq, 'data_%05d_AD%d' % (sweep_id, hs), primary * 1e3), (stim, 'data_%05d_DA%d' % (sweep_id, hs), command * 1e12)]:
+                        ts = group.create_group(name)
+                        ds = ts.create_dataset('data', data=values.astype('float32'))
+                        ds.attrs['IGORWaveScaling'] = scaling
+                        ts.create_dataset('electrode_name', data=['electrode_%d' % hs], dtype=str_dtype)
+                        ts.create_dataset('stimulus_description', data=[self.stim_name(sweep_id)], dtype=str_dtype)
+                        kind = 'AD' if group is acq else 'DA'
+                        ts.attrs['source'] = "Device=%s;Sweep=%d;%s=%d;ElectrodeNumber=%d;ElectrodeName=%d" % (device, sweep_id, kind, hs, hs, hs)
+
+            nb = hdf.create_group('general/labnotebook/' + device)
+            nb.create_dataset('numericalKeys', data=np.array([_numerical_keys], dtype=object), dtype=str_dtype)
+            nb.create_dataset('numericalValues', data=num_values)
+            nb.create_dataset('textualKeys', data=np.array([_textual_keys], dtype=object), dtype=str_dtype)
+            nb.create_dataset('textualValues', data=txt_values, dtype=str_dtype)
+
+    def add_to_db(self, db, session, storage_path=None, ephys_file=None, project_name='mouse V1 coarse matrix'):
+        """Create slice, experiment, electrode, cell, pair and synapse records for this experiment.
+
+        Returns the new Experiment record.
+        """
+        slice_entry = db.Slice(ext_id='slice_' + self.ext_id, acq_timestamp=self.timestamp - 3600, species='mouse', age=50, storage_path=storage_path)
+        expt_entry = db.Experiment(
+            ext_id=self.ext_id,
+            slice=slice_entry,
+            acq_timestamp=self.timestamp,
+            date=self.date,
+            project_name=project_name,
+            target_temperature=self.temperature,
+            storage_path=storage_path,
+            ephys_file=ephys_file,
+        )
+        session.add(expt_entry)
+
+        cell_entries = {}
+        for dev, cell in self.cells.items():
+            elec = db.Electrode(experiment=expt_entry, ext_id=cell['ext_id'], device_id=dev)
+            cell_entries[dev] = db.Cell(
+                experiment=expt_entry,
+                electrode=elec,
+                ext_id=cell['ext_id'],
+                cre_type=cell['cre_type'],
+                target_layer=cell['target_layer'],
+                position=list(cell['position']),
+                cell_class_nonsynaptic=cell['synapse_type'],
+                meta={},
+            )
+
+        for pre in self.cells:
+            for post in self.cells:
+                if pre == post:
+                    continue
+                syn = self.synapses.get((pre, post))
+                distance = np.linalg.norm(self.cells[pre]['position'] - self.cells[post]['position'])
+                pair = db.Pair(
+                    experiment=expt_entry,
+                    pre_cell=cell_entries[pre],
+                    post_cell=cell_entries[post],
+                    has_synapse=syn is not None,
+                    has_electrical=False,
+                    distance=distance,
+                    n_ex_test_spikes=0,
+                    n_in_test_spikes=0,
+                )
+                session.add(pair)
+                if syn is not None:
+                    session.add(db.Synapse(
+                        pair=pair,
+                        synapse_type=syn['synapse_type'],
+                        latency=syn['latency'],
+                        psp_amplitude=syn['amplitude'],
+                        psp_rise_time=syn['rise_time'],
+                        psp_decay_tau=syn['decay_tau'],
+                    ))
+        return expt_entry
+
+    def add_recordings_to_db(self, db, session, expt_entry):
+        """Create the sync rec, recording, stim pulse, stim spike, pulse response and baseline
+        records that would be generated by importing this experiment's NWB file.
+
+        Pulse and spike times are taken directly from the synthetic model rather than being
+        detected, so this is much faster than a real import.
+        """
+        sample_rate = db.default_sample_rate
+        elecs = {elec.device_id: elec for elec in expt_entry.electrodes}
+        pairs = {(pair.pre_cell.electrode.device_id, pair.post_cell.electrode.device_id): pair for pair in expt_entry.pairs.values()}
+        chunk_dur = 20e-3
+        qc_failures = {'ex': ['baseline outside of bounds [-80mV, -45mV]'], 'in': ['baseline outside of bounds [-60mV, -45mV]']}
+
+        for sweep_id, sweep in enumerate(self.sweeps):
+            start_time = datetime.datetime.fromtimestamp(self.sweep_start_time(sweep_id))
+            srec = db.SyncRec(ext_id=sweep_id, experiment=expt_entry, temperature=self.temperature)
+            session.add(srec)
+            holding = sweep['holding_potential']
+            ex_qc_pass = -80e-3 <= holding < -45e-3
+            in_qc_pass = -60e-3 <= holding < -45e-3
+            meta = None if ex_qc_pass and in_qc_pass else {'qc_failures': {
+                'ex': [] if ex_qc_pass else qc_failures['ex'],
+                'in': [] if in_qc_pass else qc_failures['in'],
+            }}
+
+            rec_entries = {}
+            pulse_entries = {}
+            traces = {}
+            for dev, (primary, command) in self.sweep_data(sweep_id).items():
+                trace = TSeries(primary, dt=self.dt, t0=0)
+                traces[dev] = trace
+                base = trace.time_slice(0, self.pre_delay).data
+                rec = db.Recording(sync_rec=srec, electrode=elecs[dev], start_time=start_time, sample_rate=int(self.sample_rate))
+                pcrec = db.PatchClampRecording(
+                    recording=rec,
+                    clamp_mode='ic',
+                    patch_mode='whole cell',
+                    stim_name=self.stim_name(sweep_id),
+                    baseline_potential=float_mode(base),
+                    baseline_current=0.0,
+                    baseline_rms_noise=base.std(),
+                    qc_pass=True,
+                )
+                db.MultiPatchProbe(
+                    patch_clamp_recording=pcrec,
+                    induction_frequency=sweep['induction_frequency'],
+                    recovery_delay=sweep['recovery_delay'],
+                    n_spikes_evoked=12,
+                )
+                session.add(rec)
+                rec_entries[dev] = rec
+
+                # presynaptic pulses and spikes
+                pulse_times = self.pulse_times(sweep_id, dev)
+                pulse_entries[dev] = []
+                for i, (pulse_t, spike_t) in enumerate(zip(pulse_times, self.spike_times(sweep_id, dev))):
+                    chunk = trace.time_slice(pulse_t - 2e-3, pulse_t + self.pulse_duration + 4e-3).resample(sample_rate=sample_rate)
+                    pulse = db.StimPulse(
+                        recording=rec,
+                        pulse_number=i,
+                        onset_time=pulse_t,
+                        amplitude=self.pulse_amplitude,
+                        duration=self.pulse_duration,
+                        n_spikes=1,
+                        first_spike_time=spike_t,
+                        data=chunk.data,
+                        data_start_time=chunk.t0,
+                        previous_pulse_dt=np.inf if i == 0 else pulse_t - pulse_times[i-1],
+                    )
+                    db.StimSpike(
+                        stim_pulse=pulse,
+                        onset_time=spike_t - 0.3e-3,
+                        max_slope_time=spike_t,
+                        max_slope=100.0,
+                        peak_time=spike_t + 0.3e-3,
+                        peak_value=holding + 100e-3,
+                    )
+                    session.add(pulse)
+                    pulse_entries[dev].append(pulse)
+
+            # postsynaptic responses, each matched with a baseline chunk from the pre-stimulus period
+            n_chunks = int(self.pre_delay / chunk_dur)
+            for pre_dev in self.cells:
+                pulse_times = self.pulse_times(sweep_id, pre_dev)
+                for post_dev, post_trace in traces.items():
+                    if post_dev == pre_dev:
+                        continue
+                    pair = pairs[pre_dev, post_dev]
+                    baselines = {}
+                    for i, pulse_t in enumerate(pulse_times):
+                        rec_start = pulse_t - 10e-3
+                        rec_stop = rec_start + 50e-3
+                        if i + 1 < len(pulse_times):
+                            rec_stop = min(rec_stop, pulse_times[i+1])
+                        resp = post_trace.time_slice(rec_start, rec_stop).resample(sample_rate=sample_rate)
+
+                        chunk_id = i % n_chunks
+                        if chunk_id not in baselines:
+                            base = post_trace.time_slice(chunk_id * chunk_dur, (chunk_id + 1) * chunk_dur).resample(sample_rate=sample_rate)
+                            baselines[chunk_id] = db.Baseline(
+                                recording=rec_entries[post_dev],
+                                data=base.data,
+                                data_start_time=base.t0,
+                                mode=float_mode(base.data),
+                                ex_qc_pass=ex_qc_pass,
+                                in_qc_pass=in_qc_pass,
+                                meta=meta,
+                            )
+
+                        session.add(db.PulseResponse(
+                            recording=rec_entries[post_dev],
+                            stim_pulse=pulse_entries[pre_dev][i],
+                            pair=pair,
+                            baseline=baselines[chunk_id],
+                            data=resp.data,
+                            data_start_time=resp.t0,
+                            ex_qc_pass=ex_qc_pass,
+                            in_qc_pass=in_qc_pass,
+                            meta=meta,
+                        ))
+                        pair.n_ex_test_spikes += int(ex_qc_pass)
+                        pair.n_in_test_spikes += int(in_qc_pass)
+
+    def add_pair_notes(self, session):
+        """Add manually verified average fit records for all synapses to a data notes DB session.
+        """
+        from .data.data_notes_db import PairNotes
+        for (pre, post), syn in self.synapses.items():
+            fit = {'xoffset': syn['latency'], 'rise_time': syn['rise_time'], 'decay_tau': syn['decay_tau'], 'amp': syn['amplitude'], 'nrmse': 1.0}
+            notes = {
+                'synapse_type': syn['synapse_type'],
+                'fit_parameters': {
+                    'initial': {'ic': {'-70': {'xoffset': syn['latency']}, '-55': {'xoffset': syn['latency']}}},
+                    'fit': {'ic': {'-70': fit, '-55': fit}},
+                },
+                'fit_pass': {'ic': {'-70': True, '-55': True}, 'vc': {'-70': False, '-55': False}},
+                'comments': 'synthetic',
+            }
+            session.add(PairNotes(
+                expt_id=self.ext_id,
+                pre_cell_id=self.cells[pre]['ext_id'],
+                post_cell_id=self.cells[post]['ext_id'],
+                notes=notes,
+                modification_time=datetime.datetime.now(),
+            ))
+
+
+def _spike_shape(t, max_slope_time, amplitude=100e-3, width=0.3e-3, ahp=5e-3, ahp_tau=5e-3):
+    """Action potential waveform whose rising phase has maximum slope at *max_slope_time*.
+    """
+    peak_time = max_slope_time + width / np.sqrt(2)
+    spike = amplitude * np.exp(-((t - peak_time) / width)**2)
+    after = t > peak_time
+    spike[after] -= ahp * np.exp(-(t[after] - peak_time) / ahp_tau) * (1 - np.exp(-(t[after] - peak_time) / width))
+    return spike
@@ -0,0 +1,56 @@
+import os
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+from aisynphys.database.database import Database, make_table
+
+
+ORMBase = declarative_base()
+Parent = make_table(ORMBase, name='parent', columns=[('name', 'str')])
+Child = make_table(ORMBase, name='child', columns=[('parent_id', 'parent.id'), ('name', 'str')])
+GrandChild = make_table(ORMBase, name='grand_child', columns=[('child_id', 'child.id')])
+Note = make_table(ORMBase, name='note', columns=[('child_id', 'child.id')])
+Parent.children = relationship(Child, back_populates='parent', cascade='save-update,merge,delete', single_parent=True)
+Child.parent = relationship(Parent, back_populates='children')
+Child.grand_children = relationship(GrandChild, back_populates='child', cascade='save-update,merge,delete', single_parent=True)
+GrandChild.child = relationship(Child, back_populates='grand_children')
+
+
+def test_bulk_delete(tmpdir):
+    db = Database('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'), ORMBase)
+    db.create_tables()
+    session = db.session(readonly=False)
+    for name in ['a', 'b', 'c']:
+        parent = Parent(name=name)
+        for i in range(3):
+            child = Child(parent=parent, name=name)
+            GrandChild(child=child)
+            GrandChild(child=child)
+        session.add(parent)
+    session.commit()
+    note_child = session.query(Child).filter(Child.name=='a').first()
+    session.add(Note(child_id=note_child.id))
+    session.commit()
+
+    queries = [session.query(Parent).filter(Parent.name.in_(['a', 'b']))]
+    expected = {'grand_child': 12, 'child': 6, 'parent': 2}
+
+    # dry run reports dependent tables first and changes nothing
+    counts = db.bulk_delete(queries, session, dry_run=True)
+    assert list(counts.items()) == list(expected.items())
+    assert session.query(GrandChild).count() == 18
+
+    statements = []
+    sqlalchemy.event.listen(db.rw_engine, 'before_cursor_execute', lambda conn, cursor, stmt, *args: statements.append(stmt))
+    counts = db.bulk_delete(queries, session, chunk_size=4)
+    session.commit()
+    # only references that are not followed by a delete cascade are updated (once per chunk of child ids)
+    updates = [stmt.split(' SET')[0] for stmt in statements if stmt.startswith('UPDATE')]
+    assert updates == ['UPDATE note'] * 2
+    assert dict(counts) == expected
+    assert [p.name for p in session.query(Parent).all()] == ['c']
+    assert session.query(Child).count() == 3
+    assert session.query(GrandChild).count() == 6
+
+    # references without a delete cascade are set to NULL
+    assert session.query(Note).one().child_id is None
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+from aisynphys.database.database import Database, make_table
+
+
+ORMBase = declarative_base()
+Parent = make_table(ORMBase, name='parent', columns=[('name', 'str')])
+Child = make_table(ORMBase, name='child', columns=[('parent_id', 'parent.id'), ('data', 'array'), ('value', 'float')])
+Parent.children = relationship(Child, back_populates='parent', order_by=Child.id)
+Child.parent = relationship(Parent, back_populates='children')
+
+
+def test_bulk_insert(tmpdir):
+    db = Database('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'), ORMBase)
+    db.create_tables()
+    session = db.session(readonly=False)
+    session.add(Parent(name='orm'))
+    session.commit()
+
+    # ids follow existing rows and rows reserved earlier in the same transaction
+    parent_ids = db.reserve_ids('parent', 2, session)
+    assert parent_ids == [2, 3]
+    assert db.reserve_ids('parent', 0, session) == []
+    child_ids = db.reserve_ids('child', 5, session)
+    assert child_ids == [1, 2, 3, 4, 5]
+
+    parents = [{'id': i, 'name': 'p%d' % i, 'meta': None} for i in parent_ids]
+    children = [
+        {'id': i, 'parent_id': parent_ids[i % 2], 'data': np.arange(i), 'value': i * 0.5, 'meta': {'i': i}}
+        for i in child_ids
+    ]
+    db.bulk_insert('parent', parents, session)
+    db.bulk_insert('child', children, session, chunk_size=2)
+    session.commit()
+
+    # rows read back through the ORM as if they had been added there
+    parent = session.query(Parent).filter(Parent.name=='p3').one()
+    assert [c.id for c in parent.children] == [1, 3, 5]
+    child = parent.children[2]
+    assert np.all(child.data == np.arange(5))
+    assert child.value == 2.5 and child.meta == {'i': 5}
+    assert db.reserve_ids('child', 1, session) == [6]
+    session.rollback()
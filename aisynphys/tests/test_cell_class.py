@@ -0,0 +1,60 @@
+import random
+from collections import OrderedDict
+from aisynphys.cell_class import CellClass, CellClassIndex, classify_cells, classify_pairs
+
+
+class Obj(object):
+    def __init__(self, **kwds):
+        self.__dict__.update(kwds)
+
+
+def make_cells(n=200, seed=0):
+    rng = random.Random(seed)
+    cells = []
+    for i in range(n):
+        attrs = {}
+        if rng.random() < 0.9:
+            attrs['cre_type'] = rng.choice(['pvalb', 'sst', 'vip', 'tlx3', None])
+        if rng.random() < 0.9:
+            attrs['target_layer'] = rng.choice(['2/3', '4', '5', '6'])
+        morpho = Obj(dendrite_type=rng.choice(['spiny', 'aspiny', None])) if rng.random() < 0.8 else None
+        patchseq = Obj(tree_call=rng.choice(['Core', 'I1', None]), cre_type='sst') if rng.random() < 0.5 else None
+        cells.append(Obj(id=i, morphology=morpho, patch_seq=patchseq, **attrs))
+    return cells
+
+
+cell_classes = [
+    CellClass(name='l5 pv', cre_type='pvalb', target_layer='5'),
+    CellClass(name='sst/vip', cre_type=('sst', 'vip')),
+    CellClass(name='spiny', dendrite_type='spiny'),
+    CellClass(name='no cre', cre_type=None),
+    CellClass(name='core or aspiny', tree_call={'tree_call': 'Core', 'dendrite_type': 'aspiny'}),
+    CellClass(name='missing', missing_attr=1),
+]
+
+
+def test_classify_cells():
+    cells = make_cells()
+    groups = classify_cells(cell_classes, cells=cells)
+    assert list(groups.keys()) == cell_classes
+    for cell_class in cell_classes:
+        assert groups[cell_class] == set([c for c in cells if c in cell_class])
+
+    mask = CellClassIndex(cells).mask(cell_classes[0])
+    assert list(mask) == [c in cell_classes[0] for c in cells]
+
+
+def test_classify_pairs():
+    cells = make_cells(50, seed=1)
+    rng = random.Random(2)
+    pairs = [Obj(pre_cell=rng.choice(cells), post_cell=rng.choice(cells)) for i in range(300)]
+    groups = classify_cells(cell_classes, pairs=pairs)
+    result = classify_pairs(pairs, groups)
+
+    expected = OrderedDict()
+    for pre_class, pre_group in groups.items():
+        for post_class, post_group in groups.items():
+            expected[(pre_class, post_class)] = [p for p in pairs if p.pre_cell in pre_group and p.post_cell in post_group]
+    assert list(result.keys()) == list(expected.keys())
+    for k in expected:
+        assert result[k] == expected[k]
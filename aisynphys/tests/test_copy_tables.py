@@ -0,0 +1,67 @@
+import os
+import pytest
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+from aisynphys.database.database import Database, make_table
+
+
+ORMBase = declarative_base()
+Item = make_table(ORMBase, name='item', columns=[('name', 'str', '', {'index': True}), ('value', 'int')])
+
+
+def make_db(tmpdir, name):
+    db = Database('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), name), ORMBase)
+    db.create_tables()
+    return db
+
+
+def index_names(db):
+    return [ix['name'] for ix in sqlalchemy.inspect(db.ro_engine).get_indexes('item')]
+
+
+def test_copy_tables(tmpdir):
+    source = make_db(tmpdir, 'source.sqlite')
+    session = source.session(readonly=False)
+    session.add_all([Item(name='item%d' % i, value=i) for i in range(25)])
+    session.commit()
+
+    # bad records are skipped without leaving the rest of their chunk half-written
+    dest = make_db(tmpdir, 'dest.sqlite')
+    session = dest.session(readonly=False)
+    session.add(Item(id=7, name='conflict', value=-1))
+    session.commit()
+    session.close()
+    tables = list(Database.iter_copy_tables(source, dest, skip_errors=True, vacuum=False, batch_size=10))
+    assert tables == ['item']
+    rows = dest.session().query(Item.id, Item.value).order_by(Item.id).all()
+    assert rows == [(i, -1 if i == 7 else i - 1) for i in range(1, 26)]
+    assert index_names(dest) == ['ix_item_name']
+
+    # indexes are rebuilt even if the copy fails
+    dest = make_db(tmpdir, 'dest2.sqlite')
+    session = dest.session(readonly=False)
+    session.add(Item(id=7, name='conflict', value=-1))
+    session.commit()
+    session.close()
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        list(Database.iter_copy_tables(source, dest, vacuum=False, batch_size=10))
+    assert index_names(dest) == ['ix_item_name']
+    assert dest.session().query(Item).count() == 1
+
+
+def test_bake_without_queue_tables(tmpdir):
+    from aisynphys.database import SynphysDatabase
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'source.sqlite'))
+    # a database that never created the pipeline queue tables
+    db.create_tables([name for name in db.metadata_tables() if name not in db.internal_tables])
+    assert 'pipeline_queue' not in db.table_names()
+    session = db.session(readonly=False)
+    session.add(db.Experiment(ext_id='1', acq_timestamp=1.0))
+    session.commit()
+
+    baked_file = os.path.join(str(tmpdir), 'baked.sqlite')
+    db.bake_sqlite(baked_file, vacuum=False)
+    baked = SynphysDatabase.load_sqlite(baked_file)
+    assert baked.session().query(baked.Experiment.ext_id).all() == [('1',)]
+    # internal tables are not published
+    assert not any(name in baked.table_names() for name in db.internal_tables)
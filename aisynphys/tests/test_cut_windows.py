@@ -0,0 +1,22 @@
+import numpy as np
+from neuroanalysis.data import TSeries
+from aisynphys.data import cut_windows
+
+
+def test_cut_windows():
+    rng = np.random.RandomState(0)
+    ts = TSeries(rng.normal(size=50000).astype('float32'), sample_rate=50000, t0=0.2)
+    windows = [(t, t + length) for t, length in zip(rng.uniform(0.25, 1.1, size=20), [0.05, 0.05, 0.0213, 0.02] * 5)]
+
+    for sample_rate in [20000, 50000, None]:
+        data, t0, n_samples = cut_windows(ts, windows, sample_rate=sample_rate)
+        assert data.shape == (len(windows), n_samples.max())
+        for i, (start, stop) in enumerate(windows):
+            # each row matches slicing / resampling the window on its own
+            ref = ts.time_slice(start, stop)
+            if sample_rate is not None:
+                ref = ref.resample(sample_rate=sample_rate)
+            assert n_samples[i] == len(ref)
+            assert np.array_equal(data[i, :n_samples[i]], ref.data)
+            assert t0[i] == ref.t0
+            assert np.all(np.isnan(data[i, n_samples[i]:]))
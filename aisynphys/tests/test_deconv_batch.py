@@ -0,0 +1,55 @@
+import numpy as np
+from neuroanalysis.data import TSeries
+from neuroanalysis import filter
+from neuroanalysis.event_detection import exp_deconvolve
+from aisynphys.pulse_response_strength import deconv_filter, deconv_filter_batch, remove_crosstalk_artifacts_batch
+
+
+def make_traces(n=8, seed=0):
+    rng = np.random.RandomState(seed)
+    return [
+        TSeries((rng.normal(0, 100e-6, 600) - 65e-3).astype('float32'), sample_rate=20000, t0=-10e-3 + rng.uniform(0, 50e-6))
+        for i in range(n)
+    ]
+
+
+def test_deconv_filter_batch():
+    traces = make_traces()
+    taus = [float(tau) for tau in np.linspace(5e-3, 15e-3, len(traces))]
+    batch = deconv_filter_batch(
+        np.stack([ts.data for ts in traces]), traces[0].dt, t0=[ts.t0 for ts in traces],
+        tau=np.array(taus), lowpass=2000,
+    )
+    assert batch.shape == (len(traces), 599)
+    for ts, tau, row in zip(traces, taus, batch):
+        # reference: the same steps applied to one trace at a time
+        dec = exp_deconvolve(ts, tau)
+        dec = dec - np.median(dec.time_slice(dec.t0+5e-3, dec.t0+10e-3).data)
+        ref = filter.bessel_filter(dec, 2000)
+        assert np.array_equal(row, ref.data)
+        single = deconv_filter(ts, None, tau=tau, lowpass=2000)
+        assert np.array_equal(single.data, ref.data)
+        assert single.t0 == ts.t0
+
+    # artifact removal with per-trace pulse times
+    pulse_times = [(0, 2e-3)] * len(traces)
+    batch = deconv_filter_batch(
+        np.stack([ts.data for ts in traces]), traces[0].dt, t0=[ts.t0 for ts in traces],
+        pulse_times=pulse_times, tau=None, remove_artifacts=True, lpf=False, bsub=False,
+    )
+    for ts, pt, row in zip(traces, pulse_times, batch):
+        assert np.array_equal(row, deconv_filter(ts, pt, tau=None, remove_artifacts=True, lpf=False, bsub=False).data)
+
+
+def test_remove_crosstalk_artifacts_batch():
+    traces = make_traces()
+    data = np.stack([ts.data for ts in traces])
+    # overlapping, separate, and shared artifact regions
+    pulse_times = [(5e-3, 7e-3), (5e-3, 7e-3), (5e-3, 5.1e-3), (6e-3, 9e-3)] * 2
+    batch = remove_crosstalk_artifacts_batch(data, traces[0].dt, [ts.t0 for ts in traces], pulse_times)
+    assert batch.dtype == data.dtype
+    for ts, pt, row in zip(traces, pulse_times, batch):
+        # reference: neuroanalysis applied to one trace at a time
+        edges = [(int((t-50e-6)/ts.dt), int((t+250e-6)/ts.dt)) for t in pt]
+        ref = filter.remove_artifacts(ts, edges, window=100e-6)
+        assert np.allclose(row, ref.data, rtol=0, atol=1e-9)
@@ -0,0 +1,42 @@
+import numpy as np
+from aisynphys.dynamics import pulse_amplitude_dtype, pulse_train_amplitudes
+
+
+def make_amps(rows):
+    # rows are (recording_id, ind_freq, rec_delay, pulse_number, amplitude)
+    amps = np.zeros(len(rows), dtype=pulse_amplitude_dtype)
+    for i, row in enumerate(rows):
+        for name, val in zip(['recording_id', 'induction_frequency', 'recovery_delay', 'pulse_number', 'amplitude'], row):
+            amps[name][i] = val
+    return amps
+
+
+def test_pulse_train_amplitudes():
+    amps = make_amps([
+        (5, 50, 0.25, 1, 1.0),
+        (3, 20, np.nan, 1, 2.0),
+        (5, 50, 0.25, 2, 3.0),
+        (4, 50, 0.25, 2, 4.0),
+        (3, 20, np.nan, 3, 5.0),
+        (3, 20, np.nan, 3, 6.0),
+        (4, 50, 0.25, -1, 7.0),
+    ])
+    ind_freq, rec_delay, train_amps = pulse_train_amplitudes(amps)
+
+    # recordings are grouped by stimulus in order of first appearance
+    assert ind_freq.tolist() == [50, 50, 20]
+    assert np.isnan(rec_delay[2])
+    assert train_amps.shape == (3, 13)
+    nan = np.nan
+    assert np.array_equal(train_amps[:, :4], [
+        [nan, 1.0, 3.0, nan],
+        [nan, nan, 4.0, nan],
+        [nan, 2.0, nan, 6.0],
+    ], equal_nan=True)
+    assert np.isnan(train_amps[:, 4:]).all()
+
+
+def test_pulse_train_amplitudes_empty():
+    ind_freq, rec_delay, train_amps = pulse_train_amplitudes(make_amps([]))
+    assert len(ind_freq) == len(rec_delay) == 0
+    assert train_amps.shape == (0, 13)
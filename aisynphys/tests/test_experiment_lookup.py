@@ -0,0 +1,35 @@
+import os
+import pytest
+from aisynphys.database import SynphysDatabase
+
+
+def test_experiment_from_timestamp(tmpdir):
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'))
+    db.create_tables()
+    session = db.session(readonly=False)
+    timestamps = [1500000000.123, 1500000000.128, 1500000100.5, 1500000200.0]
+    for ts in timestamps:
+        session.add(db.Experiment(ext_id='%0.3f' % ts, acq_timestamp=ts))
+    session.commit()
+
+    assert db.experiment_from_timestamp(1500000000.123, session=session).acq_timestamp == 1500000000.123
+    assert db.experiment_from_timestamp('1500000000.128', session=session).acq_timestamp == 1500000000.128
+    # timestamps truncated to 2 decimal places resolve to the nearest experiment
+    assert db.experiment_from_timestamp(1500000000.12, session=session).acq_timestamp == 1500000000.123
+    assert db.experiment_from_timestamp(1500000100.5, session=session, tolerance=0).acq_timestamp == 1500000100.5
+    with pytest.raises(KeyError):
+        db.experiment_from_timestamp(1500000100.52, session=session)
+
+    query = [1500000200.0, 1500000000.13, 1500000300.0, 1500000100.499]
+    expts = db.experiments_from_timestamps(query, session=session, chunk_size=3)
+    assert [None if e is None else e.acq_timestamp for e in expts] == [1500000200.0, 1500000000.128, None, 1500000100.5]
+    assert db.experiments_from_timestamps([], session=session) == []
+
+    # experiments equally near to a timestamp are ambiguous
+    for ts in [1500000300.0, 1500000300.5]:
+        session.add(db.Experiment(ext_id='%0.3f' % ts, acq_timestamp=ts))
+    session.commit()
+    with pytest.raises(RuntimeError):
+        db.experiment_from_timestamp(1500000300.25, session=session, tolerance=0.5)
+    with pytest.raises(RuntimeError):
+        db.experiments_from_timestamps([1500000300.25], session=session, tolerance=0.5)
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+from aisynphys.database import SynphysDatabase
+import aisynphys.synapse_prediction as synapse_prediction
+
+
+strength_fields = [
+    'pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk',
+    'baseline_pos_amp', 'baseline_neg_amp', 'baseline_pos_dec_amp', 'baseline_neg_dec_amp',
+    'baseline_pos_dec_latency', 'baseline_neg_dec_latency', 'baseline_crosstalk',
+]
+
+
+def make_expt(db, session):
+    rng = np.random.RandomState(0)
+    expt = db.Experiment(ext_id='1000.000', acq_timestamp=1000.0)
+    elecs = [db.Electrode(experiment=expt, ext_id=str(i)) for i in range(3)]
+    cells = [db.Cell(experiment=expt, electrode=elec, ext_id=str(i)) for i, elec in enumerate(elecs)]
+    pairs = {(a, b): db.Pair(experiment=expt, pre_cell=cells[a], post_cell=cells[b]) for a in range(3) for b in range(3) if a != b}
+    for i, clamp_mode in enumerate(['ic', 'vc', 'ic']):
+        srec = db.SyncRec(experiment=expt, ext_id=i)
+        recs = [db.Recording(sync_rec=srec, electrode=elec) for elec in elecs]
+        for rec in recs:
+            db.PatchClampRecording(recording=rec, clamp_mode=clamp_mode, qc_pass=True)
+        for pre in range(3):
+            for pulse_n in range(1, 4):
+                stim_pulse = db.StimPulse(recording=recs[pre], pulse_number=pulse_n, onset_time=pulse_n * 20e-3)
+                db.StimSpike(stim_pulse=stim_pulse, max_slope_time=pulse_n * 20e-3 + 1e-3)
+                for post in range(3):
+                    # pair (0, 2) has no responses
+                    if post == pre or (pre, post) == (0, 2):
+                        continue
+                    pr = db.PulseResponse(
+                        recording=recs[post], stim_pulse=stim_pulse, pair=pairs[pre, post],
+                        data=np.zeros(10, dtype='float32'), data_start_time=pulse_n * 20e-3 - 1e-3,
+                        ex_qc_pass=True, in_qc_pass=bool(pulse_n % 2),
+                    )
+                    session.add(db.PulseResponseStrength(pulse_response=pr, **{k: rng.normal() for k in strength_fields}))
+    session.add(expt)
+    session.commit()
+    return expt
+
+
+def test_expt_amps(tmpdir, monkeypatch):
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'))
+    db.create_tables()
+    monkeypatch.setattr(synapse_prediction, 'db', db)
+    session = db.session(readonly=False)
+    expt = make_expt(db, session)
+
+    amps = synapse_prediction.get_expt_amps(session, expt)
+    assert len(amps[None]) == 0
+    assert len(amps) == 6  # 5 pairs with data + empty records
+    for pair in expt.pair_list:
+        key = (pair.pre_cell.electrode_id, pair.post_cell.electrode_id)
+        for clamp_mode in ('ic', 'vc'):
+            # records match those selected separately for each pair
+            pair_recs = synapse_prediction.get_amps(session, pair, clamp_mode=clamp_mode)
+            if key not in amps:
+                assert len(pair_recs) == 0
+                continue
+            recs = amps[key][clamp_mode]
+            assert len(recs) == len(pair_recs) == (6 if clamp_mode == 'ic' else 3)
+            for field in ['id', 'response_start_time', 'in_qc_pass'] + strength_fields:
+                assert np.array_equal(recs[field], pair_recs[field])
+
+    # raw data is loaded separately
+    pair = expt.pairs['0', '1']
+    pr_ids = amps[pair.pre_cell.electrode_id, pair.post_cell.electrode_id]['ic']['pulse_response_id']
+    data = synapse_prediction.get_pulse_response_data(session, pr_ids, chunk_size=4)
+    assert sorted(data.keys()) == sorted(pr_ids)
+    assert all(np.array_equal(d, np.zeros(10)) for d in data.values())
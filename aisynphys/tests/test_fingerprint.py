@@ -0,0 +1,46 @@
+import os
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+from aisynphys.pipeline.fingerprint import FileHashCache, job_fingerprint
+
+
+def test_file_hash_cache(tmpdir):
+    data_file = os.path.join(str(tmpdir), 'data.nwb')
+    with open(data_file, 'wb') as fh:
+        fh.write(b'original data')
+    cache_file = os.path.join(str(tmpdir), 'cache', 'hashes.json')
+    cache = FileHashCache(cache_file)
+
+    h1 = cache.file_hash(data_file)
+    assert cache.file_hash(os.path.join(str(tmpdir), 'missing')) is None
+    cache.save()
+
+    # hashes are reloaded from disk and reused while size and mtime are unchanged
+    cache2 = FileHashCache(cache_file)
+    path = os.path.abspath(data_file)
+    cache2.hashes[path][2] = 'cached'
+    assert cache2.file_hash(data_file) == 'cached'
+
+    # touching a file changes its mtime but not its hash
+    stat = os.stat(data_file)
+    os.utime(data_file, (stat.st_atime, stat.st_mtime + 10))
+    assert cache2.file_hash(data_file) == h1
+
+    fp1 = job_fingerprint('dataset', 1, input_files=[data_file], upstream=[('experiment', '1', 'abc')], hash_cache=cache2)
+    assert fp1 == job_fingerprint('dataset', 1, input_files=[data_file], upstream=[('experiment', '1', 'abc')], hash_cache=cache2)
+    assert fp1 != job_fingerprint('dataset', 2, input_files=[data_file], upstream=[('experiment', '1', 'abc')], hash_cache=cache2)
+    assert fp1 != job_fingerprint('dataset', 1, input_files=[data_file], upstream=[('experiment', '1', 'abd')], hash_cache=cache2)
+
+    with open(data_file, 'wb') as fh:
+        fh.write(b'modified data')
+    os.utime(data_file, (stat.st_atime, stat.st_mtime + 20))
+    assert cache2.file_hash(data_file) != h1
+    assert fp1 != job_fingerprint('dataset', 1, input_files=[data_file], upstream=[('experiment', '1', 'abc')], hash_cache=cache2)
+
+    # stats supplied by the caller (e.g. from the raw data index) are used instead of os.stat
+    st = os.stat(data_file)
+    stats = {data_file: (st.st_mtime, st.st_size)}
+    cache2.hashes[path][2] = 'indexed'
+    assert cache2.file_hash(data_file, stats[data_file]) == 'indexed'
+    fp2 = job_fingerprint('dataset', 1, input_files=[data_file], hash_cache=cache2, input_file_stats=stats)
+    assert fp2 != job_fingerprint('dataset', 1, input_files=[data_file], hash_cache=cache2, input_file_stats={data_file: None})
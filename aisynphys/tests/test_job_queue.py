@@ -0,0 +1,141 @@
+import os, time, sqlite3, threading, multiprocessing
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+import sqlalchemy
+from aisynphys.database import SynphysDatabase, dispose_all_engines
+from aisynphys.pipeline.job_queue import JobQueue
+from aisynphys.pipeline.scheduler import JobGraph
+
+
+def make_db(tmpdir):
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'))
+    db.create_tables(['metadata'])
+    return db
+
+
+def make_graph():
+    # module b depends on module a for each job ID; jobs 'x' fail in module a
+    graph = JobGraph()
+    for job_id in [str(i) for i in range(20)] + ['x']:
+        graph.add_job('a', {'job_id': job_id, 'meta': {'source': job_id}})
+        graph.add_job('b', {'job_id': job_id})
+        graph.add_dependency(('b', job_id), ('a', job_id))
+    return graph
+
+
+def claim_all(db_file, results):
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', db_file)
+    queue = JobQueue(db, 'test')
+    claimed = []
+    while True:
+        job = queue.claim()
+        if job is None:
+            if queue.n_pending() == 0:
+                break
+            time.sleep(0.01)
+            continue
+        queue.finish(job, 'failed' if job['job_id'] == 'x' else None)
+        claimed.append((job['module_name'], job['job_id']))
+    results.put(claimed)
+
+
+def test_job_queue(tmpdir):
+    db = make_db(tmpdir)
+    db_file = db.db_name
+    queue = JobQueue(db, 'test')
+    assert queue.enqueue(make_graph()) == 42
+    assert queue.enqueue(make_graph()) == 0
+
+    # jobs in module b wait for module a
+    job1 = queue.claim()
+    assert (job1['module_name'], job1['job_id'], job1['job_meta']) == ('a', '0', {'source': '0'})
+    job2 = queue.claim()
+    assert (job2['module_name'], job2['job_id']) == ('a', '1')
+    assert queue.finish(job1)
+    job3 = queue.claim()
+    assert (job3['module_name'], job3['job_id']) == ('b', '0')
+    assert queue.finish(job2) and queue.finish(job3)
+
+    # several workers claim each job exactly once
+    dispose_all_engines()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=claim_all, args=(db_file, results)) for i in range(3)]
+    for proc in procs:
+        proc.start()
+    claimed = [job for proc in procs for job in results.get(timeout=60)]
+    for proc in procs:
+        proc.join()
+    assert len(claimed) == len(set(claimed)) == 38
+    assert ('b', 'x') not in claimed
+
+    status = queue.status()
+    assert status['a'] == {'done': 20, 'failed': 1}
+    assert status['b'] == {'done': 20, 'skipped': 1}
+
+
+def test_expired_claim(tmpdir):
+    db = make_db(tmpdir)
+    graph = JobGraph()
+    graph.add_job('a', {'job_id': '1'})
+    graph.add_job('b', {'job_id': '1'})
+    graph.add_dependency(('b', '1'), ('a', '1'))
+    JobQueue(db, 'test').enqueue(graph)
+
+    lost = JobQueue(db, 'test', lease_time=0.2, max_attempts=2, worker_name='lost')
+    job = lost.claim()
+    assert job['attempts'] == 1
+
+    # heartbeats keep the claim alive
+    worker = JobQueue(db, 'test', lease_time=0.2, max_attempts=2, worker_name='worker')
+    with lost.keep_alive(job, interval=0.05):
+        time.sleep(0.4)
+        assert worker.claim() is None
+
+    # without heartbeats the job is returned to the queue and claimed by another worker
+    time.sleep(0.3)
+    job2 = worker.claim()
+    assert job2['id'] == job['id'] and job2['attempts'] == 2
+    assert lost.finish(job) is False
+
+    # after max_attempts, the job fails and its downstream jobs are skipped
+    time.sleep(0.3)
+    assert worker.claim() is None
+    assert worker.status() == {'a': {'failed': 1}, 'b': {'skipped': 1}}
+
+
+def hold_lock(db_file, locked, duration):
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute('BEGIN IMMEDIATE')
+    locked.set()
+    time.sleep(duration)
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def test_locked_database(tmpdir):
+    db = make_db(tmpdir)
+    graph = JobGraph()
+    graph.add_job('a', {'job_id': '1'})
+    queue = JobQueue(db, 'test', busy_timeout=0.1)
+    queue.enqueue(graph)
+
+    # another connection holds the write lock for longer than the busy timeout
+    queue.max_retries = 1
+    locked = threading.Event()
+    thread = threading.Thread(target=hold_lock, args=(db.db_name, locked, 0.5))
+    thread.start()
+    locked.wait()
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        queue.claim()
+    thread.join()
+
+    # claims are retried until the lock is released
+    queue.max_retries = 3
+    locked.clear()
+    thread = threading.Thread(target=hold_lock, args=(db.db_name, locked, 0.5))
+    thread.start()
+    locked.wait()
+    job = queue.claim()
+    thread.join()
+    assert job['job_id'] == '1'
+    assert queue.heartbeat(job) and queue.finish(job)
@@ -0,0 +1,39 @@
+import io
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, select
+from aisynphys.database.database import NDArray
+
+
+@pytest.mark.parametrize('codec', [None, 'zlib', 'bz2', 'lzma'])
+def test_ndarray_roundtrip(codec):
+    engine = create_engine('sqlite://')
+    meta = MetaData()
+    table = Table('arrays', meta, 
+        Column('id', Integer, primary_key=True),
+        Column('data', NDArray(codec=codec, dtype='float32')),
+    )
+    meta.create_all(engine)
+    
+    data = np.sin(np.linspace(0, 100, 10000)) * 1e-3
+    ints = np.arange(100)
+    engine.execute(table.insert(), [{'data': data}, {'data': ints}, {'data': None}])
+    recs = [rec[0] for rec in engine.execute(select([table.c.data]).order_by(table.c.id))]
+    
+    # floats are downcast; other types are stored unchanged
+    assert recs[0].dtype == np.float32
+    assert np.allclose(recs[0], data, rtol=1e-6, atol=0)
+    assert recs[1].dtype == ints.dtype
+    assert np.all(recs[1] == ints)
+    assert recs[2] is None
+
+
+def test_ndarray_read_uncompressed():
+    # blobs written without compression must remain readable by compressed columns
+    data = np.random.normal(size=1000)
+    buf = io.BytesIO()
+    np.save(buf, data, allow_pickle=False)
+    
+    typ = NDArray(codec='zlib', dtype='float32')
+    assert np.all(typ.process_result_value(buf.getvalue(), None) == data)
+    assert typ.process_result_value(b'', None) is None
@@ -0,0 +1,58 @@
+import os, datetime
+from aisynphys.database import Database
+from aisynphys.data.data_notes_db import DataNotesORMBase, PairNotes, get_pair_notes_records, PairNotesModTimes
+
+
+def add_notes(session, expt_id, pre, post, mtime):
+    session.add(PairNotes(expt_id=expt_id, pre_cell_id=pre, post_cell_id=post, notes={'synapse_type': 'ex'}, modification_time=mtime))
+    session.commit()
+
+
+def test_pair_notes(tmpdir):
+    db = Database('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'notes.sqlite'), DataNotesORMBase)
+    db.create_tables()
+    session = db.session(readonly=False)
+    t0 = datetime.datetime(2020, 1, 1, 12, 0, 0, 123456)
+    add_notes(session, 'a', '1', '2', t0)
+    add_notes(session, 'a', '2', '1', t0 + datetime.timedelta(hours=1))
+    add_notes(session, 'b', '1', '2', t0)
+
+    recs = get_pair_notes_records(['a'], session=session)
+    assert sorted(recs.keys()) == [('a', '1', '2'), ('a', '2', '1')]
+    assert recs['a', '1', '2'].notes == {'synapse_type': 'ex'}
+    assert len(get_pair_notes_records(session=session)) == 3
+
+    cache_file = os.path.join(str(tmpdir), 'mod_times.json')
+    mod_times = PairNotesModTimes(db, cache_file=cache_file).refresh(session=session)
+    assert mod_times == {'a': t0 + datetime.timedelta(hours=1), 'b': t0}
+
+    # modification times persist exactly; later refreshes only see records past the watermark
+    tracker = PairNotesModTimes(db, cache_file=cache_file)
+    assert tracker.mod_times == mod_times
+    add_notes(session, 'c', '1', '2', t0 + datetime.timedelta(hours=2))
+    session.execute(PairNotes.__table__.update().where(PairNotes.expt_id=='b').values(modification_time=t0 + datetime.timedelta(hours=3)))
+    session.commit()
+    mod_times = tracker.refresh(session=session)
+    assert mod_times['b'] == t0 + datetime.timedelta(hours=3)
+    assert mod_times['c'] == t0 + datetime.timedelta(hours=2)
+
+    # content hashes follow the notes, not their modification times
+    hashes = dict(tracker.content_hashes)
+    assert sorted(hashes.keys()) == ['a', 'b', 'c']
+    assert PairNotesModTimes(db, cache_file=cache_file).content_hashes == hashes
+    session.execute(PairNotes.__table__.update().where(PairNotes.expt_id=='a').values(modification_time=t0 + datetime.timedelta(hours=4)))
+    session.commit()
+    tracker.refresh(session=session)
+    assert tracker.content_hashes == hashes
+    session.execute(PairNotes.__table__.update().where(PairNotes.expt_id=='a').values(notes={'synapse_type': 'in'}, modification_time=t0 + datetime.timedelta(hours=5)))
+    session.commit()
+    tracker.refresh(session=session)
+    assert tracker.content_hashes['a'] != hashes['a']
+    assert tracker.content_hashes['b'] == hashes['b']
+
+    # deleting records causes a full scan
+    session.query(PairNotes).filter(PairNotes.expt_id=='c').delete()
+    session.commit()
+    assert 'c' not in tracker.refresh(session=session)
+    assert 'c' not in tracker.content_hashes
+    session.close()
@@ -0,0 +1,48 @@
+import numpy as np
+import pyqtgraph as pg
+from collections import OrderedDict
+from aisynphys.stochastic_release_model import ParameterSpace
+
+
+def model_func(params):
+    n = params['n_release_sites']
+    events = np.zeros(n, dtype=[('expected_amplitude', float), ('likelihood', float)])
+    events['expected_amplitude'] = np.arange(n) * params['mini_amplitude_cv']
+    return {
+        'likelihood': n * params['mini_amplitude_cv'] + params['measurement_stdev'],
+        'params': dict(params, mini_amplitude=n * 2.0),
+        'events': events,
+    }
+
+
+def test_parameter_space(tmpdir):
+    pg.mkQApp()
+    params = OrderedDict([
+        ('n_release_sites', np.array([1, 2, 4])),
+        ('mini_amplitude_cv', np.array([0.1, 0.2, 0.4, 0.8])),
+        ('measurement_stdev', 0.5),
+    ])
+    dtype = [('likelihood', 'float64'), ('mini_amplitude', 'float64')]
+    ps = ParameterSpace(params, result_dtype=dtype, event_dtype=[('expected_amplitude', 'float32')])
+    ps.run(model_func, workers=1)
+
+    assert ps.result.shape == (3, 4)
+    assert ps.result['likelihood'][2, 1] == 4 * 0.2 + 0.5
+    assert ps.result['mini_amplitude'][1, 3] == 4.0
+    assert np.allclose(ps.event_result((2, 3))['expected_amplitude'], np.arange(4) * 0.8)
+
+    path = str(tmpdir.join('result'))
+    ps.save(path)
+    loaded = ParameterSpace.load(path)
+    # each result field is memory-mapped from its own file
+    assert isinstance(loaded.result['likelihood'], np.memmap)
+    assert tmpdir.join('result', 'result.mini_amplitude.npy').check()
+    assert loaded.param_order == ps.param_order
+    assert loaded.static_params == {'measurement_stdev': 0.5}
+    assert loaded[(1, 2)] == ps[(1, 2)]
+    assert loaded.result.dtype == ps.result.dtype and loaded.result.shape == ps.result.shape
+    assert loaded.result[1, 2] == ps.result[1, 2]
+    assert np.all(loaded.result[1]['likelihood'] == ps.result[1]['likelihood'])
+    assert np.all(loaded.result['likelihood'].max(axis=0) == ps.result['likelihood'].max(axis=0))
+    assert len(loaded.events) == 12
+    assert np.all(loaded.event_result((1, 0)) == ps.event_result((1, 0)))
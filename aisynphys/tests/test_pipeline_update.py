@@ -0,0 +1,144 @@
+from datetime import datetime
+from collections import OrderedDict
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+pytest.importorskip('pyqtgraph')
+from aisynphys.pipeline.pipeline import Pipeline
+from aisynphys.pipeline.pipeline_module import PipelineModule
+
+
+# raw data: {slice_id: (slice_data, {expt_id: expt_data})}
+raw_data = OrderedDict()
+# order in which jobs were run
+job_log = []
+
+
+class MemoryModule(PipelineModule):
+    """Module that keeps its results in memory.
+    """
+    results = None
+
+    @classmethod
+    def process_job(cls, job):
+        job_log.append((cls.name, job['job_id']))
+        cls.results[job['job_id']] = (datetime.now(), True, job['meta'])
+
+    def finished_jobs(self):
+        return OrderedDict([(job_id, (ts, success)) for job_id, (ts, success, meta) in self.results.items()])
+
+    def job_fingerprints(self):
+        return {job_id: (meta or {}).get('fingerprint') for job_id, (ts, success, meta) in self.results.items()}
+
+    def store_fingerprints(self, fingerprints):
+        for job_id, fp in fingerprints.items():
+            ts, success, meta = self.results[job_id]
+            self.results[job_id] = (ts, success, dict(meta or {}, fingerprint=fp))
+
+    def drop_jobs(self, job_ids):
+        for job_id in job_ids:
+            self.results.pop(job_id, None)
+
+
+class SliceModule(MemoryModule):
+    name = 'slice'
+    results = {}
+
+    def ready_jobs(self):
+        return OrderedDict([(slice_id, {'dep_time': datetime(2000, 1, 1), 'input_data': slice_data}) for slice_id, (slice_data, expts) in raw_data.items()])
+
+
+class ExperimentModule(MemoryModule):
+    name = 'experiment'
+    results = {}
+    dependencies = [SliceModule]
+
+    def ready_jobs(self):
+        # like the real experiment module, only experiments in slices that have already been imported are found
+        ready = OrderedDict()
+        for slice_id in self.pipeline.get_module('slice').finished_jobs():
+            for expt_id, expt_data in raw_data[slice_id][1].items():
+                ready[expt_id] = {'dep_time': datetime(2000, 1, 1), 'input_data': expt_data, 'upstream': [('slice', slice_id)]}
+        return ready
+
+    def dependent_job_ids(self, module, job_ids):
+        # only finished experiments are known to belong to a slice
+        return [expt_id for slice_id in job_ids for expt_id in raw_data.get(slice_id, (None, {}))[1] if expt_id in self.results]
+
+
+class MemoryPipeline(Pipeline):
+    module_classes = [SliceModule, ExperimentModule]
+
+
+@pytest.fixture
+def pipeline():
+    raw_data.clear()
+    del job_log[:]
+    SliceModule.results.clear()
+    ExperimentModule.results.clear()
+    return MemoryPipeline()
+
+
+def n_updated(results):
+    return {mod.name: res['n_updated'] for mod, res in results.items()}
+
+
+def test_new_slice_in_one_update(pipeline):
+    # a new slice and its experiments are all imported by a single update
+    raw_data['s1'] = (1, OrderedDict([('e1', 1), ('e2', 1)]))
+    assert n_updated(pipeline.update()) == {'slice': 1, 'experiment': 2}
+    assert set(ExperimentModule.results) == {'e1', 'e2'}
+
+    # a new experiment in a slice that is rerun waits for the slice job
+    raw_data['s1'] = (2, OrderedDict([('e1', 1), ('e2', 1), ('e3', 1)]))
+    plans, graph = pipeline._plan_update()
+    assert graph.upstream[('experiment', 'e3')] == {('slice', 's1')}
+    assert graph.upstream[('experiment', 'e1')] == {('slice', 's1')}
+    del job_log[:]
+    assert n_updated(pipeline.update()) == {'slice': 1, 'experiment': 3}
+    assert job_log[0] == ('slice', 's1')
+    assert set(ExperimentModule.results) == {'e1', 'e2', 'e3'}
+
+
+def test_limit_includes_dependent_jobs(pipeline):
+    raw_data['s1'] = (1, OrderedDict([('e1', 1), ('e2', 1)]))
+    raw_data['s2'] = (1, OrderedDict([('e3', 1), ('e4', 1)]))
+    pipeline.update()
+
+    # rerunning both slices would also rerun all four experiments
+    raw_data['s1'] = (2, raw_data['s1'][1])
+    raw_data['s2'] = (2, raw_data['s2'][1])
+    del job_log[:]
+    assert n_updated(pipeline.update(limit=1)) == {'slice': 1, 'experiment': 1}
+    assert len(job_log) == 2
+
+
+def test_rerun_upstream_and_downstream(pipeline):
+    raw_data['s1'] = (1, OrderedDict([('e1', 1), ('e2', 1)]))
+    pipeline.update()
+
+    # downstream fingerprints include the new hash of the rerun slice, so a second update does nothing
+    raw_data['s1'] = (2, OrderedDict([('e1', 2), ('e2', 1)]))
+    assert n_updated(pipeline.update()) == {'slice': 1, 'experiment': 2}
+    del job_log[:]
+    assert n_updated(pipeline.update()) == {'slice': 0, 'experiment': 0}
+    assert job_log == []
+
+
+def test_backfill_fingerprints(pipeline):
+    # results stored without fingerprints are compared by modification time
+    raw_data['s1'] = (1, OrderedDict([('e1', 1)]))
+    pipeline.update()
+    for module in pipeline.modules:
+        module.store_fingerprints({job_id: None for job_id in module.results})
+
+    # planning does not store fingerprints
+    plans, graph = pipeline._plan_update()
+    assert len(graph) == 0
+    assert plans[pipeline.get_module('slice')]['backfill'] != {}
+    assert set(SliceModule.results['s1'][2].values()) == {None}
+
+    # they are stored by the update
+    assert n_updated(pipeline.update()) == {'slice': 0, 'experiment': 0}
+    assert SliceModule.results['s1'][2]['fingerprint'] is not None
+    assert ExperimentModule.results['e1'][2]['fingerprint'] is not None
+    assert n_updated(pipeline.update()) == {'slice': 0, 'experiment': 0}
@@ -0,0 +1,73 @@
+import warnings
+import numpy as np
+from neuroanalysis.data import TSeries
+from neuroanalysis.fitting import StackedPsp
+from aisynphys.pulse_response_strength import measure_response, measure_responses
+from aisynphys.fitting import fit_psp_batch
+
+
+class Obj(object):
+    def __init__(self, **kwds):
+        self.__dict__.update(kwds)
+
+
+class FakePulseResponse(object):
+    def __init__(self, pair, recording, post, baseline):
+        self.pair = pair
+        self.recording = recording
+        self.stim_pulse = Obj(first_spike_time=0.0)
+        self._ts = {'post': post, 'baseline': baseline}
+
+    def get_tseries(self, ts_type, align_to):
+        return self._ts[ts_type]
+
+
+def make_responses(n=12, seed=0):
+    rng = np.random.RandomState(seed)
+    dt = 1 / 20000.
+    latency, rise_time, decay_tau = 2e-3, 1.5e-3, 10e-3
+    syn = Obj(psp_rise_time=rise_time, psp_decay_tau=decay_tau, latency=latency, synapse_type='ex')
+    pair = Obj(synapse=syn, has_synapse=True)
+    recording = Obj(patch_clamp_recording=Obj(clamp_mode='ic', baseline_potential=-70e-3))
+    prs = []
+    for i in range(n):
+        t = -5e-3 + rng.uniform(0, dt) + np.arange(400) * dt
+        amp = rng.uniform(0.2e-3, 1e-3)
+        post = StackedPsp.stacked_psp_func(t, latency + rng.normal(0, 30e-6), -65e-3, rise_time, decay_tau, amp, 2, 0, decay_tau)
+        post = post + rng.normal(0, 50e-6, len(t))
+        baseline = StackedPsp.stacked_psp_func(t, latency, -65e-3, rise_time, decay_tau, 0.3e-3, 2, 0, decay_tau)
+        baseline = baseline + rng.normal(0, 50e-6, len(t))
+        prs.append(FakePulseResponse(pair, recording, TSeries(post, time_values=t), TSeries(baseline, time_values=t)))
+    return prs
+
+
+def test_measure_responses():
+    prs = make_responses()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ref_fits = [measure_response(pr) for pr in prs]
+    batch_fits = measure_responses(prs)
+    assert len(batch_fits) == len(prs)
+
+    for ref, batch in zip(ref_fits, batch_fits):
+        for ref_fit, batch_fit in zip(ref, batch):
+            rv, bv = ref_fit.best_values, batch_fit.best_values
+            # the batched fit searches latency more thoroughly, so it may only be a better fit
+            assert batch_fit.nrmse() <= ref_fit.nrmse() + 0.01
+            assert abs(rv['amp'] - bv['amp']) < 0.05 * abs(rv['amp']) + 20e-6
+            assert abs(rv['yoffset'] - bv['yoffset']) < 20e-6
+            assert abs(rv['xoffset'] - bv['xoffset']) <= 200e-6
+            assert abs(rv['rise_time'] - bv['rise_time']) < 0.5 * rv['rise_time']
+            assert abs(rv['decay_tau'] - bv['decay_tau']) < 0.5 * rv['decay_tau']
+
+
+def test_flat_trace():
+    # flat traces have zero variance; their fits must still have a defined nrmse
+    t = np.arange(400) / 20000.
+    data = np.stack([np.full(len(t), -65e-3), StackedPsp.stacked_psp_func(t, 2e-3, -65e-3, 1.5e-3, 10e-3, 1e-3, 2, 0, 10e-3)])
+    fits = fit_psp_batch(t=np.stack([t, t]), data=data, search_window=[[1.9e-3, 2.1e-3]] * 2, clamp_mode='ic',
+                         sign=[1, 1], rise_time=[1.5e-3] * 2, decay_tau=[10e-3] * 2)
+    assert fits[0].nrmse() == 0
+    assert fits[0].best_values['amp'] == 0
+    assert abs(fits[0].best_values['yoffset'] + 65e-3) < 1e-9
+    assert np.isfinite(fits[1].nrmse())
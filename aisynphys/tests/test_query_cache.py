@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas
+from aisynphys.database import SynphysDatabase
+
+
+def test_query_cache(tmpdir, monkeypatch):
+    db = SynphysDatabase('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'))
+    db.create_tables()
+    session = db.session(readonly=False)
+    for i in range(3):
+        session.add(db.Experiment(ext_id=str(i), acq_timestamp=float(i), meta={'i': i}))
+    session.commit()
+
+    cache_dir = str(tmpdir.join('cache'))
+    db.enable_query_cache(max_entries=2, cache_dir=cache_dir)
+    read_sql = pandas.read_sql
+    n_reads = []
+    def counting_read_sql(*args, **kwds):
+        n_reads.append(1)
+        return read_sql(*args, **kwds)
+    monkeypatch.setattr(pandas, 'read_sql', counting_read_sql)
+
+    query = lambda s, ts: s.query(db.Experiment).filter(db.Experiment.acq_timestamp >= ts).order_by(db.Experiment.id)
+    df = query(db.session(), 1).dataframe()
+    assert list(df['ext_id']) == ['1', '2']
+    df['ext_id'] = 'modified'
+    # repeated queries (from any read-only session) are served from the cache
+    df = query(db.session(), 1).dataframe()
+    assert list(df['ext_id']) == ['1', '2']
+    assert list(df['meta']) == [{'i': 1}, {'i': 2}]
+    assert len(n_reads) == 1
+    # parameters are part of the key
+    assert len(query(db.session(), 2).dataframe()) == 1
+    assert len(n_reads) == 2
+    # read-write sessions are never cached
+    query(session, 1).dataframe()
+    assert len(n_reads) == 3
+
+    # results are shared between processes through the disk cache
+    db2 = SynphysDatabase('sqlite:///', None, db.db_name)
+    db2.enable_query_cache(cache_dir=cache_dir)
+    assert list(query(db2.session(), 1).dataframe()['ext_id']) == ['1', '2']
+    assert len(n_reads) == 3
+    # JSON columns are not written to parquet (which would change their type) or pickled
+    files = [os.path.join(d, f) for d, _, names in os.walk(cache_dir) for f in names]
+    assert not any(f.endswith('.parquet') for f in files)
+    for f in [f for f in files if f.endswith('.npz')]:
+        with np.load(f) as data:
+            assert 'pickle' not in list(data['formats'])
+
+    # changes to the database invalidate the cache
+    session.add(db.Experiment(ext_id='3', acq_timestamp=3.0))
+    session.commit()
+    for d in (db, db2):
+        assert list(query(d.session(), 1).dataframe()['ext_id']) == ['1', '2', '3']
+    assert len(n_reads) == 4
+
+    db.disable_query_cache()
+    query(db.session(), 1).dataframe()
+    assert len(n_reads) == 5
+
+
+def test_query_key_arrays():
+    import sqlalchemy
+    from aisynphys.database.query_cache import QueryCache
+    engine = sqlalchemy.create_engine('sqlite://')
+    key = lambda x: QueryCache.query_key(sqlalchemy.text("select :x").bindparams(x=x), engine)
+
+    # arrays whose reprs are truncated to the same string have different keys
+    a = np.zeros(10000)
+    b = a.copy()
+    b[5000] = 1
+    assert repr(a) == repr(b)
+    assert key(a) != key(b)
+    assert key(a) == key(a.copy())
+    assert key(a) != key(a.astype('float32'))
+    assert key(a) != key(a.reshape(100, 100))
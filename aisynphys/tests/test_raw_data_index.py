@@ -0,0 +1,80 @@
+import os, time
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+from aisynphys.pipeline.multipatch.raw_data_index import RawDataIndex
+
+
+def make_dir(path, timestamp):
+    os.makedirs(path)
+    with open(os.path.join(path, '.index'), 'w') as fh:
+        fh.write('.:\n    __timestamp__: %f\n' % timestamp)
+    return path
+
+
+def write_file(path, data='data'):
+    with open(path, 'w') as fh:
+        fh.write(data)
+
+
+def test_raw_data_index(tmpdir):
+    root = str(tmpdir.join('data'))
+    index_file = str(tmpdir.join('index.json'))
+    day = make_dir(os.path.join(root, '2019.01.01_000'), 1000.0)
+    sl = make_dir(os.path.join(day, 'slice_000'), 1001.0)
+    s1 = make_dir(os.path.join(sl, 'site_000'), 1002.0)
+    s2 = make_dir(os.path.join(sl, 'site_001'), 1003.0)
+    os.makedirs(os.path.join(day, 'not_a_slice', 'site_000'))
+    write_file(os.path.join(s1, 'pipettes.yml'))
+    write_file(os.path.join(s1, 'data.nwb'))
+    write_file(os.path.join(s1, 'image.tif'))
+
+    index = RawDataIndex(root, index_file=index_file)
+    index.refresh()
+    assert index.slice_dirs() == [sl]
+    assert index.site_dirs() == [s1, s2]
+    assert index.timestamp(sl) == '1001.000'
+    assert index.timestamp(s1) == '1002.000'
+    assert sorted(index.files(s1)) == ['.index', 'data.nwb', 'pipettes.yml']
+    assert index.experiment_files(s1) == [
+        s1, os.path.join(s1, 'pipettes.yml'), os.path.join(s1, 'data.nwb'),
+        os.path.join(s1, '.index'), os.path.join(sl, '.index'),
+        os.path.join(day, '.index'), os.path.join(day, 'ignore.txt'),
+    ]
+    assert index.mtime(os.path.join(s1, 'data.nwb')) == os.stat(os.path.join(s1, 'data.nwb')).st_mtime
+    assert index.mtime(os.path.join(day, 'ignore.txt')) is None
+    assert index.stat(os.path.join(s1, 'data.nwb'))[1] == os.stat(os.path.join(s1, 'data.nwb')).st_size
+    assert index.stat(s1) == (index.mtime(s1), None)
+    index.save()
+
+    # index and derived values are persistent
+    index = RawDataIndex(root, index_file=index_file)
+    index.dirs[s1]['derived']['timestamp'] = 'cached'
+    index.refresh(full=False)
+    assert index.timestamp(s1) == 'cached'
+
+    # new site is found through the slice directory mtime
+    s3 = make_dir(os.path.join(sl, 'site_002'), 1004.0)
+    os.utime(sl, (time.time() + 10, time.time() + 10))
+    index.refresh(full=False)
+    assert index.site_dirs() == [s1, s2, s3]
+
+    # rewriting a .index file in place discards derived values
+    with open(os.path.join(s1, '.index'), 'w') as fh:
+        fh.write('.:\n    __timestamp__: 2002.0\n    note: changed\n')
+    index.refresh(full=False)
+    assert index.timestamp(s1) == '2002.000'
+
+    # multiple NWB files must be resolved by the experiment
+    write_file(os.path.join(s1, 'other.nwb'))
+    os.utime(s1, (time.time() + 20, time.time() + 20))
+    index.refresh(full=False)
+    assert index.experiment_files(s1) is None
+
+    # removed sites
+    for name in os.listdir(s2):
+        os.remove(os.path.join(s2, name))
+    os.rmdir(s2)
+    os.utime(sl, (time.time() + 30, time.time() + 30))
+    index.refresh(full=False)
+    assert index.site_dirs() == [s1, s3]
+    assert s2 not in index.dirs
@@ -0,0 +1,62 @@
+import os, time
+from aisynphys.ui.site_index import SiteIndex
+
+
+def make_site(root, day, slice_name, site_name):
+    path = os.path.join(root, day, slice_name, site_name)
+    os.makedirs(path)
+    with open(os.path.join(path, '.index'), 'w') as fh:
+        fh.write('.: {}\n')
+    return path
+
+
+def touch_dir(path, t):
+    os.utime(path, (t, t))
+
+
+def test_site_index(tmpdir):
+    root = str(tmpdir.join('data'))
+    index_file = str(tmpdir.join('index.json'))
+    s1 = make_site(root, '2019.01.01_000', 'slice_000', 'site_000')
+    s2 = make_site(root, '2019.01.01_000', 'slice_000', 'site_001')
+    s3 = make_site(root, '2019.01.02_000', 'slice_001', 'site_000')
+    os.makedirs(os.path.join(root, '2019.01.02_000', 'not_a_slice', 'site_000'))
+
+    index = SiteIndex(root, index_file=index_file)
+    changed, removed = index.rescan()
+    assert sorted(changed) == sorted([s1, s2, s3])
+    assert removed == []
+    index.update_site(s1, timestamp=100.0, status='ok')
+    index.update_site(s3, timestamp=200.0, status='ok')
+    index.save()
+
+    # index is persistent and a rescan with no changes reports nothing
+    index = SiteIndex(root, index_file=index_file)
+    assert index.site_paths()[:2] == [s3, s1]
+    assert index.rescan() == ([], [])
+
+    # new site in an existing slice is found through the slice directory mtime
+    s4 = make_site(root, '2019.01.01_000', 'slice_000', 'site_002')
+    slice_dir = os.path.dirname(s4)
+    touch_dir(slice_dir, time.time() + 10)
+    changed, removed = index.rescan()
+    assert changed == [s4]
+
+    # modified site is detected by its .index file
+    with open(os.path.join(s2, '.index'), 'a') as fh:
+        fh.write('data.nwb: {}\n')
+    changed, removed = index.rescan()
+    assert changed == [s2]
+
+    # targeted rescan from filesystem events
+    s5 = make_site(root, '2019.01.03_000', 'slice_000', 'site_000')
+    changed, removed = index.rescan([os.path.join(root, '2019.01.03_000')])
+    assert changed == [s5]
+
+    # removed sites
+    os.remove(os.path.join(s1, '.index'))
+    os.rmdir(s1)
+    changed, removed = index.rescan([s1])
+    assert removed == [s1]
+    assert s1 not in index.sites
+    assert index.sites[s3]['timestamp'] == 200.0
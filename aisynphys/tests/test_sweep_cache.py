@@ -0,0 +1,75 @@
+import pytest
+import numpy as np
+import h5py
+from neuroanalysis.util import h5py_wrapper
+from aisynphys.data.sweep_cache import SweepCache
+
+
+def make_nwb(filename):
+    with h5py.File(filename, 'w') as hdf:
+        hdf.attrs['session'] = 'test'
+        grp = hdf.create_group('acquisition/timeseries/data_00000_AD0')
+        grp.attrs['source'] = 'Device=ITC18USB_Dev_0;Sweep=0;AD=0;ElectrodeNumber=0;ElectrodeName=0'
+        data = grp.create_dataset('data', data=np.arange(1000, dtype='float32'))
+        data.attrs['IGORWaveScaling'] = np.array([[0, 0], [0.05, 0]])
+        data.attrs['conversion'] = np.float32(1e-3)
+        grp.create_dataset('electrode_name', data=np.array(['electrode_3'], dtype=h5py.string_dtype()))
+        grp.create_dataset('empty', data=np.zeros((0, 3)))
+        nb = hdf.create_group('general/labnotebook/ITC18USB_Dev_0')
+        nb.create_dataset('numericalValues', data=np.random.normal(size=(5, 3, 9)))
+
+
+def test_sweep_cache(tmpdir):
+    nwb_file = str(tmpdir.join('data.nwb'))
+    make_nwb(nwb_file)
+    cache = SweepCache(str(tmpdir.join('cache', 'expt')), nwb_file)
+    assert not cache.is_valid()
+    cached = cache.open()
+    assert cache.is_valid()
+
+    orig = h5py_wrapper.File(nwb_file, 'r')
+    assert cached.attrs['session'] == orig.attrs['session']
+    assert list(cached['acquisition/timeseries'].keys()) == list(orig['acquisition/timeseries'].keys())
+
+    grp = cached['acquisition']['timeseries']['data_00000_AD0']
+    ogrp = orig['acquisition/timeseries/data_00000_AD0']
+    assert grp.attrs['source'] == ogrp.attrs['source']
+    assert np.all(np.array(grp['data']) == np.array(ogrp['data']))
+    assert grp['data'].dtype == ogrp['data'].dtype
+    assert np.all(grp['data'].attrs['IGORWaveScaling'] == ogrp['data'].attrs['IGORWaveScaling'])
+    assert grp['data'].attrs['conversion'] == ogrp['data'].attrs['conversion']
+    assert grp['electrode_name'][()][0] == ogrp['electrode_name'][()][0] == 'electrode_3'
+    assert grp['empty'].shape == (0, 3)
+
+    nb = cached['general/labnotebook/ITC18USB_Dev_0/numericalValues']
+    assert np.all(nb[1:3] == orig['general/labnotebook/ITC18USB_Dev_0/numericalValues'][1:3])
+    orig.close()
+
+    # cache is reused until the source file changes
+    assert SweepCache(cache.path, nwb_file).is_valid()
+    with h5py.File(nwb_file, 'a') as hdf:
+        hdf.attrs['session'] = 'modified test'
+    cache = SweepCache(cache.path, nwb_file)
+    assert not cache.is_valid()
+    assert cache.open().attrs['session'] == 'modified test'
+
+
+def test_experiment_sweep_cache(tmpdir, monkeypatch):
+    # data loaded by the dataset pipeline module (Experiment.data) is read through the sweep cache
+    pytest.importorskip('pyqtgraph')
+    from aisynphys import config
+    from aisynphys.data import Experiment
+
+    nwb_file = str(tmpdir.join('data.nwb'))
+    make_nwb(nwb_file)
+    monkeypatch.setattr(config, 'sweep_cache_path', str(tmpdir.join('cache')))
+    monkeypatch.setattr(Experiment, 'nwb_file', nwb_file)
+    monkeypatch.setattr(Experiment, 'uid', '1234.000')
+    expt = Experiment.__new__(Experiment)
+    expt._data = None
+
+    data = expt.data
+    assert data.sweep_cache == str(tmpdir.join('cache', '1234.000'))
+    data.open()
+    assert SweepCache(data.sweep_cache, nwb_file).is_valid()
+    assert data.hdf.attrs['session'] == 'test'
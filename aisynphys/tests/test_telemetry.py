@@ -0,0 +1,42 @@
+import os
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+from sqlalchemy.ext.declarative import declarative_base
+from aisynphys.database.database import Database, make_table
+from aisynphys.pipeline.telemetry import JobTelemetry, telemetry_report
+
+
+ORMBase = declarative_base()
+Item = make_table(ORMBase, name='item', columns=[('name', 'str')])
+
+
+def test_job_telemetry(tmpdir):
+    db = Database('sqlite:///', 'sqlite:///', os.path.join(str(tmpdir), 'test.sqlite'), ORMBase)
+    db.create_tables()
+    session = db.session(readonly=False)
+
+    with JobTelemetry() as tel:
+        for i in range(5):
+            session.add(Item(name=str(i)))
+        session.flush()
+        session.query(Item).count()
+    session.commit()
+    # statements outside the context are not recorded
+    session.query(Item).count()
+
+    result = tel.result()
+    assert result['rows'] == {'item': 5}
+    assert result['n_statements'] >= 2
+    assert 0 < result['db_time'] <= result['wall_time']
+    assert result['peak_rss'] > 0
+
+    jobs = {
+        'dataset': {'1': result, '2': dict(result, wall_time=100.0), '3': dict(result, peak_rss=result['peak_rss'] * 10)},
+        'synapse': {'2': dict(result, wall_time=1.0)},
+    }
+    report = telemetry_report(jobs)
+    lines = report.split('\n')
+    slowest_expt = lines[lines.index('=====  Slowest experiments  =====') + 3]
+    assert slowest_expt.split()[:2] == ['2', '2']
+    outliers = report.split('Memory outliers')[1].split('\n')
+    assert outliers[3].split()[:2] == ['dataset', '3']
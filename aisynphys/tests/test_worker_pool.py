@@ -0,0 +1,34 @@
+import os
+import pytest
+pytest.importorskip('acq4')  # required to import aisynphys.pipeline
+from aisynphys.pipeline.worker_pool import WorkerPool, current_rss
+
+
+_allocated = []
+
+def allocate(n_mb):
+    if n_mb < 0:
+        os._exit(3)
+    _allocated.append(bytearray(int(n_mb * 1e6)))
+    return os.getpid()
+
+
+def test_worker_pool():
+    pool = WorkerPool(workers=2, rss_limit=current_rss() / 1e6 + 150, initializer=None)
+    try:
+        # workers are reused until their memory use exceeds the limit
+        results = list(pool.imap_unordered(allocate, [1] * 10))
+        assert len(set(r[1] for r in results)) <= 2
+        assert pool.n_recycled == 0
+        results = list(pool.imap_unordered(allocate, [60] * 10))
+        assert all(r[2] is None for r in results)
+
+        # a crashed worker is replaced and its task reported as an error
+        results = list(pool.imap_unordered(allocate, [1, -1, 1]))
+        errors = [r[2] for r in results if r[2] is not None]
+        assert len(errors) == 1 and 'exited with code 3' in errors[0]
+        assert len(pool.workers) == 2
+    finally:
+        pool.close()
+    # workers may retire after sending their last result; these are counted when the pool closes
+    assert pool.n_recycled > 0
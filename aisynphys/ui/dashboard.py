@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os, sys, datetime, re, glob, traceback, time, atexit, threading
+import os, sys, datetime, re, traceback, time, atexit, threading
 try:
     import queue
 except ImportError:
@@ -12,6 +12,7 @@ from ..data import Experiment
 from ..database import default_db as database
 from ..genotypes import Genotype
 from .actions import ExperimentActions
+from .site_index import SiteIndex, SiteWatcher
 from ..yaml_local import yaml
 
 from acq4.util.DataManager import getDirHandle
@@ -476,6 +477,11 @@ class GrowingArray(object):
 
 class PollThread(QtCore.QThread):
     """Used to check in the background for changes to experiment status.
+
+    Known experiment sites are kept in a persistent SiteIndex, so the dashboard can queue
+    them immediately on startup. After that, the index is updated incrementally: from
+    filesystem events if the watchdog package is available, and otherwise (and at every
+    *interval* regardless) by a rescan that only lists directories whose mtime changed.
     """
     update = QtCore.Signal(object, object)  # search_path, status_message
     known_expts = {}
@@ -490,51 +496,96 @@ class PollThread(QtCore.QThread):
         self._stop = False
         self.waker = threading.Event()
         self.enable_polling = True   # set False to temporarily disable polling
+        self.index = SiteIndex(search_path)
+        self.watcher = None
+        self._last_full_scan = 0
         
     def stop(self):
         self._stop = True
+        if self.watcher is not None:
+            self.watcher.stop()
         self.waker.set()
 
     def run(self):
+        if SiteWatcher.available():
+            try:
+                self.watcher = SiteWatcher(self.search_path, callback=self.waker.set)
+            except Exception:
+                print("Could not watch %s for changes; falling back to periodic rescan." % self.search_path)
+                sys.excepthook(*sys.exc_info())
+
+        # start with experiments we already know about
+        if len(self.index.sites) > 0:
+            self.poll(rescan=False)
+
         while True:
             try:
-                # check for new experiments hourly
+                # check for new experiments hourly, or sooner if the filesystem reports changes
                 self.poll()
                 self.waker.wait(self.interval)
+                self.waker.clear()
                 if self._stop:
                     return
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 
-    def poll(self):
-        # Find all available site paths across all data sources
+    def poll(self, rescan=True):
         count = 0
         path = self.search_path
-
         self.update.emit(path, "Updating...")
-        root_dh = getDirHandle(path)
 
-        # iterate over all expt sites in this path
-        for day_name in sorted(os.listdir(root_dh.name()), reverse=True):
-            for expt_path in glob.iglob(os.path.join(root_dh.name(), day_name, 'slice_*', 'site_*')):
+        # Find new / changed site paths in this data source
+        changed = set()
+        if rescan:
+            now = time.time()
+            if self.watcher is not None and now - self._last_full_scan < self.interval:
+                changed, removed = self.index.rescan(self.watcher.pop_dirty())
+            else:
+                if self.watcher is not None:
+                    self.watcher.pop_dirty()
+                changed, removed = self.index.rescan()
+                self._last_full_scan = now
+            changed = set(changed)
+
+        try:
+            # iterate over all expt sites in this path
+            for expt_path in self.index.site_paths():
                 if self._stop or not self.enable_polling:
                     return
 
-                try:
-                    expt = ExperimentMetadata(path=expt_path)
-                    ts = expt.timestamp
-                except:
-                    print ('Error loading %s, ignoring and moving on...' % expt_path)
-                    sys.excepthook(*sys.exc_info())
-                    continue
+                entry = self.index.sites.get(expt_path, {})
+                ts = entry.get('timestamp')
+                if expt_path not in changed:
+                    if entry.get('status') == 'error':
+                        # failed to load previously and nothing has changed since
+                        continue
+                    with self.known_expts_lock:
+                        if ts in self.known_expts and time.time() - self.known_expts[ts][1] < self.interval:
+                            # We've already seen this expt recently; skip
+                            continue
+
+                if expt_path not in changed and entry.get('status') == 'ok' and ts is not None:
+                    # timestamp is known from the index; metadata is only loaded when this site is checked
+                    expt = SiteRef(expt_path, ts)
+                else:
+                    try:
+                        expt = ExperimentMetadata(path=expt_path)
+                        ts = expt.timestamp
+                    except:
+                        print ('Error loading %s, ignoring and moving on...' % expt_path)
+                        sys.excepthook(*sys.exc_info())
+                        self.index.update_site(expt_path, status='error')
+                        continue
                 # Couldn't get timestamp; show an error message
                 if ts is None:
                     print("Error getting timestamp for %s" % expt)
+                    self.index.update_site(expt_path, status='error')
                     continue
+                self.index.update_site(expt_path, timestamp=ts, status='ok')
 
                 with self.known_expts_lock:
                     now = time.time()
-                    if ts in self.known_expts:
+                    if ts in self.known_expts and expt_path not in changed:
                         expt, last_update = self.known_expts[ts]
                         if now - last_update < self.interval:
                             # We've already seen this expt recently; skip
@@ -547,6 +598,8 @@ class PollThread(QtCore.QThread):
                 count += 1
                 if self.limit > 0 and count >= self.limit:
                     return
+        finally:
+            self.index.save()
         self.update.emit(path, "Finished")
 
 
@@ -567,10 +620,34 @@ class ExptCheckerThread(QtCore.QThread):
             ts, expt = self.expt_queue.get(block=block)
             if self._stop or expt == 'stop':
                 return
+            if isinstance(expt, SiteRef):
+                try:
+                    expt = expt.load()
+                except Exception:
+                    print('Error loading %s, ignoring and moving on...' % expt.path)
+                    sys.excepthook(*sys.exc_info())
+                    continue
             rec = expt.check()
             self.update.emit(rec)
 
 
+class SiteRef(object):
+    """A queued experiment site whose ExperimentMetadata is not built until the site is checked.
+
+    This lets the poller queue every site in its index on startup without reading metadata for
+    sites that are never displayed (for example, if polling is stopped first).
+    """
+    def __init__(self, path, timestamp):
+        self.path = path
+        self.timestamp = timestamp
+        self._expt = None
+
+    def load(self):
+        if self._expt is None:
+            self._expt = ExperimentMetadata(path=self.path)
+        return self._expt
+
+
 class ExperimentMetadata(Experiment):
     """Handles reading experiment metadata from several possible locations.
     """
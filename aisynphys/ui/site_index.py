@@ -0,0 +1,249 @@
+"""
+Persistent index of experiment site directories, used by the dashboard to avoid
+re-walking every data source on each poll.
+
+Site directories are expected at ``root/<day>/slice_*/site_*``. The index records the
+mtime of every day and slice directory; on rescan, only directories whose mtime changed
+(meaning entries were added or removed) are listed again. Each known site is tracked by
+the mtime of its directory and the mtime / size of its ``.index`` file, along with a
+timestamp and status derived by the caller.
+
+If the optional ``watchdog`` package is installed, a SiteWatcher can be used to
+receive filesystem events (inotify on Linux) so that rescans only need to look at the
+directories that actually changed.
+"""
+from __future__ import print_function, division
+
+import os, json, hashlib, threading, logging
+from .. import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class SiteIndex(object):
+    """Persistent, incrementally updated list of experiment site paths below *root*.
+
+    Parameters
+    ----------
+    root : str
+        Search path containing day directories
+    index_file : str | None
+        JSON file in which the index is stored. By default, a file in
+        ``config.cache_path/dashboard_index`` derived from *root* is used.
+    """
+    version = 1
+
+    def __init__(self, root, index_file=None):
+        self.root = os.path.abspath(root)
+        if index_file is None:
+            key = hashlib.sha1(self.root.encode('utf8')).hexdigest()[:16]
+            index_file = os.path.join(config.cache_path, 'dashboard_index', key + '.json')
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        self.dirs = {}
+        self.sites = {}
+        self.load()
+
+    def load(self):
+        """Read the index from disk, if it exists.
+        """
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r') as fh:
+                data = json.load(fh)
+        except Exception:
+            logger.warning("Could not read site index %s; starting a new one", self.index_file)
+            return
+        if data.get('version') != self.version or data.get('root') != self.root:
+            return
+        with self.lock:
+            self.dirs = data['dirs']
+            self.sites = data['sites']
+
+    def save(self):
+        """Write the index to disk.
+        """
+        with self.lock:
+            data = {'version': self.version, 'root': self.root, 'dirs': self.dirs, 'sites': self.sites}
+            path = os.path.dirname(self.index_file)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            tmp = self.index_file + '.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump(data, fh)
+            os.rename(tmp, self.index_file)
+
+    def site_paths(self):
+        """Return a list of all known site paths, most recent first (by derived timestamp,
+        falling back to path order).
+        """
+        with self.lock:
+            return sorted(self.sites.keys(), key=lambda p: (self.sites[p].get('timestamp') or 0, p), reverse=True)
+
+    def update_site(self, site_path, **info):
+        """Store derived information (such as 'timestamp' or 'status') for a site.
+        """
+        with self.lock:
+            self.sites.setdefault(site_path, _stat_site(site_path)).update(info)
+
+    def rescan(self, paths=None):
+        """Update the index from the filesystem.
+
+        Parameters
+        ----------
+        paths : list | None
+            If given, only these paths (any directory or file below *root*) are checked. Otherwise,
+            all directories whose mtime has changed are listed and all known sites are checked.
+
+        Returns
+        -------
+        changed : list
+            Paths of sites that are new or whose contents have changed since the last scan
+        removed : list
+            Paths of sites that no longer exist
+        """
+        changed = []
+        removed = []
+        with self.lock:
+            if paths is None:
+                self._scan_dir(self.root, 0)
+                check_sites = list(self.sites.keys())
+            else:
+                check_sites = set()
+                for path in paths:
+                    path = os.path.abspath(path)
+                    rel = os.path.relpath(path, self.root).split(os.sep)
+                    if rel[0] == '..':
+                        continue
+                    if rel == ['.']:
+                        rel = []
+                    # rescan the deepest directory level that may have gained or lost entries
+                    level = min(len(rel), 3)
+                    dir_path = os.path.join(self.root, *rel[:level]) if level > 0 else self.root
+                    if level < 3:
+                        self._scan_dir(dir_path, level, force=True)
+                    else:
+                        check_sites.add(dir_path)
+                    check_sites.update(p for p in self.sites if p == dir_path or p.startswith(dir_path + os.sep))
+
+            for site_path in check_sites:
+                if not os.path.isdir(site_path):
+                    if self.sites.pop(site_path, None) is not None:
+                        removed.append(site_path)
+                    continue
+                stat = _stat_site(site_path)
+                entry = self.sites.get(site_path)
+                if entry is None or any(entry.get(k) != v for k, v in stat.items()):
+                    if entry is None:
+                        entry = self.sites[site_path] = {}
+                    entry.update(stat)
+                    changed.append(site_path)
+
+        return changed, removed
+
+    def _scan_dir(self, path, level, force=False):
+        """Recursively list directories at *level* (0=root, 1=day, 2=slice) whose mtime has changed,
+        adding any new sites found.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._forget_dir(path)
+            return
+
+        if force or self.dirs.get(path) != mtime:
+            self.dirs[path] = mtime
+            pattern = [None, 'slice_', 'site_'][level]
+            for name in sorted(os.listdir(path)):
+                child = os.path.join(path, name)
+                if pattern is not None and not name.startswith(pattern):
+                    continue
+                if not os.path.isdir(child):
+                    continue
+                if level == 2:
+                    if child not in self.sites:
+                        self.sites[child] = {}
+                else:
+                    self._scan_dir(child, level + 1)
+        elif level < 2:
+            # directory listing unchanged; check known subdirectories
+            prefix = path + os.sep
+            children = [p for p in self.dirs if p.startswith(prefix) and os.sep not in p[len(prefix):]]
+            for child in children:
+                self._scan_dir(child, level + 1)
+
+    def _forget_dir(self, path):
+        prefix = path + os.sep
+        for p in list(self.dirs.keys()):
+            if p == path or p.startswith(prefix):
+                del self.dirs[p]
+
+
+def _stat_site(site_path):
+    """Return the filesystem properties used to decide whether a site has changed.
+    """
+    stat = {'mtime': None, 'index_mtime': None, 'index_size': None}
+    try:
+        stat['mtime'] = os.stat(site_path).st_mtime
+        index_stat = os.stat(os.path.join(site_path, '.index'))
+        stat['index_mtime'] = index_stat.st_mtime
+        stat['index_size'] = index_stat.st_size
+    except OSError:
+        pass
+    return stat
+
+
+class SiteWatcher(object):
+    """Watches a SiteIndex root for filesystem events and collects the paths that changed.
+
+    Requires the optional ``watchdog`` package; use SiteWatcher.available() to check.
+    *callback* is called (from the watcher thread) after each event.
+    """
+    def __init__(self, root, callback=None):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        self.root = root
+        self.callback = callback
+        self.lock = threading.Lock()
+        self._dirty = set()
+
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher._event(event.src_path)
+                dest = getattr(event, 'dest_path', None)
+                if dest:
+                    watcher._event(dest)
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), root, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+
+    @staticmethod
+    def available():
+        try:
+            import watchdog
+            return True
+        except ImportError:
+            return False
+
+    def _event(self, path):
+        with self.lock:
+            self._dirty.add(path)
+        if self.callback is not None:
+            self.callback()
+
+    def pop_dirty(self):
+        """Return and clear the set of paths that changed since the last call.
+        """
+        with self.lock:
+            dirty = self._dirty
+            self._dirty = set()
+        return dirty
+
+    def stop(self):
+        self.observer.stop()
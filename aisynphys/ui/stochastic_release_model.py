@@ -52,9 +52,7 @@ class ModelDisplayWidget(QtGui.QWidget):
         self.model_runner = model_runner
         self.param_space = model_runner.param_space
         
-        result_img = np.zeros(self.param_space.result.shape)
-        for ind in np.ndindex(result_img.shape):
-            result_img[ind] = self.param_space.result[ind]['likelihood']
+        result_img = np.array(self.param_space.result['likelihood'])
         self.slicer.set_data(result_img)
         self.results = result_img
         
@@ -93,11 +91,14 @@ class ModelDisplayWidget(QtGui.QWidget):
         return self.param_space.result[index]
 
     def select_result(self, index, update_slicer=True):
+        params = self.param_space[index]
         result = self.get_result(index)
-        result['params'].update(self.param_space[index])
+        if 'mini_amplitude' in result.dtype.names and np.isfinite(result['mini_amplitude']):
+            # use the stored mini_amplitude rather than optimizing it again
+            params['mini_amplitude'] = float(result['mini_amplitude'])
         
         # re-run the model to get the complete results
-        full_result = self.model_runner.run_model(result['params'], full_result=True, show=True)
+        full_result = self.model_runner.run_model(params, full_result=True, show=True)
         self.result_widget.set_result(full_result)
         
         print("----- Selected result: -----")
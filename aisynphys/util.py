@@ -26,6 +26,30 @@ def timestamp_to_datetime(ts):
     return datetime.datetime.fromtimestamp(ts)
 
 
+def apply_filter_rows(data, b, a, padding=100, bidir=True):
+    """Apply a linear filter with coefficients a, b along axis 1 of a 2D array.
+
+    Each row is filtered exactly as neuroanalysis.filter.apply_filter would filter it on its own
+    (reflected padding at both ends, optionally run forward and backward), but all rows are filtered
+    together in a single lfilter call per direction.
+    """
+    import scipy.signal
+    if padding > 0:
+        pad1 = data[:, :padding][:, ::-1]
+        pad2 = data[:, -padding:][:, ::-1]
+        data = np.hstack([pad1, data, pad2])
+
+    if bidir:
+        filtered = scipy.signal.lfilter(b, a, scipy.signal.lfilter(b, a, data, axis=1)[:, ::-1], axis=1)[:, ::-1]
+    else:
+        filtered = scipy.signal.lfilter(b, a, data, axis=1)
+
+    if padding > 0:
+        filtered = filtered[:, pad1.shape[1]:filtered.shape[1]-pad2.shape[1]]
+
+    return filtered
+
+
 def dir_timestamp(path):
     """Get the timestamp from an index file.
 
@@ -286,6 +310,20 @@ def mkdir(path, test=False):
         os.mkdir(path)
 
 
+def replace_file(src, dst):
+    """Rename *src* to *dst*, replacing *dst* if it exists.
+
+    Uses os.replace where available (python 3). On python 2, os.rename already replaces *dst*
+    atomically on posix; on windows, *dst* is removed first.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    if sys.platform == 'win32' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def optional_import(module):
     """Try importing a module, but if that fails, wait until the first time it is
     accessed before raising the ImportError.
@@ -32,9 +32,13 @@ if __name__ == '__main__':
         cache_path = os.path.join(config.cache_path, 'stochastic_model_results')
         if not os.path.exists(cache_path):
             os.makedirs(cache_path)
-        cache_file = os.path.join(cache_path, "%s_%s_%s.pkl" % (experiment_id, pre_cell_id, post_cell_id))
+        cache_file = os.path.join(cache_path, "%s_%s_%s" % (experiment_id, pre_cell_id, post_cell_id))
+        legacy_cache_file = cache_file + '.pkl'
         if not args.no_cache and os.path.exists(cache_file):
             result.load_result(cache_file)
+        elif not args.no_cache and os.path.exists(legacy_cache_file):
+            # results cached by earlier versions as a single pickle file
+            result.load_result(legacy_cache_file)
         else:
             print("cache miss:", cache_file)
             result.store_result(cache_file)
@@ -16,7 +16,9 @@ if __name__ == '__main__':
     parser.add_argument('modules', type=str, nargs='*', help="The name of the analysis module(s) to run")
     parser.add_argument('--update', action='store_true', default=False, help="Process any jobs that are ready to be updated")
     parser.add_argument('--retry', action='store_true', default=False, help="During update, retry processing jobs that previously failed (implies --update)")
-    parser.add_argument('--report', action='store_true', default=False, help="Print a report of pipeline status and errors", )
+    parser.add_argument('--report', action='store_true', default=False, help="Print a report of pipeline status and errors, and of the time and memory used by each module", )
+    parser.add_argument('--enqueue', action='store_true', default=False, help="Add jobs that are ready to be updated to the database job queue instead of running them (use instead of --update)")
+    parser.add_argument('--queue-worker', action='store_true', default=False, dest='queue_worker', help="Run jobs from the database job queue until it is empty (use --workers to set the number of processes on this host)")
     parser.add_argument('--rebuild', action='store_true', default=False, help="Remove and rebuild tables for selected modules")
     parser.add_argument('--workers', type=int, default=None, help="Set the number of concurrent processes during update")
     parser.add_argument('--local', action='store_true', default=False, help="Disable concurrent processing to make debugging easier")
@@ -24,6 +26,7 @@ if __name__ == '__main__':
     parser.add_argument('--limit', type=int, default=None, help="Limit the number of experiments to process")
     parser.add_argument('--uids', type=lambda s: s.split(','), default=None, help="Select specific IDs to analyze (or drop)", )
     parser.add_argument('--drop', action='store_true', default=False, help="Drop selected analysis results (do not run updates)", )
+    parser.add_argument('--dry-run', action='store_true', default=False, dest='dry_run', help="With --drop and --uids, only report the number of rows that would be dropped from each table", )
     parser.add_argument('--vacuum', action='store_true', default=False, help="Run VACUUM ANALYZE on the database to optimize its query planner", )
     parser.add_argument('--bake', action='store_true', default=False, help="Bake an sqlite file after the pipeline update completes", )
     parser.add_argument('--info', action='store_true', default=False, help="Display information about the selected pipeline", )
@@ -63,6 +66,7 @@ if __name__ == '__main__':
 
     if args.report:
         print(pipeline.report(modules, job_ids=args.uids))
+        print(pipeline.telemetry_report(modules))
     
     if args.rebuild:
         mod_names = ', '.join([module.name for module in modules])
@@ -85,20 +89,31 @@ if __name__ == '__main__':
         print("  done.")
 
     if args.drop:
-        for module in modules:
-            if args.uids is None:
+        if args.uids is None:
+            for module in modules:
                 print("Dropping and reinitializing module %s" % module.name)
                 module.drop_all(reinitialize=True)
-            else:
-                print("Dropping %d jobs in module %s" % (len(args.uids), module.name))
-                module.drop_jobs(job_ids=args.uids)
+        else:
+            # drops are done in bulk, including results from all downstream modules
+            counts = pipeline.drop(modules, job_ids=args.uids, dry_run=args.dry_run)
+            print("\n================== Drop Report ===========================")
+            for table, n_rows in counts.items():
+                print("{:30s}  {:8d} rows{}".format(table, n_rows, " (dry run)" if args.dry_run else ""))
  
-    if args.update or args.rebuild or args.retry:
-        report = []
-        for module in modules:
-            print("=============================================")
-            result = module.update(job_ids=args.uids, retry_errors=args.retry, limit=args.limit, parallel=not args.local, workers=args.workers, debug=args.debug)
-            report.append((module, result))
+    if args.enqueue:
+        print("=============================================")
+        # workers on any host can process these jobs with --queue-worker
+        n_queued = pipeline.enqueue(modules, job_ids=args.uids, retry_errors=args.retry, limit=args.limit, debug=args.debug)
+        print("Added %d jobs to the queue." % n_queued)
+        for mod_name, counts in pipeline.job_queue().status().items():
+            print("  {:20s}  {}".format(mod_name, '  '.join(['%s: %d' % item for item in counts.items()])))
+
+    elif args.update or args.rebuild or args.retry:
+        print("=============================================")
+        # jobs from all selected modules are scheduled together; each job starts as soon as its upstream jobs finish
+        results = pipeline.update(modules, job_ids=args.uids, retry_errors=args.retry, limit=args.limit, parallel=not args.local, workers=args.workers, debug=args.debug)
+        pipeline.close()
+        report = list(results.items())
             
         if args.vacuum:
             print("Starting vacuum..")
@@ -114,7 +129,14 @@ if __name__ == '__main__':
             
         print("\n================== Update Report ===========================")
         for module, result in report:
-            print("{name:20s}  dropped: {n_dropped:6d}  updated: {n_updated:6d} ({n_retry:6d} retry)  errors: {n_errors:6d}".format(name=module.name, **result))
+            print("{name:20s}  dropped: {n_dropped:6d}  updated: {n_updated:6d} ({n_retry:6d} retry)  errors: {n_errors:6d}  skipped: {n_skipped:6d}".format(name=module.name, **result))
+
+    if args.queue_worker:
+        print("\n================== Queue Worker ===========================")
+        pipeline.run_queue_workers(workers=args.workers, local=args.local)
+        print("\n================== Queue Report ===========================")
+        for mod_name, counts in pipeline.job_queue().status().items():
+            print("  {:20s}  {}".format(mod_name, '  '.join(['%s: %d' % item for item in counts.items()])))
 
     if args.bake:
         print("\n================== Bake Sqlite ===========================")
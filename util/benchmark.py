@@ -0,0 +1,383 @@
+"""
+Benchmark the main analysis hot paths against synthetic data.
+
+Generates MIES-like NWB files and a matching sqlite synphys DB (see aisynphys.synthetic_data),
+then times each benchmark and writes the results to a JSON file so that runs can be
+compared across commits and machines.
+
+Usage:
+
+    python util/benchmark.py [--experiments N] [--cells N] [--sweeps N] [--output results.json]
+                             [--path DIR] [--only name1,name2] [--repeat N] [--workers N]
+
+Benchmarks:
+
+    dataset_import          DatasetPipelineModule.import_nwb (the body of create_db_entries,
+                            minus loading the acq4 site metadata)
+    measure_response        pulse_response_strength.measure_response, one response at a time
+    measure_responses       pulse_response_strength.measure_responses, batched per experiment
+    get_pair_avg_fits       avg_response_fit.get_pair_avg_fits for each synapse
+    generate_pair_dynamics  dynamics.generate_pair_dynamics for each synapse
+    matrix_pair_query       SynphysDatabase.matrix_pair_query for a 9x9 cell class matrix
+    stochastic_model_grid   StochasticReleaseModel evaluated over a ParameterSpace grid
+
+A benchmark whose requirements are not available (for example, the pipeline modules need acq4)
+is recorded in the output with status "skipped" and the reason.
+"""
+from __future__ import print_function, division
+import os, sys, time, json, argparse, tempfile, platform, subprocess, traceback, datetime
+from collections import OrderedDict
+import numpy as np
+
+
+benchmarks = OrderedDict()
+
+def benchmark(fn):
+    """Decorator that registers a benchmark function.
+
+    Each benchmark is called as ``fn(ctx)`` and must return a tuple ``(elapsed_time, n_items)``.
+    """
+    benchmarks[fn.__name__] = fn
+    return fn
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Context(object):
+    """Shared state for all benchmarks: DB handles, generated experiments, and CLI options.
+    """
+    def __init__(self, args, db, notes_db, experiments):
+        self.args = args
+        self.db = db
+        self.notes_db = notes_db
+        self.experiments = experiments
+        self.session = db.session(readonly=False)
+        self.notes_session = notes_db.session(readonly=False)
+        self.have_recordings = False
+        self.have_fits = False
+
+    def synapse_pairs(self):
+        db = self.db
+        q = self.session.query(db.Pair).join(db.Synapse, db.Synapse.pair_id==db.Pair.id).filter(db.Pair.has_synapse==True)
+        return q.all()
+
+    def synapse_pulse_responses(self, expt_entry=None):
+        db = self.db
+        q = self.session.query(db.PulseResponse).join(db.Pair).filter(db.Pair.has_synapse==True)
+        if expt_entry is not None:
+            q = q.filter(db.Pair.experiment_id==expt_entry.id)
+        return q.all()
+
+    def ensure_recordings(self):
+        """Make sure that sync rec / pulse response records exist, generating them directly from the
+        synthetic model if the dataset_import benchmark did not run.
+        """
+        if self.have_recordings:
+            return
+        for expt in self.experiments:
+            expt_entry = self.db.experiment_from_ext_id(expt.ext_id, session=self.session)
+            if len(expt_entry.sync_recs) > 0:
+                continue
+            expt.add_recordings_to_db(self.db, self.session, expt_entry)
+        self.session.commit()
+        self.have_recordings = True
+
+    def ensure_fits(self):
+        """Make sure that pulse response fit records exist for all synapses (as generated by the
+        pulse_response pipeline module).
+        """
+        if self.have_fits:
+            return
+        self.ensure_recordings()
+        from aisynphys.pulse_response_strength import measure_responses, measure_deconvolved_response
+        db = self.db
+        if self.session.query(db.PulseResponseFit).count() == 0:
+            for expt in self.experiments:
+                expt_entry = self.db.experiment_from_ext_id(expt.ext_id, session=self.session)
+                prs = self.synapse_pulse_responses(expt_entry)
+                for pr, (fit, base_fit) in zip(prs, measure_responses(prs)):
+                    rec = db.PulseResponseFit(pulse_response_id=pr.id)
+                    for fit, prefix in [(fit, 'fit_'), (base_fit, 'baseline_fit_')]:
+                        if fit is None:
+                            continue
+                        for k in ['amp', 'yoffset', 'rise_time', 'decay_tau', 'exp_amp']:
+                            if k in fit.best_values:
+                                setattr(rec, prefix+k, fit.best_values[k])
+                        setattr(rec, prefix+'latency', fit.best_values['xoffset'])
+                        setattr(rec, prefix+'nrmse', fit.nrmse())
+                    dec_fit, base_dec_fit = measure_deconvolved_response(pr)
+                    for fit, prefix in [(dec_fit, 'dec_fit_'), (base_dec_fit, 'baseline_dec_fit_')]:
+                        if fit is None:
+                            continue
+                        for k in ['amp', 'yoffset', 'rise_time', 'decay_tau', 'nrmse']:
+                            if k in fit:
+                                setattr(rec, prefix+k, fit[k])
+                        setattr(rec, prefix+'latency', fit['xoffset'])
+                        setattr(rec, prefix+'reconv_amp', fit['reconvolved_amp'])
+                    self.session.add(rec)
+            self.session.commit()
+        self.have_fits = True
+
+
+def timed(fn, *args, **kwds):
+    start = time.perf_counter()
+    result = fn(*args, **kwds)
+    return time.perf_counter() - start, result
+
+
+@benchmark
+def dataset_import(ctx):
+    try:
+        from aisynphys.pipeline.multipatch.dataset import DatasetPipelineModule
+    except ImportError as exc:
+        raise SkipBenchmark("could not import pipeline: %s" % exc)
+    from aisynphys.data import MultiPatchDataset
+
+    db = ctx.db
+    total = 0
+    n_sweeps = 0
+    for expt in ctx.experiments:
+        expt_entry = db.experiment_from_ext_id(expt.ext_id, session=ctx.session)
+        if len(expt_entry.sync_recs) > 0:
+            raise SkipBenchmark("experiment %s was already imported" % expt.ext_id)
+        nwb = MultiPatchDataset(os.path.join(ctx.args.path, expt_entry.storage_path, expt_entry.ephys_file))
+        dt, _ = timed(DatasetPipelineModule.import_nwb, db, expt_entry, nwb, ctx.session)
+        # committing is part of the cost of an import
+        dt2, _ = timed(ctx.session.commit)
+        total += dt + dt2
+        n_sweeps += len(nwb.contents)
+        nwb.close()
+    ctx.have_recordings = True
+    return total, n_sweeps
+
+
+@benchmark
+def measure_response(ctx):
+    from aisynphys.pulse_response_strength import measure_response
+    ctx.ensure_recordings()
+    prs = ctx.synapse_pulse_responses()[:ctx.args.max_responses]
+    if len(prs) == 0:
+        raise SkipBenchmark("no synaptic pulse responses")
+    dt, _ = timed(lambda: [measure_response(pr) for pr in prs])
+    return dt, len(prs)
+
+
+@benchmark
+def measure_responses(ctx):
+    from aisynphys.pulse_response_strength import measure_responses
+    ctx.ensure_recordings()
+    prs = ctx.synapse_pulse_responses()[:ctx.args.max_responses]
+    if len(prs) == 0:
+        raise SkipBenchmark("no synaptic pulse responses")
+    dt, _ = timed(measure_responses, prs)
+    return dt, len(prs)
+
+
+@benchmark
+def get_pair_avg_fits(ctx):
+    from aisynphys.avg_response_fit import get_pair_avg_fits
+    ctx.ensure_recordings()
+    pairs = ctx.synapse_pairs()
+    if len(pairs) == 0:
+        raise SkipBenchmark("no synapses")
+    dt, _ = timed(lambda: [get_pair_avg_fits(pair, ctx.session, ctx.notes_session) for pair in pairs])
+    return dt, len(pairs)
+
+
+@benchmark
+def generate_pair_dynamics(ctx):
+    from aisynphys.dynamics import generate_pair_dynamics
+    ctx.ensure_fits()
+    pairs = ctx.synapse_pairs()
+    if len(pairs) == 0:
+        raise SkipBenchmark("no synapses")
+    dt, _ = timed(lambda: [generate_pair_dynamics(pair, ctx.db, ctx.session) for pair in pairs])
+    ctx.session.rollback()
+    return dt, len(pairs)
+
+
+@benchmark
+def matrix_pair_query(ctx):
+    from aisynphys.cell_class import CellClass
+    db = ctx.db
+    cell_classes = OrderedDict()
+    for layer in ['2/3', '4', '5']:
+        for cre_type in [('tlx3', 'sim1', 'nr5a1', 'unknown'), 'pvalb', ('sst', 'vip')]:
+            name = "%s %s" % (layer, cre_type if isinstance(cre_type, str) else '/'.join(cre_type))
+            cell_classes[name] = CellClass(target_layer=layer, cre_type=cre_type, name=name)
+    times = []
+    for i in range(ctx.args.repeat):
+        dt, result = timed(db.matrix_pair_query, cell_classes, cell_classes, columns=[db.Synapse.psp_amplitude], pair_query_args={'session': ctx.session})
+        times.append(dt)
+    return min(times), len(result)
+
+
+@benchmark
+def stochastic_model_grid(ctx):
+    import pyqtgraph as pg
+    from aisynphys.stochastic_release_model import StochasticReleaseModel, ParameterSpace
+    pg.mkQApp()
+
+    # generate a spike train (12-pulse trains at several frequencies) and response amplitudes
+    # from a known set of parameters
+    rng = np.random.RandomState(0)
+    spike_times = []
+    t = 0
+    for i in range(ctx.args.model_trains):
+        interval = 1.0 / [10, 20, 50, 100][i % 4]
+        train = t + np.arange(8) * interval
+        spike_times.extend(train)
+        spike_times.extend(train[-1] + 0.25 + np.arange(4) * interval)
+        t = spike_times[-1] + 15
+    spike_times = np.array(spike_times)
+    true_params = {
+        'n_release_sites': 8,
+        'base_release_probability': 0.4,
+        'mini_amplitude': 100e-6,
+        'mini_amplitude_cv': 0.3,
+        'vesicle_recovery_tau': 0.2,
+        'facilitation_amount': 0.1,
+        'facilitation_recovery_tau': 0.05,
+        'measurement_stdev': 50e-6,
+    }
+    expected = StochasticReleaseModel(true_params).measure_likelihood(spike_times, None)['result']['expected_amplitude']
+    amplitudes = expected + rng.normal(scale=true_params['measurement_stdev'], size=len(expected))
+
+    params = {
+        'n_release_sites': np.array([1, 2, 4, 8, 16, 32]),
+        'base_release_probability': np.array([0.05, 0.1, 0.2, 0.4, 0.8]),
+        'mini_amplitude': true_params['mini_amplitude'],
+        'mini_amplitude_cv': np.array([0.1, 0.3, 0.6]),
+        'vesicle_recovery_tau': np.array([0.01, 0.05, 0.2, 1.0]),
+        'facilitation_amount': np.array([0.0, 0.1, 0.3]),
+        'facilitation_recovery_tau': np.array([0.02, 0.05, 0.2]),
+        'measurement_stdev': true_params['measurement_stdev'],
+    }
+    space = ParameterSpace(params)
+
+    def run_model(params):
+        return StochasticReleaseModel(params).measure_likelihood(spike_times, amplitudes)
+
+    # run once to jit-compile before timing
+    run_model(space[(0,) * len(space.axes())])
+    dt, _ = timed(space.run, run_model, workers=ctx.args.workers)
+    return dt, space.result.size
+
+
+def generate_data(args):
+    """Generate NWB files, synphys DB and data notes DB in args.path.
+    """
+    from aisynphys.database import default_db as db, Database
+    from aisynphys.data.data_notes_db import DataNotesORMBase
+    from aisynphys.synthetic_data import SyntheticExperiment
+
+    db.create_tables()
+    notes_db = Database('sqlite:///', 'sqlite:///', os.path.join(args.path, 'data_notes.sqlite'), DataNotesORMBase)
+    notes_db.create_tables()
+
+    session = db.session(readonly=False)
+    notes_session = notes_db.session(readonly=False)
+    experiments = []
+    for i in range(args.experiments):
+        expt = SyntheticExperiment(1.5e9 + i * 3600, n_cells=args.cells, n_sweeps=args.sweeps, seed=args.seed + i)
+        storage_path = expt.ext_id
+        os.makedirs(os.path.join(args.path, storage_path))
+        expt.write_nwb(os.path.join(args.path, storage_path, 'data.nwb'))
+        expt.add_to_db(db, session, storage_path=storage_path, ephys_file='data.nwb')
+        expt.add_pair_notes(notes_session)
+        experiments.append(expt)
+    session.commit()
+    notes_session.commit()
+    session.close()
+    notes_session.close()
+    return db, notes_db, experiments
+
+
+def git_commit():
+    try:
+        path = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--experiments', type=int, default=2, help="Number of synthetic experiments to generate")
+    parser.add_argument('--cells', type=int, default=4, help="Number of cells per experiment (max 8)")
+    parser.add_argument('--sweeps', type=int, default=8, help="Number of pulse train sweeps per experiment")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for generating synthetic data")
+    parser.add_argument('--path', default=None, help="Directory in which to generate data (must be empty or not exist; default is a new temporary directory)")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file to write results to")
+    parser.add_argument('--only', default=None, help="Comma-separated list of benchmarks to run (default is all)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of times to repeat fast benchmarks (the fastest run is reported)")
+    parser.add_argument('--max-responses', type=int, default=500, dest='max_responses', help="Maximum number of pulse responses to fit")
+    parser.add_argument('--model-trains', type=int, default=40, dest='model_trains', help="Number of pulse trains in the stochastic model event series")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes for the stochastic model grid")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.path is None:
+        args.path = tempfile.mkdtemp(prefix='synphys_benchmark_')
+    elif os.path.exists(args.path) and len(os.listdir(args.path)) > 0:
+        sys.exit("Data path %s is not empty" % args.path)
+    args.path = os.path.abspath(args.path)
+    if not os.path.exists(args.path):
+        os.makedirs(args.path)
+
+    # point the default DB at the synthetic database before anything else opens a connection
+    from aisynphys import config
+    config.synphys_db_host = 'sqlite:///'
+    config.synphys_db_host_rw = 'sqlite:///'
+    config.synphys_db = os.path.join(args.path, 'synphys.sqlite')
+    config.synphys_data = args.path
+
+    names = list(benchmarks.keys()) if args.only is None else args.only.split(',')
+    for name in names:
+        if name not in benchmarks:
+            sys.exit("Unknown benchmark %r; options are: %s" % (name, ', '.join(benchmarks.keys())))
+
+    print("Generating synthetic data in %s.." % args.path)
+    dt, (db, notes_db, experiments) = timed(generate_data, args)
+    print("  %d experiments generated in %0.2f s" % (len(experiments), dt))
+    ctx = Context(args, db, notes_db, experiments)
+
+    results = OrderedDict()
+    for name in names:
+        print("Running %s.." % name)
+        try:
+            elapsed, n_items = benchmarks[name](ctx)
+            results[name] = OrderedDict([
+                ('status', 'ok'),
+                ('time', elapsed),
+                ('n_items', n_items),
+                ('time_per_item', elapsed / n_items if n_items else None),
+            ])
+            print("  %0.3f s  (%d items)" % (elapsed, n_items))
+        except SkipBenchmark as exc:
+            ctx.session.rollback()
+            results[name] = OrderedDict([('status', 'skipped'), ('reason', str(exc))])
+            print("  skipped: %s" % exc)
+        except Exception as exc:
+            ctx.session.rollback()
+            results[name] = OrderedDict([('status', 'error'), ('reason', str(exc)), ('traceback', traceback.format_exc())])
+            print("  error: %s" % exc)
+
+    output = OrderedDict([
+        ('date', datetime.datetime.now().isoformat()),
+        ('git_commit', git_commit()),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('scale', OrderedDict([
+            ('experiments', args.experiments),
+            ('cells', args.cells),
+            ('sweeps', args.sweeps),
+            ('seed', args.seed),
+        ])),
+        ('benchmarks', results),
+    ])
+    with open(args.output, 'w') as fh:
+        json.dump(output, fh, indent=2)
+    print("Results written to %s" % args.output)
@@ -0,0 +1,74 @@
+"""
+Compare the run time of SynphysDatabase.matrix_pair_query against the older
+implementation that runs one pair_query per pre/post cell class combination.
+
+Usage:
+
+    python util/benchmark_matrix_pair_query.py --db-version=synphys_r1.0_2019-08-29_small.sqlite [--repeat N]
+"""
+from __future__ import print_function, division
+import sys, time, argparse
+import pandas
+from collections import OrderedDict
+from aisynphys.database import default_db as db
+from aisynphys.cell_class import CellClass
+
+
+cell_classes = OrderedDict([
+    ('2/3 pyr',  CellClass(target_layer='2/3', pyramidal=True)),
+    ('2/3 pv',   CellClass(target_layer='2/3', cre_type='pvalb')),
+    ('2/3 sst',  CellClass(target_layer='2/3', cre_type='sst')),
+    ('2/3 vip',  CellClass(target_layer='2/3', cre_type='vip')),
+    ('4 nr5a1',  CellClass(target_layer='4', cre_type='nr5a1')),
+    ('4 pv',     CellClass(target_layer='4', cre_type='pvalb')),
+    ('4 sst',    CellClass(target_layer='4', cre_type='sst')),
+    ('4 vip',    CellClass(target_layer='4', cre_type='vip')),
+    ('5 et',     CellClass(target_layer='5', cre_type=('sim1', 'fam84b'))),
+    ('5 it',     CellClass(target_layer='5', cre_type='tlx3')),
+    ('5 pv',     CellClass(target_layer='5', cre_type='pvalb')),
+    ('5 sst',    CellClass(target_layer='5', cre_type='sst')),
+    ('5 vip',    CellClass(target_layer='5', cre_type='vip')),
+    ('6 ct',     CellClass(target_layer='6', cre_type='ntsr1')),
+    ('6 pv',     CellClass(target_layer='6', cre_type='pvalb')),
+    ('6 sst',    CellClass(target_layer='6', cre_type='sst')),
+    ('6 vip',    CellClass(target_layer='6', cre_type='vip')),
+    ('spiny',    CellClass(dendrite_type='spiny')),
+    ('aspiny',   CellClass(dendrite_type='aspiny')),
+    ('inhib',    CellClass(cre_type=('pvalb', 'sst', 'vip'))),
+])
+
+
+def run(method, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = method(cell_classes, cell_classes, columns=[db.Synapse.psp_amplitude])
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=3, help="Number of times to run each query (the fastest run is reported)")
+    args = parser.parse_args(sys.argv[1:])
+
+    print("Database: %s" % db)
+    print("Matrix size: %d x %d" % (len(cell_classes), len(cell_classes)))
+
+    new_result, new_time = run(db.matrix_pair_query, args.repeat)
+    old_result, old_time = run(db._matrix_pair_query_per_class, args.repeat)
+
+    # row order within each class combination is not defined by either query
+    sort_cols = ['pre_class', 'post_class', 'id']
+    new_result = new_result.sort_values(sort_cols).reset_index(drop=True)
+    old_result = old_result.sort_values(sort_cols).reset_index(drop=True)
+    try:
+        pandas.testing.assert_frame_equal(new_result, old_result, check_dtype=False)
+        same = True
+    except AssertionError:
+        same = False
+
+    print("per-class queries:  %8.3f s  (%d rows)" % (old_time, len(old_result)))
+    print("single query:       %8.3f s  (%d rows)" % (new_time, len(new_result)))
+    print("speedup:            %8.1fx" % (old_time / new_time))
+    print("results identical:  %s" % same)
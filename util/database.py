@@ -14,6 +14,7 @@ parser.add_argument('--clone', type=str, default=None, help="Clone current datab
 parser.add_argument('--tables', type=str, default=None, help="Comma-separated list of tables to include while baking.")
 parser.add_argument('--skip-tables', type=str, default="", help="Comma-separated list of tables to skip while baking.", dest="skip_tables")
 parser.add_argument('--skip-columns', type=str, default="", help="Comma-separated list of table.column names to skip while baking.", dest="skip_columns")
+parser.add_argument('--batch-size', type=int, default=1000, help="Number of records to insert per batch while baking or cloning.", dest="batch_size")
 parser.add_argument('--overwrite', action='store_true', default=False, help="Overwrite existing sqlite file.")
 parser.add_argument('--update', action='store_true', default=False, help="Update existing sqlite file.")
 parser.add_argument('--drop', type=str, default=None, help="Drop database with the given name.")
@@ -55,11 +56,11 @@ if args.bake is not None:
     for colname in args.skip_columns.split(','):
         table, col = colname.split('.')
         skip_cols.setdefault(table, []).append(col)
-    db.bake_sqlite(args.bake, tables=tables, skip_tables=args.skip_tables.split(','), skip_columns=skip_cols)
+    db.bake_sqlite(args.bake, tables=tables, skip_tables=args.skip_tables.split(','), skip_columns=skip_cols, batch_size=args.batch_size)
 
 
 if args.clone is not None:
-    db.clone_database(args.clone, tables=tables, skip_tables=args.skip_tables.split(','))
+    db.clone_database(args.clone, tables=tables, skip_tables=args.skip_tables.split(','), batch_size=args.batch_size)
 
 
 if args.drop is not None: